@@ -6,6 +6,7 @@ from flask_talisman import Talisman
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.jobstores.mongodb import MongoDBJobStore
 import json
+import os
 from flask_wtf.csrf import CSRFProtect
 import logging
 import logging.handlers as handlers
@@ -22,6 +23,7 @@ from sres import utils
 from sres.auth import get_auth_user, is_user_administrator
 from sres.anonymiser import anonymise_identifier, anonymise, is_identity_anonymiser_active
 from sres.go import make_go_url
+from sres.aggregation_queue import start_in_process_workers
 
 from sres.blueprints import table
 from sres.blueprints import index
@@ -74,6 +76,23 @@ class LoggerFilter(logging.Filter):
                 return not self.exclude
         return self.exclude
 
+# The app created in this process, for scheduled jobs and threads that run outside of a request
+_APP = {
+    'pid': None,
+    'app': None
+}
+
+def get_app():
+    """
+        Returns the current app if there is one, otherwise the app created in this process,
+        only creating an app (and its scheduler) if this process does not have one yet.
+    """
+    if current_app:
+        return current_app._get_current_object()
+    if _APP['pid'] != os.getpid() or _APP['app'] is None:
+        return create_app()
+    return _APP['app']
+
 def create_app(test_config=None):
     
     app = Flask(__name__, instance_relative_config=True)
@@ -218,7 +237,12 @@ def create_app(test_config=None):
         )
     })
     app.scheduler.start()
-    
+
+    # aggregation queue workers; set IN_PROCESS_WORKERS to 0 if running python -m sres.aggregation_queue instead
+    in_process_aggregation_workers = app.config['SRES'].get('AGGREGATION_QUEUE', {}).get('IN_PROCESS_WORKERS', 1)
+    if in_process_aggregation_workers:
+        start_in_process_workers(app, in_process_aggregation_workers)
+
     # Babel
     app.config['BABEL_DEFAULT_LOCALE'] = app.config['SRES'].get('BABEL_DEFAULT_LOCALE', 'en')
     app.babel = Babel(app)
@@ -344,6 +368,9 @@ def create_app(test_config=None):
         flash(Markup("The following information might help a system administrator troubleshoot the issue: error id {} s{}".format(uuid, current_app.config['SRES'].get('SERVER_NUMBER', 0))), "warning")
         return render_template('denied.html')
     
+    _APP['app'] = app
+    _APP['pid'] = os.getpid()
+    
     return app
 
 def _get_sres_user_details():
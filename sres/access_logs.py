@@ -6,19 +6,19 @@ import logging
 from natsort import natsorted, ns
 
 from sres.db import _get_db
+from sres.log_writer import write_log
 from sres.auth import get_auth_user, get_auth_user_oid
 from sres import utils
 from sres.tables import format_full_name as format_full_table_name
 
 def add_access_event(asset_type=None, asset_uuid=None, action=None, related_asset_type=None, related_asset_uuid=None):
     """
-        Adds a document to db.access_logs
-        Returns the ObjectId of the inserted or updated document.
+        Queues a document to be added to db.access_logs
+        Returns the ObjectId of the document, or None if it was not logged.
         
         asset_type (string)
         asset_uuid (string)
     """
-    db = _get_db()
     username = get_auth_user()
     if username:
         # only log if user is logged in and known
@@ -36,8 +36,7 @@ def add_access_event(asset_type=None, asset_uuid=None, action=None, related_asse
                 'request_method': request.method,
                 'action': action
             }
-            result = db.access_logs.insert_one(record)
-            return result.inserted_id
+            return write_log('access_logs', record)
         except Exception as e:
             logging.error(e)
             return None
@@ -74,26 +73,29 @@ def get_recent_accesses(asset_type=None, actions=None, human_readable=True, meth
             db_filter['request_method'] = {'$in': methods}
         # timestamp
         db_filter['timestamp'] = {'$gte': (datetime.now() - timedelta(days=days))}
-        # read from DB
-        cursor = db.access_logs.find(db_filter).sort([('timestamp', -1)])
-        results = list(cursor)
-        # find most common and most recent
+        # find most common and most recent in the db
+        results = db.access_logs.aggregate([
+            {'$match': db_filter},
+            {'$sort': {'timestamp': -1}},
+            {'$group': {
+                '_id': '$asset_uuid',
+                'asset_type': {'$first': '$asset_type'},
+                'related_asset_uuid': {'$first': '$related_asset_uuid'},
+                'related_asset_type': {'$first': '$related_asset_type'},
+                'logged_records': {'$sum': 1},
+                'most_recent_timestamp': {'$max': '$timestamp'}
+            }}
+        ], allowDiskUse=True)
         recents = {}
         for result in results:
-            _asset_uuid = result.get('asset_uuid')
-            if _asset_uuid not in recents.keys():
-                recents[_asset_uuid] = {
-                    'asset_uuid': _asset_uuid,
-                    'asset_type': result.get('asset_type'),
-                    'related_asset_uuid': result.get('related_asset_uuid'),
-                    'related_asset_type': result.get('related_asset_type'),
-                    'logged_records': 1,
-                    'most_recent_timestamp': result.get('timestamp')
-                }
-            else:
-                recents[_asset_uuid]['logged_records'] += 1
-                if recents[_asset_uuid]['most_recent_timestamp'] < result.get('timestamp'):
-                    recents[_asset_uuid]['most_recent_timestamp'] = result.get('timestamp')
+            recents[result['_id']] = {
+                'asset_uuid': result['_id'],
+                'asset_type': result.get('asset_type'),
+                'related_asset_uuid': result.get('related_asset_uuid'),
+                'related_asset_type': result.get('related_asset_type'),
+                'logged_records': result['logged_records'],
+                'most_recent_timestamp': result.get('most_recent_timestamp')
+            }
         # interpret, if necessary
         if human_readable:
             if asset_type == 'table':
@@ -0,0 +1,214 @@
+import collections
+import logging
+from pymongo import UpdateOne
+
+from sres.db import _get_db
+
+# Cached aggregated_by links, keyed by column uuid. Values are dicts of aggregated_by (list of
+# aggregator column uuids), table_uuid, and version (int, the column's _config_version).
+_AGGREGATION_GRAPH = {}
+
+def invalidate_aggregation_graph(column_uuid=None):
+    """
+        Clears cached aggregated_by links, either for one column or for all columns.
+
+        column_uuid (str|None) If None, clears everything.
+    """
+    if column_uuid is None:
+        _AGGREGATION_GRAPH.clear()
+    else:
+        _AGGREGATION_GRAPH.pop(column_uuid, None)
+
+def _get_graph_nodes(column_uuids):
+    """
+        Returns the (cached) aggregated_by links of the specified columns. Cached links are
+        revalidated against each column's _config_version in one small query, so changes made
+        by other processes are seen straight away, and only those that changed are read again.
+
+        column_uuids (list of str)
+
+        Returns dict keyed by column uuid.
+    """
+    db = _get_db()
+    ret = {}
+    cached_uuids = [ c for c in column_uuids if c in _AGGREGATION_GRAPH.keys() ]
+    if cached_uuids:
+        for result in db.columns.find({'uuid': {'$in': cached_uuids}}, ['uuid', '_config_version']):
+            node = _AGGREGATION_GRAPH.get(result['uuid'])
+            if node is not None and node['version'] == result.get('_config_version', 0):
+                ret[result['uuid']] = node
+    to_fetch = [ c for c in column_uuids if c not in ret.keys() ]
+    if to_fetch:
+        results = db.columns.find(
+            {'uuid': {'$in': to_fetch}},
+            ['uuid', 'table_uuid', 'aggregated_by', '_config_version']
+        )
+        for result in results:
+            node = {
+                'aggregated_by': [ c for c in result.get('aggregated_by', []) if c and c.strip() ],
+                'table_uuid': result.get('table_uuid'),
+                'version': result.get('_config_version', 0)
+            }
+            _AGGREGATION_GRAPH[result['uuid']] = node
+            ret[result['uuid']] = node
+    # forget anything that no longer exists
+    for column_uuid in to_fetch:
+        if column_uuid not in ret.keys():
+            _AGGREGATION_GRAPH.pop(column_uuid, None)
+    return ret
+
+def get_affected_aggregators(aggregator_column_uuids):
+    """
+        Finds every aggregator that needs recalculating when the specified aggregators do,
+        i.e. the specified aggregators and everything downstream of them.
+
+        aggregator_column_uuids (list of str)
+
+        Returns a tuple of
+            ordered (list of str) The affected aggregators in an order where each comes after
+                all of the affected aggregators it depends on.
+            circular (list of str) Affected aggregators that are in, or downstream of, a circular reference.
+            nodes (dict) The aggregated_by links of the affected aggregators, keyed by column uuid.
+    """
+    nodes = {}
+    frontier = list(dict.fromkeys([ c for c in aggregator_column_uuids if c and c.strip() ]))
+    while frontier:
+        fetched = _get_graph_nodes(frontier)
+        nodes.update(fetched)
+        frontier = list(dict.fromkeys([
+            child
+            for column_uuid in frontier if column_uuid in fetched.keys()
+            for child in fetched[column_uuid]['aggregated_by'] if child not in nodes.keys()
+        ]))
+    # topologically sort
+    in_degrees = { column_uuid: 0 for column_uuid in nodes.keys() }
+    for column_uuid, node in nodes.items():
+        for child in node['aggregated_by']:
+            if child in in_degrees.keys():
+                in_degrees[child] += 1
+    ready = collections.deque([ c for c, in_degree in in_degrees.items() if in_degree == 0 ])
+    ordered = []
+    while ready:
+        column_uuid = ready.popleft()
+        ordered.append(column_uuid)
+        for child in nodes[column_uuid]['aggregated_by']:
+            if child in in_degrees.keys():
+                in_degrees[child] -= 1
+                if in_degrees[child] == 0:
+                    ready.append(child)
+    circular = [ c for c, in_degree in in_degrees.items() if in_degree > 0 ]
+    return ordered, circular, nodes
+
+def _expand_identifiers(aggregator_column, identifiers):
+    """Adds the group members of identifiers for aggregators that need them, i.e. self_peer_review."""
+    from sres.studentdata import StudentData
+    if aggregator_column.config['aggregation_options']['method'] != 'self_peer_review':
+        return identifiers
+    expanded_identifiers = list(identifiers)
+    student_data = StudentData(aggregator_column.table)
+    for identifier in identifiers:
+        student_data._reset()
+        if student_data.find_student(identifier):
+            expanded_identifiers.extend(student_data.get_identifiers_for_students_in_same_group(
+                aggregator_column.config['aggregation_options']['aggregator_type_self_peer_review_grouping_column']
+            ))
+    return list(dict.fromkeys(expanded_identifiers))
+
+def _save_circular_reference_values(column_uuid, table_uuid, identifiers, auth_user):
+    """
+        Marks an aggregator that is in a circular reference as '?!?' for the specified students,
+        with change history, version and column stats updated as for any other aggregated value.
+    """
+    from sres.studentdata import VERSION_FIELD
+    from sres.change_history import save_change_history_bulk
+    from sres.column_stats import record_data_changes
+    data = '?!?'
+    db = _get_db()
+    operations = []
+    change_history_records = []
+    data_changes = []
+    for result in db.data.find({'table_uuid': table_uuid, 'sid': {'$in': identifiers}}, ['sid', 'status', column_uuid]):
+        existing_data = result.get(column_uuid)
+        if existing_data == data:
+            continue
+        operations.append(UpdateOne(
+            {'_id': result['_id']},
+            {
+                '$set': {column_uuid: data},
+                '$inc': {VERSION_FIELD: 1}
+            }
+        ))
+        change_history_records.append({
+            'identifier': result['sid'],
+            'column_uuid': column_uuid,
+            'table_uuid': table_uuid,
+            'existing_data': existing_data if existing_data is not None else '',
+            'new_data': data
+        })
+        if result.get('status') == 'active':
+            data_changes.append((table_uuid, column_uuid, existing_data, data))
+    if operations:
+        db.data.bulk_write(operations, ordered=False)
+        save_change_history_bulk(change_history_records, auth_user or '__system__')
+        record_data_changes(data_changes)
+
+def run_aggregations(aggregator_identifiers, auth_user_override='', preloaded_columns=None):
+    """
+        Recalculates aggregators and everything downstream of them. Each affected aggregator
+        is calculated once, after everything it depends on, for all of the students that
+        need it.
+
+        aggregator_identifiers (dict) Keyed by aggregator column uuid, values are lists of the
+            identifiers that need recalculating for that aggregator.
+        auth_user_override (str)
+        preloaded_columns (dict) Loaded Column instances keyed by column uuid.
+
+        Returns a dict keyed by aggregator column uuid, of the results of calculate_aggregation.
+    """
+    from sres.aggregatorcolumns import AggregatorColumn
+    if preloaded_columns is None:
+        preloaded_columns = {}
+    ret = {}
+    ordered, circular, nodes = get_affected_aggregators(list(aggregator_identifiers.keys()))
+    pending_identifiers = { c: list(dict.fromkeys(i)) for c, i in aggregator_identifiers.items() }
+    # circular references cannot be calculated
+    if circular:
+        logging.error('Circular aggregator references detected [{}]'.format(', '.join(circular)))
+        all_identifiers = list(dict.fromkeys([ i for identifiers in aggregator_identifiers.values() for i in identifiers ]))
+        for column_uuid in circular:
+            _save_circular_reference_values(column_uuid, nodes[column_uuid]['table_uuid'], all_identifiers, auth_user_override)
+            ret[column_uuid] = { i: {'success': False, 'errors': ["Circular reference identified"]} for i in all_identifiers }
+    # calculate in order
+    for column_uuid in ordered:
+        identifiers = pending_identifiers.get(column_uuid)
+        if not identifiers:
+            continue
+        if isinstance(preloaded_columns.get(column_uuid), AggregatorColumn):
+            aggregator_column = preloaded_columns[column_uuid]
+        else:
+            aggregator_column = AggregatorColumn()
+            if not aggregator_column.load(column_uuid):
+                continue
+            preloaded_columns[column_uuid] = aggregator_column
+        if aggregator_column.config['workflow_state'] != 'active' or aggregator_column.config['aggregation_options']['recalculate_trigger'] == 'manual':
+            continue
+        try:
+            results = aggregator_column.calculate_aggregation(
+                identifiers=_expand_identifiers(aggregator_column, identifiers),
+                columns_already_traversed=[],
+                auth_user_override=auth_user_override,
+                preloaded_columns=preloaded_columns,
+                run_aggregated_by=False
+            )
+        except Exception as e:
+            logging.error('run_aggregations failed for [{}]'.format(column_uuid))
+            logging.exception(e)
+            continue
+        ret[column_uuid] = results
+        # queue up what depends on this aggregator
+        recalculated_identifiers = [ i for i, result in results.items() if result.get('success') ]
+        if recalculated_identifiers:
+            for child in nodes[column_uuid]['aggregated_by']:
+                pending_identifiers.setdefault(child, []).extend(recalculated_identifiers)
+                pending_identifiers[child] = list(dict.fromkeys(pending_identifiers[child]))
+    return ret
@@ -0,0 +1,349 @@
+"""
+    A MongoDB-backed queue of pending aggregator recalculations, worked by long-lived workers.
+
+    Run standalone workers with python -m sres.aggregation_queue [worker_count]
+"""
+from datetime import datetime, timedelta
+from multiprocessing import Process
+from os import getpid
+import platform
+import sys
+import threading
+import logging
+from uuid import uuid4
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from sres.db import _get_db, _load_db_config
+
+# How long a worker's claim on a batch lasts before another worker may take it over
+AGGREGATION_QUEUE_LEASE_SECONDS = 600
+# The longest a claim is kept alive by the heartbeat of the worker running the batch
+AGGREGATION_QUEUE_MAX_CLAIM_SECONDS = 7200
+# The most jobs (i.e. students) recalculated in one batch for one aggregator
+AGGREGATION_QUEUE_BATCH_SIZE = 500
+# How many times a batch is retried before its jobs are dropped
+AGGREGATION_QUEUE_MAX_ATTEMPTS = 3
+# How long an idle worker waits before checking the queue again, doubling up to the maximum
+AGGREGATION_QUEUE_POLL_SECONDS = 0.5
+AGGREGATION_QUEUE_MAX_POLL_SECONDS = 5
+
+# Reported by the db when a second pending job is inserted for the same aggregator and student
+DUPLICATE_KEY_ERROR_CODE = 11000
+
+# Woken by enqueue_aggregations so that workers in the same process start straight away
+_WAKE_WORKERS = threading.Event()
+
+# The in-process worker threads, so they are only started once per process
+_IN_PROCESS_WORKERS = {
+    'pid': None,
+    'threads': []
+}
+
+def _get_queue_config():
+    return _load_db_config().SRES.get('AGGREGATION_QUEUE', {})
+
+def enqueue_aggregations(aggregator_column_uuids, identifiers, auth_user, source_column_uuid=None):
+    """
+        Queues the recalculation of the specified aggregators for the specified students.
+        A job that is already pending for the same aggregator and student is reused rather
+        than duplicated.
+
+        aggregator_column_uuids (list of str)
+        identifiers (list of str) sids
+        auth_user (str) The username the aggregation is run as.
+        source_column_uuid (str|None) The column whose change needs the recalculation; used
+            by is_aggregation_pending.
+
+        Returns the number of jobs newly queued.
+    """
+    aggregator_column_uuids = list(dict.fromkeys([ c for c in aggregator_column_uuids if c and c.strip() ]))
+    identifiers = list(dict.fromkeys([ i for i in identifiers if i ]))
+    if not aggregator_column_uuids or not identifiers:
+        return 0
+    now = datetime.utcnow()
+    operations = []
+    for aggregator_column_uuid in aggregator_column_uuids:
+        for identifier in identifiers:
+            update = {
+                '$set': {
+                    'auth_user': auth_user
+                },
+                '$setOnInsert': {
+                    'enqueued': now,
+                    'attempts': 0,
+                    'claimed_by': None,
+                    'claimed_until': None
+                }
+            }
+            if source_column_uuid:
+                update['$addToSet'] = {'source_column_uuids': source_column_uuid}
+            operations.append(UpdateOne(
+                {
+                    'aggregator_column_uuid': aggregator_column_uuid,
+                    'identifier': identifier,
+                    'status': 'pending'
+                },
+                update,
+                upsert=True
+            ))
+    db = _get_db()
+    try:
+        upserted_count = db.aggregation_queue.bulk_write(operations, ordered=False).upserted_count
+    except BulkWriteError as e:
+        # another process queued some of the same jobs at the same time; they match now, so apply again
+        write_errors = e.details.get('writeErrors', [])
+        if any(error.get('code') != DUPLICATE_KEY_ERROR_CODE for error in write_errors):
+            raise
+        upserted_count = e.details.get('nUpserted', 0)
+        upserted_count += db.aggregation_queue.bulk_write(
+            [ operations[error['index']] for error in write_errors ],
+            ordered=False
+        ).upserted_count
+    _WAKE_WORKERS.set()
+    return upserted_count
+
+def is_aggregation_pending(identifier, source_column_uuid=None, aggregator_column_uuids=None):
+    """
+        Whether any recalculation is queued or running for the specified student.
+
+        identifier (str) sid
+        source_column_uuid (str|None) Only consider jobs queued because this column changed.
+        aggregator_column_uuids (list of str|None) Only consider jobs for these aggregators.
+
+        Returns boolean.
+    """
+    db_filter = {'identifier': identifier}
+    if source_column_uuid:
+        db_filter['source_column_uuids'] = source_column_uuid
+    if aggregator_column_uuids is not None:
+        db_filter['aggregator_column_uuid'] = {'$in': aggregator_column_uuids}
+    db = _get_db()
+    return db.aggregation_queue.find_one(db_filter, ['_id']) is not None
+
+def get_queue_status():
+    """Returns a dict of the number of pending and running jobs, and the age in seconds of the oldest pending job."""
+    db = _get_db()
+    ret = {
+        'pending': db.aggregation_queue.count_documents({'status': 'pending'}),
+        'running': db.aggregation_queue.count_documents({'status': 'running'}),
+        'oldest_pending_seconds': None
+    }
+    oldest = db.aggregation_queue.find_one({'status': 'pending'}, ['enqueued'], sort=[('enqueued', 1)])
+    if oldest is not None:
+        ret['oldest_pending_seconds'] = (datetime.utcnow() - oldest['enqueued']).total_seconds()
+    return ret
+
+def _claimable_filter(now):
+    """Jobs that are pending, or were claimed by a worker whose lease has run out."""
+    return {
+        '$or': [
+            {'status': 'pending'},
+            {'status': 'running', 'claimed_until': {'$lt': now}}
+        ]
+    }
+
+def _claim_batch(worker_id, batch_size=AGGREGATION_QUEUE_BATCH_SIZE, lease_seconds=AGGREGATION_QUEUE_LEASE_SECONDS):
+    """
+        Claims the oldest claimable job and up to batch_size - 1 more for the same aggregator.
+        Each job is claimed atomically, so no two workers hold the same job.
+
+        Returns a tuple of (claim token, list of job documents); the list is empty if
+        there was nothing to claim.
+    """
+    db = _get_db()
+    now = datetime.utcnow()
+    claim_token = '{}:{}'.format(worker_id, uuid4().hex)
+    claim = {
+        '$set': {
+            'status': 'running',
+            'claimed_by': claim_token,
+            'claimed_until': now + timedelta(seconds=lease_seconds)
+        }
+    }
+    first_job = db.aggregation_queue.find_one_and_update(
+        _claimable_filter(now),
+        claim,
+        sort=[('enqueued', 1)]
+    )
+    if first_job is None:
+        return claim_token, []
+    if batch_size > 1:
+        db_filter = _claimable_filter(now)
+        db_filter['aggregator_column_uuid'] = first_job['aggregator_column_uuid']
+        candidate_ids = [
+            r['_id'] for r in db.aggregation_queue.find(db_filter, ['_id']).sort('enqueued', 1).limit(batch_size - 1)
+        ]
+        if candidate_ids:
+            db_filter['_id'] = {'$in': candidate_ids}
+            db.aggregation_queue.update_many(db_filter, claim)
+    return claim_token, list(db.aggregation_queue.find({'claimed_by': claim_token}))
+
+def _release_failed_batch(claim_token, jobs):
+    """Returns a failed batch to the queue, dropping the jobs that have run out of attempts."""
+    db = _get_db()
+    exhausted_ids = [ j['_id'] for j in jobs if j.get('attempts', 0) + 1 >= AGGREGATION_QUEUE_MAX_ATTEMPTS ]
+    if exhausted_ids:
+        logging.error('aggregation queue dropping jobs after {} attempts [{}] [{}]'.format(
+            AGGREGATION_QUEUE_MAX_ATTEMPTS,
+            jobs[0]['aggregator_column_uuid'],
+            ', '.join([ j['identifier'] for j in jobs if j['_id'] in exhausted_ids ])
+        ))
+        db.aggregation_queue.delete_many({'_id': {'$in': exhausted_ids}, 'claimed_by': claim_token})
+    retry_ids = [ j['_id'] for j in jobs if j['_id'] not in exhausted_ids ]
+    if not retry_ids:
+        return
+    try:
+        db.aggregation_queue.bulk_write(
+            [
+                UpdateOne(
+                    {'_id': _id, 'claimed_by': claim_token},
+                    {
+                        '$set': {'status': 'pending', 'claimed_by': None, 'claimed_until': None},
+                        '$inc': {'attempts': 1}
+                    }
+                ) for _id in retry_ids
+            ],
+            ordered=False
+        )
+    except BulkWriteError as e:
+        # the same job has been queued again in the meantime, so that one is kept instead
+        write_errors = e.details.get('writeErrors', [])
+        if any(error.get('code') != DUPLICATE_KEY_ERROR_CODE for error in write_errors):
+            raise
+        db.aggregation_queue.delete_many({
+            '_id': {'$in': [ retry_ids[error['index']] for error in write_errors ]},
+            'claimed_by': claim_token
+        })
+
+def _heartbeat(claim_token, stop_event, interval):
+    """Renews the lease on a claimed batch until the batch is finished, the claim is lost, or it is too old."""
+    db = _get_db()
+    started = datetime.utcnow()
+    while not stop_event.wait(interval):
+        now = datetime.utcnow()
+        if (now - started).total_seconds() > AGGREGATION_QUEUE_MAX_CLAIM_SECONDS:
+            logging.warning('aggregation queue heartbeat giving up, claim too old [{}]'.format(claim_token))
+            return
+        try:
+            result = db.aggregation_queue.update_many(
+                {'claimed_by': claim_token},
+                {'$set': {'claimed_until': now + timedelta(seconds=AGGREGATION_QUEUE_LEASE_SECONDS)}}
+            )
+        except Exception as e:
+            logging.exception(e)
+            continue
+        if result.matched_count == 0:
+            logging.warning('aggregation queue heartbeat lost claim [{}]'.format(claim_token))
+            return
+
+def process_next_batch(worker_id):
+    """
+        Claims and recalculates one batch of queued jobs, along with everything downstream of
+        the batch's aggregator.
+
+        worker_id (str)
+
+        Returns the number of jobs processed.
+    """
+    from sres.aggregation_graph import run_aggregations
+    claim_token, jobs = _claim_batch(worker_id)
+    if not jobs:
+        return 0
+    aggregator_column_uuid = jobs[0]['aggregator_column_uuid']
+    identifiers_by_auth_user = {}
+    for job in jobs:
+        identifiers_by_auth_user.setdefault(job.get('auth_user') or '', []).append(job['identifier'])
+    db = _get_db()
+    preloaded_columns = {}
+    # keep the lease alive however long a single run_aggregations call takes
+    heartbeat_stop = threading.Event()
+    threading.Thread(
+        target=_heartbeat,
+        args=(claim_token, heartbeat_stop, AGGREGATION_QUEUE_LEASE_SECONDS / 3.0),
+        daemon=True
+    ).start()
+    try:
+        for auth_user, identifiers in identifiers_by_auth_user.items():
+            run_aggregations(
+                {aggregator_column_uuid: identifiers},
+                auth_user_override=auth_user,
+                preloaded_columns=preloaded_columns
+            )
+    except Exception as e:
+        logging.error('aggregation queue batch failed [{}] [{}]'.format(aggregator_column_uuid, claim_token))
+        logging.exception(e)
+        _release_failed_batch(claim_token, jobs)
+        return len(jobs)
+    finally:
+        heartbeat_stop.set()
+    db.aggregation_queue.delete_many({'claimed_by': claim_token})
+    return len(jobs)
+
+def run_worker(app=None, stop_event=None):
+    """
+        Works the queue until stop_event is set, waiting with increasing back-off while it is empty.
+
+        app (Flask|None) The app whose context aggregations are run in; created if None.
+        stop_event (threading.Event|None)
+    """
+    if app is None:
+        from sres import create_app
+        app = create_app()
+    if stop_event is None:
+        stop_event = threading.Event()
+    worker_id = '{}:{}:{}'.format(platform.node(), getpid(), threading.get_ident())
+    config = _get_queue_config()
+    min_wait = config.get('POLL_SECONDS', AGGREGATION_QUEUE_POLL_SECONDS)
+    max_wait = config.get('MAX_POLL_SECONDS', AGGREGATION_QUEUE_MAX_POLL_SECONDS)
+    wait = min_wait
+    logging.info('aggregation queue worker starting [{}]'.format(worker_id))
+    while not stop_event.is_set():
+        try:
+            with app.app_context():
+                processed = process_next_batch(worker_id)
+        except Exception as e:
+            # e.g. the db is unavailable
+            logging.exception(e)
+            processed = 0
+        if processed:
+            wait = min_wait
+            continue
+        if _WAKE_WORKERS.wait(wait):
+            _WAKE_WORKERS.clear()
+            wait = min_wait
+        else:
+            wait = min(wait * 2, max_wait)
+    logging.info('aggregation queue worker stopping [{}]'.format(worker_id))
+
+def start_in_process_workers(app, worker_count):
+    """Starts daemon worker threads in this process, once per process."""
+    if _IN_PROCESS_WORKERS['pid'] == getpid():
+        return
+    _IN_PROCESS_WORKERS['pid'] = getpid()
+    _IN_PROCESS_WORKERS['threads'] = []
+    for n in range(worker_count):
+        thread = threading.Thread(
+            target=run_worker,
+            kwargs={'app': app},
+            name='sres-aggregation-queue-{}'.format(n),
+            daemon=True
+        )
+        thread.start()
+        _IN_PROCESS_WORKERS['threads'].append(thread)
+
+def _run_worker_process():
+    # this process is a dedicated worker, so the app it creates should not start more. Under
+    # python -m this file is __main__, a different module to the sres.aggregation_queue that
+    # create_app checks, so the guard is set there and that module's worker is run.
+    from sres import aggregation_queue
+    aggregation_queue._IN_PROCESS_WORKERS['pid'] = getpid()
+    aggregation_queue.run_worker()
+
+if __name__ == '__main__':
+    worker_count = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    processes = [ Process(target=_run_worker_process, daemon=False) for _ in range(worker_count) ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
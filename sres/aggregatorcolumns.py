@@ -8,15 +8,23 @@ from bs4 import BeautifulSoup
 import collections
 import logging
 import math
+import threading
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 from decimal import Decimal, ROUND_CEILING, ROUND_FLOOR, ROUND_HALF_UP, getcontext
 
 from sres.columns import Column, table_uuids_from_column_references
 from sres.db import _get_db
 from sres import utils
-from sres.studentdata import substitute_text_variables
+from sres.studentdata import substitute_text_variables, VERSION_FIELD
 from sres.conditions import Conditions
 from sres import cexprtk_ext
-from sres.change_history import get_change_history
+from sres.change_history import get_change_history, save_change_history_bulk
+from sres.auth import get_auth_user
+from sres.aggregation_graph import invalidate_aggregation_graph, run_aggregations
+from sres.config_cache import invalidate_cached_config
+from sres.column_stats import record_data_changes
+from sres.aggregation_queue import enqueue_aggregations
 
 SIMPLE_AGGREGATORS = [
     {
@@ -268,11 +276,138 @@ def find_aggregators_of_columns(source_column_uuids):
     aggregator_column_uuids = list(dict.fromkeys(aggregator_column_uuids))
     return aggregator_column_uuids
 
+# Compiled mathematical_operations formulas, keyed by aggregator column uuid
+_COMPILED_FORMULAS = {}
+
+_NUMERIC_TEXT_PATTERN = re.compile(r'^\s*[-+]?([0-9]+(\.[0-9]*)?|\.[0-9]+)([eE][-+]?[0-9]+)?\s*$')
+
+class _CompiledFormula:
+    """
+        A mathematical_operations formula parsed once into a cexprtk.Expression, with one
+        variable per column reference.
+        
+        formula (str) The raw formula this was compiled from; used to detect staleness.
+        expression (cexprtk.Expression|None) None if the formula cannot be compiled, in which
+            case it must be evaluated by text substitution.
+        variables (list of tuples) (variable_name, column_reference)
+    """
+    
+    def __init__(self, formula, expression=None, symbol_table=None, variables=None):
+        self.formula = formula
+        self.expression = expression
+        self.symbol_table = symbol_table
+        self.variables = variables or []
+        self._lock = threading.Lock()
+    
+    def evaluate(self, values):
+        """values (dict) Numbers keyed by variable_name. Returns float."""
+        with self._lock:
+            for variable_name, value in values.items():
+                self.symbol_table.variables[variable_name] = value
+            return self.expression.value()
+
+def invalidate_compiled_formula(column_uuid):
+    _COMPILED_FORMULAS.pop(column_uuid, None)
+
+def _compile_formula(formula, default_table_uuid, preloaded_columns):
+    """
+        Compiles a mathematical_operations formula. Column references become variables,
+        so only references that yield a single 'latest' value from the aggregator's own
+        table (no magic formatters, system columns or extension functions) are supported.
+        
+        Returns a _CompiledFormula.
+    """
+    expr = BeautifulSoup(formula, 'html.parser').get_text()
+    expr = utils.clean_exprtk_expression(expr)
+    if cexprtk_ext.parse_ext_functions(expr)['column_references']:
+        return _CompiledFormula(formula)
+    column_references = list(dict.fromkeys(re.findall(utils.DELIMITED_COLUMN_REFERENCE_PATTERN, expr)))
+    variables = []
+    variable_names = {}
+    for i, delimited_column_reference in enumerate(column_references):
+        column_reference = utils.clean_delimiter_from_column_references(delimited_column_reference)
+        if column_reference in preloaded_columns.keys():
+            column = preloaded_columns[column_reference]
+        else:
+            column = Column()
+            if not column.load(column_reference, default_table_uuid=default_table_uuid):
+                return _CompiledFormula(formula)
+            preloaded_columns[column_reference] = column
+        if not column.column_loaded or column.is_system_column or column.magic_formatter or column.config['table_uuid'] != default_table_uuid:
+            return _CompiledFormula(formula)
+        variable_name = 'sres_var_{}'.format(i)
+        variables.append((variable_name, column_reference))
+        variable_names[delimited_column_reference] = variable_name
+    expr = re.sub(utils.DELIMITED_COLUMN_REFERENCE_PATTERN, lambda m: variable_names[m.group(0)], expr)
+    if '$' in expr:
+        return _CompiledFormula(formula)
+    try:
+        symbol_table = cexprtk.Symbol_Table({ v[0]: 0.0 for v in variables })
+        expression = cexprtk.Expression(expr, symbol_table)
+    except Exception:
+        return _CompiledFormula(formula)
+    return _CompiledFormula(formula, expression, symbol_table, variables)
+
 class AggregatorColumn(Column):
     
     def __init__(self):
         super().__init__()
     
+    def update(self, override_username=None):
+        invalidate_compiled_formula(self.config['uuid'])
+        return super().update(override_username=override_username)
+    
+    def _get_compiled_formula(self, preloaded_columns):
+        """Returns the (cached) _CompiledFormula for this mathematical_operations aggregator."""
+        formula = self.config['aggregation_options']['aggregator_type_mathematical_operations_formula']
+        compiled_formula = _COMPILED_FORMULAS.get(self.config['uuid'])
+        if compiled_formula is None or compiled_formula.formula != formula:
+            compiled_formula = _compile_formula(formula, self.config['table_uuid'], preloaded_columns)
+            _COMPILED_FORMULAS[self.config['uuid']] = compiled_formula
+        else:
+            # make sure the referenced columns are available to this caller
+            for variable_name, column_reference in compiled_formula.variables:
+                if column_reference not in preloaded_columns.keys():
+                    preloaded_columns[column_reference] = Column()
+                    preloaded_columns[column_reference].load(column_reference, default_table_uuid=self.config['table_uuid'])
+        return compiled_formula
+    
+    def _get_compiled_formula_values(self, compiled_formula, student_data, preloaded_columns, blank_replacement):
+        """
+            Collects the numeric value of each variable in compiled_formula for the student,
+            following what substitute_text_variables would have substituted.
+            
+            Returns a dict keyed by variable name, or None if any value is not a plain number
+            (in which case the formula should be evaluated by text substitution instead).
+        """
+        values = {}
+        try:
+            for variable_name, column_reference in compiled_formula.variables:
+                column = preloaded_columns[column_reference]
+                data_temp = student_data.get_data(column_uuid=column.config['uuid'], preloaded_column=column)
+                if data_temp['success']:
+                    value = data_temp['data']
+                    if column.subfield is not None:
+                        value = value[column.subfield] if column.subfield < len(value) else blank_replacement
+                else:
+                    value = blank_replacement
+                if (value == '' or value is None) and blank_replacement != '':
+                    value = blank_replacement
+                if isinstance(value, bool):
+                    return None
+                elif isinstance(value, (int, float)):
+                    value = float(value)
+                elif isinstance(value, str) and _NUMERIC_TEXT_PATTERN.match(value):
+                    value = float(value)
+                else:
+                    return None
+                if not math.isfinite(value):
+                    return None
+                values[variable_name] = value
+        except:
+            return None
+        return values
+    
     def get_case_builder_cases(self):
         """
             Returns a list of cases (dicts). A bit of overhead to deal with legacy storage schema.
@@ -324,11 +459,14 @@ class AggregatorColumn(Column):
         }
         # brute force remove references to this aggregator everywhere
         self.db.columns.update_many(
-            { },
+            {'aggregated_by': self.config['uuid']},
             {
-                '$pull': {'aggregated_by': self.config['uuid']}
+                '$pull': {'aggregated_by': self.config['uuid']},
+                '$inc': {'_config_version': 1}
             }
         )
+        invalidate_cached_config('columns')
+        invalidate_aggregation_graph()
         # find columns that will be aggregated by this aggregator
         aggregated_column_references = self._get_aggregated_column_references()
         # load aggregated_by for each of these columns and add this current 
@@ -499,7 +637,388 @@ class AggregatorColumn(Column):
             )
             
         
-    def calculate_aggregation(self, identifiers=[], columns_already_traversed=[], auth_user_override='', forced=False, threaded_aggregation=False, preloaded_columns=None):
+    def _append_simple_aggregation_data(self, data_array, data_temp, column_helper, blank_replacement, column_to_aggregate, identifier):
+        """
+            Processes one source value for a simple aggregator and appends it to data_array as needed.
+            Returns True if no further values from this source column should be processed.
+        """
+        # get subdata if multientry
+        if column_helper.subfield is not None:
+            try:
+                if not isinstance(data_temp, list):
+                    try:
+                        data_temp = json.loads(data_temp)
+                    except:
+                        pass
+                data_temp = data_temp[column_helper.subfield]
+            except:
+                # log it
+                #logging.debug("Problem getting multientry subfield [{}] data [{}] [{}] [{}]".format(
+                #    column_helper.subfield,
+                #    str(data_temp),
+                #    self.config['uuid'],
+                #    self.table.config['uuid']
+                #))
+                data_temp = blank_replacement
+        # check blanks
+        if (data_temp == '' or data_temp is None) and blank_replacement != '':
+            data_temp = blank_replacement
+        # save data to array
+        if self.config['aggregation_options']['method'] in 'sum,average,median,highest_average,highest_sum,lowest_average,lowest_sum,count'.split(','):
+            if utils.is_number(data_temp):
+                data_array.append(float(data_temp))
+        elif self.config['aggregation_options']['method'] in ['sumaggressive', 'averageaggressive']:
+            numbers = re.findall(
+                '((\-)?[0-9]+(\.[0-9]+)?)', 
+                str(data_temp)
+            )
+            for number in numbers:
+                if utils.is_number(number[0]): # necesssary because re.findall returns a tuple, with elements for each regex group
+                    data_array.append(number[0])
+        elif self.config['aggregation_options']['method'] == 'counta':
+            if data_temp is not None and str(data_temp) != '':
+                data_array.append(data_temp)
+        elif self.config['aggregation_options']['method'] in ['clone', 'mapper']:
+            data_array.append(data_temp)
+            # clone and mapper only take one source column, so ignore the others if >1 specified
+            return True
+        elif self.config['aggregation_options']['method'] == 'countblank':
+            if data_temp == '' or data_temp is None:
+                data_array.append(data_temp)
+        elif self.config['aggregation_options']['method'] == 'countif':
+            if data_temp == self.config['aggregation_options']['aggregator_type_simple_countif_parameter_value']:
+                data_array.append(data_temp)
+        elif self.config['aggregation_options']['method'] == 'countifstartswith':
+            if data_temp.startswith(self.config['aggregation_options']['aggregator_type_simple_countifstartswith_parameter_term']):
+                data_array.append(data_temp)
+        elif self.config['aggregation_options']['method'] == 'countifcontains':
+            if self.config['aggregation_options']['aggregator_type_simple_countifcontains_parameter_term'].lower() in str(data_temp).lower():
+                data_array.append(data_temp)
+        elif self.config['aggregation_options']['method'] == 'countifmatchregex':
+            if re.search(
+                self.config['aggregation_options']['aggregator_type_simple_countifmatchregex_parameter_term'],
+                str(data_temp),
+                flags=re.IGNORECASE
+            ):
+                data_array.append(data_temp)
+        elif self.config['aggregation_options']['method'] == 'countallmatchregex':
+            data_array.extend(
+                re.findall(
+                    self.config['aggregation_options']['aggregator_type_simple_countallmatchregex_parameter_term'],
+                    str(data_temp),
+                    flags=re.IGNORECASE
+                )
+            )
+        elif self.config['aggregation_options']['method'] in ['concatenate', 'mode']:
+            data_array.append(str(data_temp))
+        else:
+            # misconfiguration
+            logging.warning("Aggregation error, could not make data_array. [{}] [{}]".format(
+                column_to_aggregate,
+                identifier
+            ))
+        return False
+    
+    def _calculate_simple_aggregation_final_value(self, data_array):
+        """Calculates the aggregated value for a simple aggregator from a prepared data_array."""
+        final_value = ''
+        if self.config['aggregation_options']['method'] in 'sum,sumaggressive'.split(','):
+            final_value = utils.list_sum(data_array)
+        elif self.config['aggregation_options']['method'] in ['average', 'averageaggressive', 'mode', 'median']:
+            if len(data_array):
+                if self.config['aggregation_options']['method'] in ['average', 'averageaggressive']:
+                    final_value = utils.list_avg(data_array)
+                elif self.config['aggregation_options']['method'] == 'mode':
+                    final_value = utils.list_mode(data_array)
+                elif self.config['aggregation_options']['method'] == 'median':
+                    final_value = utils.list_median(data_array)
+            else:
+                final_value = ''
+        elif self.config['aggregation_options']['method'] == 'clone':
+            final_value = data_array[0] if data_array else ''
+        elif self.config['aggregation_options']['method'] == 'mapper':
+            try:
+                final_value = self.config['aggregation_options']['aggregator_type_mapper_outputs'][self.config['aggregation_options']['aggregator_type_mapper_inputs'].index(data_array[0])]
+            except:
+                final_value = ''
+        elif self.config['aggregation_options']['method'] in 'count,counta,countblank,countif,countifstartswith,countifcontains,countifmatchregex,countallmatchregex'.split(','):
+            final_value = len(data_array)
+        elif self.config['aggregation_options']['method'] in ['highest_average', 'lowest_average']:
+            _dir = self.config['aggregation_options']['method'].replace('_average', '')
+            n = self.config['aggregation_options']['aggregator_type_simple_{}_average_parameter_n'.format(_dir)]
+            if utils.is_number(n) and len(data_array):
+                n = int(n)
+                data_array = utils.list_nums(sorted(
+                    data_array,
+                    reverse=True if _dir == 'highest' else False
+                ))
+                final_value = utils.list_avg(data_array[:n])
+            else:
+                final_value = ''
+        elif self.config['aggregation_options']['method'] in ['highest_sum', 'lowest_sum']:
+            _dir = self.config['aggregation_options']['method'].replace('_sum', '')
+            n = self.config['aggregation_options']['aggregator_type_simple_{}_sum_parameter_n'.format(_dir)]
+            if utils.is_number(n):
+                n = int(n)
+                data_array = utils.list_nums(sorted(
+                    data_array, 
+                    reverse=True if _dir == 'highest' else False
+                ))
+                final_value = utils.list_sum(data_array[:n])
+        elif self.config['aggregation_options']['method'] == 'concatenate':
+            final_value = self.config['aggregation_options']['aggregator_type_simple_concatenate_parameter_separator'].join(data_array)
+        else:
+            # misconfiguration
+            print('aggregation error, could not calculate final_value')
+        return final_value
+    
+    def _post_process_final_value(self, final_value):
+        """Applies post-aggregation arithmetic, rounding, substitutions and inf/nan checks."""
+        # post-aggregation arithmetic, if needed
+        if self.config['aggregation_options']['post_aggregation_arithmetic_operator'] in ['+', '-', '*', '/'] and utils.is_number(self.config['aggregation_options']['post_aggregation_arithmetic_value']) and utils.is_number(final_value):
+            _paao = self.config['aggregation_options']['post_aggregation_arithmetic_operator']
+            _paav = float(self.config['aggregation_options']['post_aggregation_arithmetic_value'])
+            final_value = float(final_value)
+            if _paao == '+':
+                final_value = final_value + _paav
+            elif _paao == '-':
+                final_value = final_value - _paav
+            elif _paao == '*':
+                final_value = final_value * _paav
+            elif _paao == '/' and _paav != 0:
+                final_value = final_value / _paav
+        # rounding if needed
+        if self.config['aggregation_options']['rounding'] != '' and utils.is_number(final_value):
+            try:
+                getcontext().rounding = ROUND_HALF_UP
+                _dp = Decimal(10) ** -int(self.config['aggregation_options']['rounding'])
+                _final_value = final_value
+                if self.config['aggregation_options']['rounding_direction'] == 'nearest':
+                    final_value = Decimal(final_value).quantize(_dp)
+                else:
+                    final_value = Decimal(final_value).quantize(
+                        _dp,
+                        rounding=ROUND_CEILING if self.config['aggregation_options']['rounding_direction'] == 'ceiling' else ROUND_FLOOR
+                    )
+                if final_value.is_nan() or final_value.is_infinite():
+                    final_value = ''
+                else:
+                    final_value = str(final_value)
+            except:
+                final_value = _final_value
+        # substitutions if needed
+        if self.config['aggregation_options']['regex_replace_pattern'] != '':
+            if self.config['aggregation_options']['regex_replace_mode'] == 'text':
+                final_value = final_value.replace(
+                    self.config['aggregation_options']['regex_replace_pattern'],
+                    self.config['aggregation_options']['regex_replace_replacement']
+                )
+            elif self.config['aggregation_options']['regex_replace_mode'] == 'regex':
+                final_value = re.sub(
+                    self.config['aggregation_options']['regex_replace_pattern'],
+                    self.config['aggregation_options']['regex_replace_replacement'],
+                    final_value
+                )
+        # check for inf and nan
+        if utils.is_number(final_value):
+            try:
+                if final_value == math.inf or final_value == math.nan or math.isnan(final_value):
+                    final_value = ''
+            except:
+                # just yield the final_value...
+                pass
+        return final_value
+    
+    def _can_calculate_simple_aggregation_in_batch(self, simple_aggregator_column_helpers):
+        """
+            Whether the current simple aggregator can be calculated for many students at once
+            by _calculate_simple_aggregation_batch. Aggregations over the time (change history)
+            axis or over multiple reports still need the per-student path.
+        """
+        if self.config['aggregation_options']['method'] not in [a['name'] for a in SIMPLE_AGGREGATORS] + ['mapper']:
+            return False
+        if 't' in self.config['aggregation_options']['axes']:
+            return False
+        if self.has_multiple_report_mode_enabled():
+            return False
+        for column_to_aggregate, column_helper in simple_aggregator_column_helpers.items():
+            if not column_helper or not column_helper.column_loaded or not column_helper.config['table_uuid']:
+                return False
+            if 'r' in self.config['aggregation_options']['axes'] and column_helper.has_multiple_report_mode_enabled():
+                return False
+        return True
+    
+    def _calculate_simple_aggregation_batch(self, identifiers, simple_aggregator_column_helpers, blank_replacement, columns_already_traversed=[], auth_user_override='', threaded_aggregation=False, preloaded_columns=None, run_aggregated_by=True):
+        """
+            Calculates a simple aggregator for many students at once. Source data for all
+            students is fetched with one projected query per table (including crosslisted
+            tables), values are processed exactly as in the per-student path, and results
+            are written back with a single bulk_write and a single change history insert.
+            
+            Returns dict of dicts keyed by each identifier, as for calculate_aggregation.
+        """
+        from sres.studentdata import find_students_bulk
+        from sres.tables import Table
+        if preloaded_columns is None:
+            preloaded_columns = {}
+        ret = {}
+        data_logger = logging.getLogger('sres.db.studentdata')
+        # determine auth_user in the same way as set_data
+        if auth_user_override:
+            auth_user = auth_user_override
+        else:
+            try:
+                auth_user = get_auth_user()
+            except:
+                auth_user = '__system__'
+        # fetch source data, grouped by the table each source column lives in
+        source_column_uuids_by_table = {}
+        for column_to_aggregate, column_helper in simple_aggregator_column_helpers.items():
+            source_column_uuids_by_table.setdefault(column_helper.config['table_uuid'], []).append(column_helper.config['uuid'])
+        students = find_students_bulk(
+            self.table,
+            identifiers,
+            projection=source_column_uuids_by_table.get(self.config['table_uuid'], []) + [self.config['uuid']]
+        )
+        crosslisted_students = {}
+        for table_uuid, column_uuids in source_column_uuids_by_table.items():
+            if table_uuid == self.config['table_uuid']:
+                continue
+            crosslisted_table = Table()
+            if crosslisted_table.load(table_uuid):
+                crosslisted_students[table_uuid] = find_students_bulk(crosslisted_table, identifiers, projection=column_uuids)
+            else:
+                crosslisted_students[table_uuid] = {}
+        # calculate
+        update_operations = []
+        update_operation_oids = []
+        change_history_records = []
+        data_changes = []
+        prepared_oids = set()
+        recalculated_sids = []
+        for identifier in identifiers:
+            ret[identifier] = {
+                'success': False,
+                'errors': [],
+                'final_value': ''
+            }
+            student_data = students.get(identifier)
+            if student_data is None:
+                ret[identifier]['errors'].append(("Could not find student {}".format(identifier), "warning"))
+                continue
+            data_array = []
+            for column_to_aggregate in self.config['aggregation_options']['attributes']:
+                if not column_to_aggregate:
+                    continue
+                column_helper = simple_aggregator_column_helpers[column_to_aggregate]
+                if column_helper.config['table_uuid'] == self.config['table_uuid']:
+                    _student_data = student_data
+                else:
+                    _student_data = crosslisted_students[column_helper.config['table_uuid']].get(identifier)
+                    if _student_data is None:
+                        # cannot find student in the other list!
+                        continue
+                data_temp = _student_data.get_data(
+                    column_uuid=column_helper.config['uuid'],
+                    preloaded_column=column_helper
+                )
+                if data_temp['success']:
+                    data_temp = data_temp['data']
+                else:
+                    data_temp = blank_replacement
+                self._append_simple_aggregation_data(
+                    data_array=data_array,
+                    data_temp=data_temp,
+                    column_helper=column_helper,
+                    blank_replacement=blank_replacement,
+                    column_to_aggregate=column_to_aggregate,
+                    identifier=identifier
+                )
+            final_value = self._calculate_simple_aggregation_final_value(data_array)
+            final_value = self._post_process_final_value(final_value)
+            ret[identifier]['aggregated_value'] = final_value
+            ret[identifier]['success'] = True
+            if student_data._id in prepared_oids:
+                # another identifier for the same student, which is already being saved
+                continue
+            prepared_oids.add(student_data._id)
+            # prepare the save
+            data = str(final_value)
+            existing_data = student_data.data.get(self.config['uuid'])
+            update_operations.append(UpdateOne(
+                {
+                    'table_uuid': self.table.config['uuid'],
+                    '_id': student_data._id
+                },
+                {
+                    '$set': {
+                        self.config['uuid']: data
+                    },
+                    '$inc': {VERSION_FIELD: 1}
+                }
+            ))
+            update_operation_oids.append(student_data._id)
+            if existing_data is None or existing_data != data:
+                if student_data.config.get('status') == 'active':
+                    data_changes.append((student_data._id, (self.table.config['uuid'], self.config['uuid'], existing_data, data)))
+                change_history_records.append({
+                    'identifier': student_data.config['sid'],
+                    'column_uuid': self.config['uuid'],
+                    'table_uuid': self.table.config['uuid'],
+                    'existing_data': existing_data if existing_data is not None else '',
+                    'new_data': data
+                })
+            recalculated_sids.append(student_data.config['sid'])
+            data_logger.info("Data set [{}] [{}] [{}] [{}] [{}] [{}]".format(
+                True,
+                self.config['uuid'],
+                self.table.config['uuid'],
+                auth_user,
+                student_data.config['sid'],
+                data
+            ))
+        # save
+        if update_operations:
+            failed_oids = []
+            try:
+                self.db.data.bulk_write(update_operations, ordered=False)
+            except BulkWriteError as e:
+                logging.error("Bulk aggregation write errors [{}] [{}]".format(self.config['uuid'], str(e.details.get('writeErrors'))))
+                failed_oids = [ update_operation_oids[err['index']] for err in e.details.get('writeErrors', []) ]
+                for identifier, student_data in students.items():
+                    if student_data._id in failed_oids and identifier in ret.keys():
+                        ret[identifier]['success'] = False
+            save_change_history_bulk(change_history_records, auth_user)
+            record_data_changes([ change for oid, change in data_changes if oid not in failed_oids ])
+        # trigger aggregators that depend on this one
+        if run_aggregated_by:
+            self._run_aggregated_by(recalculated_sids, auth_user, threaded_aggregation, preloaded_columns)
+        return ret
+    
+    def _run_aggregated_by(self, identifiers, auth_user_override, threaded_aggregation=False, preloaded_columns=None):
+        """
+            Recalculates the aggregators that depend on this one, for the specified identifiers.
+            
+            identifiers (list of str) The students whose value of this aggregator was recalculated.
+        """
+        aggregated_by = [ c for c in self.config['aggregated_by'] if c.strip() ]
+        if not aggregated_by or not identifiers:
+            return
+        if threaded_aggregation:
+            enqueue_aggregations(
+                aggregated_by,
+                identifiers,
+                auth_user_override,
+                source_column_uuid=self.config['uuid']
+            )
+        else:
+            run_aggregations(
+                { aggregator_column_uuid: identifiers for aggregator_column_uuid in aggregated_by },
+                auth_user_override=auth_user_override,
+                preloaded_columns=preloaded_columns
+            )
+    
+    def calculate_aggregation(self, identifiers=[], columns_already_traversed=[], auth_user_override='', forced=False, threaded_aggregation=False, preloaded_columns=None, run_aggregated_by=True):
         """
             Calculates the aggregation for this column for the specified identifiers.
             
@@ -508,8 +1027,10 @@ class AggregatorColumn(Column):
             columns_already_traversed (list of strings uuids)
             auth_user_override (string username)
             forced (boolean) True if a manual recalculation is being requested.
-            threaded_aggregation (boolean) Whether to use threaded and multiprocessing aggregation.
+            threaded_aggregation (boolean) Whether to queue downstream aggregations for the background workers.
             preloaded_columns
+            run_aggregated_by (boolean) Whether to then recalculate the aggregators that depend on this one.
+                False when called from sres.aggregation_graph.run_aggregations, which does this itself.
             
             Returns dict of dicts, keyed by each identifier.
                 {
@@ -586,6 +1107,7 @@ class AggregatorColumn(Column):
                         simple_aggregator_column_helpers[column_to_aggregate].load(column_to_aggregate)
                         preloaded_columns[column_to_aggregate] = simple_aggregator_column_helpers[column_to_aggregate]
         elif self.config['aggregation_options']['method'] == 'mathematical_operations':
+            compiled_formula = self._get_compiled_formula(preloaded_columns)
             mathematical_operations_aggregator_extension_column_helpers = {}
             expr = self.config['aggregation_options']['aggregator_type_mathematical_operations_formula']
             expr = BeautifulSoup(expr, 'html.parser').get_text()
@@ -621,6 +1143,19 @@ class AggregatorColumn(Column):
         # determine the blank replacement
         blank_replacement = 0 if self.config['aggregation_options']['blank_handling'] == 'zero' else ''
         
+        # simple aggregators over many students can be calculated in one pass
+        if self.config['aggregation_options']['method'] in _ALL_SIMPLE_AGGREGATOR_NAMES and len(identifiers) > 1 and self._can_calculate_simple_aggregation_in_batch(simple_aggregator_column_helpers):
+            return self._calculate_simple_aggregation_batch(
+                identifiers=identifiers,
+                simple_aggregator_column_helpers=simple_aggregator_column_helpers,
+                blank_replacement=blank_replacement,
+                columns_already_traversed=columns_already_traversed,
+                auth_user_override=auth_user_override,
+                threaded_aggregation=threaded_aggregation,
+                preloaded_columns=preloaded_columns,
+                run_aggregated_by=run_aggregated_by
+            )
+        
         # loop through each identifier and perform the aggregation for each
         for identifier in identifiers:
             student_data._reset()
@@ -717,81 +1252,14 @@ class AggregatorColumn(Column):
                             #logging.debug(str(data_temp_set))
                             
                             for data_temp in data_temp_set:
-                                # get subdata if multientry
-                                if simple_aggregator_column_helpers[column_to_aggregate].subfield is not None:
-                                    try:
-                                        if not isinstance(data_temp, list):
-                                            try:
-                                                data_temp = json.loads(data_temp)
-                                            except:
-                                                pass
-                                        data_temp = data_temp[simple_aggregator_column_helpers[column_to_aggregate].subfield]
-                                    except:
-                                        # log it
-                                        #logging.debug("Problem getting multientry subfield [{}] data [{}] [{}] [{}]".format(
-                                        #    simple_aggregator_column_helpers[column_to_aggregate].subfield,
-                                        #    str(data_temp),
-                                        #    self.config['uuid'],
-                                        #    self.table.config['uuid']
-                                        #))
-                                        data_temp = blank_replacement
-                                # check blanks
-                                if (data_temp == '' or data_temp is None) and blank_replacement != '':
-                                    data_temp = blank_replacement
-                                # save data to array
-                                if self.config['aggregation_options']['method'] in 'sum,average,median,highest_average,highest_sum,lowest_average,lowest_sum,count'.split(','):
-                                    if utils.is_number(data_temp):
-                                        data_array.append(float(data_temp))
-                                elif self.config['aggregation_options']['method'] in ['sumaggressive', 'averageaggressive']:
-                                    numbers = re.findall(
-                                        '((\-)?[0-9]+(\.[0-9]+)?)', 
-                                        str(data_temp)
-                                    )
-                                    for number in numbers:
-                                        if utils.is_number(number[0]): # necesssary because re.findall returns a tuple, with elements for each regex group
-                                            data_array.append(number[0])
-                                elif self.config['aggregation_options']['method'] == 'counta':
-                                    if data_temp is not None and str(data_temp) != '':
-                                        data_array.append(data_temp)
-                                elif self.config['aggregation_options']['method'] in ['clone', 'mapper']:
-                                    data_array.append(data_temp)
-                                    # clone and mapper only take one source column, so ignore the others if >1 specified
+                                if self._append_simple_aggregation_data(
+                                        data_array=data_array,
+                                        data_temp=data_temp,
+                                        column_helper=simple_aggregator_column_helpers[column_to_aggregate],
+                                        blank_replacement=blank_replacement,
+                                        column_to_aggregate=column_to_aggregate,
+                                        identifier=identifier):
                                     break
-                                elif self.config['aggregation_options']['method'] == 'countblank':
-                                    if data_temp == '' or data_temp is None:
-                                        data_array.append(data_temp)
-                                elif self.config['aggregation_options']['method'] == 'countif':
-                                    if data_temp == self.config['aggregation_options']['aggregator_type_simple_countif_parameter_value']:
-                                        data_array.append(data_temp)
-                                elif self.config['aggregation_options']['method'] == 'countifstartswith':
-                                    if data_temp.startswith(self.config['aggregation_options']['aggregator_type_simple_countifstartswith_parameter_term']):
-                                        data_array.append(data_temp)
-                                elif self.config['aggregation_options']['method'] == 'countifcontains':
-                                    if self.config['aggregation_options']['aggregator_type_simple_countifcontains_parameter_term'].lower() in str(data_temp).lower():
-                                        data_array.append(data_temp)
-                                elif self.config['aggregation_options']['method'] == 'countifmatchregex':
-                                    if re.search(
-                                        self.config['aggregation_options']['aggregator_type_simple_countifmatchregex_parameter_term'],
-                                        str(data_temp),
-                                        flags=re.IGNORECASE
-                                    ):
-                                        data_array.append(data_temp)
-                                elif self.config['aggregation_options']['method'] == 'countallmatchregex':
-                                    data_array.extend(
-                                        re.findall(
-                                            self.config['aggregation_options']['aggregator_type_simple_countallmatchregex_parameter_term'],
-                                            str(data_temp),
-                                            flags=re.IGNORECASE
-                                        )
-                                    )
-                                elif self.config['aggregation_options']['method'] in ['concatenate', 'mode']:
-                                    data_array.append(str(data_temp))
-                                else:
-                                    # misconfiguration
-                                    logging.warning("Aggregation error, could not make data_array. [{}] [{}]".format(
-                                        column_to_aggregate,
-                                        identifier
-                                    ))
                         else:
                             logging.error("Aggregator [{}] [{}] could not be loaded. [{}]".format(
                                 column_to_aggregate,
@@ -802,83 +1270,43 @@ class AggregatorColumn(Column):
                     #logging.debug(str(data_array))
                     #logging.debug(self.config['uuid'] + ' time for making data_array ' + str((datetime.now() - t0).total_seconds()))
                     # calculate aggregated value
-                    final_value = ''
-                    if self.config['aggregation_options']['method'] in 'sum,sumaggressive'.split(','):
-                        final_value = utils.list_sum(data_array)
-                    elif self.config['aggregation_options']['method'] in ['average', 'averageaggressive', 'mode', 'median']:
-                        if len(data_array):
-                            if self.config['aggregation_options']['method'] in ['average', 'averageaggressive']:
-                                final_value = utils.list_avg(data_array)
-                            elif self.config['aggregation_options']['method'] == 'mode':
-                                final_value = utils.list_mode(data_array)
-                            elif self.config['aggregation_options']['method'] == 'median':
-                                final_value = utils.list_median(data_array)
-                        else:
-                            final_value = ''
-                    elif self.config['aggregation_options']['method'] == 'clone':
-                        final_value = data_array[0] if data_array else ''
-                    elif self.config['aggregation_options']['method'] == 'mapper':
+                    final_value = self._calculate_simple_aggregation_final_value(data_array)
+                elif self.config['aggregation_options']['method'] == 'mathematical_operations':
+                    compiled_formula_values = None
+                    if compiled_formula.expression is not None:
+                        compiled_formula_values = self._get_compiled_formula_values(compiled_formula, student_data, preloaded_columns, blank_replacement)
+                    if compiled_formula_values is not None:
                         try:
-                            final_value = self.config['aggregation_options']['aggregator_type_mapper_outputs'][self.config['aggregation_options']['aggregator_type_mapper_inputs'].index(data_array[0])]
+                            final_value = compiled_formula.evaluate(compiled_formula_values)
                         except:
                             final_value = ''
-                    elif self.config['aggregation_options']['method'] in 'count,counta,countblank,countif,countifstartswith,countifcontains,countifmatchregex,countallmatchregex'.split(','):
-                        final_value = len(data_array)
-                    elif self.config['aggregation_options']['method'] in ['highest_average', 'lowest_average']:
-                        _dir = self.config['aggregation_options']['method'].replace('_average', '')
-                        n = self.config['aggregation_options']['aggregator_type_simple_{}_average_parameter_n'.format(_dir)]
-                        if utils.is_number(n) and len(data_array):
-                            n = int(n)
-                            data_array = utils.list_nums(sorted(
-                                data_array,
-                                reverse=True if _dir == 'highest' else False
-                            ))
-                            final_value = utils.list_avg(data_array[:n])
-                        else:
-                            final_value = ''
-                    elif self.config['aggregation_options']['method'] in ['highest_sum', 'lowest_sum']:
-                        _dir = self.config['aggregation_options']['method'].replace('_sum', '')
-                        n = self.config['aggregation_options']['aggregator_type_simple_{}_sum_parameter_n'.format(_dir)]
-                        if utils.is_number(n):
-                            n = int(n)
-                            data_array = utils.list_nums(sorted(
-                                data_array, 
-                                reverse=True if _dir == 'highest' else False
-                            ))
-                            final_value = utils.list_sum(data_array[:n])
-                    elif self.config['aggregation_options']['method'] == 'concatenate':
-                        final_value = self.config['aggregation_options']['aggregator_type_simple_concatenate_parameter_separator'].join(data_array)
                     else:
-                        # misconfiguration
-                        print('aggregation error, could not calculate final_value')
-                    #logging.debug(self.config['uuid'] + ' time for calculating final_value ' + str((datetime.now() - t0).total_seconds()))
-                elif self.config['aggregation_options']['method'] == 'mathematical_operations':
-                    expr = self.config['aggregation_options']['aggregator_type_mathematical_operations_formula']
-                    expr = BeautifulSoup(expr, 'html.parser').get_text()
-                    expr = utils.clean_exprtk_expression(expr)
-                    # if any extension functions are included, call them
-                    if mathematical_operations_aggregator_extension_column_helpers:
-                        expr = cexprtk_ext.substitute_ext_function_result(
-                            expr=expr,
+                        expr = self.config['aggregation_options']['aggregator_type_mathematical_operations_formula']
+                        expr = BeautifulSoup(expr, 'html.parser').get_text()
+                        expr = utils.clean_exprtk_expression(expr)
+                        # if any extension functions are included, call them
+                        if mathematical_operations_aggregator_extension_column_helpers:
+                            expr = cexprtk_ext.substitute_ext_function_result(
+                                expr=expr,
+                                identifier=identifier,
+                                preloaded_student_data=student_data,
+                                preloaded_columns=mathematical_operations_aggregator_extension_column_helpers
+                            )
+                        # simply use substitute text variables to swap out column references for values!!!
+                        final_expr = substitute_text_variables(
+                            input=expr,
                             identifier=identifier,
+                            default_table_uuid=self.config['table_uuid'],
                             preloaded_student_data=student_data,
+                            blank_replacement=blank_replacement,
                             preloaded_columns=mathematical_operations_aggregator_extension_column_helpers
-                        )
-                    # simply use substitute text variables to swap out column references for values!!!
-                    final_expr = substitute_text_variables(
-                        input=expr,
-                        identifier=identifier,
-                        default_table_uuid=self.config['table_uuid'],
-                        preloaded_student_data=student_data,
-                        blank_replacement=blank_replacement,
-                        preloaded_columns=mathematical_operations_aggregator_extension_column_helpers
-                    )['new_text']
-                    # evaluate
-                    try:
-                        final_value = cexprtk.evaluate_expression(final_expr, {})
-                    except:
-                        print('err final_expr', final_expr)
-                        final_value = ''
+                        )['new_text']
+                        # evaluate
+                        try:
+                            final_value = cexprtk.evaluate_expression(final_expr, {})
+                        except:
+                            print('err final_expr', final_expr)
+                            final_value = ''
                 elif self.config['aggregation_options']['method'] == 'case_builder':
                     cases = self.get_case_builder_cases()
                     final_value = ''
@@ -990,7 +1418,8 @@ class AggregatorColumn(Column):
                             pass # TODO
                     ch = get_change_history( # already sorted by timestamp, most recent first
                         column_uuids=[ score_column.config['uuid'] ],
-                        sids=all_members_sids
+                        sids=all_members_sids,
+                        only_fields=['identifier', 'auth_user', 'new_value', 'timestamp']
                     )
                     # calculate how many group members this member has saved data for
                     all_targets_saved_for = []
@@ -1177,59 +1606,7 @@ class AggregatorColumn(Column):
                 # final_value has been determined; perform any post-processing now
                 ###################################################################
                 
-                # post-aggregation arithmetic, if needed
-                if self.config['aggregation_options']['post_aggregation_arithmetic_operator'] in ['+', '-', '*', '/'] and utils.is_number(self.config['aggregation_options']['post_aggregation_arithmetic_value']) and utils.is_number(final_value):
-                    _paao = self.config['aggregation_options']['post_aggregation_arithmetic_operator']
-                    _paav = float(self.config['aggregation_options']['post_aggregation_arithmetic_value'])
-                    final_value = float(final_value)
-                    if _paao == '+':
-                        final_value = final_value + _paav
-                    elif _paao == '-':
-                        final_value = final_value - _paav
-                    elif _paao == '*':
-                        final_value = final_value * _paav
-                    elif _paao == '/' and _paav != 0:
-                        final_value = final_value / _paav
-                # rounding if needed
-                if self.config['aggregation_options']['rounding'] != '' and utils.is_number(final_value):
-                    try:
-                        getcontext().rounding = ROUND_HALF_UP
-                        _dp = Decimal(10) ** -int(self.config['aggregation_options']['rounding'])
-                        _final_value = final_value
-                        if self.config['aggregation_options']['rounding_direction'] == 'nearest':
-                            final_value = Decimal(final_value).quantize(_dp)
-                        else:
-                            final_value = Decimal(final_value).quantize(
-                                _dp,
-                                rounding=ROUND_CEILING if self.config['aggregation_options']['rounding_direction'] == 'ceiling' else ROUND_FLOOR
-                            )
-                        if final_value.is_nan() or final_value.is_infinite():
-                            final_value = ''
-                        else:
-                            final_value = str(final_value)
-                    except:
-                        final_value = _final_value
-                # substitutions if needed
-                if self.config['aggregation_options']['regex_replace_pattern'] != '':
-                    if self.config['aggregation_options']['regex_replace_mode'] == 'text':
-                        final_value = final_value.replace(
-                            self.config['aggregation_options']['regex_replace_pattern'],
-                            self.config['aggregation_options']['regex_replace_replacement']
-                        )
-                    elif self.config['aggregation_options']['regex_replace_mode'] == 'regex':
-                        final_value = re.sub(
-                            self.config['aggregation_options']['regex_replace_pattern'],
-                            self.config['aggregation_options']['regex_replace_replacement'],
-                            final_value
-                        )
-                # check for inf and nan
-                if utils.is_number(final_value):
-                    try:
-                        if final_value == math.inf or final_value == math.nan or math.isnan(final_value):
-                            final_value = ''
-                    except:
-                        # just yield the final_value...
-                        pass
+                final_value = self._post_process_final_value(final_value)
                 # save
                 ret[identifier]['aggregated_value'] = final_value
                 ret[identifier]['success'] = True
@@ -1238,6 +1615,7 @@ class AggregatorColumn(Column):
                     column_uuid=self.config['uuid'],
                     data=final_value,
                     auth_user_override=auth_user_override,
+                    skip_aggregation=True, # aggregators that depend on this one are run together below
                     columns_already_traversed=columns_already_traversed[:],
                     ignore_active=True,
                     commit_immediately=True,
@@ -1352,5 +1730,13 @@ class AggregatorColumn(Column):
                 #print('time for save data', (datetime.now() - t0).total_seconds())
             else:
                 ret[identifier]['errors'].append(("Could not find student {}".format(identifier), "warning"))
+        # trigger aggregators that depend on this one
+        if run_aggregated_by:
+            self._run_aggregated_by(
+                [ identifier for identifier, result in ret.items() if result['success'] ],
+                auth_user_override,
+                threaded_aggregation,
+                preloaded_columns
+            )
         return ret
     
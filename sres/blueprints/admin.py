@@ -463,7 +463,7 @@ def manage_db_indexes():
         flash("Sorry, you are not authorised to complete this action.", "danger")
         return render_template('denied.html')
         
-    from sres.db import _check_mongo_indexes, _create_mongo_index, _DB_INDEXES
+    from sres.db import _check_mongo_indexes, _create_mongo_index, _index_matches, _DB_INDEXES
     
     create_missing_indexes = True if request.args.get('create', None) == '1' else False
     
@@ -475,7 +475,7 @@ def manage_db_indexes():
             for index in indexes:
                 index_found = False
                 for current_index_name, current_index in current_indexes.items():
-                    if current_index['key'] == index['keys']:
+                    if _index_matches(current_index, index):
                         index_found = True
                         break
                 if index_found:
@@ -483,10 +483,26 @@ def manage_db_indexes():
                 else:
                     ret.append(f"NOT FOUND {str(index)}")
                     if create_missing_indexes and index['keys'][0][0] != '_id':
-                        res = _create_mongo_index(collection, index['keys'], index['unique'])
+                        res = _create_mongo_index(collection, index['keys'], index['unique'], index.get('collation'), index.get('name'), index.get('weights'), index.get('expire_after_seconds'), index.get('partial_filter_expression'))
                         ret.append(f"CREATE RESULT: {str(res)}")
         return '<br><br>'.join(ret) + "<hr>Set URL param <pre>create=1</pre> to force create any indexes not found.<br><br>"
     
+@bp.route('/db_pool', methods=['GET'])
+@login_required
+def view_db_pool_stats():
+    if not is_user_administrator(category='super'):
+        abort(403)
+    from sres.db import get_pool_stats
+    return json.dumps(get_pool_stats())
+
+@bp.route('/aggregation_queue', methods=['GET'])
+@login_required
+def view_aggregation_queue_status():
+    if not is_user_administrator(category='super'):
+        abort(403)
+    from sres.aggregation_queue import get_queue_status
+    return json.dumps(get_queue_status())
+
 @bp.route('/logs/feedback', methods=['GET'])
 @login_required
 def view_feedback_logs():
@@ -10,7 +10,7 @@ from sres.auth import is_logged_in, get_auth_user, is_user_administrator
 from sres.tables import Table, list_authorised_tables
 from sres.columns import Column
 from sres.users import oids_to_usernames, usernames_to_oids
-from sres.studentdata import StudentData, STUDENT_DATA_DEFAULT_CONFIG, REQUIRED_BASE_FIELDS
+from sres.studentdata import STUDENT_DATA_DEFAULT_CONFIG, REQUIRED_BASE_FIELDS
 
 bp = Blueprint('api_tables', __name__, url_prefix='/api/v1')
 
@@ -183,22 +183,18 @@ def crud_students(table_uuid, override_method=None):
     if request_method == 'DELETE':
         
         identifiers = request.args.getlist('identifiers')
-        student_data = StudentData(table)
         
         ret = []
         
-        for identifier in identifiers:
-            student_data._reset()
-            if student_data.find_student(identifier):
-                student_data.config['status'] = 'inactive'
-                student_data.save()
+        for identifier, student_data in table.find_students_bulk(identifiers).items():
+            student_data.config['status'] = 'inactive'
+            student_data.save()
         
         return crud_students(table_uuid, override_method='GET')
         
     elif request_method == 'GET':
         
         identifiers = request.args.getlist('identifiers')
-        student_data = StudentData(table)
         
         ret = []
         
@@ -214,9 +210,10 @@ def crud_students(table_uuid, override_method=None):
                 ret.append(_student)
         else:
             # get specified students
+            found_students = table.find_students_bulk(identifiers)
             for identifier in identifiers:
-                student_data._reset()
-                if student_data.find_student(identifier):
+                student_data = found_students.get(identifier)
+                if student_data is not None:
                     _student = {}
                     for key in STUDENT_DATA_DEFAULT_CONFIG.keys():
                         if student_data.config.get(key) is not None:
@@ -289,7 +286,6 @@ def cru_data(table_uuid, override_method=None):
         
         column_uuids = request.args.getlist('column_uuids')
         identifiers = request.args.getlist('identifiers')
-        student_data = StudentData(table)
         
         # preload columns
         preloaded_columns = {}
@@ -304,13 +300,14 @@ def cru_data(table_uuid, override_method=None):
         if len(identifiers) == 0:
             identifiers = table.get_all_students_sids()
         
+        found_students = table.find_students_bulk(identifiers)
         for identifier in identifiers:
             
-            student_data._reset()
+            student_data = found_students.get(identifier)
             _student = {
                 'identifier': identifier
             }
-            if student_data.find_student(identifier):
+            if student_data is not None:
                 _student['sid'] = student_data.config['sid']
                 _student['email'] = student_data.config['email']
                 _data = {}
@@ -341,8 +338,6 @@ def cru_data(table_uuid, override_method=None):
         #records = _parse_unknown_list(request.form.get('data'))
         records = request.get_json(force=True)
         
-        student_data = StudentData(table)
-        
         # preload the columns
         column_uuids = []
         for record in records:
@@ -359,8 +354,8 @@ def cru_data(table_uuid, override_method=None):
         ret = []
         
         allowed_column_uuids = list(preloaded_columns.keys())
+        found_students = table.find_students_bulk([ record.get('identifier') for record in records if record.get('identifier') ])
         for record in records:
-            student_data._reset()
             identifier = record.get('identifier')
             data = record.get('data')
             if identifier and data:
@@ -368,7 +363,8 @@ def cru_data(table_uuid, override_method=None):
                     'identifier': identifier,
                     'results': {}
                 }
-                if student_data.find_student(identifier):
+                student_data = found_students.get(identifier)
+                if student_data is not None:
                     for column_uuid, _data in data.items():
                         _ret['results'][column_uuid] = {}
                         if column_uuid in allowed_column_uuids:
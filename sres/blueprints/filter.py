@@ -1,4 +1,4 @@
-from flask import (Blueprint, flash, g, redirect, render_template, request, session, url_for, current_app, Markup, abort)
+from flask import (Blueprint, flash, g, redirect, render_template, request, session, url_for, current_app, Markup, abort, Response, stream_with_context)
 from bs4 import BeautifulSoup
 import json
 import os
@@ -540,11 +540,38 @@ def run_filter_message(filter_uuid, mode='preview'):
                 identifiers = request.form.getlist('identifiers[]')
                 #logging.debug(str(identifiers))
                 if mode == 'preview':
-                    results = filter.get_personalised_message(identifiers=identifiers, mode=mode)
-                    if is_identity_anonymiser_active():
-                        for i, result in enumerate(results):
-                            results[i]['email']['target']['email'] = anonymise('email', results[i]['email']['target']['email'])
-                            results[i]['email']['target']['name'] = anonymise('full_name', results[i]['email']['target']['name'])
+                    # stream the JSON array one message at a time
+                    identity_anonymiser_active = is_identity_anonymiser_active()
+                    def _generate_previews():
+                        # once streaming has started the response cannot become a 500, so failures
+                        # are reported as elements and the array is always closed
+                        failed_identifiers = []
+                        count = 0
+                        yield '['
+                        try:
+                            for result in filter.iterate_personalised_messages(identifiers=identifiers, mode=mode, errors=failed_identifiers):
+                                if identity_anonymiser_active:
+                                    result['email']['target']['email'] = anonymise('email', result['email']['target']['email'])
+                                    result['email']['target']['name'] = anonymise('full_name', result['email']['target']['name'])
+                                yield (', ' if count > 0 else '') + json.dumps(result)
+                                count += 1
+                        except Exception as e:
+                            logging.error('could not generate previews [{}]'.format(filter.config['uuid']))
+                            logging.exception(e)
+                            failed_identifiers.append(None)
+                        for failed_identifier in failed_identifiers:
+                            if identity_anonymiser_active and failed_identifier is not None:
+                                failed_identifier = anonymise('sid', failed_identifier)
+                            message = "Could not prepare the message for {}.".format(failed_identifier) if failed_identifier is not None else "Could not prepare the remaining messages."
+                            yield (', ' if count > 0 else '') + json.dumps({
+                                'identifier': failed_identifier,
+                                'success': False,
+                                'message': message,
+                                'messages': [(message, "danger")]
+                            })
+                            count += 1
+                        yield ']'
+                    return Response(stream_with_context(_generate_previews()))
                 elif mode == 'queue':
                     results = filter.queue_send(identifiers=identifiers, auth_username=get_auth_user())
                 elif mode == 'schedule':
@@ -9,6 +9,35 @@ from sres.db import _get_db
 from sres.auth import get_auth_user, get_auth_user_oid
 from sres import utils
 
+# Most documents counted by count_change_history when approximate=True
+CHANGE_HISTORY_APPROXIMATE_COUNT_LIMIT = 1000
+
+def _make_change_history(identifier, record, username, caller):
+    history = {
+        'old_value': str(record['existing_data']),
+        'new_value': str(record['new_data']),
+        'caller': caller,
+        'timestamp': datetime.now(),
+        'auth_user': username,
+        'identifier': identifier,
+        #'table': column_ids[column_uuid]['table'],
+        #'column': column_ids[column_uuid]['_id'],
+        'column_uuid': record['column_uuid'],
+        'table_uuid': record['table_uuid']
+    }
+    if record.get('real_auth_user'):
+        history['real_auth_user'] = record.get('real_auth_user')
+    if record.get('report_number') is not None and utils.is_number(record.get('report_number')):
+        history['report_number'] = str(record.get('report_number'))
+        history['report_workflow_state'] = record.get('report_workflow_state', 'active')
+    return history
+
+def _get_caller(caller_override=''):
+    try:
+        return request.full_path
+    except:
+        return caller_override
+
 def save_change_history(identifier, records=[], username=None, caller_override=''):
     """
         Saves one or many change history records.
@@ -23,52 +52,42 @@ def save_change_history(identifier, records=[], username=None, caller_override='
         }
     """
     db = _get_db()
-    # collate the data to save
-    histories = []
     # determine username
     if not username:
         username = get_auth_user()
     # determine caller
-    try:
-        caller = request.full_path
-    except:
-        caller = caller_override
-    # parse records
-    for record in records:
-        history = {
-            'old_value': str(record['existing_data']),
-            'new_value': str(record['new_data']),
-            'caller': caller,
-            'timestamp': datetime.now(),
-            'auth_user': username,
-            'identifier': identifier,
-            #'table': column_ids[column_uuid]['table'],
-            #'column': column_ids[column_uuid]['_id'],
-            'column_uuid': record['column_uuid'],
-            'table_uuid': record['table_uuid']
-        }
-        if record.get('real_auth_user'):
-            history['real_auth_user'] = record.get('real_auth_user')
-        if record.get('report_number') is not None and utils.is_number(record.get('report_number')):
-            history['report_number'] = str(record.get('report_number'))
-            history['report_workflow_state'] = record.get('report_workflow_state', 'active')
-        
-        #print('a history in save_change_history')
-        #print(str(history))
-        
-        histories.append(history)
+    caller = _get_caller(caller_override)
+    # collate the data to save
+    histories = [ _make_change_history(identifier, record, username, caller) for record in records ]
     # save to db
     result = db.change_history.insert_many(histories)
     # return
     return result.acknowledged
 
+def save_change_history_bulk(records=[], username=None, caller_override=''):
+    """
+        Saves change history records for many students in one unordered insert.
+        
+        Each record is as for save_change_history, plus identifier (string)
+    """
+    if not records:
+        return True
+    db = _get_db()
+    if not username:
+        username = get_auth_user()
+    caller = _get_caller(caller_override)
+    histories = [ _make_change_history(record['identifier'], record, username, caller) for record in records ]
+    result = db.change_history.insert_many(histories, ordered=False)
+    return result.acknowledged
+
 def get_recent_change_histories_for_table(table_uuid, days=7):
     db = _get_db()
     _column_uuids = list(db.columns.find({'table_uuid': table_uuid}, ['uuid']))
     column_uuids = [ c['uuid'] for c in _column_uuids ]
     ch = get_change_history(
         column_uuids=column_uuids,
-        only_after=(datetime.now() - timedelta(days=days))
+        only_after=(datetime.now() - timedelta(days=days)),
+        only_fields=['column_uuid', 'identifier', 'auth_user', 'timestamp']
     )
     return ch
 
@@ -80,9 +99,7 @@ def get_recently_updated_columns_for_table(table_uuid, days=10):
     }
     if days is not None:
         db_filter['timestamp'] = {'$gte': (datetime.now() - timedelta(days=days))}
-    results = db.change_history.find(db_filter, {'column_uuid': 1, '_id': 0}).sort([('timestamp', -1)])
-    results = list(results)
-    results = list(set([ r['column_uuid'] for r in results ]))
+    results = db.change_history.distinct('column_uuid', db_filter)
     return results
 
 def get_distinct_auth_users(column_uuids=None):
@@ -99,13 +116,42 @@ def get_distinct_auth_users(column_uuids=None):
     ).distinct('auth_user')
     return results
 
-def get_change_history(column_uuids=None, max_rows=0, auth_users=None, only_after=None, only_before=None, sid=None, email=None, return_cursor=False, sids=None):
+def _get_change_history_filter(column_uuids, auth_users=None, only_after=None, only_before=None, sid=None, email=None, sids=None):
+    filters = [
+        {
+            'column_uuid': {'$in': column_uuids}
+        }
+    ]
+    if sid is not None or email is not None:
+        filters.append(
+            {
+                'identifier': {'$in': [sid, email]}
+            }
+        )
+    if sids is not None and type(sids) is list:
+        filters.append(
+            {
+                'identifier': { '$in': sids }
+            }
+        )
+    # authuser filter
+    if auth_users:
+        filters.append({'auth_user': {'$in': auth_users}})
+    # datetime filters
+    if only_after is not None and isinstance(only_after, datetime):
+        filters.append({'timestamp': {'$gte': only_after}})
+    if only_before is not None and isinstance(only_before, datetime):
+        filters.append({'timestamp': {'$lte': only_before}})
+    return {'$and': filters}
+
+def get_change_history(column_uuids=None, max_rows=0, auth_users=None, only_after=None, only_before=None, sid=None, email=None, return_cursor=False, sids=None, only_fields=None):
     """
-        Returns a list of db.change_history documents for the specified column_uuids.
+        Returns a list of db.change_history documents for the specified column_uuids,
+        most recent first.
         If max_rows == 1, this still returns a single-element list.
         
         column_uuids (list of strings) Must be supplied
-        max_rows (int)
+        max_rows (int) If > 0, only this many of the most recent documents are read from the db
         auth_users (list of string usernames)
         only_after (datetime|None)
         only_before (datetime|None)
@@ -113,47 +159,35 @@ def get_change_history(column_uuids=None, max_rows=0, auth_users=None, only_afte
         email (str or None) Specify a filter for the identifier
         return_cursor (boolean) If True, returns cursor instead of list
         sids (list or None) Specify a filter for a number of SID identifiers
+        only_fields (list of str|None) If specified, only these fields (and _id) are returned
     """
     db = _get_db()
     if column_uuids is None or not column_uuids:
         return []
-    else:
-        filters = [
-            {
-                'column_uuid': {'$in': column_uuids}
-            }
-        ]
-        if sid is not None or email is not None:
-            filters.append(
-                {
-                    'identifier': {'$in': [sid, email]}
-                }
-            )
-        if sids is not None and type(sids) is list:
-            filters.append(
-                {
-                    'identifier': { '$in': sids }
-                }
-            )
-        # authuser filter
-        if auth_users:
-            filters.append({'auth_user': {'$in': auth_users}})
-        # datetime filters
-        if only_after is not None and isinstance(only_after, datetime):
-            filters.append({'timestamp': {'$gte': only_after}})
-        if only_before is not None and isinstance(only_before, datetime):
-            filters.append({'timestamp': {'$lte': only_before}})
-        # search
-        results = db.change_history.find({'$and': filters}).sort([
-            ('timestamp', -1)
-        ])
-        if results.count() > 0:
-            if max_rows > 0:
-                return list(results)[:max_rows]
-            else:
-                return results if return_cursor else list(results)
-        else:
-            return []
+    db_filter = _get_change_history_filter(column_uuids, auth_users, only_after, only_before, sid, email, sids)
+    # search; the sort and limit are served by the compound indexes on db.change_history
+    results = db.change_history.find(db_filter, only_fields).sort([
+        ('timestamp', -1)
+    ])
+    if max_rows > 0:
+        results = results.limit(max_rows)
+    return results if return_cursor else list(results)
+
+def count_change_history(column_uuids=None, auth_users=None, only_after=None, only_before=None, sid=None, email=None, sids=None, approximate=False):
+    """
+        Returns the number (int) of db.change_history documents matching the same filters
+        as get_change_history.
+        
+        approximate (boolean) If True, counting stops at CHANGE_HISTORY_APPROXIMATE_COUNT_LIMIT,
+            so the result is a lower bound for very long histories.
+    """
+    db = _get_db()
+    if column_uuids is None or not column_uuids:
+        return 0
+    db_filter = _get_change_history_filter(column_uuids, auth_users, only_after, only_before, sid, email, sids)
+    if approximate:
+        return db.change_history.count_documents(db_filter, limit=CHANGE_HISTORY_APPROXIMATE_COUNT_LIMIT)
+    return db.change_history.count_documents(db_filter)
 
 def revert_change_history(_id, column_uuid, student_data, on_behalf_of=False):
     """
@@ -169,14 +203,13 @@ def revert_change_history(_id, column_uuid, student_data, on_behalf_of=False):
         'messages': []
     }
     # get current value
-    results = db.change_history.find({
+    results = list(db.change_history.find({
         'column_uuid': column_uuid,
         'identifier': {'$in': [student_data.config['sid'], student_data.config['email']]},
         '_id': ObjectId(_id)
-    })
+    }).limit(2))
     # set again
-    if results.count() == 1:
-        results = list(results)
+    if len(results) == 1:
         res = student_data.set_data(
             column_uuid=column_uuid,
             data=results[0]['new_value'],
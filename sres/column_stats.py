@@ -0,0 +1,329 @@
+"""
+    Materialised statistics of the data in each column, kept in db.column_stats.
+
+    A stats document is computed in bulk from db.data the first time it is needed, and then
+    kept up to date incrementally as StudentData saves values. It is recomputed in bulk once
+    it is stale, i.e. when the column config has changed, when enough values have changed that
+    the bulk-only figures (quantiles, histogram, z-score counts) have drifted, or when it is old
+    enough that writes which bypass StudentData may have been missed.
+"""
+from datetime import datetime
+from collections import Counter
+import json
+import logging
+import math
+import numpy
+from pymongo import UpdateOne
+
+from sres.db import _get_db
+from sres.config_cache import get_cached_configs
+
+# Bump when the shape of the stats documents changes, so that old documents are recomputed
+COLUMN_STATS_FORMAT_VERSION = 1
+# Stats older than this are recomputed, to pick up writes that bypass StudentData
+COLUMN_STATS_MAX_AGE_SECONDS = 3600
+# Stats are recomputed once more than this fraction of students have changed since
+COLUMN_STATS_MAX_CHANGED_FRACTION = 0.25
+# Category frequencies are not kept for columns with more distinct values than this, or
+# with values longer than this
+COLUMN_STATS_MAX_DISTINCT_VALUES = 1000
+COLUMN_STATS_MAX_VALUE_LENGTH = 200
+COLUMN_STATS_QUANTILES = [0, 0.25, 0.5, 0.75, 1]
+COLUMN_STATS_HISTOGRAM_BINS = 10
+
+def _encode_value_key(value):
+    """Makes a str value safe to use as a field name."""
+    return 'v' + value.replace('%', '%25').replace('.', '%2E').replace('$', '%24')
+
+def _decode_value_key(key):
+    return key[1:].replace('%24', '$').replace('%2E', '.').replace('%25', '%')
+
+def _to_number(value):
+    """Returns value as a finite float, or None if it is not numeric."""
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if math.isfinite(number) else None
+
+def _is_multientry(column_config):
+    return column_config.get('type') == 'multiEntry' or column_config.get('multientry_data_format') == True
+
+def _get_reference_values(column_config, value):
+    """
+        Splits a stored value into the values of each column reference that stats are kept for,
+        i.e. the column itself and, for multientry columns, each of its subfields. Subfields are
+        unpacked the same way as Table.export_data_to_df.
+
+        column_config (dict) db.columns document
+        value (any) The stored value, or None if missing
+
+        Returns dict of values keyed by column reference, or an empty dict if stats are not
+        kept for this type of column.
+    """
+    if column_config.get('type') == 'signinoutmemory':
+        return {}
+    ret = {column_config['uuid']: value}
+    if _is_multientry(column_config):
+        try:
+            unpacked = json.loads(value)
+        except:
+            unpacked = []
+        for n in range(len(column_config.get('multi_entry', {}).get('options', []))):
+            try:
+                ret['{}.{}'.format(column_config['uuid'], n)] = unpacked[n]
+            except:
+                ret['{}.{}'.format(column_config['uuid'], n)] = ''
+    return ret
+
+def _make_stats(values):
+    """
+        Computes the stats of a list of values.
+
+        Returns dict.
+    """
+    missing_count = len([ v for v in values if v is None ])
+    present = [ str(v) for v in values if v is not None ]
+    frequencies = Counter(present)
+    frequencies_truncated = len(frequencies) > COLUMN_STATS_MAX_DISTINCT_VALUES or any(len(v) > COLUMN_STATS_MAX_VALUE_LENGTH for v in frequencies.keys())
+    numbers = [ n for n in (_to_number(v) for v in values) if n is not None ]
+    stats = {
+        'count': len(values),
+        'missing_count': missing_count,
+        'frequencies': {} if frequencies_truncated else { _encode_value_key(v): c for v, c in frequencies.items() },
+        'frequencies_truncated': frequencies_truncated,
+        'numeric': {
+            'count': len(numbers),
+            'sum': float(sum(numbers)),
+            'sum_squares': float(sum(n * n for n in numbers))
+        },
+        'min': None,
+        'max': None,
+        'quantiles': [],
+        'histogram': {'breaks': [], 'counts': []},
+        'zscore_counts': {'lower_than_minus_1z': 0, 'higher_than_plus_1z': 0}
+    }
+    if numbers:
+        array = numpy.array(numbers)
+        stats['min'] = float(array.min())
+        stats['max'] = float(array.max())
+        stats['quantiles'] = [ float(q) for q in numpy.quantile(array, COLUMN_STATS_QUANTILES) ]
+        counts, breaks = numpy.histogram(array, bins=COLUMN_STATS_HISTOGRAM_BINS)
+        stats['histogram'] = {'breaks': [ float(b) for b in breaks ], 'counts': [ int(c) for c in counts ]}
+        std_dev = array.std()
+        if std_dev > 0:
+            zscores = (array - array.mean()) / std_dev
+            stats['zscore_counts'] = {
+                'lower_than_minus_1z': int((zscores <= -1.0).sum()),
+                'higher_than_plus_1z': int((zscores >= 1.0).sum())
+            }
+    return stats
+
+def compute_column_stats(table_uuid, column_config):
+    """
+        Recomputes and saves the stats of a column and its subfields from db.data, over the
+        active students in the table.
+
+        table_uuid (str)
+        column_config (dict) db.columns document
+
+        Returns dict of stats documents keyed by column reference.
+    """
+    db = _get_db()
+    column_uuid = column_config['uuid']
+    values = {}
+    results = db.data.find({'table_uuid': table_uuid, 'status': 'active'}, [column_uuid])
+    for result in results:
+        for column_reference, value in _get_reference_values(column_config, result.get(column_uuid)).items():
+            values.setdefault(column_reference, []).append(value)
+    if not values:
+        # no students, but still record the references so the stats are not recomputed every time
+        values = { r: [] for r in _get_reference_values(column_config, None).keys() }
+    ret = {}
+    now = datetime.now()
+    for column_reference, reference_values in values.items():
+        stats = _make_stats(reference_values)
+        stats.update({
+            'column_reference': column_reference,
+            'column_uuid': column_uuid,
+            'table_uuid': table_uuid,
+            'format_version': COLUMN_STATS_FORMAT_VERSION,
+            'column_version': column_config.get('_config_version', 0),
+            'computed': now,
+            'changes_since_computed': 0
+        })
+        db.column_stats.replace_one({'column_reference': column_reference}, stats, upsert=True)
+        ret[column_reference] = stats
+    return ret
+
+def _is_stale(stats, column_config, now):
+    if stats.get('format_version') != COLUMN_STATS_FORMAT_VERSION:
+        return True
+    if stats.get('column_version') != column_config.get('_config_version', 0):
+        return True
+    if (now - stats['computed']).total_seconds() > COLUMN_STATS_MAX_AGE_SECONDS:
+        return True
+    if stats.get('changes_since_computed', 0) > COLUMN_STATS_MAX_CHANGED_FRACTION * max(stats.get('count', 0), 1):
+        return True
+    return False
+
+def get_column_stats(table_uuid, column_uuids):
+    """
+        Gets the stats of columns and their subfields, recomputing any that are missing or stale.
+
+        table_uuid (str)
+        column_uuids (list of str)
+
+        Returns dict of stats documents keyed by column reference. Columns that stats are not
+        kept for, or that do not belong to table_uuid, are absent.
+    """
+    column_configs = {
+        column_uuid: column_config
+        for column_uuid, column_config in get_cached_configs('columns', column_uuids).items()
+        if column_config.get('table_uuid') == table_uuid and _get_reference_values(column_config, None)
+    }
+    if not column_configs:
+        return {}
+    db = _get_db()
+    existing = {}
+    for stats in db.column_stats.find({'column_uuid': {'$in': list(column_configs.keys())}}):
+        existing.setdefault(stats['column_uuid'], {})[stats['column_reference']] = stats
+    ret = {}
+    now = datetime.now()
+    for column_uuid, column_config in column_configs.items():
+        expected_references = _get_reference_values(column_config, None).keys()
+        column_stats = existing.get(column_uuid, {})
+        if any(r not in column_stats.keys() or _is_stale(column_stats[r], column_config, now) for r in expected_references):
+            column_stats = compute_column_stats(table_uuid, column_config)
+        for column_reference in expected_references:
+            if column_reference in column_stats.keys():
+                ret[column_reference] = column_stats[column_reference]
+    return ret
+
+def record_data_changes(changes):
+    """
+        Updates stats incrementally for values that have just been saved for active students.
+        Stats that have not been computed yet are left alone.
+
+        changes (list of tuples) Each is (table_uuid, column_uuid, old value, new value); values
+            are None if missing.
+    """
+    changes = [ c for c in changes if c[2] != c[3] ]
+    if not changes:
+        return
+    column_configs = get_cached_configs('columns', [ c[1] for c in changes ])
+    incs = {}
+    frequency_incs = {}
+    too_long = set()
+    mins = {}
+    maxs = {}
+    for table_uuid, column_uuid, old_value, new_value in changes:
+        column_config = column_configs.get(column_uuid)
+        if column_config is None or column_config.get('table_uuid') != table_uuid:
+            continue
+        old_values = _get_reference_values(column_config, old_value)
+        new_values = _get_reference_values(column_config, new_value)
+        for column_reference in old_values.keys():
+            _old = old_values[column_reference]
+            _new = new_values[column_reference]
+            if _old == _new:
+                continue
+            inc = incs.setdefault(column_reference, Counter())
+            frequency_inc = frequency_incs.setdefault(column_reference, Counter())
+            inc['changes_since_computed'] += 1
+            for value, sign in [(_old, -1), (_new, 1)]:
+                if value is None:
+                    inc['missing_count'] += sign
+                else:
+                    frequency_inc['frequencies.' + _encode_value_key(str(value))] += sign
+                    if sign > 0 and len(str(value)) > COLUMN_STATS_MAX_VALUE_LENGTH:
+                        too_long.add(column_reference)
+                number = _to_number(value)
+                if number is not None:
+                    inc['numeric.count'] += sign
+                    inc['numeric.sum'] += sign * number
+                    inc['numeric.sum_squares'] += sign * number * number
+                    if sign > 0:
+                        mins[column_reference] = min(number, mins.get(column_reference, number))
+                        maxs[column_reference] = max(number, maxs.get(column_reference, number))
+    operations = []
+    for column_reference, inc in incs.items():
+        update = {'$inc': dict(inc)}
+        if column_reference in mins.keys():
+            update['$min'] = {'min': mins[column_reference]}
+            update['$max'] = {'max': maxs[column_reference]}
+        operations.append(UpdateOne({'column_reference': column_reference}, update))
+        frequency_inc = { k: v for k, v in frequency_incs[column_reference].items() if v != 0 }
+        if column_reference in too_long:
+            operations.append(UpdateOne(
+                {'column_reference': column_reference},
+                {'$set': {'frequencies': {}, 'frequencies_truncated': True}}
+            ))
+        elif frequency_inc:
+            operations.append(UpdateOne(
+                {'column_reference': column_reference, 'frequencies_truncated': False},
+                {'$inc': frequency_inc}
+            ))
+    if operations:
+        try:
+            _get_db().column_stats.bulk_write(operations, ordered=False)
+        except Exception as e:
+            # stats are recomputed once stale, so this is not worth failing a save over
+            logging.exception(e)
+
+def invalidate_column_stats(table_uuid):
+    """
+        Drops the stats of all columns in a table so they are recomputed when next read.
+        For changes that record_data_changes does not see, such as students becoming inactive.
+    """
+    try:
+        _get_db().column_stats.delete_many({'table_uuid': table_uuid})
+    except Exception as e:
+        logging.exception(e)
+
+def get_value_counts(stats, count_missing_as_empty=True):
+    """
+        Gets the number of students with each value (as str).
+
+        stats (dict) As returned by get_column_stats
+        count_missing_as_empty (bool) Whether to count missing values as ''; if False, they are
+            left out and can be read from stats['missing_count'].
+
+        Returns dict, or None if frequencies are not kept for this column.
+    """
+    if stats.get('frequencies_truncated'):
+        return None
+    ret = Counter()
+    for key, count in stats.get('frequencies', {}).items():
+        if count > 0:
+            ret[_decode_value_key(key)] += count
+    if count_missing_as_empty and stats.get('missing_count', 0) > 0:
+        ret[''] += stats['missing_count']
+    return dict(ret)
+
+def get_numeric_value_counts(stats):
+    """Returns a list of tuples of (number, count) of the numeric values, or None if frequencies are not kept for this column."""
+    value_counts = get_value_counts(stats, count_missing_as_empty=False)
+    if value_counts is None:
+        return None
+    numeric_counts = Counter()
+    for value, count in value_counts.items():
+        number = _to_number(value)
+        if number is not None:
+            numeric_counts[number] += count
+    return list(numeric_counts.items())
+
+def get_numeric_summary(stats):
+    """Returns a dict of count, mean, and std_dev (population) of the numeric values."""
+    numeric = stats.get('numeric', {})
+    count = numeric.get('count', 0)
+    if count <= 0:
+        return {'count': 0, 'mean': None, 'std_dev': None}
+    mean = numeric['sum'] / count
+    return {
+        'count': count,
+        'mean': mean,
+        'std_dev': math.sqrt(max(numeric['sum_squares'] / count - mean * mean, 0))
+    }
@@ -14,6 +14,8 @@ from sres.db import _get_db
 from sres.auth import is_user_administrator, get_auth_user, get_auth_user_oid
 from sres import utils
 from sres.jobs import APSJob
+from sres.aggregation_graph import invalidate_aggregation_graph
+from sres.config_cache import get_cached_config, get_cached_configs, invalidate_cached_config
 from bson import ObjectId
 
 
@@ -783,11 +785,13 @@ def sum_and_save_tags_for_a_set_of_columns(tableuuid, column_uuids, new_column_u
 
 def add_tag_to_column(column_uuid, tag_objectid):
     db = _get_db()
-    db.columns.update({'uuid': column_uuid}, {'$push': {'tags': ObjectId(tag_objectid)}})
+    db.columns.update({'uuid': column_uuid}, {'$push': {'tags': ObjectId(tag_objectid)}, '$inc': {'_config_version': 1}})
+    invalidate_cached_config('columns', [column_uuid])
 
 def remove_tag_from_column(column_uuid, tag_objectid):
     db = _get_db()
-    db.columns.update({'uuid': column_uuid}, {'$pull': {'tags': ObjectId(tag_objectid)}})
+    db.columns.update({'uuid': column_uuid}, {'$pull': {'tags': ObjectId(tag_objectid)}, '$inc': {'_config_version': 1}})
+    invalidate_cached_config('columns', [column_uuid])
 
 
 def add_tag_to_multientry(column_uuid, tag_objectid, multientry_label):
@@ -795,16 +799,18 @@ def add_tag_to_multientry(column_uuid, tag_objectid, multientry_label):
     multientry_label_number=0
     for a_multientry_label in db.columns.find({'uuid': column_uuid})[0]['multi_entry']['options']:
       if a_multientry_label['label'] == multientry_label:
-        db.columns.update({'uuid': column_uuid}, {'$push': {'multi_entry.options.' + str(multientry_label_number) + '.tags': ObjectId(tag_objectid)}})
+        db.columns.update({'uuid': column_uuid}, {'$push': {'multi_entry.options.' + str(multientry_label_number) + '.tags': ObjectId(tag_objectid)}, '$inc': {'_config_version': 1}})
       multientry_label_number+=1
+    invalidate_cached_config('columns', [column_uuid])
 
 def remove_tag_from_multientry(column_uuid, tag_objectid, multientry_label):
     db = _get_db()
     multientry_label_number=0
     for a_multientry_label in db.columns.find_one({'uuid': column_uuid})['multi_entry']['options']:
       if a_multientry_label['label'] == multientry_label:
-        db.columns.update({'uuid': column_uuid}, {'$pull': {'multi_entry.options.' + str(multientry_label_number) + '.tags': ObjectId(tag_objectid)}})
+        db.columns.update({'uuid': column_uuid}, {'$pull': {'multi_entry.options.' + str(multientry_label_number) + '.tags': ObjectId(tag_objectid)}, '$inc': {'_config_version': 1}})
       multientry_label_number+=1
+    invalidate_cached_config('columns', [column_uuid])
 
 
 def get_columns_with_tag_in_table(table_uuid, tag_objectid):
@@ -828,16 +834,12 @@ def load_multiple_columns_by_uuids(uuids, default_table):
         Returns a dict of loaded Column instances, keyed by uuid
     """
     loaded_columns = {}
-    db = _get_db()
     _uuids = []
     for uuid in uuids:
         _uuids.append(utils.clean_uuid(uuid))
     _uuids = list(set(_uuids))
-    # get from db
-    results = db.columns.find({
-        'uuid': {'$in': _uuids}
-    })
-    results = list(results)
+    # get from cache or db
+    results = get_cached_configs('columns', _uuids).values()
     # load
     for result in results:
         _uuid = result['uuid']
@@ -1091,7 +1093,10 @@ class Column:
                 filter['uuid'] = column_uuid
             if column_oid is not None:
                 filter['_id'] = column_oid
-            if preloaded_db_result is None:
+            if preloaded_db_result is None and column_oid is None and filter.get('uuid'):
+                result = get_cached_config('columns', filter['uuid'])
+                result = [result] if result is not None else []
+            elif preloaded_db_result is None:
                 result = self.db.columns.find(filter)
                 result = list(result)
             else:
@@ -1164,7 +1169,11 @@ class Column:
     def update(self, override_username=None):
         if self.table.is_user_authorised(username=override_username):
             self.config['_referenced_column_references'] = self.get_referenced_column_references()
-            result = self.db.columns.update_one({'uuid': self.config['uuid']}, {'$set': self.config})
+            result = self.db.columns.update_one({'uuid': self.config['uuid']}, {'$set': self.config, '$inc': {'_config_version': 1}})
+            invalidate_cached_config('columns', [self.config['uuid']])
+            invalidate_aggregation_graph(self.config['uuid'])
+            from sres.studentdata import invalidate_compiled_templates
+            invalidate_compiled_templates()
             return result.acknowledged
         else:
             return False
@@ -1196,7 +1205,8 @@ class Column:
     
     def delete(self, override_username=None):
         if self.table.is_user_authorised(username=override_username):
-            result = self.db.columns.update_one({'uuid': self.config['uuid']}, {'$set': {'workflow_state': 'deleted'}})
+            result = self.db.columns.update_one({'uuid': self.config['uuid']}, {'$set': {'workflow_state': 'deleted'}, '$inc': {'_config_version': 1}})
+            invalidate_cached_config('columns', [self.config['uuid']])
             return result.acknowledged
         return False
     
@@ -4,6 +4,7 @@ from dateutil import parser
 import collections
 import json
 import re
+import hashlib
 import cexprtk
 import logging
 
@@ -132,24 +133,140 @@ NUMERIC_COMPARATORS = [k for k, v in ALL_COMPARATORS.items() if v['numeric']]
 DATETIME_COMPARATORS = [k for k, v in ALL_COMPARATORS.items() if v['datetime']]
 STRING_COMPARATORS = [k for k, v in ALL_COMPARATORS.items() if v['string']]
 
-def _build_query_from_conditions(conditions):
+# Comparators that can be translated to a db.data filter
+PUSHDOWN_COMPARATORS = ['equal', 'not_equal', 'in', 'begins_with', 'is_empty', 'is_null', 'is_not_empty', 'less', 'less_or_equal', 'greater', 'greater_or_equal', 'between']
+# Comparators that can hold true for a blank value, and which therefore can only be pushed down
+# when all the data comes from one table (a student filtered out of one table would otherwise
+# still be evaluated from their records in the other tables, with a blank value)
+_PUSHDOWN_BLANK_TRUE_COMPARATORS = ['not_equal', 'is_empty', 'is_null', 'less', 'less_or_equal']
+# Stored values that are decoded from JSON into None, True or False, and then compared as text
+_PUSHDOWN_JSON_LITERAL_TEXTS = ['none', 'true', 'false']
+_PUSHDOWN_EMPTY_JSON_STRING_PATTERN = re.compile('^\\s*""\\s*$')
+
+def _is_pushdown_safe_text(value):
+    """Whether value (str) can be matched by a regex against stored values, as they would be decoded by run_conditions."""
+    if not value or not isinstance(value, str):
+        return False
+    if not all(32 <= ord(c) < 127 for c in value):
+        return False
+    if any(c in value for c in '"\\[{'):
+        return False
+    return True
+
+def _build_query_from_rule(rule, column, single_table=False):
     """
-        Builds a mongo find query/filter for db.data based on conditions (dict) per queryBuilder config.
+        Translates a single QueryBuilder rule into a db.data filter on the rule's column.
+        
+        The filter is deliberately loose: it is a superset of the records for which
+        Conditions.evaluate_conditions would find the rule to be true, so the rules still need to be
+        evaluated in Python on the records that are returned. Records holding arrays are always let
+        through. Returns None if the rule cannot be pushed down.
+        
+        rule (dict) QueryBuilder rule
+        column (Column) Loaded Column instance for rule['id']
+        single_table (boolean) Whether all the data being evaluated comes from column's table
     """
-    if not isinstance(conditions, collections.Mapping):
+    comparator = rule.get('operator')
+    value = rule.get('value')
+    if comparator not in PUSHDOWN_COMPARATORS:
         return None
-    filters = []
-    combiner = '$and' if conditions['condition'] == 'AND' else '$or'
-    for rule in conditions['rules']:
-        if 'rules' in rule.keys():
-            # the current 'rule' is actually a group, so, need to recurse
-            filters.append(build_query_from_conditions(rule))
+    if comparator in _PUSHDOWN_BLANK_TRUE_COMPARATORS and not single_table:
+        return None
+    if not column.column_loaded or column.is_system_column or column.subfield is not None or column.magic_formatter:
+        return None
+    if value and '$' in str(value):
+        # right hand side is a column reference, substituted per student
+        return None
+    column_uuid = column.config['uuid']
+    alternatives = []
+    non_number = {'$not': {'$type': 'number'}, '$ne': None}
+    non_string = {'$not': {'$type': 'string'}, '$ne': None}
+    if comparator in ['equal', 'not_equal', 'less', 'less_or_equal', 'greater', 'greater_or_equal'] and utils.is_number(value):
+        # numbers are compared numerically; anything that is not a stored number may be compared
+        # numerically (from text), as datetimes or as text, so needs to be evaluated later
+        _operators = {
+            'equal': '$eq',
+            'not_equal': '$ne',
+            'less': '$lt',
+            'less_or_equal': '$lte',
+            'greater': '$gt',
+            'greater_or_equal': '$gte'
+        }
+        alternatives.append({ _operators[comparator]: float(value) })
+        alternatives.append({'$not': {'$type': 'number'}} if comparator in _PUSHDOWN_BLANK_TRUE_COMPARATORS else non_number)
+    elif comparator == 'between':
+        if not isinstance(value, list) or len(value) != 2 or not utils.is_number(value[0]) or not utils.is_number(value[1]):
+            return None
+        alternatives.append({'$gt': float(value[0]), '$lt': float(value[1])})
+        alternatives.append(non_number)
+    elif comparator in ['equal', 'not_equal']:
+        if not _is_pushdown_safe_text(value) or utils.is_datetime(value) or value.lower() in _PUSHDOWN_JSON_LITERAL_TEXTS:
+            return None
+        pattern = re.compile('^\\s*"?' + re.escape(value) + '"?\\s*$', re.IGNORECASE)
+        if comparator == 'equal':
+            alternatives.append({'$regex': pattern})
+            alternatives.append(non_string)
         else:
-            pass
+            alternatives.append({'$not': re.compile('^' + re.escape(value) + '$', re.IGNORECASE)})
+    elif comparator == 'in':
+        if not isinstance(value, str):
+            return None
+        items = value.split(',')
+        if not all(_is_pushdown_safe_text(item) and item.lower() not in _PUSHDOWN_JSON_LITERAL_TEXTS for item in items):
+            return None
+        pattern = re.compile('^\\s*"?(' + '|'.join(re.escape(item) for item in items) + ')"?\\s*$', re.IGNORECASE)
+        alternatives.append({'$regex': pattern})
+        alternatives.append(non_string)
+    elif comparator == 'begins_with':
+        if not _is_pushdown_safe_text(value) or any(t.startswith(value.lower()) for t in _PUSHDOWN_JSON_LITERAL_TEXTS):
+            return None
+        alternatives.append({'$regex': re.compile('^\\s*"?' + re.escape(value), re.IGNORECASE)})
+        alternatives.append(non_string)
+    elif comparator in ['is_empty', 'is_null']:
+        alternatives.append({'$in': [None, '']})
+        alternatives.append({'$regex': _PUSHDOWN_EMPTY_JSON_STRING_PATTERN})
+    elif comparator == 'is_not_empty':
+        alternatives.append({'$nin': [None, ''], '$not': _PUSHDOWN_EMPTY_JSON_STRING_PATTERN})
+    else:
+        return None
+    alternatives.append({'$type': 'array'})
     return {
-        combiner: filters
+        '$or': [ {column_uuid: alternative} for alternative in alternatives ]
     }
 
+def _build_query_from_conditions(conditions, preloaded_columns, single_table=False):
+    """
+        Builds mongo find filters for db.data based on conditions (dict) per queryBuilder config.
+        
+        Only rules that must all hold true (i.e. in the top-level AND group, or in AND groups
+        nested within it) are translated. The filters only narrow down which records need to be
+        fetched; the conditions must still be evaluated against what is returned.
+        
+        conditions (dict) QueryBuilder rules object
+        preloaded_columns (dict of Column instances, keyed by column reference)
+        single_table (boolean) Whether all the referenced columns are in the same table
+        
+        Returns a dict of lists of filters, keyed by table_uuid.
+    """
+    filters = {}
+    if not isinstance(conditions, collections.Mapping):
+        return filters
+    if conditions.get('condition') != 'AND' or conditions.get('not'):
+        return filters
+    for rule in conditions.get('rules', []):
+        if 'rules' in rule.keys():
+            # the current 'rule' is actually a group, so, need to recurse
+            for table_uuid, table_filters in _build_query_from_conditions(rule, preloaded_columns, single_table).items():
+                filters.setdefault(table_uuid, []).extend(table_filters)
+        else:
+            column = preloaded_columns.get(rule.get('id'))
+            if column is None:
+                continue
+            rule_filter = _build_query_from_rule(rule, column, single_table)
+            if rule_filter is not None:
+                filters.setdefault(column.config['table_uuid'], []).append(rule_filter)
+    return filters
+
 class AdvancedConditions:
     
     def __init__(self, conditions):
@@ -329,20 +446,46 @@ class OpenConditions:
                     # no good! Not authorised for all the needed tables.
                     logging.warning(f'Not authorised for all needed tables to run conditions [{all_table_uuids}]')
                     return ret
+        # cache up all Column instances
+        preloaded_columns = {}
+        for column_reference in all_column_references:
+            preloaded_columns[column_reference] = Column()
+            preloaded_columns[column_reference].load(column_reference)
+        # push down what conditions we can into the db query
+        pushdown_filters = _build_query_from_conditions(
+            self.conditions,
+            preloaded_columns,
+            single_table=(len(all_table_uuids) == 1)
+        )
+        table_filters = []
+        for table_uuid in all_table_uuids:
+            if table_uuid in pushdown_filters.keys():
+                table_filters.append({'$and': [{'table_uuid': table_uuid}] + pushdown_filters[table_uuid]})
+            else:
+                table_filters.append({'table_uuid': table_uuid})
+        query = {
+            '$and': [
+                {'status': 'active'},
+                {'$or': table_filters}
+            ]
+        }
+        if pushdown_filters and len(all_table_uuids) > 1:
+            # students must pass the pushed down filters in each of those tables, so only
+            # fetch records for students who do
+            candidate_sids = None
+            for table_filter in table_filters:
+                if '$and' in table_filter.keys():
+                    sids = set(self.db.data.distinct('sid', {'$and': [{'status': 'active'}, table_filter]}))
+                    candidate_sids = sids if candidate_sids is None else candidate_sids.intersection(sids)
+            if candidate_sids is not None:
+                if not candidate_sids:
+                    ret['all_column_references'] = all_column_references
+                    ret['all_column_uuids'] = all_column_uuids
+                    return ret
+                query['$and'].append({'sid': {'$in': list(candidate_sids)}})
         # extract relevant data from db into memory
-        #exists = []
-        #for column_uuid in all_column_uuids:
-        #    exists.append({'{}'.format(column_uuid): {'$exists': True}})
         fields = all_column_uuids + ['table', 'table_uuid', 'status'] + NAME_FIELDS + IDENTIFIER_FIELDS
-        results = self.db.data.find(
-            {
-                '$and': [
-                    {'status': 'active'},
-                    {'table_uuid': {'$in': all_table_uuids}}
-                ]
-            }, 
-            fields
-        )
+        results = self.db.data.find(query, fields)
         results = list(results)
         # populate a dict with all fields from the results dict
         student_data = {}
@@ -365,11 +508,6 @@ class OpenConditions:
                         student_data[idx][column_uuid] = result[column_uuid]
                 else:
                     student_data[idx][column_uuid] = ''
-        # cache up all Column instances
-        preloaded_columns = {}
-        for column_reference in all_column_references:
-            preloaded_columns[column_reference] = Column()
-            preloaded_columns[column_reference].load(column_reference)
         # use Conditions.evaluate_conditions to evaluate whether the conditions apply to each student
         student_outcomes = {}
         default_table = Table()
@@ -394,6 +532,307 @@ class OpenConditions:
         ret['all_column_uuids'] = all_column_uuids
         return ret
         
+# Compiled rule trees, keyed by a hash of the QueryBuilder rules object
+_COMPILED_CONDITIONS = {}
+_COMPILED_CONDITIONS_MAX_SIZE = 1000
+# Two unrelated days to parse datetimes against; a value that parses the same against both names its own date
+_DATETIME_PARSE_DEFAULTS = (datetime.datetime(2000, 1, 1), datetime.datetime(2001, 2, 3))
+
+def compile_conditions(conditions):
+    """
+        Returns a CompiledConditions for conditions (dict, QueryBuilder rules object),
+        reusing a previously compiled one for identical rules.
+    """
+    key = hashlib.sha1(json.dumps(conditions, sort_keys=True, default=str).encode()).hexdigest()
+    compiled_conditions = _COMPILED_CONDITIONS.get(key)
+    if compiled_conditions is None:
+        compiled_conditions = CompiledConditions(conditions)
+        if len(_COMPILED_CONDITIONS) >= _COMPILED_CONDITIONS_MAX_SIZE:
+            _COMPILED_CONDITIONS.clear()
+        _COMPILED_CONDITIONS[key] = compiled_conditions
+    return compiled_conditions
+
+class _RuleValue:
+    
+    """The right hand side of a rule, with its numeric, datetime and string forms worked out once"""
+    
+    def __init__(self, value):
+        self.value = value
+        self.string = str(value)
+        self.lower = self.string.lower()
+        self.items = [_RuleValue(v) for v in value] if isinstance(value, list) else None
+        self._is_number = None
+        self._number = None
+        self._is_datetime = None
+        self._datetime = None
+        self._in_list = None
+        self._regex = None
+    
+    def is_number(self):
+        if self._is_number is None:
+            self._is_number = utils.is_number(self.value)
+            if self._is_number:
+                self._number = float(self.value)
+        return self._is_number
+    
+    def number(self):
+        self.is_number()
+        return self._number
+    
+    def is_datetime(self):
+        if self._is_datetime is None:
+            try:
+                parsed = [ parser.parse(self.value, default=default) for default in _DATETIME_PARSE_DEFAULTS ]
+                self._is_datetime = True
+            except:
+                self._is_datetime = False
+            else:
+                # partial values such as '10:00' or 'Monday' are relative to today, so are parsed afresh each time
+                if parsed[0] == parsed[1]:
+                    self._datetime = parsed[0]
+        return self._is_datetime
+    
+    def as_datetime(self):
+        if not self.is_datetime():
+            return None
+        if self._datetime is not None:
+            return self._datetime
+        return parser.parse(self.value)
+    
+    def in_list(self):
+        if self._in_list is None:
+            self._in_list = self.lower.split(',')
+        return self._in_list
+    
+    def regex(self):
+        if self._regex is None:
+            self._regex = re.compile(self.string)
+        return self._regex
+
+class _CompiledRule:
+    
+    """A single (non-group) QueryBuilder rule"""
+    
+    def __init__(self, rule):
+        self.column_reference = rule['id']
+        self.comparator = rule['operator']
+        expr_right = rule['value'] # the value, or 'operator', or right hand side of the expression
+        # a potential column reference on the right hand side needs to be substituted per student
+        self.substitute_right = True if (expr_right and '$' in str(expr_right)) else False
+        self.expr_right = expr_right
+        self.right = _RuleValue(expr_right)
+    
+    def _get_column(self, context):
+        column = None
+        if context.preloaded_columns is not None:
+            # use Column instance cache please
+            column = context.preloaded_columns.get(self.column_reference)
+        if column is None:
+            column = Column(preloaded_table=context.default_table)
+            if not column.load(self.column_reference):
+                return None
+            if context.preloaded_columns is not None:
+                context.preloaded_columns[self.column_reference] = column
+        return column
+    
+    def evaluate(self, context, blank_replacement=''):
+        """
+            context (Conditions) Supplies identifier, student_data and the column helpers.
+            blank_replacement (any)
+        """
+        right = self.right
+        if self.substitute_right:
+            # potential column reference
+            if re.match(utils.DELIMITED_COLUMN_REFERENCE_PATTERN, self.expr_right):
+                right = _RuleValue(substitute_text_variables(
+                    self.expr_right,
+                    context.identifier,
+                    context.student_data.table.config['uuid'],
+                    preloaded_student_data=context.student_data,
+                    preloaded_columns=context.preloaded_columns
+                )['new_text'])
+        comparator = self.comparator
+        # get data (expr_left)
+        column = self._get_column(context)
+        if column is None:
+            return False
+        if context.student_data_type == 'class':
+            data_temp = context.student_data.get_data(
+                column_uuid=column.config['uuid'], 
+                preloaded_column=column, 
+                default_value=blank_replacement # default to blank
+            )
+        elif context.student_data_type == 'dict':
+            data_temp = {
+                'data': context.student_data.get(column.config['uuid'], blank_replacement), # default to blank
+                'success': True
+            }
+        else:
+            # something misconfigured
+            data_temp = {
+                'success': False,
+                'data': blank_replacement
+            }
+        if not data_temp['success']:
+            return False
+        # determine expr_left
+        _expr_left_do_not_stringify = False
+        if column.subfield is not None:
+            try:
+                if isinstance(data_temp['data'], list) and column.subfield < len(data_temp['data']):
+                    expr_left = data_temp['data'][column.subfield]
+                    _expr_left_do_not_stringify = True
+                else:
+                    expr_left = blank_replacement
+            except:
+                return False
+        else:
+            expr_left = data_temp['data']
+        # convert if necessary for blank_replacement
+        if blank_replacement != '' and (expr_left == '' or expr_left is None):
+            expr_left = blank_replacement
+        # determine how to perform the comparison
+        mode = 'string'
+        expr_right = right.value
+        expr_right_lower = right.lower
+        if (comparator == 'between' or comparator == 'not_between') and right.items is not None:
+            if right.items[0].is_number() and right.items[1].is_number() and utils.is_number(expr_left) and comparator in NUMERIC_COMPARATORS:
+                expr_left = float(expr_left)
+                expr_right = [right.items[0].number(), right.items[1].number()]
+                mode = 'numeric'
+            elif right.items[0].is_datetime() and right.items[1].is_datetime() and utils.is_datetime(expr_left) and comparator in DATETIME_COMPARATORS:
+                expr_left = parser.parse(expr_left)
+                expr_right = [right.items[0].as_datetime(), right.items[1].as_datetime()]
+                mode = 'datetime'
+        elif (comparator in ['contains', 'not_contains', 'in', 'not_in', 'begins_with', 'not_begins_with', 'ends_with', 'not_ends_with', 'matches_regex', 'not_matches_regex']):
+            if type(expr_left) is list:
+                expr_left = json.dumps(expr_left, default=str)
+            else:
+                expr_left = str(expr_left)
+            expr_right = right.string
+        else:
+            if comparator in NUMERIC_COMPARATORS and right.is_number() and utils.is_number(expr_left):
+                expr_left = float(expr_left)
+                expr_right = right.number()
+                mode = 'numeric'
+            elif comparator in DATETIME_COMPARATORS and right.is_datetime() and utils.is_datetime(expr_left):
+                expr_left = parser.parse(expr_left)
+                expr_right = right.as_datetime()
+                mode = 'datetime'
+            else:
+                # operate as strings...
+                if comparator == 'is_null': comparator = 'is_empty'
+                if comparator == 'is_not_null': comparator = 'is_not_empty'
+                if not _expr_left_do_not_stringify:
+                    if type(expr_left) is list:
+                        expr_left = json.dumps(expr_left, default=str)
+                    else:
+                        expr_left = str(expr_left)
+                expr_right = right.string
+        # perform the comparison
+        if comparator == 'equal':
+            if mode == 'string':
+                return expr_left.lower() == expr_right_lower
+            else:
+                return expr_left == expr_right
+        elif comparator == 'not_equal':
+            if mode == 'string':
+                return expr_left.lower() != expr_right_lower
+            else:
+                return expr_left != expr_right
+        elif comparator == 'in':
+            return expr_left.lower() in right.in_list()
+        elif comparator == 'not_in':
+            return expr_left.lower() not in right.in_list()
+        elif comparator == 'less':
+            return expr_left < expr_right
+        elif comparator == 'less_or_equal':
+            return expr_left <= expr_right
+        elif comparator == 'greater':
+            return expr_left > expr_right
+        elif comparator == 'greater_or_equal':
+            return expr_left >= expr_right
+        elif comparator == 'between' or comparator == 'not_between':
+            if isinstance(expr_right, list):
+                # OK
+                if comparator == 'between':
+                    return expr_right[0] < expr_left < expr_right[1]
+                elif comparator == 'not_between':
+                    return not (expr_right[0] < expr_left < expr_right[1])
+            else:
+                # misconfiguration
+                return False
+        elif comparator == 'begins_with':
+            return expr_left.lower().startswith(expr_right_lower)
+        elif comparator == 'not_begins_with':
+            return not expr_left.lower().startswith(expr_right_lower)
+        elif comparator == 'contains':
+            return expr_right_lower in expr_left.lower()
+        elif comparator == 'not_contains':
+            return not (expr_right_lower in expr_left.lower())
+        elif comparator == 'ends_with':
+            return expr_left.lower().endswith(expr_right_lower)
+        elif comparator == 'not_ends_with':
+            return not(expr_left.lower().endswith(expr_right_lower))
+        elif comparator == 'is_empty':
+            try:
+                return len(expr_left) == 0
+            except:
+                return expr_left == ''
+        elif comparator == 'is_not_empty':
+            try:
+                return len(expr_left) != 0
+            except:
+                return expr_left != ''
+        elif comparator == 'matches_regex':
+            return True if right.regex().search(expr_left) is not None else False
+        elif comparator == 'not_matches_regex':
+            return False if right.regex().search(expr_left) is not None else True
+        else:
+            # problem, unrecognised comparator/operator!
+            return False
+
+class CompiledConditions:
+    
+    """
+        A QueryBuilder rules object turned into a reusable predicate. Constants on the right hand
+        side are typed (numeric/datetime/string) and regexes compiled once, rather than for every
+        student the conditions are evaluated for.
+    """
+    
+    def __init__(self, conditions):
+        """
+            conditions (dict) QueryBulder rules object
+        """
+        self.combiner = conditions['condition']
+        self._not = 'not' in conditions.keys() and conditions['not']
+        self.rules = []
+        for rule in conditions['rules']:
+            if 'rules' in rule.keys():
+                # the current 'rule' is actually a group
+                self.rules.append(CompiledConditions(rule))
+            else:
+                self.rules.append(_CompiledRule(rule))
+    
+    def evaluate(self, context, blank_replacement=''):
+        """
+            Returns True or False if rules and combiner hold true for the student in context.
+            
+            context (Conditions) Supplies identifier, student_data and the column helpers.
+            blank_replacement (any)
+        """
+        if self.combiner == 'AND':
+            interim_outcome = all(rule.evaluate(context, blank_replacement=blank_replacement) for rule in self.rules)
+        elif self.combiner == 'OR':
+            interim_outcome = any(rule.evaluate(context, blank_replacement=blank_replacement) for rule in self.rules)
+        else:
+            # something went wrong...
+            return False
+        if self._not:
+            return not interim_outcome
+        else:
+            return interim_outcome
+
 class Conditions:
     
     """Generic class for processing QueryBuilder conditions"""
@@ -425,211 +864,7 @@ class Conditions:
             
             Returns simply a True or False if rules and combiner ('condition' in queryBuilder parlance) hold true.
         """
-        combiner = self.conditions['condition']
-        rules = self.conditions['rules']
-        _not = 'not' in self.conditions.keys() and self.conditions['not']
-        rule_outcomes = [False for r in rules]
-        r = 0
-        for rule in rules:
-            if 'rules' in rule.keys():
-                # the current 'rule' is actually a group, so, need to recurse
-                conditions = Conditions(
-                    identifier=self.identifier,
-                    conditions=rule,
-                    student_data=self.student_data,
-                    preloaded_columns=self.preloaded_columns
-                )
-                rule_outcomes[r] = conditions.evaluate_conditions(blank_replacement=blank_replacement)
-            else:
-                column_reference = rule['id']
-                expr_right = rule['value'] # the value, or 'operator', or right hand side of the expression
-                if expr_right and '$' in str(expr_right):
-                    # potential column reference
-                    if re.match(utils.DELIMITED_COLUMN_REFERENCE_PATTERN, expr_right):
-                        _substituted_expr_right = substitute_text_variables(
-                            expr_right,
-                            self.identifier,
-                            self.student_data.table.config['uuid'],
-                            preloaded_student_data=self.student_data,
-                            preloaded_columns=self.preloaded_columns
-                        )['new_text']
-                        expr_right = _substituted_expr_right
-                comparator = rule['operator']
-                # get data (expr_left)
-                column = None
-                if self.preloaded_columns is not None:
-                    # use Column instance cache please
-                    if column_reference in self.preloaded_columns.keys():
-                        column = self.preloaded_columns[column_reference]
-                    else:
-                        # need to load...
-                        pass
-                if column is None:
-                    column = Column(preloaded_table=self.default_table)
-                    if not column.load(column_reference):
-                        rule_outcomes[r] = False
-                        continue
-                if self.student_data_type == 'class':
-                    data_temp = self.student_data.get_data(
-                        column_uuid=column.config['uuid'], 
-                        preloaded_column=column, 
-                        default_value=blank_replacement # default to blank
-                    )
-                elif self.student_data_type == 'dict':
-                    data_temp = {
-                        'data': blank_replacement
-                    }
-                    if column.config['uuid'] in self.student_data.keys():
-                        data_temp['data'] = self.student_data[column.config['uuid']]
-                    else:
-                        data_temp['data'] = blank_replacement # default to blank
-                    data_temp['success'] = True
-                else:
-                    # something misconfigured
-                    data_temp = {
-                        'success': False,
-                        'data': blank_replacement
-                    }
-                #logging.debug(str(self.identifier) + ' ' + str(data_temp))
-                if not data_temp['success']:
-                    rule_outcomes[r] = False
-                    continue
-                # determine expr_left
-                _expr_left_do_not_stringify = False
-                if column.subfield is not None:
-                    try:
-                        if isinstance(data_temp['data'], list) and column.subfield < len(data_temp['data']):
-                            expr_left = data_temp['data'][column.subfield]
-                            _expr_left_do_not_stringify = True
-                        else:
-                            expr_left = blank_replacement
-                    except:
-                        rule_outcomes[r] = False
-                        continue
-                else:
-                    expr_left = data_temp['data']
-                # convert if necessary for blank_replacement
-                if blank_replacement != '' and (expr_left == '' or expr_left is None):
-                    expr_left = blank_replacement
-                # determine how to perform the comparison
-                mode = 'string'
-                if (comparator == 'between' or comparator == 'not_between') and isinstance(expr_right, list):
-                    if utils.is_number(expr_right[0]) and utils.is_number(expr_right[1]) and utils.is_number(expr_left) and comparator in NUMERIC_COMPARATORS:
-                        expr_left = float(expr_left)
-                        expr_right = [float(expr_right[0]), float(expr_right[1])]
-                        mode = 'numeric'
-                    elif utils.is_datetime(expr_right[0]) and utils.is_datetime(expr_right[1]) and utils.is_datetime(expr_left) and comparator in DATETIME_COMPARATORS:
-                        expr_left = parser.parse(expr_left)
-                        expr_right = [parser.parse(expr_right[0]), parser.parse(expr_right[1])]
-                        mode = 'datetime'
-                elif (comparator in ['contains', 'not_contains', 'in', 'not_in', 'begins_with', 'not_begins_with', 'ends_with', 'not_ends_with', 'matches_regex', 'not_matches_regex']):
-                    if type(expr_left) is list:
-                        expr_left = json.dumps(expr_left, default=str)
-                    else:
-                        expr_left = str(expr_left)
-                    expr_right = str(expr_right)
-                else:
-                    if utils.is_number(expr_right) and utils.is_number(expr_left) and comparator in NUMERIC_COMPARATORS:
-                        expr_left = float(expr_left)
-                        expr_right = float(expr_right)
-                        mode = 'numeric'
-                    elif utils.is_datetime(expr_right) and utils.is_datetime(expr_left) and comparator in DATETIME_COMPARATORS:
-                        expr_left = parser.parse(expr_left)
-                        expr_right = parser.parse(expr_right)
-                        mode = 'datetime'
-                    else:
-                        # operate as strings...
-                        if comparator == 'is_null': comparator = 'is_empty'
-                        if comparator == 'is_not_null': comparator = 'is_not_empty'
-                        if not _expr_left_do_not_stringify:
-                            if type(expr_left) is list:
-                                expr_left = json.dumps(expr_left, default=str)
-                            else:
-                                expr_left = str(expr_left)
-                        expr_right = str(expr_right)
-                # perform the comparison
-                if comparator == 'equal':
-                    if mode == 'string':
-                        rule_outcomes[r] = expr_left.lower() == expr_right.lower()
-                    else:
-                        rule_outcomes[r] = expr_left == expr_right
-                elif comparator == 'not_equal':
-                    if mode == 'string':
-                        rule_outcomes[r] = expr_left.lower() != expr_right.lower()
-                    else:
-                        rule_outcomes[r] = expr_left != expr_right
-                elif comparator == 'in':
-                    rule_outcomes[r] = expr_left.lower() in expr_right.lower().split(',')
-                elif comparator == 'not_in':
-                    rule_outcomes[r] = expr_left.lower() not in expr_right.lower().split(',')
-                elif comparator == 'less':
-                    rule_outcomes[r] = expr_left < expr_right
-                elif comparator == 'less_or_equal':
-                    rule_outcomes[r] = expr_left <= expr_right
-                elif comparator == 'greater':
-                    rule_outcomes[r] = expr_left > expr_right
-                elif comparator == 'greater_or_equal':
-                    rule_outcomes[r] = expr_left >= expr_right
-                elif comparator == 'between' or comparator == 'not_between':
-                    if isinstance(expr_right, list):
-                        # OK
-                        if comparator == 'between':
-                            rule_outcomes[r] = expr_right[0] < expr_left < expr_right[1]
-                        elif comparator == 'not_between':
-                            rule_outcomes[r] = not (expr_right[0] < expr_left < expr_right[1])
-                    else:
-                        # misconfiguration
-                        rule_outcomes[r] = False
-                elif comparator == 'begins_with':
-                    rule_outcomes[r] = expr_left.lower().startswith(expr_right.lower())
-                elif comparator == 'not_begins_with':
-                    rule_outcomes[r] = not expr_left.lower().startswith(expr_right.lower())
-                elif comparator == 'contains':
-                    rule_outcomes[r] = expr_right.lower() in expr_left.lower()
-                elif comparator == 'not_contains':
-                    rule_outcomes[r] = not (expr_right.lower() in expr_left.lower())
-                elif comparator == 'ends_with':
-                    rule_outcomes[r] = expr_left.lower().endswith(expr_right.lower())
-                elif comparator == 'not_ends_with':
-                    rule_outcomes[r] = not(expr_left.lower().endswith(expr_right.lower()))
-                elif comparator == 'is_empty':
-                    try:
-                        rule_outcomes[r] = len(expr_left) == 0
-                    except:
-                        rule_outcomes[r] = expr_left == ''
-                elif comparator == 'is_not_empty':
-                    try:
-                        rule_outcomes[r] = len(expr_left) != 0
-                    except:
-                        rule_outcomes[r] = expr_left != ''
-                elif comparator == 'matches_regex':
-                    rule_outcomes[r] = True if re.search(expr_right, expr_left) is not None else False
-                elif comparator == 'not_matches_regex':
-                    rule_outcomes[r] = False if re.search(expr_right, expr_left) is not None else True
-                else:
-                    # problem, unrecognised comparator/operator!
-                    rule_outcomes[r] = False
-            r += 1
-        # finished looping through rules. decide on interim final outcome
-        interim_outcome = None
-        if combiner == 'AND':
-            if False in rule_outcomes:
-                interim_outcome = False
-            else:
-                interim_outcome = True
-        if combiner == 'OR':
-            if True in rule_outcomes:
-                interim_outcome = True
-            else:
-                interim_outcome = False
-        if interim_outcome is not None:
-            if _not:
-                return not interim_outcome
-            else:
-                return interim_outcome
-        else:
-            # something went wrong...
-            return False
+        return compile_conditions(self.conditions).evaluate(self, blank_replacement=blank_replacement)
     
     def extract_all_column_references(self, remove_duplicates=True):
         """
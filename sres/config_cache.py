@@ -0,0 +1,101 @@
+from copy import deepcopy
+from datetime import datetime
+from threading import Lock
+import os
+
+from sres.db import _get_db
+
+# The collections whose documents may be cached. Anything that writes to them must
+# also {'$inc': {'_config_version': 1}} and call invalidate_cached_config.
+CONFIG_CACHE_COLLECTIONS = ['columns', 'tables']
+# How long a cached document is trusted before its _config_version is checked against the db again
+CONFIG_CACHE_TTL_SECONDS = 5
+# Most documents cached per collection; everything is dropped when this is reached
+CONFIG_CACHE_MAX_DOCUMENTS = 5000
+
+# Cached documents keyed by collection name then uuid. Values are dicts of
+# document, version (int), and checked (datetime).
+_CONFIG_CACHE = {
+    'pid': None,
+    'collections': {}
+}
+_CONFIG_CACHE_LOCK = Lock()
+
+def _get_collection_cache(collection_name):
+    # a forked process starts with an empty cache
+    if _CONFIG_CACHE['pid'] != os.getpid():
+        _CONFIG_CACHE['pid'] = os.getpid()
+        _CONFIG_CACHE['collections'] = {}
+    return _CONFIG_CACHE['collections'].setdefault(collection_name, {})
+
+def invalidate_cached_config(collection_name, uuids=None):
+    """
+        Drops cached documents so that they are read from the db next time.
+
+        collection_name (str) e.g. 'columns'
+        uuids (list of str|None) If None, drops the whole collection.
+    """
+    with _CONFIG_CACHE_LOCK:
+        collection_cache = _get_collection_cache(collection_name)
+        if uuids is None:
+            collection_cache.clear()
+        else:
+            for uuid in uuids:
+                collection_cache.pop(uuid, None)
+
+def get_cached_configs(collection_name, uuids):
+    """
+        Gets documents by uuid, from this process's cache where possible. Cached documents
+        older than CONFIG_CACHE_TTL_SECONDS are revalidated by comparing _config_version
+        in one small query, and only those that changed are read again.
+
+        collection_name (str) One of CONFIG_CACHE_COLLECTIONS
+        uuids (list of str)
+
+        Returns a dict of documents keyed by uuid; missing uuids are absent. The documents
+        are copies and can be modified by the caller.
+    """
+    now = datetime.now()
+    uuids = list(dict.fromkeys([ u for u in uuids if u ]))
+    found = {}
+    to_check = {}
+    with _CONFIG_CACHE_LOCK:
+        collection_cache = _get_collection_cache(collection_name)
+        for uuid in uuids:
+            entry = collection_cache.get(uuid)
+            if entry is None:
+                continue
+            if (now - entry['checked']).total_seconds() < CONFIG_CACHE_TTL_SECONDS:
+                found[uuid] = entry['document']
+            else:
+                to_check[uuid] = entry
+    db = _get_db()
+    collection = db[collection_name]
+    to_fetch = [ u for u in uuids if u not in found.keys() and u not in to_check.keys() ]
+    if to_check:
+        for result in collection.find({'uuid': {'$in': list(to_check.keys())}}, ['uuid', '_config_version']):
+            entry = to_check[result['uuid']]
+            if entry['version'] == result.get('_config_version', 0):
+                entry['checked'] = now
+                found[result['uuid']] = entry['document']
+        to_fetch.extend([ u for u in to_check.keys() if u not in found.keys() ])
+    if to_fetch:
+        results = list(collection.find({'uuid': {'$in': to_fetch}}))
+        with _CONFIG_CACHE_LOCK:
+            collection_cache = _get_collection_cache(collection_name)
+            if len(collection_cache) + len(results) > CONFIG_CACHE_MAX_DOCUMENTS:
+                collection_cache.clear()
+            for result in results:
+                collection_cache[result['uuid']] = {
+                    'document': result,
+                    'version': result.get('_config_version', 0),
+                    'checked': now
+                }
+                found[result['uuid']] = result
+        # forget anything that no longer exists
+        invalidate_cached_config(collection_name, [ u for u in to_fetch if u not in found.keys() ])
+    return { uuid: deepcopy(found[uuid]) for uuid in uuids if uuid in found.keys() }
+
+def get_cached_config(collection_name, uuid):
+    """Gets one document by uuid as per get_cached_configs. Returns dict, or None if not found."""
+    return get_cached_configs(collection_name, [uuid]).get(uuid)
@@ -1,6 +1,7 @@
 from flask import current_app, g
 import json
 import requests
+from requests.adapters import HTTPAdapter
 import pandas as pd
 from copy import deepcopy
 from datetime import datetime, timedelta
@@ -10,6 +11,9 @@ import bleach
 from natsort import natsorted, ns
 from queue import Queue
 from threading import Thread
+from concurrent.futures import ThreadPoolExecutor
+import time
+import random
 from bs4 import BeautifulSoup
 import base64
 import os, sys
@@ -21,7 +25,7 @@ import pickle
 from sres.db import DbCookie, _get_db
 from sres.auth import get_auth_user, is_user_administrator
 from sres import utils
-from sres.studentdata import StudentData, run_aggregation_bulk
+from sres.studentdata import StudentData, SAVE_MANY_BATCH_SIZE, run_aggregation_bulk
 from sres.tables import Table, USER_ROLES
 from sres.columns import find_column_by_name, Column, ColumnReferences
 from sres.aggregatorcolumns import find_aggregators_of_columns, AggregatorColumn
@@ -34,6 +38,64 @@ def _encrypt_auth_token(unencrypted_token):
 def _decrypt_auth_token(encrypted_token):
     return utils.decrypt_from_hex(encrypted_token)
 
+# Most pages of one paginated Canvas response fetched at the same time
+CANVAS_PAGINATION_WORKERS = 4
+# Most pages followed for one paginated Canvas response
+CANVAS_PAGINATION_MAX_PAGES = 200
+# How many times a throttled or temporarily failed request is retried, with exponential backoff from CANVAS_REQUEST_BACKOFF_SECONDS
+CANVAS_REQUEST_MAX_RETRIES = 5
+CANVAS_REQUEST_BACKOFF_SECONDS = 1
+CANVAS_REQUEST_TIMEOUT_SECONDS = 120
+# Methods that are safe to send again after a timeout or server error. Others (e.g. POSTing a
+# conversation) may already have been processed, so they are only retried when throttled.
+CANVAS_RETRYABLE_METHODS = ['GET', 'HEAD']
+# Requests slow down once x-rate-limit-remaining falls below this (Canvas buckets start at 700)
+CANVAS_RATE_LIMIT_LOW_WATERMARK = 150
+
+def _parse_link_header(link_header):
+    """Parses a Link header into a dict of unquoted url keyed by rel."""
+    parsed_link_headers = {}
+    for link_string in link_header.split(','):
+        link_url = re.findall('(?<=<).+?(?=>)', link_string)
+        link_rel = re.findall('(?<=rel=").+?(?=")', link_string)
+        if link_url and link_rel:
+            parsed_link_headers[link_rel[0]] = parse.unquote(link_url[0])
+    return parsed_link_headers
+
+def _get_remaining_page_urls(parsed_link_headers):
+    """
+        Works out the urls of all the pages after the current one, if the Link header gives the last page
+        and pages are numbered. Canvas omits rel=last, or uses opaque bookmarks, where this is not possible.
+        
+        Returns list of urls, or None if the pages can only be followed one by one.
+    """
+    if 'next' not in parsed_link_headers.keys() or 'last' not in parsed_link_headers.keys():
+        return None
+    next_url = parse.urlsplit(parsed_link_headers['next'])
+    next_query = parse.parse_qsl(next_url.query, keep_blank_values=True)
+    next_page = [ v for k, v in next_query if k == 'page' ]
+    last_page = [ v for k, v in parse.parse_qsl(parse.urlsplit(parsed_link_headers['last']).query, keep_blank_values=True) if k == 'page' ]
+    if len(next_page) != 1 or len(last_page) != 1 or not next_page[0].isdigit() or not last_page[0].isdigit():
+        return None
+    urls = []
+    for page in range(int(next_page[0]), min(int(last_page[0]), int(next_page[0]) + CANVAS_PAGINATION_MAX_PAGES - 1) + 1):
+        query = parse.urlencode([ (k, str(page) if k == 'page' else v) for k, v in next_query ])
+        urls.append(parse.urlunsplit(next_url._replace(query=query)))
+    return urls
+
+def _is_retryable_response(r, method='GET'):
+    """
+        Whether a Canvas response means the request was throttled, or failed temporarily and can
+        be sent again safely.
+    """
+    if r.status_code == 429:
+        return True
+    if r.status_code == 403 and 'rate limit exceeded' in r.text.lower():
+        return True
+    if r.status_code in [502, 503, 504] and method.upper() in CANVAS_RETRYABLE_METHODS:
+        return True
+    return False
+
 def _make_job_id(connection_type, table_uuid, identifiers=None):
     if identifiers is None or (isinstance(identifiers, list) and len(identifiers) == 0):
         return 'sres_connector_canvas_{}_t{}'.format(
@@ -852,6 +914,53 @@ class CanvasConnector:
         
         self.db_cookie = DbCookie(self.override_username or get_auth_user())
         self.data_logger = logging.getLogger('sres.db.studentdata')
+        self._session = None
+    
+    def _get_session(self):
+        """Returns this connector's requests.Session, which keeps connections to Canvas alive between requests."""
+        if self._session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=CANVAS_PAGINATION_WORKERS)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self._session = session
+        return self._session
+    
+    def _request(self, method, url, auth_token, parameters):
+        """
+            Sends one request through the session, retrying with backoff when Canvas throttles it or fails
+            temporarily, and slowing down as the rate limit bucket empties. Only requests with
+            CANVAS_RETRYABLE_METHODS are retried after timeouts, connection errors and server errors.
+            
+            Returns requests.Response
+        """
+        for attempt in range(CANVAS_REQUEST_MAX_RETRIES + 1):
+            backoff = CANVAS_REQUEST_BACKOFF_SECONDS * (2 ** attempt) * (1 + random.random() / 2)
+            try:
+                r = self._get_session().request(
+                    method.upper(),
+                    url,
+                    headers={'Authorization': 'Bearer {}'.format(auth_token)},
+                    data=parameters,
+                    proxies=_get_proxies(),
+                    timeout=CANVAS_REQUEST_TIMEOUT_SECONDS
+                )
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt >= CANVAS_REQUEST_MAX_RETRIES or method.upper() not in CANVAS_RETRYABLE_METHODS:
+                    raise
+                logging.warning('Canvas request failed, retrying [{}] [{}] [{}]'.format(method, url, repr(e)))
+                time.sleep(backoff)
+                continue
+            if _is_retryable_response(r, method) and attempt < CANVAS_REQUEST_MAX_RETRIES:
+                retry_after = r.headers.get('retry-after', '')
+                logging.warning('Canvas request throttled, retrying [{}] [{}] [{}] [{}]'.format(method, url, r.status_code, r.headers.get('x-rate-limit-remaining', '?')))
+                time.sleep(float(retry_after) if utils.is_number(retry_after) else backoff)
+                continue
+            # ease off before the bucket runs dry
+            rate_limit_remaining = r.headers.get('x-rate-limit-remaining', '')
+            if utils.is_number(rate_limit_remaining) and float(rate_limit_remaining) < CANVAS_RATE_LIMIT_LOW_WATERMARK:
+                time.sleep(CANVAS_REQUEST_BACKOFF_SECONDS * (1 - max(float(rate_limit_remaining), 0) / CANVAS_RATE_LIMIT_LOW_WATERMARK))
+            return r
     
     def check_token_validity(self):
         """Basic token checker by requesting user's own details."""
@@ -1362,9 +1471,21 @@ class CanvasConnector:
         df_data.fillna('', inplace=True)
         # save data
         success_count = 0
-        student_data = StudentData(table_uuid)
+        table = Table()
+        table.load(table_uuid)
+        students_to_save = []
+        sids_to_save = set()
+        def _save_students():
+            saved_count = 0
+            for student_data, saved in zip(students_to_save, StudentData.save_many(students_to_save)):
+                if saved:
+                    self.data_logger.info("Data committed in _import_data for {} {}".format(student_data.config['sid'], str(student_data._id)))
+                    saved_count += 1
+            students_to_save.clear()
+            sids_to_save.clear()
+            return saved_count
         for index, row in df_data.iterrows():
-            student_data._reset()
+            student_data = StudentData(table)
             student_found = False
             if expected_identifier_in_use != '':
                 student_found = student_data.find_student({
@@ -1380,7 +1501,12 @@ class CanvasConnector:
                             expected_identifier_in_use = expected_identifier
                             break
             if student_found:
+                if student_data.config['sid'] in sids_to_save:
+                    # student appears again, so save what is pending first
+                    success_count += _save_students()
+                    student_data.reload()
                 destination_identifiers.append(student_data.config['sid'])
+                student_data.change_history_buffer = []
                 for column_header in column_mappings:
                     current_data = row[column_header]
                     # Canvas returns null values as 'null' string
@@ -1397,10 +1523,11 @@ class CanvasConnector:
                         skip_aggregation=True, # Important to save resources until final aggregation,
                         preloaded_column=preloaded_columns[column_mappings[column_header]]
                     )
-                # commit to db
-                if student_data.save():
-                    self.data_logger.info("Data committed in _import_data for {} {}".format(student_data.config['sid'], str(student_data._id)))
-                    success_count += 1
+                # commit to db in batches
+                students_to_save.append(student_data)
+                sids_to_save.add(student_data.config['sid'])
+                if len(students_to_save) >= SAVE_MANY_BATCH_SIZE:
+                    success_count += _save_students()
             elif expected_identifier_in_use == '':
                 # problem
                 print('Could not find student AAA')
@@ -1411,6 +1538,7 @@ class CanvasConnector:
                 ret['messages'].append(("Could not find student.", "warning"))
                 logging.warning("Could not find student, in _import_data")
             pass
+        success_count += _save_students()
         # run aggregators if necessary
         bulk_aggregation_results = run_aggregation_bulk(
             source_column_uuids=destination_column_uuids,
@@ -4129,7 +4257,7 @@ class CanvasConnector:
     # Generic functions #
     #####################
     
-    def _send_request(self, url, method='GET', parameters={}, failure_count=0, ignore_link_header=False, unpack_key='', use_admin_token=False):
+    def _send_request(self, url, method='GET', parameters={}, failure_count=0, ignore_link_header=False, unpack_key='', use_admin_token=False, auth_token=None):
         """
             Sends a request to Canvas API and follows all link rels as necessary.
             
@@ -4141,6 +4269,8 @@ class CanvasConnector:
             unpack_key (string) If request is expected to return an object with an array of objects, 
                 the unpack_key specifies the first-level object's key to read
             use_admin_token (boolean) Whether to use the configured admin token
+            auth_token (string|None) Token to use instead of looking one up, e.g. when fetching pages
+                in other threads
         """
         #print('requesting', url)
         ret = {
@@ -4150,27 +4280,13 @@ class CanvasConnector:
             'headers': None
         }
         # get auth token
-        auth_token = None
-        if use_admin_token:
+        if auth_token is None and use_admin_token:
             auth_token = self.config.get('admin_auth_token')
         if auth_token is None:
             auth_token = self.get_auth_token()
         # run the request
-        if method.lower() == 'get':
-            r = requests.get(
-                url,
-                headers={'Authorization': 'Bearer {}'.format(auth_token)},
-                data=parameters,
-                proxies=_get_proxies()
-            )
-        elif method.lower() == 'post':
-            r = requests.post(
-                url,
-                headers={'Authorization': 'Bearer {}'.format(auth_token)},
-                data=parameters,
-                proxies=_get_proxies()
-            )
-        request_cost = r.headers['x-request-cost'] if 'x-request-cost' in [k.lower() for k in r.headers.keys()] else '?'
+        r = self._request(method, url, auth_token, parameters)
+        request_cost = r.headers.get('x-request-cost', '?')
         ret['status_code'] = r.status_code
         ret['headers'] = deepcopy(r.headers)
         ret['raw'] = r.text
@@ -4179,49 +4295,66 @@ class CanvasConnector:
             # deal with pagination
             if 'link' in [k.lower() for k in r.headers.keys()] and not ignore_link_header:
                 temp_filecontent = r.json()
-                r_internal = {
-                    'status_code': r.status_code,
-                    'headers': deepcopy(r.headers)
-                }
                 combined_filecontent = []
                 if unpack_key == '' or isinstance(temp_filecontent, list):
                     combined_filecontent.extend(temp_filecontent)
                 else:
                     if unpack_key.lower() in [k.lower() for k in temp_filecontent.keys()]:
                         combined_filecontent.extend(temp_filecontent[unpack_key])
-                # loop through links
-                for loop_counter in range(1, 201):
-                    if 'link' in [k.lower() for k in r_internal['headers'].keys()]:
-                        # parse link header
-                        parsed_link_headers = {}
-                        for link_string in r_internal['headers']['link'].split(','):
-                            link_url = re.findall('(?<=<).+?(?=>)', link_string)[0]
-                            link_url = parse.unquote(link_url)
-                            link_rel = re.findall('(?<=rel=").+?(?=")', link_string)[0]
-                            parsed_link_headers[link_rel] = link_url
-                        # see if next link exists
-                        if 'next' in parsed_link_headers.keys():
-                            # next exists, so get it
-                            r_internal = self._send_request(
-                                url=parsed_link_headers['next'],
-                                method=method,
-                                parameters=parameters,
-                                ignore_link_header=True,
-                                unpack_key=unpack_key
-                            )
-                            #print('nexting', r_internal['headers'])
-                            if r_internal['status_code'] == 200:
-                                temp_filecontent = r_internal['data']
-                                if unpack_key == '' or isinstance(temp_filecontent, list):
-                                    if temp_filecontent:
-                                        combined_filecontent.extend(temp_filecontent)
-                                else:
-                                    if unpack_key.lower() in [k.lower() for k in temp_filecontent.keys()]:
-                                        combined_filecontent.extend(temp_filecontent[unpack_key])
+                def _extend_combined_filecontent(r_internal):
+                    if r_internal['status_code'] == 200:
+                        temp_filecontent = r_internal['data']
+                        if unpack_key == '' or isinstance(temp_filecontent, list):
+                            if temp_filecontent:
+                                combined_filecontent.extend(temp_filecontent)
+                        else:
+                            if unpack_key.lower() in [k.lower() for k in temp_filecontent.keys()]:
+                                combined_filecontent.extend(temp_filecontent[unpack_key])
+                remaining_page_urls = _get_remaining_page_urls(_parse_link_header(r.headers['link']))
+                if remaining_page_urls is not None:
+                    # pages are numbered, so fetch them all at once
+                    app = current_app._get_current_object() if current_app else None
+                    def _fetch_page(page_url):
+                        kwargs = {
+                            'url': page_url,
+                            'method': method,
+                            'parameters': parameters,
+                            'ignore_link_header': True,
+                            'unpack_key': unpack_key,
+                            'auth_token': auth_token
+                        }
+                        if app is None:
+                            return self._send_request(**kwargs)
+                        with app.app_context():
+                            return self._send_request(**kwargs)
+                    with ThreadPoolExecutor(max_workers=CANVAS_PAGINATION_WORKERS) as executor:
+                        for r_internal in executor.map(_fetch_page, remaining_page_urls):
+                            _extend_combined_filecontent(r_internal)
+                else:
+                    # follow the next links one by one
+                    r_internal = {
+                        'status_code': r.status_code,
+                        'headers': deepcopy(r.headers)
+                    }
+                    for loop_counter in range(1, CANVAS_PAGINATION_MAX_PAGES + 1):
+                        if r_internal['headers'] is not None and 'link' in [k.lower() for k in r_internal['headers'].keys()]:
+                            parsed_link_headers = _parse_link_header(r_internal['headers']['link'])
+                            # see if next link exists
+                            if 'next' in parsed_link_headers.keys():
+                                # next exists, so get it
+                                r_internal = self._send_request(
+                                    url=parsed_link_headers['next'],
+                                    method=method,
+                                    parameters=parameters,
+                                    ignore_link_header=True,
+                                    unpack_key=unpack_key,
+                                    auth_token=auth_token
+                                )
+                                _extend_combined_filecontent(r_internal)
                             else:
-                                continue
-                    else:
-                        break
+                                break
+                        else:
+                            break
                 ret['data'] = combined_filecontent
             else:
                 if unpack_key == '':
@@ -4249,7 +4382,10 @@ class CanvasConnector:
                         url=url,
                         method=method,
                         parameters=parameters,
-                        failure_count=(failure_count + 1)
+                        failure_count=(failure_count + 1),
+                        ignore_link_header=ignore_link_header,
+                        unpack_key=unpack_key,
+                        use_admin_token=use_admin_token
                     )
                 else:
                     # problem refreshing token
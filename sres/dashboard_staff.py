@@ -12,6 +12,7 @@ from sres.portals import list_authorised_portals, Portal
 from sres.insights import list_authorised_insights
 from sres.access_logs import get_recent_accesses as get_recent_accesses_from_logs
 from sres.change_history import get_recent_change_histories_for_table, get_recently_updated_columns_for_table
+from sres.column_stats import get_column_stats, get_value_counts, get_numeric_value_counts, get_numeric_summary
 from sres.search import search_haystacks
 from sres.logs import get_latest_feedback_events_many
 from sres import utils
@@ -221,9 +222,87 @@ def get_pinned_dashboard_assets(asset_type=None):
         current_pins = _current_pins
     return current_pins
 
+# A column is notable if between MIN and MAX of its data differ from the most frequent value
+NOTABLE_MIN_THRESHOLD = 0.01
+NOTABLE_MAX_THRESHOLD = 0.33
+
+def _get_notable_reasons(value_counts, numeric_summary, zscore_counts):
+    """
+        Works out why a column is notable.
+        
+        value_counts (dict|None) Number of students with each value (as str)
+        numeric_summary (dict) count, mean, and std_dev of the numeric values
+        zscore_counts (dict) Number of numeric values lower_than_minus_1z and higher_than_plus_1z
+        
+        Returns a list of tuples of (reason, meta); where there are several, the last wins.
+    """
+    reasons = []
+    # quick and dirty detection of potentially divergent data
+    if value_counts and len(value_counts) >= 2:
+        total = sum(value_counts.values())
+        most_frequent_value, most_frequent_count = max(value_counts.items(), key=lambda kv: kv[1])
+        most_frequent_value_frequency = most_frequent_count / total
+        if most_frequent_value_frequency > (1.0 - NOTABLE_MAX_THRESHOLD) and most_frequent_value_frequency < (1.0 - NOTABLE_MIN_THRESHOLD):
+            # i.e. between 2/3 and all of the data are a single value
+            # i.e. there are between 0.33 and 0.01 of the data being something different to the majority
+            reasons.append(('most_frequent', {
+                'most_frequent_value': most_frequent_value,
+                'most_frequent_value_frequency': most_frequent_value_frequency
+            }))
+    # more intelligent detection based on numeric values
+    if numeric_summary['count']:
+        for reason in ['lower_than_minus_1z', 'higher_than_plus_1z']:
+            if zscore_counts[reason] > 1:
+                reasons.append((reason, {
+                    'count': zscore_counts[reason],
+                    'mean': numeric_summary['mean'],
+                    'std_dev': numeric_summary['std_dev']
+                }))
+    return reasons
+
+def _get_notable_reasons_from_stats(stats):
+    value_counts = get_value_counts(stats)
+    if value_counts is None:
+        # as at the last time the stats were computed in bulk
+        return _get_notable_reasons(None, get_numeric_summary(stats), stats['zscore_counts'])
+    # exact z-scores from the frequencies of the current values
+    numeric_counts = get_numeric_value_counts(stats)
+    numeric_summary = {'count': sum(c for v, c in numeric_counts), 'mean': None, 'std_dev': None}
+    zscore_counts = {'lower_than_minus_1z': 0, 'higher_than_plus_1z': 0}
+    if numeric_summary['count']:
+        mean = sum(v * c for v, c in numeric_counts) / numeric_summary['count']
+        std_dev = (sum(c * (v - mean) ** 2 for v, c in numeric_counts) / numeric_summary['count']) ** 0.5
+        numeric_summary.update({'mean': mean, 'std_dev': std_dev})
+        if std_dev > 0:
+            for v, c in numeric_counts:
+                if (v - mean) / std_dev <= -1.0:
+                    zscore_counts['lower_than_minus_1z'] += c
+                if (v - mean) / std_dev >= 1.0:
+                    zscore_counts['higher_than_plus_1z'] += c
+    return _get_notable_reasons(value_counts, numeric_summary, zscore_counts)
+
+def _get_notable_reasons_from_series(series):
+    value_counts = series.fillna('').astype(str).value_counts(sort=True, dropna=False).to_dict()
+    _series = pandas.to_numeric(series, errors='coerce').dropna()
+    std_dev = _series.std(ddof=0)
+    mean = _series.mean()
+    _zscores = (_series - mean) / std_dev
+    numeric_summary = {
+        'count': len(_series),
+        'mean': mean,
+        'std_dev': std_dev
+    }
+    zscore_counts = {
+        'lower_than_minus_1z': _zscores.le(-1.0).sum(),
+        'higher_than_plus_1z': _zscores.ge(1.0).sum()
+    }
+    return _get_notable_reasons(value_counts, numeric_summary, zscore_counts)
+
 def get_notable_columns():
     pinned_tables = get_pinned_dashboard_assets(asset_type='table')
     notable_columns_per_table = {}
+    IGNORE_HEADERS = [ c['name'].lower() for c in SYSTEM_COLUMNS ]
+    IGNORE_HEADERS.append('canvas_avatar')
     for table_uuid, pinned_table in pinned_tables.items():
         # get the columns most recently updated
         recently_updated_columns_uuids = get_recently_updated_columns_for_table(table_uuid)
@@ -231,80 +310,36 @@ def get_notable_columns():
         table = Table()
         if table.load(table_uuid):
             notable_columns_per_table[table_uuid] = {}
-            # get the relevant data
-            data = table.export_data_to_df(
-                only_column_uuids=recently_updated_columns_uuids,
-                return_just_df=True,
-                do_not_rename_headers=True
-            ).get('data', [])
-            # make a dataframe
-            df_data = pandas.DataFrame(data)
-            headers = list(df_data.columns)
-            # set a few things
-            MIN_THRESHOLD = 0.01
-            MAX_THRESHOLD = 0.33
-            IGNORE_HEADERS = [ c['name'].lower() for c in SYSTEM_COLUMNS ]
-            IGNORE_HEADERS.append('canvas_avatar')
-            # iterate over the columns in the dataframe to determine any interesting circumstances
-            notable_headers = []
-            for header in headers:
-                #logging.debug(f"HEADER: {header}")
-                #logging.debug(df_data[header])
-                # ignore some headers
-                if header.lower() in IGNORE_HEADERS:
+            notable_reasons = {}
+            # use the materialised stats where they are kept
+            column_stats = get_column_stats(table_uuid, recently_updated_columns_uuids)
+            for column_reference, stats in column_stats.items():
+                notable_reasons[column_reference] = _get_notable_reasons_from_stats(stats)
+            # otherwise calculate from the data
+            other_column_uuids = [ c for c in recently_updated_columns_uuids if c not in column_stats.keys() ]
+            if other_column_uuids:
+                data = table.export_data_to_df(
+                    only_column_uuids=other_column_uuids,
+                    return_just_df=True,
+                    do_not_rename_headers=True
+                ).get('data', [])
+                df_data = pandas.DataFrame(data)
+                for header in list(df_data.columns):
+                    # ignore some headers
+                    if header.lower() in IGNORE_HEADERS or header in column_stats.keys():
+                        continue
+                    notable_reasons[header] = _get_notable_reasons_from_series(df_data[header])
+            for column_reference, reasons in notable_reasons.items():
+                if not reasons:
                     continue
-                # quick and dirty detection of potentially divergent data
-                value_counts = df_data[header].fillna('').astype(str).value_counts(normalize=True, sort=True, dropna=False)
-                if len(value_counts) >= 2:
-                    if value_counts[0] > (1.0 - MAX_THRESHOLD) and value_counts[0] < (1.0 - MIN_THRESHOLD):
-                        # i.e. between 2/3 and all of the data are a single value
-                        # i.e. there are between 0.33 and 0.01 of the data being something different to the majority
-                        notable_headers.append(header)
-                        column = Column(table)
-                        if column.load(header):
-                            notable_columns_per_table[table_uuid][column.column_reference] = {
-                                'column': column,
-                                'reason': 'most_frequent',
-                                'meta': {
-                                    'most_frequent_value': value_counts.index[0],
-                                    'most_frequent_value_frequency': value_counts[0]
-                                }
-                            }
-                # more intelligent detection based on numeric values
-                dtype = df_data.dtypes[header]
-                _series = pandas.to_numeric(df_data[header], errors='coerce')
-                if not _series.isnull().all():
-                    _series.dropna(inplace=True)
-                    # perhaps try z scores
-                    std_dev = _series.std(ddof=0)
-                    mean = _series.mean()
-                    _zscores = (_series - mean) / std_dev
-                    count_lower_than_minus_1z = _zscores.le(-1.0).sum()
-                    count_higher_than_plus_1z = _zscores.ge(1.0).sum()
-                    if count_lower_than_minus_1z > 1 or count_higher_than_plus_1z > 1:
-                        notable_headers.append(header)
-                        column = Column(table)
-                        if column.load(header):
-                            if count_lower_than_minus_1z > 1:
-                                notable_columns_per_table[table_uuid][column.column_reference] = {
-                                    'column': column,
-                                    'reason': 'lower_than_minus_1z',
-                                    'meta': {
-                                        'count': count_lower_than_minus_1z,
-                                        'mean':  mean,
-                                        'std_dev': std_dev
-                                    }
-                                }
-                            if count_higher_than_plus_1z > 1:
-                                notable_columns_per_table[table_uuid][column.column_reference] = {
-                                    'column': column,
-                                    'reason': 'higher_than_plus_1z',
-                                    'meta': {
-                                        'count': count_higher_than_plus_1z,
-                                        'mean':  mean,
-                                        'std_dev': std_dev
-                                    }
-                                }
+                column = Column(table)
+                if column.load(column_reference):
+                    for reason, meta in reasons:
+                        notable_columns_per_table[table_uuid][column.column_reference] = {
+                            'column': column,
+                            'reason': reason,
+                            'meta': meta
+                        }
     return notable_columns_per_table
 
 
@@ -1,8 +1,25 @@
 from flask import g, current_app
-from pymongo import MongoClient, ReadPreference
+from pymongo import MongoClient, ReadPreference, monitoring
+from pymongo.collation import Collation
 from datetime import datetime, timedelta
 import os, sys
 import logging
+import threading
+
+# Used for exact, case-insensitive identifier matching; queries must specify the
+# same collation in order to use the corresponding indexes.
+CASE_INSENSITIVE_COLLATION = {
+    'locale': 'en',
+    'strength': 2
+}
+
+# Used for sorting student data the way people expect, i.e. case-insensitively and with
+# runs of digits compared as numbers.
+NATURAL_SORT_COLLATION = {
+    'locale': 'en',
+    'strength': 2,
+    'numericOrdering': True
+}
 
 _DB_INDEXES = {
     'tables': [
@@ -53,6 +70,18 @@ _DB_INDEXES = {
                 ('staff.users', 1)
             ],
             'unique': False
+        },
+        {
+            'keys': [
+                ('name', 'text'),
+                ('code', 'text')
+            ],
+            'unique': False,
+            'weights': {
+                'name': 10,
+                'code': 10
+            },
+            'name': 'search_text'
         }
     ],
     'columns': [
@@ -97,6 +126,32 @@ _DB_INDEXES = {
                 ('type', 1)
             ],
             'unique': False
+        },
+        {
+            'keys': [
+                ('name', 'text'),
+                ('description', 'text'),
+                ('multi_entry.options.label', 'text'),
+                ('multi_entry.options.select.display', 'text'),
+                ('multi_entry.options.select.description', 'text'),
+                ('multi_entry.options.select.value', 'text'),
+                ('quick_info.single', 'text'),
+                ('quick_info.bulk', 'text'),
+                ('custom_options.quickinfo_rollview', 'text')
+            ],
+            'unique': False,
+            'weights': {
+                'name': 10,
+                'description': 1,
+                'multi_entry.options.label': 1,
+                'multi_entry.options.select.display': 1,
+                'multi_entry.options.select.description': 1,
+                'multi_entry.options.select.value': 1,
+                'quick_info.single': 1,
+                'quick_info.bulk': 1,
+                'custom_options.quickinfo_rollview': 1
+            },
+            'name': 'search_text'
         }
     ],
     'data': [
@@ -149,6 +204,60 @@ _DB_INDEXES = {
             ],
             'unique': False
         },
+        {
+            'keys': [
+                ('table_uuid', 1),
+                ('sid', 1)
+            ],
+            'unique': False,
+            'collation': CASE_INSENSITIVE_COLLATION,
+            'name': 'table_uuid_1_sid_1_ci'
+        },
+        {
+            'keys': [
+                ('table_uuid', 1),
+                ('email', 1)
+            ],
+            'unique': False,
+            'collation': CASE_INSENSITIVE_COLLATION,
+            'name': 'table_uuid_1_email_1_ci'
+        },
+        {
+            'keys': [
+                ('table_uuid', 1),
+                ('username', 1)
+            ],
+            'unique': False,
+            'collation': CASE_INSENSITIVE_COLLATION,
+            'name': 'table_uuid_1_username_1_ci'
+        },
+        {
+            'keys': [
+                ('table_uuid', 1),
+                ('alternative_id1', 1)
+            ],
+            'unique': False,
+            'collation': CASE_INSENSITIVE_COLLATION,
+            'name': 'table_uuid_1_alternative_id1_1_ci'
+        },
+        {
+            'keys': [
+                ('table_uuid', 1),
+                ('alternative_id2', 1)
+            ],
+            'unique': False,
+            'collation': CASE_INSENSITIVE_COLLATION,
+            'name': 'table_uuid_1_alternative_id2_1_ci'
+        },
+        {
+            'keys': [
+                ('table_uuid', 1),
+                ('status', 1)
+            ],
+            'unique': False,
+            'collation': NATURAL_SORT_COLLATION,
+            'name': 'table_uuid_1_status_1_natural'
+        },
         {
             'keys': [
                 ('status', 1)
@@ -172,6 +281,19 @@ _DB_INDEXES = {
                 ('preferred_name', 1)
             ],
             'unique': False
+        },
+        {
+            'keys': [
+                ('table_uuid', 1),
+                ('search_tokens', 1)
+            ],
+            'unique': False
+        },
+        {
+            'keys': [
+                ('search_tokens', 1)
+            ],
+            'unique': False
         }
     ],
     'change_history': [
@@ -224,6 +346,45 @@ _DB_INDEXES = {
                 ('identifier', 1)
             ],
             'unique': False
+        },
+        {
+            'keys': [
+                ('column_uuid', 1),
+                ('timestamp', -1)
+            ],
+            'unique': False
+        },
+        {
+            'keys': [
+                ('column_uuid', 1),
+                ('identifier', 1),
+                ('timestamp', -1)
+            ],
+            'unique': False
+        },
+        {
+            'keys': [
+                ('column_uuid', 1),
+                ('auth_user', 1),
+                ('timestamp', -1)
+            ],
+            'unique': False
+        },
+        {
+            'keys': [
+                ('table_uuid', 1),
+                ('timestamp', -1)
+            ],
+            'unique': False
+        },
+        {
+            'keys': [
+                ('table_uuid', 1),
+                ('column_uuid', 1),
+                ('identifier', 1),
+                ('timestamp', -1)
+            ],
+            'unique': False
         }
     ],
     'collective_assets': [
@@ -345,6 +506,23 @@ _DB_INDEXES = {
                 ('source_asset_type', 1)
             ],
             'unique': False
+        },
+        {
+            'keys': [
+                ('source_asset_type', 1),
+                ('source_asset_uuid', 1),
+                ('timestamp', 1)
+            ],
+            'unique': False
+        },
+        {
+            'keys': [
+                ('source_asset_type', 1),
+                ('source_asset_uuid', 1),
+                ('target', 1),
+                ('timestamp', 1)
+            ],
+            'unique': False
         }
     ],
     'files.chunks': [
@@ -419,6 +597,26 @@ _DB_INDEXES = {
                 ('uuid', 1)
             ],
             'unique': True
+        },
+        {
+            'keys': [
+                ('name', 'text'),
+                ('description', 'text'),
+                ('email.sections.content', 'text'),
+                ('email.subject', 'text'),
+                ('email.body_first', 'text'),
+                ('email.body_last', 'text')
+            ],
+            'unique': False,
+            'weights': {
+                'name': 10,
+                'description': 1,
+                'email.sections.content': 1,
+                'email.subject': 1,
+                'email.body_first': 1,
+                'email.body_last': 1
+            },
+            'name': 'search_text'
         }
     ],
     'insights': [
@@ -447,6 +645,42 @@ _DB_INDEXES = {
                 ('uuid', 1)
             ],
             'unique': False
+        },
+        {
+            'keys': [
+                ('name', 'text'),
+                ('description', 'text'),
+                ('panels.content', 'text')
+            ],
+            'unique': False,
+            'weights': {
+                'name': 10,
+                'description': 1,
+                'panels.content': 1
+            },
+            'name': 'search_text'
+        }
+    ],
+    'import_chunks': [
+        {
+            'keys': [
+                ('_id', 1)
+            ],
+            'unique': True
+        },
+        {
+            'keys': [
+                ('cache_key', 1),
+                ('row_start', 1)
+            ],
+            'unique': False
+        },
+        {
+            'keys': [
+                ('created', 1)
+            ],
+            'unique': False,
+            'expire_after_seconds': 172800
         }
     ],
     'job_claims': [
@@ -461,6 +695,71 @@ _DB_INDEXES = {
                 ('job_id', 1)
             ],
             'unique': True
+        },
+        {
+            'keys': [
+                ('expires_at', 1)
+            ],
+            'unique': False,
+            'expire_after_seconds': 0
+        }
+    ],
+    'aggregation_queue': [
+        {
+            'keys': [
+                ('_id', 1)
+            ],
+            'unique': True
+        },
+        {
+            'keys': [
+                ('status', 1),
+                ('enqueued', 1)
+            ],
+            'unique': False
+        },
+        {
+            'keys': [
+                ('aggregator_column_uuid', 1),
+                ('identifier', 1),
+                ('status', 1)
+            ],
+            'unique': True,
+            'partial_filter_expression': {'status': 'pending'},
+            'name': 'aggregation_queue_pending_unique'
+        },
+        {
+            'keys': [
+                ('claimed_by', 1)
+            ],
+            'unique': False
+        },
+        {
+            'keys': [
+                ('identifier', 1),
+                ('source_column_uuids', 1)
+            ],
+            'unique': False
+        }
+    ],
+    'column_stats': [
+        {
+            'keys': [
+                ('_id', 1)
+            ],
+            'unique': True
+        },
+        {
+            'keys': [
+                ('column_reference', 1)
+            ],
+            'unique': True
+        },
+        {
+            'keys': [
+                ('column_uuid', 1)
+            ],
+            'unique': False
         }
     ],
     'sres.apscheduler': [
@@ -539,6 +838,14 @@ _DB_INDEXES = {
                 ('action', 1)
             ],
             'unique': False
+        },
+        {
+            'keys': [
+                ('source_asset_type', 1),
+                ('source_asset_uuid', 1),
+                ('timestamp', 1)
+            ],
+            'unique': False
         }
     ],
     'message_send_logs': [
@@ -701,6 +1008,14 @@ _DB_INDEXES = {
                 ('action', 1)
             ],
             'unique': False
+        },
+        {
+            'keys': [
+                ('username', 1),
+                ('asset_type', 1),
+                ('timestamp', -1)
+            ],
+            'unique': False
         }
     ],
     'lti': [
@@ -771,30 +1086,210 @@ _DB_INDEXES = {
     ]
 }
 
-def _get_db(read_preference='primaryPreferred'):
-    """Thread-safe and request/current_app-less db getter?????"""
+_CLIENT_REGISTRY = {
+    'pid': None,
+    'clients': {}, # keyed by MONGO_URI
+    'databases': {} # keyed by (MONGO_URI, read_preference)
+}
+_CLIENT_REGISTRY_LOCK = threading.RLock()
+
+_READ_PREFERENCES = {
+    'primaryPreferred': ReadPreference.PRIMARY_PREFERRED,
+    'secondaryPreferred': ReadPreference.SECONDARY_PREFERRED
+}
+
+# Defaults for the connection pool; each can be overridden in instance/config.py
+_MONGO_CLIENT_OPTIONS = {
+    'MONGO_MAX_POOL_SIZE': ('maxPoolSize', 100),
+    'MONGO_MIN_POOL_SIZE': ('minPoolSize', 0),
+    'MONGO_MAX_IDLE_TIME_MS': ('maxIdleTimeMS', None),
+    'MONGO_WAIT_QUEUE_TIMEOUT_MS': ('waitQueueTimeoutMS', None),
+    'MONGO_CONNECT_TIMEOUT_MS': ('connectTimeoutMS', 20000),
+    'MONGO_SOCKET_TIMEOUT_MS': ('socketTimeoutMS', None),
+    'MONGO_SERVER_SELECTION_TIMEOUT_MS': ('serverSelectionTimeoutMS', 30000)
+}
+
+class _PoolCounters(object):
+    """Process-local counters of connection pool activity, for watching pool pressure."""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        with self._lock:
+            self.clients_created = 0
+            self.connections_created = 0
+            self.connections_closed = 0
+            self.checked_out = 0
+            self.checked_out_peak = 0
+            self.checkouts_total = 0
+            self.checkout_failures = 0
+    
+    def incr(self, counter, by=1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + by)
+            if counter == 'checked_out' and self.checked_out > self.checked_out_peak:
+                self.checked_out_peak = self.checked_out
+    
+    def as_dict(self):
+        with self._lock:
+            return {
+                'clients_created': self.clients_created,
+                'connections_created': self.connections_created,
+                'connections_closed': self.connections_closed,
+                'checked_out': self.checked_out,
+                'checked_out_peak': self.checked_out_peak,
+                'checkouts_total': self.checkouts_total,
+                'checkout_failures': self.checkout_failures
+            }
+
+_POOL_COUNTERS = _PoolCounters()
+
+if hasattr(monitoring, 'ConnectionPoolListener'):
+    # CMAP events are only available from pymongo 3.9
+    class _PoolListener(monitoring.ConnectionPoolListener):
+        def pool_created(self, event):
+            pass
+        def pool_cleared(self, event):
+            pass
+        def pool_closed(self, event):
+            pass
+        def connection_created(self, event):
+            _POOL_COUNTERS.incr('connections_created')
+        def connection_ready(self, event):
+            pass
+        def connection_closed(self, event):
+            _POOL_COUNTERS.incr('connections_closed')
+        def connection_check_out_started(self, event):
+            pass
+        def connection_check_out_failed(self, event):
+            _POOL_COUNTERS.incr('checkout_failures')
+        def connection_checked_out(self, event):
+            _POOL_COUNTERS.incr('checkouts_total')
+            _POOL_COUNTERS.incr('checked_out')
+        def connection_checked_in(self, event):
+            _POOL_COUNTERS.incr('checked_out', -1)
+    _POOL_LISTENERS = [_PoolListener()]
+else:
+    _POOL_LISTENERS = []
+
+def _load_db_config():
     # import config for db directly from instance - this is hacky...
-    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-    from instance.config import MONGO_URI, MONGO_DB
-    client = MongoClient(MONGO_URI)
-    if read_preference == 'primaryPreferred':
-        return client.get_database(MONGO_DB, read_preference=ReadPreference.PRIMARY_PREFERRED)
-    elif read_preference == 'secondaryPreferred':
-        return client.get_database(MONGO_DB, read_preference=ReadPreference.SECONDARY_PREFERRED)
+    instance_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    if instance_parent not in sys.path:
+        sys.path.append(instance_parent)
+    from instance import config
+    return config
+
+def _reset_client_registry():
+    """Forgets all clients in this process. Called in a child after os.fork, since
+        MongoClient instances (and their pools and monitor threads) must not be
+        shared across processes. The parent's clients are deliberately not closed
+        from the child."""
+    global _CLIENT_REGISTRY_LOCK
+    _CLIENT_REGISTRY_LOCK = threading.RLock()
+    _CLIENT_REGISTRY['pid'] = os.getpid()
+    _CLIENT_REGISTRY['clients'] = {}
+    _CLIENT_REGISTRY['databases'] = {}
+    _POOL_COUNTERS.__init__()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_client_registry)
+
+def _get_client(mongo_uri, config=None):
+    """Returns the pooled MongoClient for mongo_uri in this process, creating it if needed."""
+    if _CLIENT_REGISTRY['pid'] != os.getpid():
+        # fallback fork detection for platforms without os.register_at_fork
+        _reset_client_registry()
+    client = _CLIENT_REGISTRY['clients'].get(mongo_uri)
+    if client is not None:
+        return client
+    with _CLIENT_REGISTRY_LOCK:
+        client = _CLIENT_REGISTRY['clients'].get(mongo_uri)
+        if client is None:
+            config = config or _load_db_config()
+            kwargs = {}
+            for config_key, (option, default) in _MONGO_CLIENT_OPTIONS.items():
+                value = getattr(config, config_key, default)
+                if value is not None:
+                    kwargs[option] = value
+            if _POOL_LISTENERS:
+                kwargs['event_listeners'] = _POOL_LISTENERS
+            client = MongoClient(mongo_uri, **kwargs)
+            _CLIENT_REGISTRY['clients'][mongo_uri] = client
+            _POOL_COUNTERS.incr('clients_created')
+    return client
+
+def _get_db(read_preference='primaryPreferred'):
+    """Thread-safe and request/current_app-less db getter.
+        
+        Returns a Database from a single pooled MongoClient per process, keyed by
+        MONGO_URI and read_preference. Safe to call from requests, APScheduler
+        jobs and forked worker processes.
+    """
+    config = _load_db_config()
+    key = (config.MONGO_URI, read_preference)
+    db = _CLIENT_REGISTRY['databases'].get(key)
+    if db is not None and _CLIENT_REGISTRY['pid'] == os.getpid():
+        return db
+    client = _get_client(config.MONGO_URI, config)
+    if read_preference in _READ_PREFERENCES.keys():
+        db = client.get_database(config.MONGO_DB, read_preference=_READ_PREFERENCES[read_preference])
     else:
         # default
-        return client[MONGO_DB]
+        db = client[config.MONGO_DB]
+    _CLIENT_REGISTRY['databases'][key] = db
+    return db
+
+def get_pool_stats():
+    """Returns a dict of connection pool counters for this process."""
+    ret = _POOL_COUNTERS.as_dict()
+    ret['pid'] = os.getpid()
+    ret['clients'] = len(_CLIENT_REGISTRY['clients']) if _CLIENT_REGISTRY['pid'] == os.getpid() else 0
+    ret['counters_available'] = bool(_POOL_LISTENERS)
+    return ret
 
 def _check_mongo_indexes(collection):
     db = _get_db()
     indexes = db[collection].index_information()
     return indexes
     
-def _create_mongo_index(collection, keys, unique=False):
+def _create_mongo_index(collection, keys, unique=False, collation=None, name=None, weights=None, expire_after_seconds=None, partial_filter_expression=None):
     db = _get_db()
-    res = db[collection].create_index(keys, unique=unique, background=True)
+    kwargs = {}
+    if collation is not None:
+        kwargs['collation'] = Collation(**collation)
+    if name is not None:
+        kwargs['name'] = name
+    if weights is not None:
+        kwargs['weights'] = weights
+    if expire_after_seconds is not None:
+        kwargs['expireAfterSeconds'] = expire_after_seconds
+    if partial_filter_expression is not None:
+        kwargs['partialFilterExpression'] = partial_filter_expression
+    res = db[collection].create_index(keys, unique=unique, background=True, **kwargs)
     return res
 
+def _index_matches(current_index, index):
+    """Whether an entry from index_information() satisfies an entry of _DB_INDEXES."""
+    text_fields = [ field for field, direction in index['keys'] if direction == 'text' ]
+    if text_fields:
+        # text indexes are reported by their weights rather than their keys
+        return sorted(current_index.get('weights', {}).keys()) == sorted(text_fields)
+    if current_index['key'] != index['keys']:
+        return False
+    if current_index.get('expireAfterSeconds') != index.get('expire_after_seconds'):
+        return False
+    if current_index.get('partialFilterExpression') != index.get('partial_filter_expression'):
+        return False
+    current_collation = current_index.get('collation', {})
+    wanted_collation = index.get('collation', {})
+    if wanted_collation:
+        return all(current_collation.get(k) == v for k, v in wanted_collation.items())
+    else:
+        return not current_collation or current_collation.get('locale') == 'simple'
+
 class DbCookie:
     
     def __init__(self, username_override=None):
@@ -2,6 +2,7 @@ from flask import g, session, url_for, escape, current_app
 from copy import deepcopy
 import collections
 import re
+import json
 from datetime import datetime, timedelta
 import time
 from natsort import natsorted, ns
@@ -9,6 +10,7 @@ from bs4 import BeautifulSoup
 from flask_mail import Message
 import mimetypes
 import os
+import smtplib
 import threading
 import logging
 
@@ -19,9 +21,9 @@ from sres.users import User, oids_to_usernames
 from sres.conditions import Conditions, OpenConditions, AdvancedConditions
 from sres.columns import column_oid_to_uuid, table_uuids_from_column_references, Column
 from sres.tables import Table
-from sres.studentdata import StudentData, substitute_text_variables
+from sres.studentdata import StudentData, substitute_text_variables, find_students_bulk
 from sres.files import get_file_access_url, GridFile
-from sres.logs import log_message_send, get_send_logs, get_feedback_stats, get_interaction_logs
+from sres.logs import log_message_send, log_message_sends, make_message_send_log, get_send_logs, get_feedback_stats, get_interaction_logs
 from sres.tracking import make_urls_trackable, get_beacon_html
 from sres.connector_canvas import CanvasConnector, is_canvas_connection_enabled
 
@@ -41,6 +43,9 @@ FEEDBACK_STYLES = {
     }
 }
 
+# Number of recipients looked up at a time by Filter.iterate_personalised_messages
+PERSONALISED_MESSAGE_BATCH_SIZE = 100
+
 HIDEABLE_UI_ELEMENTS = [
     ('n', 'name'),
     ('d', 'description'),
@@ -120,6 +125,15 @@ def get_filters_for_table_uuid(table_uuid):
     find_filter['tracking_record'] = {'$elemMatch': {'table_uuid': table_uuid}}
     return list(db.filters.find(find_filter))
 
+def _is_mail_connection_error(e):
+    """Whether e means the mail connection itself failed, so the rest of a batch sent over it will fail too."""
+    if isinstance(e, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, ConnectionError, TimeoutError)):
+        return True
+    # e.g. 421 too many messages, try again later
+    if isinstance(e, smtplib.SMTPResponseException) and e.smtp_code == 421:
+        return True
+    return False
+
 def send_messages(filter_uuid, identifiers, auth_username, attempts_already=0, ignorelist_identifiers=None, rerun_primary_conditions=False):
     """Called upon to send filter messages asynchronously."""
     from sres.jobs import APSJob
@@ -137,7 +151,9 @@ def send_messages(filter_uuid, identifiers, auth_username, attempts_already=0, i
             logging.debug('filter has_already_started, quitting [{}] pid [{}]'.format(filter_uuid, os.getpid()))
             return False
         # check who still needs to be sent this message
-        identifiers_already_sent = filter.get_all_targets(return_identifiers=True)
+        sent_targets, identifiers_already_sent = filter.get_all_targets_and_identifiers()
+        # targets already sent to, checked by iterate_personalised_messages instead of querying for each message
+        sent_targets = set(sent_targets)
         if rerun_primary_conditions == True:
             if ignorelist_identifiers is None or type(ignorelist_identifiers) is not list:
                 # misconfiguration
@@ -153,25 +169,45 @@ def send_messages(filter_uuid, identifiers, auth_username, attempts_already=0, i
         # if run_history is blank, then add
         if len(filter.config['run_history']) == 0:
             filter.add_run_history(auth_username)
-        # iterate send messages
+        # send messages in batches, each batch over one mail connection
         failure_encountered = False
         count_successful_sends = 0
-        from sres import create_app
-        app = create_app()
-        for identifier in identifiers_to_be_sent:
+        # the app this job runs in, rather than a new one
+        from sres import get_app
+        app = get_app()
+        batch_size = max(int(app.config.get('MAIL_BATCH_SIZE', 50)), 1)
+        batch_delay = float(app.config.get('MAIL_BATCH_DELAY_SECONDS', 0))
+        for i in range(0, len(identifiers_to_be_sent), batch_size):
+            batch_identifiers = identifiers_to_be_sent[i:i + batch_size]
+            send_logs = []
+            failed_identifiers = []
             try:
                 with app.app_context():
-                    # actually do the send
-                    results = filter.get_personalised_message(
-                        identifiers=[identifier],
-                        mode='send',
-                        auth_username=auth_username
-                    )
-                count_successful_sends += 1
+                    with current_app.mail.connect() as mail_connection:
+                        # actually do the sends, one message at a time
+                        for result in filter.iterate_personalised_messages(
+                            identifiers=batch_identifiers,
+                            mode='send',
+                            auth_username=auth_username,
+                            mail_connection=mail_connection,
+                            sent_targets=sent_targets,
+                            send_logs=send_logs,
+                            errors=failed_identifiers
+                        ):
+                            count_successful_sends += 1
             except Exception as e:
+                # e.g. could not connect to the mail server, or the connection dropped part way;
+                # the rest of this batch is sent when the run is requeued
                 failure_encountered = True
-                logging.error('send_messages failed to identifier [{}] [{}]'.format(identifier, filter_uuid))
+                logging.error('send_messages failed batch from [{}] [{}]'.format(i, filter_uuid))
                 logging.exception(e)
+            finally:
+                # record what was sent, even if the batch did not complete
+                log_message_sends(send_logs)
+            if failed_identifiers:
+                failure_encountered = True
+            if batch_delay and i + batch_size < len(identifiers_to_be_sent):
+                time.sleep(batch_delay)
         # are we done? if not, reschedule for followup
         if failure_encountered:
             with app.app_context():
@@ -202,7 +238,6 @@ def send_messages(filter_uuid, identifiers, auth_username, attempts_already=0, i
         else:
             logging.info(f'send_messages completed without sending any messages [{filter_uuid}] [{count_successful_sends}] on [{os.getpid()}]')
         job.release_claim()
-        del app
     else:
         logging.error('send_messages failed, could not load [{}]'.format(filter_uuid))
 
@@ -617,7 +652,7 @@ class Filter:
             # return
             return results
     
-    def get_personalised_message(self, identifiers, mode='preview', auth_username=None):
+    def get_personalised_message(self, identifiers, mode='preview', auth_username=None, mail_connection=None, sent_targets=None, send_logs=None):
         """
             Processes a personalised message for this current filter for the specified identifier(s).
             May be used to send a message.
@@ -625,10 +660,41 @@ class Filter:
             identifiers (list of strings) Typically SID
             mode (string) preview|send
             auth_username (string) Needed for when not running in a request context.
+            mail_connection (flask_mail.Connection) An open connection to send emails through. If None,
+                each email is sent over its own connection.
+            sent_targets (set of strings) Targets already sent this filter. If provided, this is used
+                (and updated) instead of checking the logs for each message.
+            send_logs (list) If provided, send log records are appended to this for the caller to
+                save with log_message_sends, instead of being saved one by one.
             
             Returns list of dicts of structure ret_element. Each dict corresponds to one identifier.
         """
-        ret = []
+        return list(self.iterate_personalised_messages(
+            identifiers=identifiers,
+            mode=mode,
+            auth_username=auth_username,
+            mail_connection=mail_connection,
+            sent_targets=sent_targets,
+            send_logs=send_logs
+        ))
+    
+    def iterate_personalised_messages(self, identifiers, mode='preview', auth_username=None, mail_connection=None, sent_targets=None, send_logs=None, errors=None):
+        """
+            Processes personalised messages like get_personalised_message, but yields them one at a time.
+            Recipients are looked up in every referenced table PERSONALISED_MESSAGE_BATCH_SIZE at a time,
+            and attachments are read once per run, so any number of identifiers can be streamed.
+            
+            identifiers (list of strings) Typically SID
+            mode (string) preview|send
+            auth_username, mail_connection, sent_targets, send_logs As for get_personalised_message
+            errors (list|None) If provided, identifiers whose message raised an exception are logged
+                and appended here, and processing continues with the next identifier. Otherwise
+                the exception is raised. Sends over mail_connection that fail count as exceptions,
+                and a failed mail connection is always raised as the rest of the batch would fail too.
+            
+            Yields dicts of structure ret_element, one per identifier except those skipped because
+                they have already been sent this filter.
+        """
         ret_element = {
             'identifier': '',
 			'success': False,
@@ -655,224 +721,296 @@ class Filter:
         for _referenced_table_uuid in _referenced_table_uuids:
             _referenced_tables[_referenced_table_uuid] = Table()
             _referenced_tables[_referenced_table_uuid].load(_referenced_table_uuid)
+        # fetch only the referenced columns, unless summaries may need others
+        projection = self.get_referenced_column_references(order_by_prevalence=False, uuids_only=True)
+        if '$SMY_' in json.dumps(self.config['email'], default=str):
+            projection = None
+        # load attachments once
+        attachments = []
+        for attachment in self.config['email']['attachments']:
+            attachment_info = self.get_attachment(
+                local_filename=attachment['filename'],
+                get_file_content=True if mode == 'send' else False
+            )
+            if attachment_info:
+                attachment_info['filename'] = get_file_access_url(attachment['filename'])
+                attachments.append(attachment_info)
+            else:
+                print('failed getting attachment_info', attachment['filename'])
         # load up connectors if needed
+        canvas_connector = None
         if 'canvasinbox' in self.config['contact_type'] and is_canvas_connection_enabled():
             canvas_connector = CanvasConnector(_override_username=auth_username)
             canvas_connector.load_connections(self.config['tracking_record'][0]['table_uuid'])
             canvas_connector.load_connected_course_ids()
-        # iterate through identifiers
-        for identifier in identifiers:
-            main_table_student_data = StudentData(_referenced_tables[main_table_uuid])
-            ret_el = deepcopy(ret_element)
-            ret_el['identifier'] = identifier
-            # try and find the student
-            student_found = False
-            student_data = None
-            if main_table_student_data.find_student(identifier):
+        # iterate through identifiers in batches
+        for i in range(0, len(identifiers), PERSONALISED_MESSAGE_BATCH_SIZE):
+            batch_identifiers = identifiers[i:i + PERSONALISED_MESSAGE_BATCH_SIZE]
+            batch_student_data = {
+                _referenced_table_uuid: find_students_bulk(_referenced_table, batch_identifiers, projection=projection)
+                for _referenced_table_uuid, _referenced_table in _referenced_tables.items()
+            }
+            for identifier in batch_identifiers:
+                try:
+                    ret_el = self._make_personalised_message(
+                        identifier=identifier,
+                        ret_element=ret_element,
+                        mode=mode,
+                        referenced_tables=_referenced_tables,
+                        main_table_uuid=main_table_uuid,
+                        batch_student_data=batch_student_data,
+                        attachments=attachments,
+                        canvas_connector=canvas_connector,
+                        mail_connection=mail_connection,
+                        sent_targets=sent_targets,
+                        send_logs=send_logs
+                    )
+                except Exception as e:
+                    if errors is None or _is_mail_connection_error(e):
+                        raise
+                    logging.error('iterate_personalised_messages failed for identifier [{}] [{}]'.format(identifier, self.config['uuid']))
+                    logging.exception(e)
+                    errors.append(identifier)
+                    continue
+                if ret_el is not None:
+                    yield ret_el
+    
+    def _make_personalised_message(self, identifier, ret_element, mode, referenced_tables, main_table_uuid, batch_student_data, attachments, canvas_connector, mail_connection, sent_targets, send_logs):
+        """
+            Processes the personalised message for one identifier, for iterate_personalised_messages.
+            
+            batch_student_data (dict) Keyed by table uuid, dicts of loaded StudentData keyed by identifier
+                as returned by find_students_bulk.
+            
+            Returns a dict of structure ret_element, or None if the message was skipped because it
+                has already been sent.
+        """
+        ret_el = deepcopy(ret_element)
+        ret_el['identifier'] = identifier
+        # the student's records in each referenced table, or unloaded instances where they are not found
+        student_data_instances = {
+            _referenced_table_uuid: batch_student_data[_referenced_table_uuid].get(identifier) or StudentData(_referenced_table)
+            for _referenced_table_uuid, _referenced_table in referenced_tables.items()
+        }
+        # try and find the student, in the main table first
+        student_found = False
+        student_data = None
+        for _referenced_table_uuid in [main_table_uuid] + [ t for t in referenced_tables.keys() if t != main_table_uuid ]:
+            if student_data_instances[_referenced_table_uuid]._id:
                 student_found = True
-                student_data = main_table_student_data
-            elif len(_referenced_tables) > 1:
-                # try another table?
-                for _referenced_table_uuid, _referenced_table in _referenced_tables.items():
-                    if _referenced_table_uuid == main_table_uuid:
-                        continue # no need to check this one, already checked
-                    _student_data = StudentData(_referenced_table)
-                    if _student_data.find_student(identifier):
-                        student_found = True
-                        student_data = _student_data
-                        break
-            if student_found and student_data:
-                # basic email details
-                ret_el['email']['details']['sender_name'] = substitute_text_variables(
-                    input=self.config['email']['sender']['name'], 
-                    identifier=identifier, 
-                    default_table_uuid=student_data.table.config['uuid'], 
-                    preloaded_student_data=student_data
-                )['new_text']
-                ret_el['email']['details']['sender_email'] = substitute_text_variables(
-                    input=self.config['email']['sender']['email'], 
-                    identifier=identifier, 
-                    default_table_uuid=student_data.table.config['uuid'], 
-                    preloaded_student_data=student_data
-                )['new_text']
-                ret_el['email']['details']['reply_to'] = substitute_text_variables(
-                    input=self.config['email']['addresses']['reply_to'], 
-                    identifier=identifier, 
-                    default_table_uuid=student_data.table.config['uuid'], 
-                    preloaded_student_data=student_data
-                )['new_text']
-                ret_el['email']['details']['cc'] = substitute_text_variables(
-                    input=self.config['email']['addresses']['cc'], 
-                    identifier=identifier, 
-                    default_table_uuid=student_data.table.config['uuid'], 
-                    preloaded_student_data=student_data
-                )['new_text']
-                ret_el['email']['details']['bcc'] = substitute_text_variables(
-                    input=self.config['email']['addresses']['bcc'], 
-                    identifier=identifier, 
-                    default_table_uuid=student_data.table.config['uuid'], 
-                    preloaded_student_data=student_data
-                )['new_text'] 
-                ret_el['email']['details']['to'] = substitute_text_variables(
-                    input=self.config['email']['addresses'].get('to', ''), 
-                    identifier=identifier, 
-                    default_table_uuid=student_data.table.config['uuid'], 
-                    preloaded_student_data=student_data
-                )['new_text'] 
-                ret_el['email']['target']['name'] = '{} {}'.format(student_data.config['preferred_name'], student_data.config['surname'])
-                ret_el['email']['target']['email'] = student_data.config['email']
-                # attachments
-                ret_el['email']['attachments'] = []
-                if self.config['email']['attachments']:
-                    for attachment in self.config['email']['attachments']:
-                        attachment_info = self.get_attachment(
-                            local_filename=attachment['filename'],
-                            get_file_content=True if mode == 'send' else False
+                student_data = student_data_instances[_referenced_table_uuid]
+                break
+        if student_found and student_data:
+            # basic email details
+            ret_el['email']['details']['sender_name'] = substitute_text_variables(
+                input=self.config['email']['sender']['name'], 
+                identifier=identifier, 
+                default_table_uuid=student_data.table.config['uuid'], 
+                preloaded_student_data=student_data,
+                preloaded_student_data_instances=student_data_instances
+            )['new_text']
+            ret_el['email']['details']['sender_email'] = substitute_text_variables(
+                input=self.config['email']['sender']['email'], 
+                identifier=identifier, 
+                default_table_uuid=student_data.table.config['uuid'], 
+                preloaded_student_data=student_data,
+                preloaded_student_data_instances=student_data_instances
+            )['new_text']
+            ret_el['email']['details']['reply_to'] = substitute_text_variables(
+                input=self.config['email']['addresses']['reply_to'], 
+                identifier=identifier, 
+                default_table_uuid=student_data.table.config['uuid'], 
+                preloaded_student_data=student_data,
+                preloaded_student_data_instances=student_data_instances
+            )['new_text']
+            ret_el['email']['details']['cc'] = substitute_text_variables(
+                input=self.config['email']['addresses']['cc'], 
+                identifier=identifier, 
+                default_table_uuid=student_data.table.config['uuid'], 
+                preloaded_student_data=student_data,
+                preloaded_student_data_instances=student_data_instances
+            )['new_text']
+            ret_el['email']['details']['bcc'] = substitute_text_variables(
+                input=self.config['email']['addresses']['bcc'], 
+                identifier=identifier, 
+                default_table_uuid=student_data.table.config['uuid'], 
+                preloaded_student_data=student_data,
+                preloaded_student_data_instances=student_data_instances
+            )['new_text'] 
+            ret_el['email']['details']['to'] = substitute_text_variables(
+                input=self.config['email']['addresses'].get('to', ''), 
+                identifier=identifier, 
+                default_table_uuid=student_data.table.config['uuid'], 
+                preloaded_student_data=student_data,
+                preloaded_student_data_instances=student_data_instances
+            )['new_text'] 
+            ret_el['email']['target']['name'] = '{} {}'.format(student_data.config['preferred_name'], student_data.config['surname'])
+            ret_el['email']['target']['email'] = student_data.config['email']
+            # attachments, sharing the file content read once per run
+            ret_el['email']['attachments'] = [ dict(attachment) for attachment in attachments ]
+            # message
+            ret_el['email']['subject'] = substitute_text_variables(
+                input=self.config['email']['subject'], 
+                identifier=identifier, 
+                default_table_uuid=student_data.table.config['uuid'], 
+                preloaded_student_data=student_data,
+                preloaded_student_data_instances=student_data_instances
+            )['new_text']
+            ret_el['email']['body'] = self.get_substituted_email_body(
+                identifier=identifier, 
+                default_table_uuid=student_data.table.config['uuid'], 
+                preloaded_student_data=student_data,
+                preloaded_student_data_instances=student_data_instances
+            )
+            # recipients
+            if len(ret_el['email']['details']['to'].strip()) > 0:
+                ret_el['email']['target']['email'] = re.findall("[^\s,;]+", ret_el['email']['details']['to'])
+                ret_el['email']['target']['name'] = ''
+            # determine action
+            if mode == 'send':
+                tracking_log_uuid = utils.create_uuid(sep='-')
+                # url tracking
+                ret_el['email']['body'] = make_urls_trackable(ret_el['email']['body'], tracking_log_uuid)
+                # inject_feedback_request
+                ret_el['email']['body'] = self.inject_feedback_request(ret_el['email']['body'], tracking_log_uuid)
+                # inject tracking beacon
+                ret_el['email']['body'] = ret_el['email']['body'] + '<br>' + get_beacon_html(tracking_log_uuid)
+                # recipients
+                recipients = ret_el['email']['target']['email'] if isinstance(ret_el['email']['target']['email'], list) else [ret_el['email']['target']['email']]
+                # send!
+                logging.debug("Attempting to send message filter [{}] [{}]".format(self.config['uuid'], str(recipients)))
+                try:
+                    # check if already sent
+                    if sent_targets is not None:
+                        already_sent = any(recipient in sent_targets for recipient in recipients)
+                    else:
+                        already_sent = self.get_sent_messages(targets=recipients)
+                    if already_sent:
+                        logging.warning("Skipping sending filter [{}] to [{}] because a record already exists in logs".format(self.config['uuid'], str(recipients)))
+                        return None
+                    # continue with send
+                    if 'email' in self.config['contact_type']:
+                        # form message
+                        msg = Message(
+                            subject=ret_el['email']['subject'],
+                            recipients=recipients,
+                            html=ret_el['email']['body'],
+                            sender=(ret_el['email']['details']['sender_name'], ret_el['email']['details']['sender_email']),
+                            reply_to=ret_el['email']['details']['reply_to'],
+                            cc=re.findall("[^\s,;]+", ret_el['email']['details']['cc']),
+                            bcc=re.findall("[^\s,;]+", ret_el['email']['details']['bcc']),
+                            charset='utf-8'
                         )
-                        if attachment_info:
-                            attachment_info['filename'] = get_file_access_url(attachment['filename'])
-                            ret_el['email']['attachments'].append(attachment_info)
+                        # attachments
+                        if ret_el['email']['attachments']:
+                            for a, attachment in enumerate(ret_el['email']['attachments']):
+                                msg.attach(
+                                    filename=attachment['original_filename'],
+                                    content_type=attachment['mime_type'],
+                                    data=attachment['file_content']
+                                )
+                        if mail_connection is not None:
+                            mail_connection.send(msg)
                         else:
-                            print('failed getting attachment_info', identifier, attachment['filename'])
-                # message
-                ret_el['email']['subject'] = substitute_text_variables(
-                    input=self.config['email']['subject'], 
-                    identifier=identifier, 
-                    default_table_uuid=student_data.table.config['uuid'], 
-                    preloaded_student_data=student_data
-                )['new_text']
-                ret_el['email']['body'] = self.get_substituted_email_body(
-                    identifier=identifier, 
-                    default_table_uuid=student_data.table.config['uuid'], 
-                    preloaded_student_data=student_data
-                )
-                # recipients
-                if len(ret_el['email']['details']['to'].strip()) > 0:
-                    ret_el['email']['target']['email'] = re.findall("[^\s,;]+", ret_el['email']['details']['to'])
-                    ret_el['email']['target']['name'] = ''
-                # determine action
-                if mode == 'send':
-                    tracking_log_uuid = utils.create_uuid(sep='-')
-                    # url tracking
-                    ret_el['email']['body'] = make_urls_trackable(ret_el['email']['body'], tracking_log_uuid)
-                    # inject_feedback_request
-                    ret_el['email']['body'] = self.inject_feedback_request(ret_el['email']['body'], tracking_log_uuid)
-                    # inject tracking beacon
-                    ret_el['email']['body'] = ret_el['email']['body'] + '<br>' + get_beacon_html(tracking_log_uuid)
-                    # recipients
-                    recipients = ret_el['email']['target']['email'] if isinstance(ret_el['email']['target']['email'], list) else [ret_el['email']['target']['email']]
-                    # send!
-                    logging.debug("Attempting to send message filter [{}] [{}]".format(self.config['uuid'], str(recipients)))
-                    try:
-                        # check if already sent
-                        if self.get_sent_messages(targets=recipients):
-                            logging.warning("Skipping sending filter [{}] to [{}] because a record already exists in logs".format(self.config['uuid'], str(recipients)))
-                            continue
-                        # continue with send
-                        if 'email' in self.config['contact_type']:
-                            # form message
-                            msg = Message(
-                                subject=ret_el['email']['subject'],
-                                recipients=recipients,
-                                html=ret_el['email']['body'],
-                                sender=(ret_el['email']['details']['sender_name'], ret_el['email']['details']['sender_email']),
-                                reply_to=ret_el['email']['details']['reply_to'],
-                                cc=re.findall("[^\s,;]+", ret_el['email']['details']['cc']),
-                                bcc=re.findall("[^\s,;]+", ret_el['email']['details']['bcc']),
-                                charset='utf-8'
-                            )
-                            # attachments
-                            if ret_el['email']['attachments']:
-                                for a, attachment in enumerate(ret_el['email']['attachments']):
-                                    msg.attach(
-                                        filename=attachment['original_filename'],
-                                        content_type=attachment['mime_type'],
-                                        data=attachment['file_content']
-                                    )
                             with current_app.mail.record_messages() as outbox:
                                 current_app.mail.send(msg)
-                            # logging
-                            log_message_send(
-                                target=ret_el['email']['target']['email'], 
-                                contact_type='email', 
-                                message={
-                                    'subject': ret_el['email']['subject'],
-                                    'body': ret_el['email']['body']
-                                },
-                                source_asset_type='filter', 
-                                source_asset_uuid=self.config['uuid'], 
-                                log_uuid=tracking_log_uuid,
-                                identifier=student_data.config['sid']
-                            )
-                            ret_el['contact_types'].append('email')
-                            logging.info(f"Filter email dispatched [{self.config['uuid']}] [{recipients}] [{tracking_log_uuid}]")
-                        if 'canvasinbox' in self.config['contact_type'] and is_canvas_connection_enabled():
-                            # get canvas context
-                            connected_course_ids = canvas_connector.connected_course_ids
-                            course_context_id = None
-                            if len(connected_course_ids) > 0:
-                                course_context_id = connected_course_ids[0]
-                            # make body
-                            plain_body = _convert_html_message_to_plaintext(ret_el['email']['body'])
-                            # make different tracking_log_uuid
-                            canvasinbox_tracking_log_uuid = utils.create_uuid(sep='-')
-                            plain_body = plain_body.replace(tracking_log_uuid, canvasinbox_tracking_log_uuid)
-                            # get recipient user id
-                            canvas_recipient = student_data.config['alternative_id1']
-                            # send it
-                            canvas_connector.create_conversation(
-                                subject=ret_el['email']['subject'],
-                                body=plain_body,
-                                recipient=canvas_recipient,
-                                override_course_context_id=course_context_id
-                            )
-                            # logging
-                            log_message_send(
-                                target=f"{student_data.config['sid']} ({canvas_recipient})", 
-                                contact_type='canvasinbox', 
-                                message={
-                                    'subject': ret_el['email']['subject'],
-                                    'body': plain_body
-                                },
-                                source_asset_type='filter', 
-                                source_asset_uuid=self.config['uuid'], 
-                                log_uuid=canvasinbox_tracking_log_uuid,
-                                identifier=student_data.config['sid']
-                            )
-                            ret_el['contact_types'].append('canvasinbox')
-                            logging.info(f"Filter canvasinbox dispatched [{self.config['uuid']}] [{canvas_recipient}] [{canvasinbox_tracking_log_uuid}]")
-                        # increment_counter
-                        self.increment_counter(
-                            log_uuid=tracking_log_uuid, 
-                            reset_to=0, 
-                            preloaded_student_data=student_data
+                        if sent_targets is not None:
+                            sent_targets.update(recipients)
+                        # logging
+                        self._log_message_send(
+                            send_logs=send_logs,
+                            target=ret_el['email']['target']['email'], 
+                            contact_type='email', 
+                            message={
+                                'subject': ret_el['email']['subject'],
+                                'body': ret_el['email']['body']
+                            },
+                            source_asset_type='filter', 
+                            source_asset_uuid=self.config['uuid'], 
+                            log_uuid=tracking_log_uuid,
+                            identifier=student_data.config['sid']
                         )
-                        # update send_result
-                        ret_el['email']['send_result']['success'] = True
-                        ret_el['email']['send_result']['target'] = ret_el['email']['target']['email']
-                    except Exception as e:
-                        logging.error("FAILED send message filter [{}] [{}] [{}]".format(self.config['uuid'], str(recipients), repr(e)))
-                        logging.exception(e)
-                        ret_el['email']['send_result']['success'] = False
-                        ret_el['messages'].append(("Error sending to {}.".format(str(recipients)), "warning"))
-                    # wipe attachment filecontent
-                    if ret_el['email']['attachments']:
-                        for a, attachment in enumerate(ret_el['email']['attachments']):
-                            if 'file_content' in attachment.keys():
-                                del ret_el['email']['attachments'][a]['file_content']
-                elif mode == 'preview':
-                    ret_el['email']['body'] = self.inject_feedback_request(ret_el['email']['body'], '')
-                    ret_el['email']['body_plaintext'] = _convert_html_message_to_plaintext(ret_el['email']['body'])
-                    ret_el['contact_types'] = self.config['contact_type'].copy()
-                    if not is_canvas_connection_enabled() and 'canvasinbox' in ret_el['contact_types']:
-                        ret_el['contact_types'].remove('canvasinbox')
-                ret_el['contact_types_display'] = [ _CONTACT_METHODS.get(ct, {}).get('name', "Unknown") for ct in ret_el['contact_types'] ]
-                # success
-                ret_el['success'] = True
-            else:
-                ret_el['messages'].append(("Identifier {} not found.".format(identifier), "warning"))
-            ret.append(ret_el)
-        return ret
+                        ret_el['contact_types'].append('email')
+                        logging.info(f"Filter email dispatched [{self.config['uuid']}] [{recipients}] [{tracking_log_uuid}]")
+                    if 'canvasinbox' in self.config['contact_type'] and is_canvas_connection_enabled():
+                        # get canvas context
+                        connected_course_ids = canvas_connector.connected_course_ids
+                        course_context_id = None
+                        if len(connected_course_ids) > 0:
+                            course_context_id = connected_course_ids[0]
+                        # make body
+                        plain_body = _convert_html_message_to_plaintext(ret_el['email']['body'])
+                        # make different tracking_log_uuid
+                        canvasinbox_tracking_log_uuid = utils.create_uuid(sep='-')
+                        plain_body = plain_body.replace(tracking_log_uuid, canvasinbox_tracking_log_uuid)
+                        # get recipient user id
+                        canvas_recipient = student_data.config['alternative_id1']
+                        # send it
+                        canvas_connector.create_conversation(
+                            subject=ret_el['email']['subject'],
+                            body=plain_body,
+                            recipient=canvas_recipient,
+                            override_course_context_id=course_context_id
+                        )
+                        if sent_targets is not None:
+                            sent_targets.add(f"{student_data.config['sid']} ({canvas_recipient})")
+                        # logging
+                        self._log_message_send(
+                            send_logs=send_logs,
+                            target=f"{student_data.config['sid']} ({canvas_recipient})", 
+                            contact_type='canvasinbox', 
+                            message={
+                                'subject': ret_el['email']['subject'],
+                                'body': plain_body
+                            },
+                            source_asset_type='filter', 
+                            source_asset_uuid=self.config['uuid'], 
+                            log_uuid=canvasinbox_tracking_log_uuid,
+                            identifier=student_data.config['sid']
+                        )
+                        ret_el['contact_types'].append('canvasinbox')
+                        logging.info(f"Filter canvasinbox dispatched [{self.config['uuid']}] [{canvas_recipient}] [{canvasinbox_tracking_log_uuid}]")
+                    # increment_counter
+                    self.increment_counter(
+                        log_uuid=tracking_log_uuid, 
+                        reset_to=0, 
+                        preloaded_student_data=student_data
+                    )
+                    # update send_result
+                    ret_el['email']['send_result']['success'] = True
+                    ret_el['email']['send_result']['target'] = ret_el['email']['target']['email']
+                except Exception as e:
+                    logging.error("FAILED send message filter [{}] [{}] [{}]".format(self.config['uuid'], str(recipients), repr(e)))
+                    logging.exception(e)
+                    if mail_connection is not None:
+                        # a batched send; let send_messages know so that this recipient is retried
+                        raise
+                    ret_el['email']['send_result']['success'] = False
+                    ret_el['messages'].append(("Error sending to {}.".format(str(recipients)), "warning"))
+                # wipe attachment filecontent
+                if ret_el['email']['attachments']:
+                    for a, attachment in enumerate(ret_el['email']['attachments']):
+                        if 'file_content' in attachment.keys():
+                            del ret_el['email']['attachments'][a]['file_content']
+            elif mode == 'preview':
+                ret_el['email']['body'] = self.inject_feedback_request(ret_el['email']['body'], '')
+                ret_el['email']['body_plaintext'] = _convert_html_message_to_plaintext(ret_el['email']['body'])
+                ret_el['contact_types'] = self.config['contact_type'].copy()
+                if not is_canvas_connection_enabled() and 'canvasinbox' in ret_el['contact_types']:
+                    ret_el['contact_types'].remove('canvasinbox')
+            ret_el['contact_types_display'] = [ _CONTACT_METHODS.get(ct, {}).get('name', "Unknown") for ct in ret_el['contact_types'] ]
+            # success
+            ret_el['success'] = True
+        else:
+            ret_el['messages'].append(("Identifier {} not found.".format(identifier), "warning"))
+        return ret_el
+    
+    def _log_message_send(self, send_logs=None, **kwargs):
+        """Saves a message send log now, or if send_logs (list) is provided, appends it there to be saved later."""
+        if send_logs is None:
+            log_message_send(**kwargs)
+        else:
+            send_logs.append(make_message_send_log(**kwargs))
     
     def add_run_history(self, auth_username):
         self.config['run_history'].append({
@@ -882,14 +1020,15 @@ class Filter:
         })
         return self.update(override_username=auth_username)
     
-    def get_substituted_email_body(self, identifier, default_table_uuid, preloaded_student_data):
+    def get_substituted_email_body(self, identifier, default_table_uuid, preloaded_student_data, preloaded_student_data_instances=None):
         complete_body = ''
         # first section
         complete_body = complete_body + substitute_text_variables(
             input=self.config['email']['body_first'],
             identifier=identifier,
             default_table_uuid=default_table_uuid,
-            preloaded_student_data=preloaded_student_data
+            preloaded_student_data=preloaded_student_data,
+            preloaded_student_data_instances=preloaded_student_data_instances
         )['new_text']
         # additional sections
         for section in self.config['email']['sections']:
@@ -904,14 +1043,16 @@ class Filter:
                     input=section['content'],
                     identifier=identifier,
                     default_table_uuid=default_table_uuid,
-                    preloaded_student_data=preloaded_student_data
+                    preloaded_student_data=preloaded_student_data,
+                    preloaded_student_data_instances=preloaded_student_data_instances
                 )['new_text']
         # last section
         complete_body = complete_body + substitute_text_variables(
             input=self.config['email']['body_last'],
             identifier=identifier,
             default_table_uuid=default_table_uuid,
-            preloaded_student_data=preloaded_student_data
+            preloaded_student_data=preloaded_student_data,
+            preloaded_student_data_instances=preloaded_student_data_instances
         )['new_text']
         return complete_body
     
@@ -1135,6 +1276,21 @@ class Filter:
         records = list(dict.fromkeys(records))
         return records
         
+    def get_all_targets_and_identifiers(self):
+        """Returns a tuple of (targets, identifiers), each a list, that this filter has been sent to, from one query."""
+        records = list(self.db.message_send_logs.find(
+            {
+                'source_asset_type': 'filter',
+                'source_asset_uuid': self.config['uuid']
+            },
+            ['target', 'identifier']
+        ))
+        ret = []
+        for key in ['target', 'identifier']:
+            values, topology = utils.flatten_list([ r[key] for r in records if r.get(key) is not None ])
+            ret.append(list(dict.fromkeys(values)))
+        return ret[0], ret[1]
+    
     def get_all_targets_types(self):
         records = self.db.message_send_logs.find(
             {
@@ -5,7 +5,6 @@ import collections
 from datetime import datetime, timedelta
 from dateutil import parser
 from natsort import natsorted, ns
-from scipy import stats
 import pandas
 import numpy
 from flask_mail import Message
@@ -286,186 +285,7 @@ def run_insight(insight_uuid, send_email=True, return_html=False):
         # TODO for weekday..??
         students_by_groups = dict(natsorted(students_by_groups.items(), key=lambda kv: kv[0], alg=ns.IGNORECASE))
         
-        targeted_identifiers = []
-        
-        if insight.config['trigger_config']['trigger_type'] == 'quartiles':
-            # calculate the quartiles for each column requested
-            for column_reference in column_references:
-                df_data[column_reference] = pandas.to_numeric(df_data[column_reference], errors='coerce')
-                df_data['quartile_{}'.format(column_reference)] = pandas.qcut(
-                    df_data[column_reference],
-                    4,
-                    labels=False,
-                    duplicates='drop'
-                )
-            # perform comparison for each student
-            df_data['match_count'] = 0
-            for column_reference in column_references:
-                quartiles_range = int(insight.config['trigger_config']['trigger_config_quartiles_range'])
-                if quartiles_range in [1,2]:
-                    df_data['match_count'] = df_data['match_count'] + df_data['quartile_{}'.format(column_reference)].apply(
-                        lambda x: 1 if x <= quartiles_range - 1 else 0
-                    )
-                elif quartiles_range in [3,4]:
-                    df_data['match_count'] = df_data['match_count'] + df_data['quartile_{}'.format(column_reference)].apply(
-                        lambda x: 1 if x >= quartiles_range - 1 else 0
-                    )
-            #print('quartile df_data', df_data)
-            if insight.config['trigger_config']['trigger_config_quartiles_combiner'] == 'any':
-                df_filtered = df_data.loc[df_data['match_count'] >= 1]
-            else: # all
-                df_filtered = df_data.loc[df_data['match_count'] == len(column_references)]
-            #print('quartile df_filtered', df_filtered)
-            # collect
-            targeted_identifiers = df_filtered['identifier'].tolist()
-        elif insight.config['trigger_config']['trigger_type'] == 'matching':
-            # perform comparison for each student for each column
-            df_data['match_count'] = 0
-            matching_value = insight.config['trigger_config']['trigger_config_matching_value']
-            if insight.config['trigger_config']['trigger_config_matching_method'] == 'eq':
-                for column_reference in column_references:
-                    df_data['match_count'] = df_data['match_count'] + df_data[column_reference].apply(
-                        lambda x: 1 if str(x) == str(matching_value) else 0
-                    )
-            elif insight.config['trigger_config']['trigger_config_matching_method'] == 'neq':
-                for column_reference in column_references:
-                    df_data['match_count'] = df_data['match_count'] + df_data[column_reference].apply(
-                        lambda x: 1 if str(x) != str(matching_value) else 0
-                    )
-            elif insight.config['trigger_config']['trigger_config_matching_method'] == 'like':
-                for column_reference in column_references:
-                    df_data['match_count'] = df_data['match_count'] + df_data[column_reference].apply(
-                        lambda x: 1 if str(matching_value).lower() in str(x).lower() else 0
-                    )
-            elif insight.config['trigger_config']['trigger_config_matching_method'] == 'notlike':
-                for column_reference in column_references:
-                    df_data['match_count'] = df_data['match_count'] + df_data[column_reference].apply(
-                        lambda x: 1 if str(matching_value).lower() not in str(x).lower() else 0
-                    )
-            elif insight.config['trigger_config']['trigger_config_matching_method'] in ['lt', 'lte', 'gt', 'gte']:
-                for column_reference in column_references:
-                    df_data['match_count'] = df_data['match_count'] + df_data[column_reference].apply(
-                        lambda x: _compare_values(
-                            x,
-                            insight.config['trigger_config']['trigger_config_matching_method'],
-                            matching_value
-                        )
-                    )
-            elif insight.config['trigger_config']['trigger_config_matching_method'] == 'isnull':
-                for column_reference in column_references:
-                    df_data['match_count'] = df_data['match_count'] + df_data[column_reference].apply(
-                        lambda x: 1 if x == '' or x is None else 0
-                    )
-            elif insight.config['trigger_config']['trigger_config_matching_method'] == 'isnotnull':
-                for column_reference in column_references:
-                    df_data['match_count'] = df_data['match_count'] + df_data[column_reference].apply(
-                        lambda x: 1 if x != '' and x is not None else 0
-                    )
-            elif insight.config['trigger_config']['trigger_config_matching_method'] == 'regex':
-                def _regex_matcher(matching_value, x):
-                    try:
-                        if len(re.findall(matching_value, x)):
-                            logging.debug('matched [{}] ... [{}] in [{}]'.format(matching_value, x, insight.config['uuid']))
-                            return 1
-                        return 0
-                    except:
-                        #logging.debug('error matching [{}] ... [{}] in [{}]'.format(matching_value, x, insight.config['uuid']))
-                        return 0
-                for column_reference in column_references:
-                    df_data['match_count'] = df_data['match_count'] + df_data[column_reference].apply(
-                        lambda x: _regex_matcher(matching_value, x)
-                    )
-            # check if met the threshold
-            matching_count = int(insight.config['trigger_config']['trigger_config_matching_count'])
-            matching_count_comparator = insight.config['trigger_config']['trigger_config_matching_count_comparator']
-            if matching_count_comparator == 'eq':
-                df_filtered = df_data.loc[df_data['match_count'] == matching_count]
-            elif matching_count_comparator == 'lt':
-                df_filtered = df_data.loc[df_data['match_count'] < matching_count]
-            elif matching_count_comparator == 'gt':
-                df_filtered = df_data.loc[df_data['match_count'] > matching_count]
-            # collect
-            targeted_identifiers = df_filtered['identifier'].tolist()
-        elif insight.config['trigger_config']['trigger_type'] == 'trending':
-            # slope calculator method
-            def _slope(x_values, y_values):
-                mask = ~numpy.isnan(x_values) & ~numpy.isnan(y_values)
-                x_values, y_values = numpy.array(x_values), numpy.array(y_values)
-                if len(x_values[mask]):
-                    reg = stats.linregress(x_values[mask], y_values[mask])
-                    return reg[0]
-                else:
-                    return numpy.nan
-            # any data conversions specified?
-            data_conversion = insight.config['trigger_config']['trigger_config_trending_data_conversion']
-            if data_conversion == 'binarise':
-                # presence of data as 1, absence as 0
-                for column_reference in column_references:
-                    df_data[column_reference] = df_data[column_reference].apply(
-                        lambda x: 0 if str(x) == '' or x is None or x is numpy.nan else 1
-                    )
-            elif data_conversion == 'blankzero' or data_conversion == 'none':
-                if data_conversion == 'blankzero':
-                    # convert blanks to zero
-                    for column_reference in column_references:
-                        df_data[column_reference] = df_data[column_reference].apply(
-                            lambda x: 0 if str(x) == '' or x is None or x is numpy.nan else x
-                        )
-                elif data_conversion == 'none':
-                    pass
-                # cast to numeric
-                for column_reference in column_references:
-                    df_data[column_reference] = pandas.to_numeric(df_data[column_reference], errors='coerce')
-                df_data.fillna(value=numpy.nan, inplace=True)
-            # calculate slopes
-            df_data['slope'] = df_data.apply(
-                lambda x: _slope(
-                    list(range(0, len(column_references))),
-                    [x[column_reference] for column_reference in column_references]
-                )
-            , axis=1)
-            # check if met the threshold
-            trending_direction = insight.config['trigger_config']['trigger_config_trending_direction']
-            if trending_direction == 'down':
-                df_filtered = df_data.loc[df_data['slope'] < 0]
-            elif trending_direction == 'up':
-                df_filtered = df_data.loc[df_data['slope'] > 0]
-            # collect
-            targeted_identifiers = df_filtered['identifier'].tolist()
-        elif insight.config['trigger_config']['trigger_type'] == 'distance_from_average':
-            # calculate the mean for each column and the distance from
-            for column_reference in column_references:
-                df_data[column_reference] = pandas.to_numeric(df_data[column_reference], errors='coerce')
-                mean = df_data[column_reference].mean()
-                df_data['distance_{}'.format(column_reference)] = df_data[column_reference].apply(
-                    lambda x: x - mean
-                )
-            # perform comparison for each student
-            df_data['match_count'] = 0
-            distance_value = float(insight.config['trigger_config']['trigger_config_distance_value'])
-            distance_direction = insight.config['trigger_config']['trigger_config_distance_direction']
-            for column_reference in column_references:
-                if distance_direction == 'lt':
-                    df_data['match_count'] = df_data['match_count'] + df_data['distance_{}'.format(column_reference)].apply(
-                        lambda x: 1 if x < distance_value else 0
-                    )
-                elif distance_direction == 'gt':
-                    df_data['match_count'] = df_data['match_count'] + df_data['distance_{}'.format(column_reference)].apply(
-                        lambda x: 1 if x > distance_value else 0
-                    )
-                if distance_direction == 'ltgt':
-                    df_data['match_count'] = df_data['match_count'] + df_data['distance_{}'.format(column_reference)].apply(
-                        lambda x: 1 if x < distance_value or x > distance_value else 0
-                    )
-            if insight.config['trigger_config']['trigger_config_distance_combiner'] == 'any':
-                df_filtered = df_data.loc[df_data['match_count'] >= 1]
-            else: # all
-                df_filtered = df_data.loc[df_data['match_count'] == len(column_references)]
-            # collect
-            targeted_identifiers = df_filtered['identifier'].tolist()
-        elif insight.config['trigger_config']['trigger_type'] == 'ml_outliers':
-            # TODO
-            pass
+        targeted_identifiers = get_triggered_identifiers(df_data, column_references, insight.config['trigger_config'])
         
         # set up app context
         if not current_app:
@@ -654,6 +474,212 @@ def _compare_values(matching_value, operator, x):
     else:
         return _operate(matching_value, operator, x)
 
+_SERIES_COMPARATORS = {
+    'lt': lambda left, right: left < right,
+    'lte': lambda left, right: left <= right,
+    'gt': lambda left, right: left > right,
+    'gte': lambda left, right: left >= right
+}
+
+def _to_numeric(series):
+    """Casts a column of student data to floats, with NaN for anything not numeric."""
+    try:
+        return pandas.to_numeric(series, errors='coerce')
+    except TypeError:
+        # unhashable cell values such as lists
+        return pandas.to_numeric(series.map(lambda x: x if utils.is_number(x) else None), errors='coerce')
+
+def _is_blank(series):
+    """Boolean series of which cells are empty."""
+    return series.isnull() | (series == '')
+
+def _count_matches(matches):
+    """Sums a list of boolean series, one per column, into a count of matches per student."""
+    return pandas.concat(matches, axis=1).sum(axis=1)
+
+def _combine_match_counts(match_count, combiner, column_count):
+    if combiner == 'any':
+        return match_count >= 1
+    else: # all
+        return match_count == column_count
+
+def _compare_series(series, operator, matching_value):
+    """Vectorised version of _compare_values for every cell of a column. Returns a boolean series."""
+    result = pandas.Series(False, index=series.index)
+    remaining = pandas.Series(True, index=series.index)
+    if utils.is_number(matching_value):
+        numbers = _to_numeric(series)
+        remaining = numbers.isnull()
+        result = _SERIES_COMPARATORS[operator](numbers, float(matching_value)) & ~remaining
+    # blanks are compared as empty text
+    blanks = remaining & _is_blank(series)
+    if blanks.any():
+        result[blanks] = _compare_values('', operator, matching_value) == 1
+        remaining = remaining & ~blanks
+    # other cells that are not numbers are compared as datetimes or text, as before
+    if remaining.any():
+        texts = series[remaining].astype(str)
+        outcomes = {text: _compare_values(text, operator, matching_value) == 1 for text in texts.unique()}
+        result[remaining] = texts.map(outcomes)
+    return result
+
+def _trending_slopes(values):
+    """
+        Calculates the least squares slope of each row of values against column position, ignoring NaNs.
+        
+        values (2D numpy array) One row per student, one column per column reference.
+        
+        Returns a 1D numpy array of slopes, NaN where fewer than two values are present.
+    """
+    present = ~numpy.isnan(values)
+    positions = numpy.broadcast_to(numpy.arange(values.shape[1], dtype=float), values.shape)
+    counts = present.sum(axis=1)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        mean_positions = numpy.where(present, positions, 0).sum(axis=1) / counts
+        mean_values = numpy.where(present, values, 0).sum(axis=1) / counts
+        position_deviations = numpy.where(present, positions - mean_positions[:, None], 0)
+        value_deviations = numpy.where(present, values - mean_values[:, None], 0)
+        sxx = (position_deviations * position_deviations).sum(axis=1)
+        sxy = (position_deviations * value_deviations).sum(axis=1)
+        return numpy.where(sxx > 0, sxy / sxx, numpy.nan)
+
+def _evaluate_quartiles_trigger(df_data, column_references, trigger_config):
+    quartiles_range = int(trigger_config['trigger_config_quartiles_range'])
+    matches = []
+    for column_reference in column_references:
+        quartiles = pandas.qcut(
+            _to_numeric(df_data[column_reference]),
+            4,
+            labels=False,
+            duplicates='drop'
+        )
+        if quartiles_range in [1, 2]:
+            matches.append(quartiles <= quartiles_range - 1)
+        elif quartiles_range in [3, 4]:
+            matches.append(quartiles >= quartiles_range - 1)
+    if not matches:
+        return pandas.Series(False, index=df_data.index)
+    return _combine_match_counts(
+        _count_matches(matches),
+        trigger_config['trigger_config_quartiles_combiner'],
+        len(column_references)
+    )
+
+def _evaluate_matching_trigger(df_data, column_references, trigger_config):
+    matching_value = trigger_config['trigger_config_matching_value']
+    matching_method = trigger_config['trigger_config_matching_method']
+    matches = []
+    if matching_method == 'regex':
+        try:
+            matching_pattern = re.compile(matching_value)
+        except:
+            matching_pattern = None
+    for column_reference in column_references:
+        series = df_data[column_reference]
+        if matching_method == 'eq':
+            matches.append(series.astype(str) == str(matching_value))
+        elif matching_method == 'neq':
+            matches.append(series.astype(str) != str(matching_value))
+        elif matching_method == 'like':
+            matches.append(series.astype(str).str.lower().str.contains(str(matching_value).lower(), regex=False))
+        elif matching_method == 'notlike':
+            matches.append(~series.astype(str).str.lower().str.contains(str(matching_value).lower(), regex=False))
+        elif matching_method in ['lt', 'lte', 'gt', 'gte']:
+            matches.append(_compare_series(series, matching_method, matching_value))
+        elif matching_method == 'isnull':
+            matches.append(_is_blank(series))
+        elif matching_method == 'isnotnull':
+            matches.append(~_is_blank(series))
+        elif matching_method == 'regex':
+            # only text is matched against the regular expression
+            try:
+                matched = series.str.contains(matching_pattern, na=False) if matching_pattern is not None else None
+            except (AttributeError, TypeError):
+                matched = None
+            matches.append(matched.astype(bool) if matched is not None else pandas.Series(False, index=df_data.index))
+    match_count = _count_matches(matches) if matches else pandas.Series(0, index=df_data.index)
+    # check if met the threshold
+    matching_count = int(trigger_config['trigger_config_matching_count'])
+    matching_count_comparator = trigger_config['trigger_config_matching_count_comparator']
+    if matching_count_comparator == 'eq':
+        return match_count == matching_count
+    elif matching_count_comparator == 'lt':
+        return match_count < matching_count
+    elif matching_count_comparator == 'gt':
+        return match_count > matching_count
+    return pandas.Series(False, index=df_data.index)
+
+def _evaluate_trending_trigger(df_data, column_references, trigger_config):
+    data_conversion = trigger_config['trigger_config_trending_data_conversion']
+    columns = []
+    for column_reference in column_references:
+        series = df_data[column_reference]
+        if data_conversion == 'binarise':
+            # presence of data as 1, absence as 0
+            columns.append((~_is_blank(series)).astype(float))
+        elif data_conversion == 'blankzero':
+            columns.append(_to_numeric(series.mask(_is_blank(series), 0)))
+        else:
+            columns.append(_to_numeric(series))
+    if not columns:
+        return pandas.Series(False, index=df_data.index)
+    slopes = pandas.Series(
+        _trending_slopes(numpy.column_stack([column.to_numpy(dtype=float) for column in columns])),
+        index=df_data.index
+    )
+    # check if met the threshold
+    trending_direction = trigger_config['trigger_config_trending_direction']
+    if trending_direction == 'down':
+        return slopes < 0
+    elif trending_direction == 'up':
+        return slopes > 0
+    return pandas.Series(False, index=df_data.index)
+
+def _evaluate_distance_from_average_trigger(df_data, column_references, trigger_config):
+    distance_value = float(trigger_config['trigger_config_distance_value'])
+    distance_direction = trigger_config['trigger_config_distance_direction']
+    matches = []
+    for column_reference in column_references:
+        values = _to_numeric(df_data[column_reference])
+        distances = values - values.mean()
+        if distance_direction == 'lt':
+            matches.append(distances < distance_value)
+        elif distance_direction == 'gt':
+            matches.append(distances > distance_value)
+        elif distance_direction == 'ltgt':
+            matches.append((distances < distance_value) | (distances > distance_value))
+    if not matches:
+        return pandas.Series(False, index=df_data.index)
+    return _combine_match_counts(
+        _count_matches(matches),
+        trigger_config['trigger_config_distance_combiner'],
+        len(column_references)
+    )
+
+_TRIGGER_EVALUATORS = {
+    'quartiles': _evaluate_quartiles_trigger,
+    'matching': _evaluate_matching_trigger,
+    'trending': _evaluate_trending_trigger,
+    'distance_from_average': _evaluate_distance_from_average_trigger
+}
+
+def get_triggered_identifiers(df_data, column_references, trigger_config):
+    """
+        Evaluates an insight trigger for all students at once.
+        
+        df_data (DataFrame) One row per student, with an 'identifier' column and a column per column reference.
+        column_references (list of strings) The column references to evaluate the trigger over.
+        trigger_config (dict) The trigger_config of an insight.
+        
+        Returns a list of the identifiers of the students that met the trigger, in the order of df_data.
+    """
+    evaluator = _TRIGGER_EVALUATORS.get(trigger_config['trigger_type'])
+    if evaluator is None or df_data.empty:
+        # ml_outliers TODO
+        return []
+    triggered = evaluator(df_data, column_references, trigger_config)
+    return df_data.loc[triggered.fillna(False).astype(bool), 'identifier'].tolist()
+
 class Insight:
     
     default_config = {
@@ -1,22 +1,47 @@
-from datetime import datetime
-from time import sleep
-import random
+from datetime import datetime, timedelta
 from os import getpid
 import platform
+import threading
+import weakref
+from pymongo import ReturnDocument
 from pymongo.errors import DuplicateKeyError
 import logging
+from uuid import uuid4
 
 from sres.db import _get_db
 from sres.config import _get_config
 
+# How long a claim on a job lasts unless renewed by its heartbeat
+JOB_CLAIM_LEASE_SECONDS = 300
+# The longest a claim is kept alive by its heartbeat
+JOB_CLAIM_MAX_SECONDS = 7200
+
+def _heartbeat(job_ref, stop_event, interval):
+    """Renews the claim of the referenced APSJob until it is released, garbage collected, or too old."""
+    while not stop_event.wait(interval):
+        job = job_ref()
+        if job is None:
+            return
+        if (datetime.now() - job.claimed_on).total_seconds() > JOB_CLAIM_MAX_SECONDS:
+            logging.warning('job claim heartbeat giving up, claim too old [{}] [{}]'.format(job.job_id, job.owner))
+            return
+        if not job.renew_claim():
+            logging.warning('job claim heartbeat lost claim [{}] [{}]'.format(job.job_id, job.owner))
+            return
+        del job
+
 class APSJob:
-    def __init__(self, job_id):
+    def __init__(self, job_id, lease_seconds=JOB_CLAIM_LEASE_SECONDS):
         self.job_id = job_id
         self.db = _get_db()
         self.dbc = self.db['sres.apscheduler']
         self.loaded = False
         config = _get_config()
         self.server_number = config.SRES.get('SERVER_NUMBER', 1)
+        self.lease_seconds = lease_seconds
+        self.owner = '{}:{}:{}'.format(platform.node(), getpid(), uuid4().hex)
+        self.claimed_on = None
+        self._heartbeat_stop = None
     
     def load(self):
         """Loads the job_id specified on instantiation. Returns True if successful, False otherwise."""
@@ -55,40 +80,86 @@ class APSJob:
         if self.loaded:
             self.dbc.update_one({'_id': self.job_id}, {'$unset': {'flags': 1}})
     
-    def claim_job(self, skip_loading=False):
-        """Tries to claim the job for this worker/process. Returns True if OK to proceed otherwise False"""
+    def claim_job(self, skip_loading=False, heartbeat=True):
+        """
+            Tries to claim the job for this worker/process. Returns True if OK to proceed otherwise False.
+            
+            Claims are leases in db.job_claims that expire after self.lease_seconds. A claim is taken
+            in one atomic upsert, which only succeeds if there is no claim for the job or the
+            existing claim has expired.
+            
+            skip_loading (boolean) Whether to skip checking that the job exists in the job store.
+            heartbeat (boolean) Whether to keep renewing the claim in a background thread until it
+                is released (or up to JOB_CLAIM_MAX_SECONDS), for long-running jobs.
+        """
         logging.debug('node [{}] pid [{}] trying to claim job [{}]'.format(platform.node(), getpid(), self.job_id))
-        #logging.debug('claiming...')
         if skip_loading or self.load():
-            sleep(random.uniform(0.5, self.server_number) * float(int(str(getpid())[-1])))
+            now = datetime.utcnow()
             try:
-                self.db.job_claims.insert({
-                    'job_id': self.job_id,
-                    'node': platform.node(),
-                    'pid': getpid(),
-                    'claimed_on': datetime.now()
-                })
-                logging.debug('job successfully claimed [{}] [{}]'.format(self.job_id, getpid()))
-                return True
+                claim = self.db.job_claims.find_one_and_update(
+                    {
+                        'job_id': self.job_id,
+                        '$or': [
+                            {'expires_at': {'$lte': now}},
+                            # claims made before leases were introduced
+                            {'expires_at': {'$exists': False}, 'claimed_on': {'$lt': datetime.now() - timedelta(seconds=JOB_CLAIM_MAX_SECONDS)}}
+                        ]
+                    },
+                    {
+                        '$set': {
+                            'owner': self.owner,
+                            'node': platform.node(),
+                            'pid': getpid(),
+                            'claimed_on': datetime.now(),
+                            'expires_at': now + timedelta(seconds=self.lease_seconds)
+                        }
+                    },
+                    upsert=True,
+                    return_document=ReturnDocument.AFTER
+                )
             except DuplicateKeyError:
-                logging.debug('node [{}] pid [{}] duplicate key job_id [{}]'.format(platform.node(), getpid(), self.job_id))
-                claims = self.db.job_claims.find({'job_id': self.job_id})
-                claim = list(claims)[0]
-                if (datetime.now() - claim.get('claimed_on')).total_seconds() < 7200:
-                    logging.debug('job_id appears to be running still [{}]'.format(self.job_id))
-                    return False
-                else:
-                    self.release_claim()
-                    return self.claim_job()
+                # there is an unexpired claim
+                logging.debug('job_id appears to be running still [{}]'.format(self.job_id))
                 return False
+            if claim is None or claim.get('owner') != self.owner:
+                return False
+            self.claimed_on = claim['claimed_on']
+            logging.debug('job successfully claimed [{}] [{}]'.format(self.job_id, self.owner))
+            if heartbeat:
+                self._heartbeat_stop = threading.Event()
+                threading.Thread(
+                    target=_heartbeat,
+                    args=(weakref.ref(self), self._heartbeat_stop, self.lease_seconds / 3.0),
+                    daemon=True
+                ).start()
+            return True
         else:
             logging.debug('Could not load for claim_job job_id [{}] [{}]'.format(self.job_id, getpid()))
         return False
     
+    def renew_claim(self):
+        """Extends this worker's claim on the job. Returns True if the claim is still held."""
+        res = self.db.job_claims.update_one(
+            {
+                'job_id': self.job_id,
+                'owner': self.owner
+            },
+            {
+                '$set': {
+                    'expires_at': datetime.utcnow() + timedelta(seconds=self.lease_seconds)
+                }
+            }
+        )
+        return res.matched_count == 1
+    
     def release_claim(self):
+        """Releases this worker's claim on the job, if it holds one."""
+        if self._heartbeat_stop is not None:
+            self._heartbeat_stop.set()
+            self._heartbeat_stop = None
         if self.job_id:
-            res = self.db.job_claims.delete_one({'job_id': self.job_id})
-            logging.debug('release claim [{}] [{}]'.format(self.job_id, res.acknowledged))
+            res = self.db.job_claims.delete_one({'job_id': self.job_id, 'owner': self.owner})
+            logging.debug('release claim [{}] [{}]'.format(self.job_id, res.deleted_count))
             return res.acknowledged
         return False
     
@@ -99,10 +170,6 @@ class APSJob:
     
     def has_already_started(self):
         if self.loaded:
-            # first wait a random amount of time to allow other processes to catch up,
-            # as in, allow the process that has grabbed this job to flag it as started
-            sleep(random.uniform(1.0, 3.0) * float(int(str(getpid())[-1])) + (self.server_number * 2.0))
-            # then check
             flag = self.get_flag('started')
             if flag and flag.get('timestamp'):
                 if (datetime.now() - flag.get('timestamp')).total_seconds() < 7200:
@@ -0,0 +1,184 @@
+"""
+    Buffers log documents in memory and writes them to the db in batches from a background
+    thread, so that logging does not hold up requests.
+"""
+from datetime import datetime
+from queue import Queue, Full, Empty
+import atexit
+import logging
+import os
+import threading
+import time
+from bson import BSON, ObjectId
+from bson.errors import InvalidDocument
+from pymongo.errors import BulkWriteError
+
+from sres.db import _get_db, _load_db_config
+
+# Most log documents waiting to be written; past this, droppable documents are dropped
+LOG_WRITER_QUEUE_SIZE = 10000
+# Most log documents written in one insert_many
+LOG_WRITER_BATCH_SIZE = 500
+# Longest a log document waits before being written
+LOG_WRITER_FLUSH_SECONDS = 1
+# How often dropped documents are reported
+LOG_WRITER_DROP_REPORT_SECONDS = 60
+
+_LOG_WRITER = {
+    'pid': None,
+    'queue': None,
+    'thread': None,
+    'dropped': 0,
+    'dropped_reported': None
+}
+_LOG_WRITER_LOCK = threading.Lock()
+
+def _get_writer_config():
+    try:
+        return _load_db_config().SRES.get('LOG_WRITER', {})
+    except:
+        return {}
+
+def _get_queue():
+    """Returns this process's queue, starting the writer thread if needed; or None if writing synchronously."""
+    if _LOG_WRITER['pid'] == os.getpid():
+        return _LOG_WRITER['queue']
+    with _LOG_WRITER_LOCK:
+        if _LOG_WRITER['pid'] != os.getpid():
+            config = _get_writer_config()
+            if config.get('ASYNC', True):
+                _LOG_WRITER['queue'] = Queue(maxsize=config.get('QUEUE_SIZE', LOG_WRITER_QUEUE_SIZE))
+                _LOG_WRITER['thread'] = threading.Thread(
+                    target=_run_writer,
+                    args=(_LOG_WRITER['queue'], config.get('BATCH_SIZE', LOG_WRITER_BATCH_SIZE), config.get('FLUSH_SECONDS', LOG_WRITER_FLUSH_SECONDS)),
+                    name='sres-log-writer',
+                    daemon=True
+                )
+                _LOG_WRITER['thread'].start()
+            else:
+                _LOG_WRITER['queue'] = None
+                _LOG_WRITER['thread'] = None
+            _LOG_WRITER['dropped'] = 0
+            _LOG_WRITER['pid'] = os.getpid()
+    return _LOG_WRITER['queue']
+
+def _insert_records(collection_name, records):
+    """Inserts records, isolating any that cannot be saved so that the rest still are."""
+    db = _get_db()
+    try:
+        db[collection_name].insert_many(records, ordered=False)
+    except BulkWriteError as e:
+        # e.g. duplicate _ids; the rest are still inserted
+        logging.error('log writer bulk write errors [{}] [{}]'.format(collection_name, str(e.details.get('writeErrors'))))
+    except InvalidDocument:
+        for record in records:
+            try:
+                db[collection_name].insert_one(record)
+            except Exception as e:
+                logging.error('log writer could not save log [{}] [{}]'.format(collection_name, repr(e)))
+
+def _write_batch(batch):
+    records_by_collection = {}
+    for collection_name, record in batch:
+        records_by_collection.setdefault(collection_name, []).append(record)
+    for collection_name, records in records_by_collection.items():
+        try:
+            _insert_records(collection_name, records)
+        except Exception as e:
+            # e.g. the db is unavailable
+            logging.error('log writer lost {} logs [{}]'.format(len(records), collection_name))
+            logging.exception(e)
+
+def _run_writer(queue, batch_size, flush_seconds):
+    batch = []
+    waiters = []
+    deadline = None
+    while True:
+        timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+        try:
+            item = queue.get(timeout=timeout)
+        except Empty:
+            item = None
+        if isinstance(item, threading.Event):
+            # flush requested
+            waiters.append(item)
+        elif item is not None:
+            batch.append(item)
+            if deadline is None:
+                deadline = time.monotonic() + flush_seconds
+        if waiters or len(batch) >= batch_size or (deadline is not None and time.monotonic() >= deadline):
+            if batch:
+                _write_batch(batch)
+            batch = []
+            deadline = None
+            for waiter in waiters:
+                waiter.set()
+            waiters = []
+
+def _record_drop(collection_name):
+    with _LOG_WRITER_LOCK:
+        _LOG_WRITER['dropped'] += 1
+        now = datetime.now()
+        if _LOG_WRITER['dropped_reported'] is None or (now - _LOG_WRITER['dropped_reported']).total_seconds() > LOG_WRITER_DROP_REPORT_SECONDS:
+            logging.warning('log writer overloaded, {} logs dropped so far [{}]'.format(_LOG_WRITER['dropped'], collection_name))
+            _LOG_WRITER['dropped_reported'] = now
+
+def write_log(collection_name, record, droppable=True):
+    """
+        Queues a log document to be inserted. An _id is assigned straight away.
+
+        collection_name (str) e.g. 'access_logs'
+        record (dict)
+        droppable (bool) If True, the document is dropped when the queue is full; otherwise
+            it is inserted synchronously instead.
+
+        Returns the ObjectId of the document, or None if it was dropped.
+    """
+    if '_id' not in record.keys():
+        record['_id'] = ObjectId()
+    queue = _get_queue()
+    if queue is not None:
+        try:
+            queue.put_nowait((collection_name, record))
+            return record['_id']
+        except Full:
+            if droppable:
+                _record_drop(collection_name)
+                return None
+    _get_db()[collection_name].insert_one(record)
+    return record['_id']
+
+def is_encodable(record):
+    """Whether record can be saved as it is, i.e. whether it would be rejected at write time."""
+    try:
+        BSON.encode(record)
+        return True
+    except Exception:
+        return False
+
+def flush_logs(timeout=10):
+    """
+        Waits until everything queued so far has been written.
+
+        timeout (int) Most seconds to wait.
+
+        Returns True if flushed in time.
+    """
+    if _LOG_WRITER['pid'] != os.getpid() or _LOG_WRITER['queue'] is None or not _LOG_WRITER['thread'].is_alive():
+        return True
+    flushed = threading.Event()
+    try:
+        _LOG_WRITER['queue'].put(flushed, timeout=timeout)
+    except Full:
+        return False
+    return flushed.wait(timeout)
+
+def get_log_writer_status():
+    """Returns a dict of the number of logs waiting to be written and dropped by this process."""
+    return {
+        'pid': os.getpid(),
+        'queued': _LOG_WRITER['queue'].qsize() if _LOG_WRITER['pid'] == os.getpid() and _LOG_WRITER['queue'] is not None else 0,
+        'dropped': _LOG_WRITER['dropped'] if _LOG_WRITER['pid'] == os.getpid() else 0
+    }
+
+atexit.register(flush_logs)
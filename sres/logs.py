@@ -5,27 +5,18 @@ from bson import ObjectId
 import logging
 
 from sres.db import _get_db
+from sres.log_writer import write_log, is_encodable
 from sres import utils
 
-def log_message_send(target, contact_type, message, source_asset_type, source_asset_uuid, log_uuid=None, identifier=None):
+def make_message_send_log(target, contact_type, message, source_asset_type, source_asset_uuid, log_uuid=None, identifier=None):
     """
-        Records a message send event in db.message_send_logs
-        Returns string log_uuid if insert acknowledged, otherwise None.
-        
-        target (string) Recipient identifier e.g. email address
-        contact_type (string) mode of contact e.g. email|sms
-        message (dict) describing the message
-        source_asset_type (string) source of the message e.g. filter
-        source_asset_uuid (string uuid) uuid of the source e.g. a filter_uuid
-        log_uuid (string uuid)
-        identifier (string) usually SID
+        Returns a record (dict) for db.message_send_logs. Arguments are as for log_message_send.
     """
-    db = _get_db()
     # create a log uuid if not provided
     if log_uuid is None:
         log_uuid = utils.create_uuid(sep='-')
     # parse
-    record = {
+    return {
         'target': target,
         'type': contact_type,
         'message': message,
@@ -35,12 +26,38 @@ def log_message_send(target, contact_type, message, source_asset_type, source_as
         'sent': datetime.now(),
         'identifier': str(identifier)
     }
-    # write to db
-    result = db.message_send_logs.insert_one(record)
-    if result.acknowledged:
-        return log_uuid
-    else:
-        return None
+
+def log_message_send(target, contact_type, message, source_asset_type, source_asset_uuid, log_uuid=None, identifier=None):
+    """
+        Queues a message send event to be recorded in db.message_send_logs
+        Returns string log_uuid.
+        
+        target (string) Recipient identifier e.g. email address
+        contact_type (string) mode of contact e.g. email|sms
+        message (dict) describing the message
+        source_asset_type (string) source of the message e.g. filter
+        source_asset_uuid (string uuid) uuid of the source e.g. a filter_uuid
+        log_uuid (string uuid)
+        identifier (string) usually SID
+    """
+    record = make_message_send_log(target, contact_type, message, source_asset_type, source_asset_uuid, log_uuid, identifier)
+    # write to db; never dropped because tracking and feedback look these up
+    write_log('message_send_logs', record, droppable=False)
+    return record['uuid']
+
+def log_message_sends(records):
+    """
+        Records many message send events in db.message_send_logs at once.
+        
+        records (list of dicts) from make_message_send_log
+        
+        Returns the number of records inserted.
+    """
+    if not records:
+        return 0
+    db = _get_db()
+    result = db.message_send_logs.insert_many(records, ordered=False)
+    return len(result.inserted_ids)
 
 def get_send_logs(source_asset_type=None, source_asset_uuid=None, targets=None, log_uuid=None, from_date=None, to_date=None):
     """
@@ -73,16 +90,15 @@ def get_send_logs(source_asset_type=None, source_asset_uuid=None, targets=None,
 
 def add_interaction_event(source_asset_type, source_asset_uuid, parent, action, data, target):
     """
-        Adds a record to db.interactions
+        Queues a record to be added to db.interaction_logs
         
         source_asset_type (string)
         source_asset_uuid (string)
         parent (string)
         action (string)
-        data (any) Will be json.dumps'ed if pymongo saving fails.
+        data (any) Will be json.dumps'ed if pymongo cannot save it.
         target (string)
     """
-    db = _get_db()
     record = {
         'timestamp': datetime.now(),
         'ip_address': utils.get_client_ip_address(),
@@ -93,11 +109,9 @@ def add_interaction_event(source_asset_type, source_asset_uuid, parent, action,
         'data': data,
         'target': target
     }
-    try:
-        db.interaction_logs.insert_one(record)
-    except: # TODO more selective except?
+    if not is_encodable(record):
         record['data'] = json.dumps(record['data'])
-        db.interaction_logs.insert_one(record)
+    write_log('interaction_logs', record)
     return None
 
 def log_email_url_click(url, log_uuid):
@@ -143,38 +157,46 @@ def get_interaction_logs(source_asset_type, source_asset_uuid, all_targets=[], p
         'records': {},
         'urls': []
     }
-    records = db.interaction_logs.find(
-        {
+    # count opens and clicks per target (and url) in the db
+    results = db.interaction_logs.aggregate([
+        {'$match': {
             'source_asset_type': source_asset_type,
             'source_asset_uuid': source_asset_uuid
-        }
-    )
-    for record in records:
-        if type(record['target']) is list:
-            _record_targets, _topology = utils.flatten_list(record['target'])
-        else:
-            _record_targets = [record['target']]
-        for _record_target in _record_targets:
-            if _record_target not in ret['records'].keys():
-                ret['records'][_record_target] = {
-                    'loguuid': record['parent'],
-                    'target': _record_target,
-                    'opens': 0,
-                    'clicks': {}
-                }
-            if record['action'] == 'open':
-                ret['records'][_record_target]['opens'] += 1
-            elif record['action'] == 'click':
-                url = None
-                if 'data' in record.keys() and record['data'] and 'url' in record['data'].keys():
-                    url = record['data']['url']
-                if url:
-                    if url in ret['records'][_record_target]['clicks'].keys():
-                        ret['records'][_record_target]['clicks'][url] += 1
-                    else:
-                        ret['records'][_record_target]['clicks'][url] = 1
-                if url not in  ret['urls']:
-                     ret['urls'].append(url)
+        }},
+        # targets may be (nested) lists; logs without a target are counted under None
+        {'$unwind': {'path': '$target', 'preserveNullAndEmptyArrays': True}},
+        {'$unwind': {'path': '$target', 'preserveNullAndEmptyArrays': True}},
+        # so that $first takes the parent of the earliest log, as before
+        {'$sort': {'_id': 1}},
+        {'$group': {
+            '_id': {
+                'target': '$target',
+                'action': '$action',
+                'url': {'$cond': [{'$eq': ['$action', 'click']}, '$data.url', None]}
+            },
+            'count': {'$sum': 1},
+            'loguuid': {'$first': '$parent'},
+            'first_oid': {'$min': '$_id'}
+        }},
+        {'$sort': {'first_oid': 1}}
+    ], allowDiskUse=True)
+    for result in results:
+        _record_target = result['_id'].get('target')
+        if _record_target not in ret['records'].keys():
+            ret['records'][_record_target] = {
+                'loguuid': result.get('loguuid'),
+                'target': _record_target,
+                'opens': 0,
+                'clicks': {}
+            }
+        if result['_id'].get('action') == 'open':
+            ret['records'][_record_target]['opens'] += result['count']
+        elif result['_id'].get('action') == 'click':
+            url = result['_id'].get('url')
+            if url:
+                ret['records'][_record_target]['clicks'][url] = ret['records'][_record_target]['clicks'].get(url, 0) + result['count']
+            if url not in ret['urls']:
+                ret['urls'].append(url)
     # fill for targets with no interaction logs
     for target in all_targets:
         if target not in ret['records'].keys():
@@ -187,8 +209,9 @@ def get_interaction_logs(source_asset_type, source_asset_uuid, all_targets=[], p
 
 def add_feedback_event(source_asset_type=None, source_asset_uuid=None, parent=None, vote=None, data=None, target=None, _id=None):
     """
-        Adds or updates a document to db.feedback_logs
-        Returns the ObjectId of the inserted or updated document. Returns None if no update took place.
+        Adds or updates a document in db.feedback_logs. Unlike other logs this is written straight
+        away, as it is a single click and a comment may update it next.
+        Returns the ObjectId of the added or upserted document. Returns None if an existing document was updated.
         
         source_asset_type (string)
         source_asset_uuid (string)
@@ -198,7 +221,6 @@ def add_feedback_event(source_asset_type=None, source_asset_uuid=None, parent=No
         target (string)
         _id (ObjectId or str) Specified if we are updating an existing entry in db.feedback_logs
     """
-    db = _get_db()
     record = {
         'timestamp': datetime.now(),
         'ip_address': utils.get_client_ip_address(),
@@ -209,6 +231,7 @@ def add_feedback_event(source_asset_type=None, source_asset_uuid=None, parent=No
     if vote: record['vote'] = vote
     if data: record['data'] = data
     if target: record['target'] = target
+    db = _get_db()
     if _id:
         if isinstance(_id, str):
             _id = ObjectId(_id)
@@ -258,23 +281,50 @@ def get_feedback_stats(source_asset_type, source_asset_uuid, days=None):
     }
     if days:
         db_filter['timestamp'] = {'$gte': (datetime.now() - timedelta(days=days))}
-    records = db.feedback_logs.find(db_filter).sort([('timestamp', -1)])
+    # tally in the db
+    results = list(db.feedback_logs.aggregate([
+        {'$match': db_filter},
+        {'$facet': {
+            'totals': [
+                {'$group': {
+                    '_id': None,
+                    'total_votes': {'$sum': 1},
+                    'targets': {'$addToSet': '$target'}
+                }},
+                {'$project': {
+                    'total_votes': 1,
+                    'unique_votes': {'$size': '$targets'}
+                }}
+            ],
+            'votes': [
+                {'$match': {'vote': {'$exists': True, '$nin': [None, '']}}},
+                {'$group': {
+                    '_id': '$vote',
+                    'count': {'$sum': 1},
+                    'most_recent_timestamp': {'$max': '$timestamp'}
+                }},
+                {'$sort': {'most_recent_timestamp': -1}}
+            ]
+        }}
+    ], allowDiskUse=True))
+    if not results:
+        return ret
+    results = results[0]
+    if results['totals']:
+        ret['total_votes'] = results['totals'][0]['total_votes']
+        ret['unique_votes'] = results['totals'][0]['unique_votes']
     count_by_vote = {}
-    voting_targets = []
-    for record in records:
-        ret['total_votes'] += 1
-        voting_targets.append(record.get('target'))
-        if record.get('vote'):
-            if record['vote'] not in count_by_vote.keys():
-                count_by_vote[record['vote']] = 1
-                ret['comments_by_vote'][record['vote']] = []
-            else:
-                count_by_vote[record['vote']] += 1
-        if 'data' in record.keys() and record['data'] and record['data'].get('comment'):
-            ret['comments_by_vote'][record['vote']].append(record['data']['comment'])
-            ret['total_votes_substantiated'] += 1
-            ret['comments_most_recent'].append(record['data']['comment'])
-    ret['unique_votes'] = len(set(voting_targets))
+    for result in results['votes']:
+        count_by_vote[result['_id']] = result['count']
+        ret['comments_by_vote'][result['_id']] = []
+    # the comments are read separately, as there can be too many to fit in one aggregation result
+    comments_filter = dict(db_filter)
+    comments_filter['data.comment'] = {'$nin': [None, '']}
+    comments = db.feedback_logs.find(comments_filter, {'vote': 1, 'data.comment': 1}).sort([('timestamp', -1)])
+    for result in comments:
+        ret['comments_by_vote'].setdefault(result.get('vote'), []).append(result['data']['comment'])
+        ret['total_votes_substantiated'] += 1
+        ret['comments_most_recent'].append(result['data']['comment'])
     ret['votes'] = [
         {
             'vote': v, # the vote option e.g. 'Yes', 'No'
@@ -295,6 +345,8 @@ def get_feedback_stats(source_asset_type, source_asset_uuid, days=None):
 
 def get_latest_feedback_events(source_asset_type, source_asset_uuid, target=None, records_to_return=1):
     """Returns a list"""
+    if records_to_return == 0 or records_to_return < -1:
+        return []
     db = _get_db()
     filter = {
         'source_asset_type': source_asset_type,
@@ -302,16 +354,10 @@ def get_latest_feedback_events(source_asset_type, source_asset_uuid, target=None
     }
     if target is not None:
         filter['target'] = target
-    events = list(db.feedback_logs.find(filter).sort([('timestamp', 1)]))
-    #logging.debug(str(events))
-    if len(events) == 0:
-        return []
-    if records_to_return == -1:
-        return events
-    elif records_to_return > 0:
-        return events[0:records_to_return]
-    else:
-        return []
+    cursor = db.feedback_logs.find(filter).sort([('timestamp', 1)])
+    if records_to_return > 0:
+        cursor = cursor.limit(records_to_return)
+    return list(cursor)
     
 def get_latest_feedback_events_many(source_asset_uuids=None, source_asset_types=None, records_to_return=-1, days=31):
     """Returns a list of feedback events for the specified source asset uuid(s) and/or type(s).
@@ -321,6 +367,8 @@ def get_latest_feedback_events_many(source_asset_uuids=None, source_asset_types=
         records_to_return (int) -1 for all records otherwise number of records
         days (int or None) Recency of feedback events to return
     """
+    if records_to_return == 0 or records_to_return < -1:
+        return []
     db = _get_db()
     db_filter = {}
     if source_asset_uuids is not None:
@@ -329,16 +377,7 @@ def get_latest_feedback_events_many(source_asset_uuids=None, source_asset_types=
         db_filter['source_asset_type'] = {'$in': source_asset_types}
     if days:
         db_filter['timestamp'] = {'$gte': (datetime.now() - timedelta(days=days))}
-    events = list(db.feedback_logs.find(db_filter).sort([('timestamp', -1)]))
-    # return
-    if len(events) == 0:
-        return []
-    if records_to_return == -1:
-        return events
-    elif records_to_return > 0:
-        return events[0:records_to_return]
-    else:
-        return []
-
-
-
+    cursor = db.feedback_logs.find(db_filter).sort([('timestamp', -1)])
+    if records_to_return > 0:
+        cursor = cursor.limit(records_to_return)
+    return list(cursor)
@@ -366,18 +366,27 @@ class Portal:
             'opened_by': [],
             'total_opens': 0
         }
-        records = self.db.interaction_logs.find(
-            {
+        # count opens and clicks per target (and url) in the db
+        results = self.db.interaction_logs.aggregate([
+            {'$match': {
                 'source_asset_type': 'portal',
                 'source_asset_uuid': self.config['uuid']
-            }
-        )
-        for record in records:
-            try:
-                auth_user = record.get('data', {}).get('auth_user')
-                target = record.get('target')
-            except:
-                continue
+            }},
+            {'$group': {
+                '_id': {
+                    'target': '$target',
+                    'auth_user': '$data.auth_user',
+                    'action': '$action',
+                    'url': {'$cond': [{'$eq': ['$action', 'click']}, '$data.details', None]}
+                },
+                'count': {'$sum': 1},
+                'first_oid': {'$min': '$_id'}
+            }},
+            {'$sort': {'first_oid': 1}}
+        ], allowDiskUse=True)
+        for result in results:
+            auth_user = result['_id'].get('auth_user')
+            target = result['_id'].get('target')
             if auth_user and auth_user == target:
                 if target not in ret['records'].keys():
                     ret['records'][target] = {
@@ -385,25 +394,22 @@ class Portal:
                         'opens': 0,
                         'clicks': {}
                     }
-                if record.get('action') == 'open':
+                if result['_id'].get('action') == 'open':
                     # increment overall counter
-                    ret['total_opens'] += 1
+                    ret['total_opens'] += result['count']
                     # count for this target
-                    ret['records'][target]['opens'] += 1
+                    ret['records'][target]['opens'] += result['count']
                     # add target to openers
                     if target not in ret['opened_by']:
                         ret['opened_by'].append(target)
-                elif record.get('action') == 'click':
-                    url = record.get('data', {}).get('details')
+                elif result['_id'].get('action') == 'click':
+                    url = result['_id'].get('url')
                     if url:
                         # remove pointless url clicks
                         if '/login/logout' in url:
                             continue
                         # save
-                        if url in ret['records'][target]['clicks'].keys():
-                            ret['records'][target]['clicks'][url] += 1
-                        else:
-                            ret['records'][target]['clicks'][url] = 1
+                        ret['records'][target]['clicks'][url] = ret['records'][target]['clicks'].get(url, 0) + result['count']
                         if url not in ret['urls']:
                              ret['urls'].append(url)
         return ret
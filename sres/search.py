@@ -4,15 +4,53 @@ import json
 from bson import ObjectId
 import logging
 from natsort import natsorted, ns
+from pymongo.errors import OperationFailure
 
 from sres.db import _get_db
 from sres.auth import get_auth_user, get_auth_user_oid, is_user_administrator
 from sres import utils
 from sres.tables import format_full_name as format_full_table_name, list_authorised_tables, Table
 from sres.anonymiser import anonymise
+from sres.studentdata import find_by_search_tokens, ensure_search_tokens
 
-def search_haystacks(term, haystack_types=None):
-    """Searches for assets and other SRES elements (defined by haystack_types) for the provided term."""
+# Maximum number of results returned per haystack type
+SEARCH_HAYSTACK_RESULTS_LIMIT = 110
+
+def _find_assets(collection, db_filter, term, regex_fields, limit=SEARCH_HAYSTACK_RESULTS_LIMIT):
+    """
+        Searches db[collection] using its text index, most relevant first. Falls back to
+        case-insensitive regex matching on regex_fields if the text search finds nothing (e.g. for
+        partial words) or the text index has not been created.
+        
+        collection (str)
+        db_filter (dict) Any additional filter, e.g. for permissions
+        term (str)
+        regex_fields (list of str)
+        limit (int)
+        
+        Returns a list of up to limit documents.
+    """
+    db = _get_db()
+    results = []
+    try:
+        results = list(db[collection].find(
+            {**db_filter, '$text': {'$search': term}},
+            {'_search_score': {'$meta': 'textScore'}}
+        ).sort([('_search_score', {'$meta': 'textScore'})]).limit(limit))
+        for result in results:
+            result.pop('_search_score', None)
+    except OperationFailure as e:
+        logging.warning(f'Text search on {collection} failed, is the text index missing? [{e}]')
+    if not results:
+        results = list(db[collection].find(
+            {**db_filter, '$or': [ {field: {'$regex': term, '$options': 'i'}} for field in regex_fields ]}
+        ).limit(limit))
+    return results
+
+def search_haystacks(term, haystack_types=None, limit=SEARCH_HAYSTACK_RESULTS_LIMIT):
+    """Searches for assets and other SRES elements (defined by haystack_types) for the provided term.
+        Returns up to limit (int) results for each haystack type.
+    """
     
     ret = {
         'success': False,
@@ -40,24 +78,15 @@ def search_haystacks(term, haystack_types=None):
         authorised_tables_keyed = { t['uuid']:t for t in authorised_tables }
     
     for haystack_type in haystack_types:
-        db_filters = []
         if haystack_type == 'tables':
-            db_filters.append({'name': {'$regex': term, '$options': 'i'}})
-            db_filters.append({'code': {'$regex': term, '$options': 'i'}})
             if is_superadmin:
-                results = list(db.tables.find(
-                    {
-                        '$or': db_filters
-                    }
-                ))
+                db_filter = {}
             else:
-                results = list(db.tables.find(
-                    {
-                        'workflow_state': { '$ne': 'deleted' },
-                        'staff.administrators': user_oid,
-                        '$or': db_filters
-                    }
-                ))
+                db_filter = {
+                    'workflow_state': { '$ne': 'deleted' },
+                    'staff.administrators': user_oid
+                }
+            results = _find_assets('tables', db_filter, term, ['name', 'code'], limit)
             for result in results:
                 ret['results'].append({
                     'haystack_type': 'tables',
@@ -75,30 +104,32 @@ def search_haystacks(term, haystack_types=None):
                     'workflow_state': result['workflow_state']
                 })
         elif haystack_type == 'columns':
-            db_filters.append({'name': {'$regex': term, '$options': 'i'}})
-            db_filters.append({'description': {'$regex': term, '$options': 'i'}})
-            db_filters.append({'multi_entry.options.label': {'$regex': term, '$options': 'i'}})
-            db_filters.append({'multi_entry.options.select.display': {'$regex': term, '$options': 'i'}})
-            db_filters.append({'multi_entry.options.select.description': {'$regex': term, '$options': 'i'}})
-            db_filters.append({'multi_entry.options.select.value': {'$regex': term, '$options': 'i'}})
-            db_filters.append({'quick_info.single': {'$regex': term, '$options': 'i'}})
-            db_filters.append({'quick_info.bulk': {'$regex': term, '$options': 'i'}})
-            db_filters.append({'custom_options.quickinfo_rollview': {'$regex': term, '$options': 'i'}})
             if is_superadmin:
-                results = list(db.columns.find(
-                    {
-                        'workflow_state': { '$ne': 'collective' },
-                        '$or': db_filters
-                    }
-                ))
+                db_filter = {
+                    'workflow_state': { '$ne': 'collective' }
+                }
             else:
-                results = list(db.columns.find(
-                    {
-                        'workflow_state': { '$nin': ['collective', 'deleted'] },
-                        'table_uuid': { '$in': authorised_tables_uuids },
-                        '$or': db_filters
-                    }
-                ))
+                db_filter = {
+                    'workflow_state': { '$nin': ['collective', 'deleted'] },
+                    'table_uuid': { '$in': authorised_tables_uuids }
+                }
+            results = _find_assets(
+                'columns',
+                db_filter,
+                term,
+                [
+                    'name',
+                    'description',
+                    'multi_entry.options.label',
+                    'multi_entry.options.select.display',
+                    'multi_entry.options.select.description',
+                    'multi_entry.options.select.value',
+                    'quick_info.single',
+                    'quick_info.bulk',
+                    'custom_options.quickinfo_rollview'
+                ],
+                limit
+            )
             for result in results:
                 ret['results'].append({
                     'haystack_type': 'columns',
@@ -126,27 +157,22 @@ def search_haystacks(term, haystack_types=None):
                     'config': json.dumps(result, default=str)
                 })
         elif haystack_type == 'filters':
-            db_filters.append({'name': {'$regex': term, '$options': 'i'}})
-            db_filters.append({'description': {'$regex': term, '$options': 'i'}})
-            db_filters.append({'email.sections.content': {'$regex': term, '$options': 'i'}})
-            db_filters.append({'email.subject': {'$regex': term, '$options': 'i'}})
-            db_filters.append({'email.body_first': {'$regex': term, '$options': 'i'}})
-            db_filters.append({'email.body_last': {'$regex': term, '$options': 'i'}})
             if is_superadmin:
-                results = list(db.filters.find(
-                    {
-                        'workflow_state': { '$ne': 'collective' },
-                        '$or': db_filters
-                    }
-                ))
+                db_filter = {
+                    'workflow_state': { '$ne': 'collective' }
+                }
             else:
-                results = list(db.filters.find(
-                    {
-                        'workflow_state': { '$nin': ['collective', 'deleted'] },
-                        'administrators': user_oid,
-                        '$or': db_filters
-                    }
-                ))
+                db_filter = {
+                    'workflow_state': { '$nin': ['collective', 'deleted'] },
+                    'administrators': user_oid
+                }
+            results = _find_assets(
+                'filters',
+                db_filter,
+                term,
+                ['name', 'description', 'email.sections.content', 'email.subject', 'email.body_first', 'email.body_last'],
+                limit
+            )
             for result in results:
                 ret['results'].append({
                     'haystack_type': 'filters',
@@ -171,24 +197,16 @@ def search_haystacks(term, haystack_types=None):
                     'config': json.dumps(result, default=str)
                 })
         elif haystack_type == 'portals':
-            db_filters.append({'name': {'$regex': term, '$options': 'i'}})
-            db_filters.append({'description': {'$regex': term, '$options': 'i'}})
-            db_filters.append({'panels.content': {'$regex': term, '$options': 'i'}})
             if is_superadmin:
-                results = list(db.portals.find(
-                    {
-                        'workflow_state': { '$ne': 'collective' },
-                        '$or': db_filters
-                    }
-                ))
+                db_filter = {
+                    'workflow_state': { '$ne': 'collective' }
+                }
             else:
-                results = list(db.portals.find(
-                    {
-                        'workflow_state': { '$nin': ['collective', 'deleted'] },
-                        'administrators': user_oid,
-                        '$or': db_filters
-                    }
-                ))
+                db_filter = {
+                    'workflow_state': { '$nin': ['collective', 'deleted'] },
+                    'administrators': user_oid
+                }
+            results = _find_assets('portals', db_filter, term, ['name', 'description', 'panels.content'], limit)
             for result in results:
                 ret['results'].append({
                     'haystack_type': 'portals',
@@ -213,26 +231,16 @@ def search_haystacks(term, haystack_types=None):
                     'config': json.dumps(result, default=str)
                 })
         elif haystack_type == 'identifiers':
-            db_filters.append({'sid': {'$regex': term, '$options': 'i'}})
-            db_filters.append({'given_names': {'$regex': term, '$options': 'i'}})
-            db_filters.append({'preferred_name': {'$regex': term, '$options': 'i'}})
-            db_filters.append({'surname': {'$regex': term, '$options': 'i'}})
-            db_filters.append({'email': {'$regex': term, '$options': 'i'}})
-            db_filters.append({'alternative_id1': {'$regex': term, '$options': 'i'}})
-            db_filters.append({'alternative_id2': {'$regex': term, '$options': 'i'}})
+            # names and identifiers are searched by prefix through their search tokens
             if is_superadmin:
-                results = list(db.data.find(
-                    {
-                        '$or': db_filters
-                    }
-                ))
+                ensure_search_tokens()
+                db_filter = {}
             else:
-                results = list(db.data.find(
-                    {
-                        'table_uuid': { '$in': authorised_tables_uuids },
-                        '$or': db_filters
-                    }
-                ))
+                ensure_search_tokens(authorised_tables_uuids)
+                db_filter = {
+                    'table_uuid': { '$in': authorised_tables_uuids }
+                }
+            results = find_by_search_tokens(db_filter, term, limit=limit)
             for result in results:
                 _result = {
                     'haystack_type': 'identifiers',
@@ -261,7 +269,10 @@ def search_haystacks(term, haystack_types=None):
                 }
                 ret['results'].append(_result)
         elif haystack_type == 'student_data':
+            student_data_results_count = 0
             for table_uuid, table_meta in authorised_tables_keyed.items():
+                if student_data_results_count >= limit:
+                    break
                 table = Table()
                 if table.load(table_uuid) and table.is_user_authorised():
                     available_columns_uuids = table.get_available_columns(uuids_only=True)
@@ -271,7 +282,8 @@ def search_haystacks(term, haystack_types=None):
                         'table_uuid': table_uuid,
                         '$or': [ {column_uuid: {'$regex': term, '$options': 'i'}} for column_uuid in available_columns_uuids ]
                     }
-                    results = list(db.data.find(db_filter))
+                    results = list(db.data.find(db_filter).limit(limit - student_data_results_count))
+                    student_data_results_count += len(results)
                     for result in results:
                         _result = {
                             'haystack_type': 'student_data',
@@ -3,27 +3,31 @@ from copy import deepcopy
 import re
 from bs4 import BeautifulSoup
 import json
+import collections
+import hashlib
 from natsort import natsorted, ns
 from datetime import datetime
 import pprint
 import random
 import base64
 import os
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
+from pymongo.collation import Collation
 from bson import ObjectId
 import logging
 import html
 from multiprocessing import Process, active_children, JoinableQueue
-from threading import Thread
-import concurrent.futures
+from threading import Thread, Lock
 from urllib import parse
 
-from sres.db import _get_db, DbCookie
+from sres.db import _get_db, CASE_INSENSITIVE_COLLATION
 from sres.columns import Column, SYSTEM_COLUMNS, MAGIC_FORMATTERS_LIST, get_friendly_column_name
 from sres.auth import get_auth_user
 from sres import utils
 from sres.files import get_file_access_url, GridFile
 from sres import change_history
+from sres.column_stats import record_data_changes
 from sres.anonymiser import anonymise, is_identity_anonymiser_active
 from sres.summaries import Summary, Representation
 
@@ -51,6 +55,14 @@ REQUIRED_BASE_FIELDS = [
 
 NON_DATA_FIELDS = NAME_FIELDS + IDENTIFIER_FIELDS + ['status']
 
+# db.data field holding lowercased name and identifier tokens, for prefix searching of students
+SEARCH_TOKENS_FIELD = 'search_tokens'
+# incremented by every write through StudentData, for optimistic concurrency checks in save()
+VERSION_FIELD = '_version'
+SEARCH_RESULTS_LIMIT = 100
+# Number of students to write at a time with StudentData.save_many
+SAVE_MANY_BATCH_SIZE = 500
+
 GENERAL_FIELDS = {
     'TIMESTAMP': {
         'format': '%Y-%m-%d %H:%M:%S',
@@ -112,756 +124,878 @@ def _preload_columns(input_text, default_table_uuid, enclosing_char='$'):
                 del ret[column_reference]
     return ret
 
-def substitute_text_variables(input, identifier, default_table_uuid='', enclosing_char='$', do_not_encode=False, preloaded_student_data=None, preloaded_columns=None, blank_replacement='', preloaded_student_data_instances=None, only_process_global_magic_formatters=False):
-    """Replaces column references ('variables' in the supplied text) with their actual values.
+# Most compiled text templates kept by compile_text_template, least recently used dropped first
+TEXT_TEMPLATE_CACHE_SIZE = 500
+# How long a compiled text template reuses the Columns it references before reloading them
+TEXT_TEMPLATE_COLUMN_TTL_SECONDS = 60
+
+_TEXT_TEMPLATE_CACHE = collections.OrderedDict()
+_TEXT_TEMPLATE_CACHE_LOCK = Lock()
+
+GLOBAL_MAGIC_FORMATTER_HISTORY_MODES = ['all', 'earliest', 'user_latest', 'user_earliest', 'given_latest', 'given_earliest', 'given_user_latest', 'given_user_earliest', 'given_all']
+GLOBAL_MAGIC_FORMATTER_AUTH_USER_MODES = ['username', 'full_name', 'given_names', 'surname', 'email']
+
+def _load_student_data_from_preload(identifier, column, preloaded_student_data_instances):
+    """Loads a StudentData instance from preloaded_student_data_instances
         
         Args:
-            input (str): The text containing column references to be replaced, amongst other text.
-            identifier (str)
-            default_table_uuid (str): uuid
-            enclosing_char (str): The character prefix and suffix for column references.
-                If an empty string, then most words will look like a column reference so only use this
-                in certain circumstances.
-            do_not_encode (bool): If True, will not escape or get_text() on the returned text.
-            preloaded_student_data (StudentData): A loaded instance of StudentData, used for faster access to data.
-                A student's records must have been loaded already.
-            preloaded_columns (dict): dict of Column instances, keyed by column reference.
-            blank_replacement (any): Value to use if data cannot be found.
-            preloaded_student_data_instances (None or dict): Keyed by table_uuid, a dict of preloaded StudentData instances.
-                A student's record must have been loaded already in each of these instances.
-            only_process_global_magic_formatters (bool): Whether to only process the global magic formatters.
+            identifier (str): identifier for the student
+            column (Column): loaded Column instance
+            preloaded_student_data_instances (dict): Keyed by table_uuid
+    """
+    if column.table.config['uuid'] in preloaded_student_data_instances.keys():
+        student_data = preloaded_student_data_instances[ column.table.config['uuid'] ]
+    else:
+        student_data = StudentData(column.table)
+        student_data.find_student(identifier)
+        if student_data._id:
+            preloaded_student_data_instances[ column.table.config['uuid'] ] = student_data
+    return student_data
+
+def _find_column_references(enclosing_char, text):
+    if enclosing_char:
+        _refs = re.findall("(?:\$)[A-Z0-9a-z_\.]+(?:\$)", text)
+    else:
+        _refs = re.findall("(?:\$?)[A-Z0-9a-z_\.]+(?:\$?)", text)
+    return [ r for r in _refs if not r.startswith('$SMY_') ]
+
+def _get_replacement_data(column, student_data, allow_html, do_not_encode, substitution_aggregation_mode='latest', blank_replacement='', append_auth_user_mode=None):
+    """Loads up the data in the specified column and student_data.
+        Returns list of strings.
         
-        Returns:
-            dict {
-                new_text (str): Substituted text
-                scripts (str): Any javascript needed for rendering
-            }
+        column (Column)
+        student_data (StudentData)
+        allow_html (bool)
+        do_not_encode (bool)
+        substitution_aggregation_mode (str) latest|earliest|user_latest|user_earliest|all|given_latest|given_earliest|given_user_latest|given_user_earliest|given_all
+        blank_replacement (any) Pass-through from parent method
+        append_auth_user_mode (None|str) username|full_name|given_names|surname|email
     """
-    
-    return_text = input
+    replacement_data = []
+    replacement_data_metadata = []
     return_scripts = ''
-    
-    if preloaded_student_data_instances is None:
-        preloaded_student_data_instances = {}
-    if len(preloaded_student_data_instances) == 0 and preloaded_student_data is not None:
-        preloaded_student_data_instances[ preloaded_student_data.table.config['uuid'] ] = preloaded_student_data
-    
-    # restore any encoded enclosing chars
-    return_text = return_text.replace(enclosing_char, '$')
-    if preloaded_columns is None:
-        preloaded_columns = {}
-    
-    identity_anonymiser_active = is_identity_anonymiser_active()
-    
-    ### preloaded student_data loading method
-    def _load_student_data_from_preload(identifier, column, preloaded_student_data_instances):
-        """Loads a StudentData instance from preloaded_student_data_instances
-            
-            Args:
-                identifier (str): identifier for the student
-                column (Column): loaded Column instance
-                preloaded_student_data_instances (dict): Keyed by table_uuid
-        """
-        if column.table.config['uuid'] in preloaded_student_data_instances.keys():
-            student_data = preloaded_student_data_instances[ column.table.config['uuid'] ]
-        else:
-            student_data = StudentData(column.table)
-            student_data.find_student(identifier)
-            if student_data._id:
-                preloaded_student_data_instances[ column.table.config['uuid'] ] = student_data
-        return student_data
-    
-    ### column reference finding method
-    def _find_column_references(enclosing_char, text):
-        if enclosing_char:
-            _refs = re.findall("(?:\$)[A-Z0-9a-z_\.]+(?:\$)", text)
-        else:
-            _refs = re.findall("(?:\$?)[A-Z0-9a-z_\.]+(?:\$?)", text)
-        return [ r for r in _refs if not r.startswith('$SMY_') ]
-    
-    ### summary reference finding method
-    def _find_summary_references(text):
-         return re.findall(utils.DELIMITED_SUMMARY_REFERENCE_PATTERN, text)
-    
-    ### data getting
-    def _get_replacement_data(column, student_data, allow_html, do_not_encode, substitution_aggregation_mode='latest', blank_replacement='', append_auth_user_mode=None):
-        """Loads up the data in the specified column and student_data.
-            Returns list of strings.
-            
-            column (Column)
-            student_data (StudentData)
-            allow_html (bool)
-            do_not_encode (bool)
-            substitution_aggregation_mode (str) latest|earliest|user_latest|user_earliest|all|given_latest|given_earliest|given_user_latest|given_user_earliest|given_all
-            blank_replacement (any) Pass-through from parent method
-            append_auth_user_mode (None|str) username|full_name|given_names|surname|email
-        """
-        replacement_data = []
-        replacement_data_metadata = []
-        return_scripts = ''
-        # load up data
-        if substitution_aggregation_mode == 'latest':
-            if column.subfield is not None:
-                # is a multientry column
-                data_temp = student_data.get_data(column_uuid=column.config['uuid'], preloaded_column=column)
-                if data_temp['success']:
-                    if column.subfield < len(data_temp['data']):
-                        replacement_data = [data_temp['data'][column.subfield]]
-                    else:
-                        # problem; required index is beyond what is available in data
-                        replacement_data = [blank_replacement]
+    # load up data
+    if substitution_aggregation_mode == 'latest':
+        if column.subfield is not None:
+            # is a multientry column
+            data_temp = student_data.get_data(column_uuid=column.config['uuid'], preloaded_column=column)
+            if data_temp['success']:
+                if column.subfield < len(data_temp['data']):
+                    replacement_data = [data_temp['data'][column.subfield]]
                 else:
+                    # problem; required index is beyond what is available in data
                     replacement_data = [blank_replacement]
             else:
-                # not a multientry column
-                data_temp = student_data.get_data(column_uuid=column.config['uuid'], preloaded_column=column)
-                if data_temp['success']:
-                    replacement_data = [data_temp['data']]
-                else:
-                    replacement_data = [blank_replacement]
+                replacement_data = [blank_replacement]
         else:
-            replacement_data = []
-            # get change history to render
-            if substitution_aggregation_mode.startswith('given_'):
-                # a bit different here - we need to fetch the change history records that were GIVEN or SAVED
-                # by this student
-                ch = change_history.get_change_history(
-                    column_uuids=[column.config['uuid']],
-                    max_rows=0,
-                    auth_users=[student_data.config['username']], 
-                    sid=None, 
-                    email=None
-                )
-                sid_to_username = column.table.get_sid_username_map()['sid_to_username']
-                if len(ch):
-                    if substitution_aggregation_mode == 'given_latest':
-                        replacement_data = [ch[0].get('new_value', '')]
-                        replacement_data_metadata = [ sid_to_username.get(ch[0].get('identifier')) ]
-                    elif substitution_aggregation_mode == 'given_earliest':
-                        replacement_data = [ch[-1].get('new_value', '')]
-                        replacement_data_metadata = [ sid_to_username.get(ch[-1].get('identifier')) ]
-                    elif substitution_aggregation_mode in ['given_user_earliest', 'given_user_latest']:
-                        receivers = []
-                        if substitution_aggregation_mode == 'given_user_earliest':
-                            ch_iter = reversed(ch)
-                        else:
-                            ch_iter = ch
-                        for r in ch_iter:
-                            if r.get('identifier') not in receivers:
-                                replacement_data.append(r.get('new_value'))
-                                replacement_data_metadata.append(sid_to_username.get(r.get('identifier')))
-                                receivers.append(r.get('identifier'))
-                    elif substitution_aggregation_mode == 'given_all':
-                        replacement_data = [ e.get('new_value', '') for e in ch ]
-                        replacement_data_metadata = [ sid_to_username.get(e.get('identifier')) for e in ch ]
+            # not a multientry column
+            data_temp = student_data.get_data(column_uuid=column.config['uuid'], preloaded_column=column)
+            if data_temp['success']:
+                replacement_data = [data_temp['data']]
             else:
-                ch = student_data.get_change_history(column_uuids=[column.config['uuid']])
-                if len(ch):
-                    if substitution_aggregation_mode == 'earliest':
-                        replacement_data = [ch[-1].get('new_value', '')]
-                        replacement_data_metadata = [ch[-1].get('auth_user')]
-                    elif substitution_aggregation_mode in ['user_earliest', 'user_latest']:
-                        users = []
-                        if substitution_aggregation_mode == 'user_earliest':
-                            ch_iter = reversed(ch)
-                        else:
-                            ch_iter = ch
-                        for r in ch_iter:
-                            if r.get('auth_user') not in users:
-                                replacement_data.append(r.get('new_value'))
-                                replacement_data_metadata.append(r.get('auth_user'))
-                                users.append(r.get('auth_user'))
-                    elif substitution_aggregation_mode == 'all':
-                        replacement_data = [ e.get('new_value', '') for e in ch ]
-                        replacement_data_metadata = [ e.get('auth_user') for e in ch ]
-            # expand subfields if needed
-            if column.subfield is not None and len(replacement_data):
-                _replacement_data = []
-                for d in replacement_data:
-                    try:
-                        _replacement_data.append(json.loads(d)[column.subfield])
-                    except:
-                        _replacement_data.append('')
-                replacement_data = _replacement_data
-        # escape replacement_data if necessary
-        if column.config['type'] == 'multiEntry' and column.subfield_type == 'audio-recording':
-            pass
-        if column.config['type'] == 'multiEntry' and column.subfield_type == 'html-simple':
-            pass
-        elif column.config['type'] == 'file':
-            pass
+                replacement_data = [blank_replacement]
+    else:
+        replacement_data = []
+        # get change history to render
+        if substitution_aggregation_mode.startswith('given_'):
+            # a bit different here - we need to fetch the change history records that were GIVEN or SAVED
+            # by this student
+            ch = change_history.get_change_history(
+                column_uuids=[column.config['uuid']],
+                max_rows=0,
+                auth_users=[student_data.config['username']], 
+                sid=None, 
+                email=None
+            )
+            sid_to_username = column.table.get_sid_username_map()['sid_to_username']
+            if len(ch):
+                if substitution_aggregation_mode == 'given_latest':
+                    replacement_data = [ch[0].get('new_value', '')]
+                    replacement_data_metadata = [ sid_to_username.get(ch[0].get('identifier')) ]
+                elif substitution_aggregation_mode == 'given_earliest':
+                    replacement_data = [ch[-1].get('new_value', '')]
+                    replacement_data_metadata = [ sid_to_username.get(ch[-1].get('identifier')) ]
+                elif substitution_aggregation_mode in ['given_user_earliest', 'given_user_latest']:
+                    receivers = []
+                    if substitution_aggregation_mode == 'given_user_earliest':
+                        ch_iter = reversed(ch)
+                    else:
+                        ch_iter = ch
+                    for r in ch_iter:
+                        if r.get('identifier') not in receivers:
+                            replacement_data.append(r.get('new_value'))
+                            replacement_data_metadata.append(sid_to_username.get(r.get('identifier')))
+                            receivers.append(r.get('identifier'))
+                elif substitution_aggregation_mode == 'given_all':
+                    replacement_data = [ e.get('new_value', '') for e in ch ]
+                    replacement_data_metadata = [ sid_to_username.get(e.get('identifier')) for e in ch ]
         else:
-            replacement_data = _escape_substituted_text(replacement_data, do_not_encode, allow_html)
-        # transform and present loaded data
-        if not isinstance(replacement_data, list):
-            replacement_data = [replacement_data]
-        # convert blanks if necessary
-        if blank_replacement != '':
-            replacement_data = [ blank_replacement if (r == '' or r is None) else r for r in replacement_data ]
-        # replace and format
-        replacement_data_formatted = []
-        if column.magic_formatter == 'display' or column.magic_formatter == 'description':
-            if column.config['type'] == 'multiEntry' and column.subfield is not None:
-                if replacement_data:
-                    # flatten if needed
-                    replacement_data, _topology = utils.flatten_list(replacement_data)
-                    for replacement_data_item in replacement_data:
-                        # format
-                        key = 'display' if not column.magic_formatter else column.magic_formatter
-                        replacement_data_formatted_part = None
-                        for _select_item in column.config['multi_entry']['options'][column.subfield]['select']:
-                            #if _escape_substituted_text(str(_select_item['value']), do_not_encode, allow_html) == str(replacement_data_item):
-                            #    replacement_data_formatted_part = _select_item[key]
-                            #    break
-                            if str(_select_item['value']) == Markup.unescape(str(replacement_data_item)):
-                                replacement_data_formatted_part = _select_item[key]
-                                break
-                        if replacement_data_formatted_part is None and column.config['multi_entry']['options'][column.subfield].get('range_mode') is not None:
-                            # try to use range to figure out where the value lies in the spectrum
-                            _range_mode = column.config['multi_entry']['options'][column.subfield].get('range_mode')
-                            _select_items = column.config['multi_entry']['options'][column.subfield]['select']
-                            for i, select_item in enumerate(_select_items):
-                                replacement_data_formatted_part = None
+            ch = student_data.get_change_history(column_uuids=[column.config['uuid']])
+            if len(ch):
+                if substitution_aggregation_mode == 'earliest':
+                    replacement_data = [ch[-1].get('new_value', '')]
+                    replacement_data_metadata = [ch[-1].get('auth_user')]
+                elif substitution_aggregation_mode in ['user_earliest', 'user_latest']:
+                    users = []
+                    if substitution_aggregation_mode == 'user_earliest':
+                        ch_iter = reversed(ch)
+                    else:
+                        ch_iter = ch
+                    for r in ch_iter:
+                        if r.get('auth_user') not in users:
+                            replacement_data.append(r.get('new_value'))
+                            replacement_data_metadata.append(r.get('auth_user'))
+                            users.append(r.get('auth_user'))
+                elif substitution_aggregation_mode == 'all':
+                    replacement_data = [ e.get('new_value', '') for e in ch ]
+                    replacement_data_metadata = [ e.get('auth_user') for e in ch ]
+        # expand subfields if needed
+        if column.subfield is not None and len(replacement_data):
+            _replacement_data = []
+            for d in replacement_data:
+                try:
+                    _replacement_data.append(json.loads(d)[column.subfield])
+                except:
+                    _replacement_data.append('')
+            replacement_data = _replacement_data
+    # escape replacement_data if necessary
+    if column.config['type'] == 'multiEntry' and column.subfield_type == 'audio-recording':
+        pass
+    if column.config['type'] == 'multiEntry' and column.subfield_type == 'html-simple':
+        pass
+    elif column.config['type'] == 'file':
+        pass
+    else:
+        replacement_data = _escape_substituted_text(replacement_data, do_not_encode, allow_html)
+    # transform and present loaded data
+    if not isinstance(replacement_data, list):
+        replacement_data = [replacement_data]
+    # convert blanks if necessary
+    if blank_replacement != '':
+        replacement_data = [ blank_replacement if (r == '' or r is None) else r for r in replacement_data ]
+    # replace and format
+    replacement_data_formatted = []
+    if column.magic_formatter == 'display' or column.magic_formatter == 'description':
+        if column.config['type'] == 'multiEntry' and column.subfield is not None:
+            if replacement_data:
+                # flatten if needed
+                replacement_data, _topology = utils.flatten_list(replacement_data)
+                for replacement_data_item in replacement_data:
+                    # format
+                    key = 'display' if not column.magic_formatter else column.magic_formatter
+                    replacement_data_formatted_part = None
+                    for _select_item in column.config['multi_entry']['options'][column.subfield]['select']:
+                        #if _escape_substituted_text(str(_select_item['value']), do_not_encode, allow_html) == str(replacement_data_item):
+                        #    replacement_data_formatted_part = _select_item[key]
+                        #    break
+                        if str(_select_item['value']) == Markup.unescape(str(replacement_data_item)):
+                            replacement_data_formatted_part = _select_item[key]
+                            break
+                    if replacement_data_formatted_part is None and column.config['multi_entry']['options'][column.subfield].get('range_mode') is not None:
+                        # try to use range to figure out where the value lies in the spectrum
+                        _range_mode = column.config['multi_entry']['options'][column.subfield].get('range_mode')
+                        _select_items = column.config['multi_entry']['options'][column.subfield]['select']
+                        for i, select_item in enumerate(_select_items):
+                            replacement_data_formatted_part = None
+                            try:
+                                _challenge_value = float(replacement_data_item)
+                                _current_item_value = float(select_item['value'])
                                 try:
-                                    _challenge_value = float(replacement_data_item)
-                                    _current_item_value = float(select_item['value'])
-                                    try:
-                                        _next_item_value = float(_select_items[i+1]['value'])
-                                        if (_current_item_value < _challenge_value < _next_item_value) or (_current_item_value > _challenge_value > _next_item_value):
-                                            if _range_mode == 'roundup':
-                                                if _current_item_value > _next_item_value:
-                                                    replacement_data_formatted_part = _select_items[i][key]
-                                                else:
-                                                    replacement_data_formatted_part = _select_items[i+1][key]
-                                            else: # _range_mode == 'rounddown':
-                                                if _current_item_value > _next_item_value:
-                                                    replacement_data_formatted_part = _select_items[i+1][key]
-                                                else:
-                                                    replacement_data_formatted_part = _select_items[i][key]
-                                        else:
-                                            pass
-                                    except:
+                                    _next_item_value = float(_select_items[i+1]['value'])
+                                    if (_current_item_value < _challenge_value < _next_item_value) or (_current_item_value > _challenge_value > _next_item_value):
+                                        if _range_mode == 'roundup':
+                                            if _current_item_value > _next_item_value:
+                                                replacement_data_formatted_part = _select_items[i][key]
+                                            else:
+                                                replacement_data_formatted_part = _select_items[i+1][key]
+                                        else: # _range_mode == 'rounddown':
+                                            if _current_item_value > _next_item_value:
+                                                replacement_data_formatted_part = _select_items[i+1][key]
+                                            else:
+                                                replacement_data_formatted_part = _select_items[i][key]
+                                    else:
                                         pass
                                 except:
                                     pass
-                                if replacement_data_formatted_part is not None:
-                                    break
-                        if replacement_data_formatted_part:
-                            replacement_data_formatted.append(replacement_data_formatted_part)
-            elif column.config['type'] == 'multiEntry' and column.subfield is None:
-                replacement_data_formatted.append(blank_replacement)
-            elif column.config['type'] == 'mark':
-                for replacement_data_item in replacement_data:
-                    # load if necessary
-                    if utils.is_json(replacement_data_item):
-                        replacement_data_item = json.loads(replacement_data_item)
-                    # format
-                    key = 'display' if not column.magic_formatter else column.magic_formatter
-                    replacement_data_formatted_part = next(
-                        (list_option[key] 
-                        for list_option in column.config['simple_input']['options']
-                        if str(list_option['value']) == str(replacement_data_item)),
-                        None
-                    )
+                            except:
+                                pass
+                            if replacement_data_formatted_part is not None:
+                                break
                     if replacement_data_formatted_part:
                         replacement_data_formatted.append(replacement_data_formatted_part)
-        elif column.magic_formatter == 'image' and (column.config['type'] == 'image' or column.config['type'] == 'imgurl'):
-            # see if dimensions are set
-            _style = ''
-            try:
-                _dim = column.column_reference.split('.')[column.column_reference.split('.').index('image') + 1]
-                if _dim:
-                    if utils.is_number(_dim):
-                        _style = 'style="min-width:{d}px; min-height:{d}px; max-width:{d}px; max-height:{d}px;"'.format(d=_dim)
-                    else:
-                        _dim = re.sub('[^A-Z0-9a-z\%]', '', _dim)
-                        if _dim.startswith('w') or _dim.startswith('h'):
-                            _axis = 'height' if _dim.startswith('h') else 'width'
-                            _dim = _dim[1:]
-                            if utils.is_number(_dim):
-                                _style = 'style="{a}: {d}px;"'.format(a=_axis, d=_dim)
-                            else:
-                                _style = 'style="{a}: {d};"'.format(a=_axis, d=_dim)
-            except:
-                pass
-            # return the img tag
-            if column.config['type'] == 'image':
-                replacement_data_formatted = [ '<img src="{}" {}>'.format(get_file_access_url(d, full_path=True), _style) for d in replacement_data ]
-            elif column.magic_formatter == 'image' and column.config['type'] == 'imgurl':
-                replacement_data_formatted = [ '<img src="{}" {}>'.format(d, _style) for d in replacement_data ]
-        elif column.magic_formatter == 'audio_player':
-            if column.config['type'] == 'multiEntry': # technically only possible for a particular subfield type
-                replacement_data, _topology = utils.flatten_list(replacement_data)
-                replacement_data_formatted = [ '<audio controls src="{}"></audio>'.format(get_file_access_url(fn, full_path=True)) for fn in replacement_data ]
-            else:
-                replacement_data_formatted = str(replacement_data)
-        elif column.magic_formatter in ['file_download_links', 'file_download_links_bullets'] and column.config['type'] == 'file':
-            # load up the file list
-            if replacement_data and utils.is_json(replacement_data):
-                files = json.loads(replacement_data)
-            elif type(replacement_data) is list:
-                files = replacement_data
-            else:
-                files = None
-            # format the file list
-            if files:
-                # flatten it first
-                files, _topology = utils.flatten_list(files)
-                download_links = []
-                # render the download links
-                for file in files:
-                    if type(file) is dict:
-                        saved_filename = file.get('saved_filename')
-                        original_filename = file.get('original_filename', saved_filename)
-                        url = file.get('url')
-                        download_links.append(f'<a href="{url}">{original_filename}</a>')
-                    else:
-                        download_links.append("No file(s) are available") # Or should we use blank_replacement ??
-                replacement_data_formatted = download_links
-        elif column.magic_formatter in ['join_space', 'join_bullets', 'join_paragraphs']:
-            replacement_data_formatted = [ utils.force_interpret_str_to_list(d, sort_list=False) for d in replacement_data ]
-        elif column.magic_formatter == 'tabulate_reports':
-            # grab all reports
-            _all_reports_data = student_data.get_data_for_entry(column)['all_reports_data_keyed']
-            _table_id = 'tabulated_reports_' + utils.create_uuid()
-            replacement_data_formatted = f"""<table class="table" id="{_table_id}">"""
-            # make table header
-            _headers = ['Report #']
-            if column.config['type'] == 'multiEntry':
-                _headers.extend(column.get_multientry_labels(get_text_only=True))
-            else:
-                _headers.append(get_friendly_column_name(show_table_info=False, get_text_only=True, table=column.table, column=column))
-            replacement_data_formatted += """<thead><tr>"""
-            for _header in _headers:
-                replacement_data_formatted += f"""<th>{_header}</th>"""
-            replacement_data_formatted += """</tr></thead>"""
-            # make table rows
-            _rows = []
-            replacement_data_formatted += """<tbody>"""
-            _multientry_options = column.config['multi_entry'].get('options', [])
-            for _report_number, _report_data in _all_reports_data.items():
-                replacement_data_formatted += """<tr>"""
-                for _a, _header in enumerate(_headers):
-                    if _a == 0:
-                        replacement_data_formatted += f"""<td>{_report_number}</td>"""
-                    elif _a > len(_report_data):
-                        replacement_data_formatted += f"""<td></td>"""
-                    else:
-                        _cell = _report_data[_a - 1]
-                        _td_html = ''
-                        if _a < len(_multientry_options):
-                            _subfield_type = _multientry_options[_a - 1].get('type')
-                            if _subfield_type == 'audio-recording':
-                                _td_html += f"""<td>
-                                    <div class="sres-audio-recording-recordings-container mt-2" data-sres-field="{_subfield_type}" data-sres-columnuuid="{column.config['uuid']}"
-                                        data-sres-saved-recordings="{escape(json.dumps(_cell))}" readonly>
-                                    </div></td>
-                                """
-                            elif _subfield_type == 'sketch-small':
-                                _td_html += f"""<td>
-                                    <input type="hidden" data-sres-field="sketch-small" data-sres-columnuuid="{column.config['uuid']}" value="{_cell}" readonly>
-                                    <div class="sres-sketch-container" style="width:100%;">
-                                        <canvas id="sres_sketch_{utils.create_uuid()}" height="100" width="300" class="sres-sketch-area sres-sketch-small">
-                                    </div></td>
-                                """
-                        if len(_td_html) == 0:
-                            if len(str(_cell)) > 200:
-                                _td_html += f"""<td><div class="sres-multiple-reports-table-td-wrap">{_cell}</div></td>"""
-                            else:
-                                _td_html += f"""<td><div>{_cell}</div></td>"""
-                        replacement_data_formatted += _td_html
-                replacement_data_formatted += """</tr>"""
-            replacement_data_formatted += """</tbody>"""
-            # finish table
-            replacement_data_formatted += """</table>"""
-            # load up datatable
-            return_scripts += """
-            <script>$(document).ready(function(){
-                oTable_""" + _table_id + """ = $('#""" + _table_id + """').DataTable({
-                    dom: "<'row'<'col-sm-4'l><'col-sm-4'B><'col-sm-4'f>><'row'<'col-sm-12't>><'row'<'col-sm-6'i><'col-sm-6'p>>",
-                    scrollX: true,
-                    fixedColumns: true,
-                    language: {
-                        lengthMenu: "Show _MENU_ reports",
-                        info: "Showing _START_ to _END_ of _TOTAL_ reports"
+        elif column.config['type'] == 'multiEntry' and column.subfield is None:
+            replacement_data_formatted.append(blank_replacement)
+        elif column.config['type'] == 'mark':
+            for replacement_data_item in replacement_data:
+                # load if necessary
+                if utils.is_json(replacement_data_item):
+                    replacement_data_item = json.loads(replacement_data_item)
+                # format
+                key = 'display' if not column.magic_formatter else column.magic_formatter
+                replacement_data_formatted_part = next(
+                    (list_option[key] 
+                    for list_option in column.config['simple_input']['options']
+                    if str(list_option['value']) == str(replacement_data_item)),
+                    None
+                )
+                if replacement_data_formatted_part:
+                    replacement_data_formatted.append(replacement_data_formatted_part)
+    elif column.magic_formatter == 'image' and (column.config['type'] == 'image' or column.config['type'] == 'imgurl'):
+        # see if dimensions are set
+        _style = ''
+        try:
+            _dim = column.column_reference.split('.')[column.column_reference.split('.').index('image') + 1]
+            if _dim:
+                if utils.is_number(_dim):
+                    _style = 'style="min-width:{d}px; min-height:{d}px; max-width:{d}px; max-height:{d}px;"'.format(d=_dim)
+                else:
+                    _dim = re.sub('[^A-Z0-9a-z\%]', '', _dim)
+                    if _dim.startswith('w') or _dim.startswith('h'):
+                        _axis = 'height' if _dim.startswith('h') else 'width'
+                        _dim = _dim[1:]
+                        if utils.is_number(_dim):
+                            _style = 'style="{a}: {d}px;"'.format(a=_axis, d=_dim)
+                        else:
+                            _style = 'style="{a}: {d};"'.format(a=_axis, d=_dim)
+        except:
+            pass
+        # return the img tag
+        if column.config['type'] == 'image':
+            replacement_data_formatted = [ '<img src="{}" {}>'.format(get_file_access_url(d, full_path=True), _style) for d in replacement_data ]
+        elif column.magic_formatter == 'image' and column.config['type'] == 'imgurl':
+            replacement_data_formatted = [ '<img src="{}" {}>'.format(d, _style) for d in replacement_data ]
+    elif column.magic_formatter == 'audio_player':
+        if column.config['type'] == 'multiEntry': # technically only possible for a particular subfield type
+            replacement_data, _topology = utils.flatten_list(replacement_data)
+            replacement_data_formatted = [ '<audio controls src="{}"></audio>'.format(get_file_access_url(fn, full_path=True)) for fn in replacement_data ]
+        else:
+            replacement_data_formatted = str(replacement_data)
+    elif column.magic_formatter in ['file_download_links', 'file_download_links_bullets'] and column.config['type'] == 'file':
+        # load up the file list
+        if replacement_data and utils.is_json(replacement_data):
+            files = json.loads(replacement_data)
+        elif type(replacement_data) is list:
+            files = replacement_data
+        else:
+            files = None
+        # format the file list
+        if files:
+            # flatten it first
+            files, _topology = utils.flatten_list(files)
+            download_links = []
+            # render the download links
+            for file in files:
+                if type(file) is dict:
+                    saved_filename = file.get('saved_filename')
+                    original_filename = file.get('original_filename', saved_filename)
+                    url = file.get('url')
+                    download_links.append(f'<a href="{url}">{original_filename}</a>')
+                else:
+                    download_links.append("No file(s) are available") # Or should we use blank_replacement ??
+            replacement_data_formatted = download_links
+    elif column.magic_formatter in ['join_space', 'join_bullets', 'join_paragraphs']:
+        replacement_data_formatted = [ utils.force_interpret_str_to_list(d, sort_list=False) for d in replacement_data ]
+    elif column.magic_formatter == 'tabulate_reports':
+        # grab all reports
+        _all_reports_data = student_data.get_data_for_entry(column)['all_reports_data_keyed']
+        _table_id = 'tabulated_reports_' + utils.create_uuid()
+        replacement_data_formatted = f"""<table class="table" id="{_table_id}">"""
+        # make table header
+        _headers = ['Report #']
+        if column.config['type'] == 'multiEntry':
+            _headers.extend(column.get_multientry_labels(get_text_only=True))
+        else:
+            _headers.append(get_friendly_column_name(show_table_info=False, get_text_only=True, table=column.table, column=column))
+        replacement_data_formatted += """<thead><tr>"""
+        for _header in _headers:
+            replacement_data_formatted += f"""<th>{_header}</th>"""
+        replacement_data_formatted += """</tr></thead>"""
+        # make table rows
+        _rows = []
+        replacement_data_formatted += """<tbody>"""
+        _multientry_options = column.config['multi_entry'].get('options', [])
+        for _report_number, _report_data in _all_reports_data.items():
+            replacement_data_formatted += """<tr>"""
+            for _a, _header in enumerate(_headers):
+                if _a == 0:
+                    replacement_data_formatted += f"""<td>{_report_number}</td>"""
+                elif _a > len(_report_data):
+                    replacement_data_formatted += f"""<td></td>"""
+                else:
+                    _cell = _report_data[_a - 1]
+                    _td_html = ''
+                    if _a < len(_multientry_options):
+                        _subfield_type = _multientry_options[_a - 1].get('type')
+                        if _subfield_type == 'audio-recording':
+                            _td_html += f"""<td>
+                                <div class="sres-audio-recording-recordings-container mt-2" data-sres-field="{_subfield_type}" data-sres-columnuuid="{column.config['uuid']}"
+                                    data-sres-saved-recordings="{escape(json.dumps(_cell))}" readonly>
+                                </div></td>
+                            """
+                        elif _subfield_type == 'sketch-small':
+                            _td_html += f"""<td>
+                                <input type="hidden" data-sres-field="sketch-small" data-sres-columnuuid="{column.config['uuid']}" value="{_cell}" readonly>
+                                <div class="sres-sketch-container" style="width:100%;">
+                                    <canvas id="sres_sketch_{utils.create_uuid()}" height="100" width="300" class="sres-sketch-area sres-sketch-small">
+                                </div></td>
+                            """
+                    if len(_td_html) == 0:
+                        if len(str(_cell)) > 200:
+                            _td_html += f"""<td><div class="sres-multiple-reports-table-td-wrap">{_cell}</div></td>"""
+                        else:
+                            _td_html += f"""<td><div>{_cell}</div></td>"""
+                    replacement_data_formatted += _td_html
+            replacement_data_formatted += """</tr>"""
+        replacement_data_formatted += """</tbody>"""
+        # finish table
+        replacement_data_formatted += """</table>"""
+        # load up datatable
+        return_scripts += """
+        <script>$(document).ready(function(){
+            oTable_""" + _table_id + """ = $('#""" + _table_id + """').DataTable({
+                dom: "<'row'<'col-sm-4'l><'col-sm-4'B><'col-sm-4'f>><'row'<'col-sm-12't>><'row'<'col-sm-6'i><'col-sm-6'p>>",
+                scrollX: true,
+                fixedColumns: true,
+                language: {
+                    lengthMenu: "Show _MENU_ reports",
+                    info: "Showing _START_ to _END_ of _TOTAL_ reports"
+                },
+                buttons: [
+                    /*{
+                        extend: 'print',
+                        autoPrint: false,
+                        customize: function(win){
+                            let table = $(win.document.body).find('table');
+                            table.prepend('message');
+                        }
+                    },*/
+                    {
+                        extend: 'excelHtml5',
+                        text: '<span class="fa fa-download"></span> Excel',
+                        title: """ + json.dumps(column.get_friendly_name(show_table_info=True, get_text_only=True) + ' - ' + student_data.config.get('sid', '')) + """
                     },
-                    buttons: [
-                        /*{
-                            extend: 'print',
-                            autoPrint: false,
-                            customize: function(win){
-                                let table = $(win.document.body).find('table');
-                                table.prepend('message');
-                            }
-                        },*/
-                        {
-                            extend: 'excelHtml5',
-                            text: '<span class="fa fa-download"></span> Excel',
-                            title: """ + json.dumps(column.get_friendly_name(show_table_info=True, get_text_only=True) + ' - ' + student_data.config.get('sid', '')) + """
-                        },
-                        {
-                            extend: 'excelHtml5',
-                            text: '<span class="fa fa-download"></span> Page as Excel',
-                            title: """ + json.dumps(column.get_friendly_name(show_table_info=True, get_text_only=True) + ' - ' + student_data.config.get('sid', '')) + """,
-                            customize: function(xlsx) {
-                                /** quickinfo dumping **/
-                                let sheet = xlsx.xl.worksheets['sheet1.xml'];
-                                let quickInfoContainer = $('.sres-quickinfo-container');
-                                let quickInfoExceptTable = $('.sres-quickinfo-container :not(script):not(style):not(#""" + _table_id + """_wrapper, #""" + _table_id + """_wrapper *)');
-                                let textRows = [];
-                                for (let e = 0; e < quickInfoExceptTable.length; e++) {
-                                    if (e > 0) {
-                                        if (quickInfoExceptTable[e - 1].contains(quickInfoExceptTable[e])) {
-                                            continue;
-                                        }
+                    {
+                        extend: 'excelHtml5',
+                        text: '<span class="fa fa-download"></span> Page as Excel',
+                        title: """ + json.dumps(column.get_friendly_name(show_table_info=True, get_text_only=True) + ' - ' + student_data.config.get('sid', '')) + """,
+                        customize: function(xlsx) {
+                            /** quickinfo dumping **/
+                            let sheet = xlsx.xl.worksheets['sheet1.xml'];
+                            let quickInfoContainer = $('.sres-quickinfo-container');
+                            let quickInfoExceptTable = $('.sres-quickinfo-container :not(script):not(style):not(#""" + _table_id + """_wrapper, #""" + _table_id + """_wrapper *)');
+                            let textRows = [];
+                            for (let e = 0; e < quickInfoExceptTable.length; e++) {
+                                if (e > 0) {
+                                    if (quickInfoExceptTable[e - 1].contains(quickInfoExceptTable[e])) {
+                                        continue;
                                     }
-                                    textRows.push( quickInfoExceptTable[e].innerText );
-                                }
-                                $('c[r=A1] t', sheet).text(textRows.join('\\n'));
-                                $('c[r=A1]', sheet).attr('s', 50);
-                                /** data entry dumping **/
-                                // make a new sheet, from https://codepen.io/RedJokingInn/pen/pVKWjz
-                                let source = xlsx['[Content_Types].xml'].getElementsByTagName('Override')[1];
-                                let clone = source.cloneNode(true);
-                                clone.setAttribute('PartName','/xl/worksheets/sheet2.xml');
-                                xlsx['[Content_Types].xml'].getElementsByTagName('Types')[0].appendChild(clone);
-                                source = xlsx.xl._rels['workbook.xml.rels'].getElementsByTagName('Relationship')[0];
-                                clone = source.cloneNode(true);
-                                clone.setAttribute('Id','rId3');
-                                clone.setAttribute('Target','worksheets/sheet2.xml');
-                                xlsx.xl._rels['workbook.xml.rels'].getElementsByTagName('Relationships')[0].appendChild(clone);
-                                source = xlsx.xl['workbook.xml'].getElementsByTagName('sheet')[0];
-                                clone = source.cloneNode(true);
-                                clone.setAttribute('name','Info');
-                                clone.setAttribute('sheetId','2');
-                                clone.setAttribute('r:id','rId3');
-                                xlsx.xl['workbook.xml'].getElementsByTagName('sheets')[0].appendChild(clone);
-                                let newSheet = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>' +
-                                    '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships" xmlns:mc="http://schemas.openxmlformats.org/markup-compatibility/2006" xmlns:x14ac="http://schemas.microsoft.com/office/spreadsheetml/2009/9/ac" mc:Ignorable="x14ac">' +
-                                    '<cols >' +
-                                      '<col min="1" max="1" width="24.7" customWidth="1"/>' +
-                                      '<col min="2" max="2" width="37.7" customWidth="1"/>' +
-                                    '</cols>' +
-                                    '<sheetData>';
-                                // add data to new sheet
-                                let rowCount = oTable_""" + _table_id + """.rows().count();
-                                let dataFields = $('#set_data_container').find("[data-sres-field]");
-                                let tmpData = collectMultientryData(dataFields);
-                                for (let f = 0; f < dataFields.length; f++) {
-                                    let label = $(dataFields[f]).parent().find('.sres-field-label').text();
-                                    let data = tmpData[f];
-                                    newSheet +='<row r="' + (f+1) + '">' + 
-                                        '<c t="inlineStr" s="2" r="A' + (f+1) + '"><is><t>' + label + '</t></is></c>' + 
-                                        '<c t="inlineStr" s="0" r="B' + (f+1) + '"><is><t>' + data  + '</t></is></c>' + 
-                                    '</row>';
                                 }
-                                newSheet += '</sheetData></worksheet>';
-                                xlsx.xl.worksheets['sheet2.xml'] = $.parseXML(newSheet);
+                                textRows.push( quickInfoExceptTable[e].innerText );
                             }
+                            $('c[r=A1] t', sheet).text(textRows.join('\\n'));
+                            $('c[r=A1]', sheet).attr('s', 50);
+                            /** data entry dumping **/
+                            // make a new sheet, from https://codepen.io/RedJokingInn/pen/pVKWjz
+                            let source = xlsx['[Content_Types].xml'].getElementsByTagName('Override')[1];
+                            let clone = source.cloneNode(true);
+                            clone.setAttribute('PartName','/xl/worksheets/sheet2.xml');
+                            xlsx['[Content_Types].xml'].getElementsByTagName('Types')[0].appendChild(clone);
+                            source = xlsx.xl._rels['workbook.xml.rels'].getElementsByTagName('Relationship')[0];
+                            clone = source.cloneNode(true);
+                            clone.setAttribute('Id','rId3');
+                            clone.setAttribute('Target','worksheets/sheet2.xml');
+                            xlsx.xl._rels['workbook.xml.rels'].getElementsByTagName('Relationships')[0].appendChild(clone);
+                            source = xlsx.xl['workbook.xml'].getElementsByTagName('sheet')[0];
+                            clone = source.cloneNode(true);
+                            clone.setAttribute('name','Info');
+                            clone.setAttribute('sheetId','2');
+                            clone.setAttribute('r:id','rId3');
+                            xlsx.xl['workbook.xml'].getElementsByTagName('sheets')[0].appendChild(clone);
+                            let newSheet = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>' +
+                                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships" xmlns:mc="http://schemas.openxmlformats.org/markup-compatibility/2006" xmlns:x14ac="http://schemas.microsoft.com/office/spreadsheetml/2009/9/ac" mc:Ignorable="x14ac">' +
+                                '<cols >' +
+                                  '<col min="1" max="1" width="24.7" customWidth="1"/>' +
+                                  '<col min="2" max="2" width="37.7" customWidth="1"/>' +
+                                '</cols>' +
+                                '<sheetData>';
+                            // add data to new sheet
+                            let rowCount = oTable_""" + _table_id + """.rows().count();
+                            let dataFields = $('#set_data_container').find("[data-sres-field]");
+                            let tmpData = collectMultientryData(dataFields);
+                            for (let f = 0; f < dataFields.length; f++) {
+                                let label = $(dataFields[f]).parent().find('.sres-field-label').text();
+                                let data = tmpData[f];
+                                newSheet +='<row r="' + (f+1) + '">' + 
+                                    '<c t="inlineStr" s="2" r="A' + (f+1) + '"><is><t>' + label + '</t></is></c>' + 
+                                    '<c t="inlineStr" s="0" r="B' + (f+1) + '"><is><t>' + data  + '</t></is></c>' + 
+                                '</row>';
+                            }
+                            newSheet += '</sheetData></worksheet>';
+                            xlsx.xl.worksheets['sheet2.xml'] = $.parseXML(newSheet);
                         }
-                    ]
-                });
-                // hacky way to get datatable to render properly
-                setTimeout(function(){ $('#""" + _table_id + """').DataTable().draw(); }, 1000);
+                    }
+                ]
             });
-            </script>
-            """
-            # return
-            replacement_data_formatted = [replacement_data_formatted]
-        else:
-            replacement_data_formatted = [ json.dumps(d) if not isinstance(d, str) else d for d in replacement_data ]
+            // hacky way to get datatable to render properly
+            setTimeout(function(){ $('#""" + _table_id + """').DataTable().draw(); }, 1000);
+        });
+        </script>
+        """
+        # return
+        replacement_data_formatted = [replacement_data_formatted]
+    else:
+        replacement_data_formatted = [ json.dumps(d) if not isinstance(d, str) else d for d in replacement_data ]
+    
+    
+    if append_auth_user_mode is not None:
+        # see what type of metadata is being requested
+        from sres.users import User
+        _unique_usernames = list(set(replacement_data_metadata))
+        _user_map = {}
+        for _username in _unique_usernames:
+            _user_map[_username] = User()
+            if not _user_map[_username].find_user(username=_username, add_if_not_exists=False):
+                del(_user_map[_username])
+        # append the auth_user metadata
+        replacement_data_flattened, _topology = utils.flatten_list(replacement_data_formatted)
+        _expanded_replacement_data_metadata = []
+        for i, _e in enumerate(_topology):
+            _expanded_replacement_data_metadata.extend([replacement_data_metadata[i]] * _e)
+        for i, meta in enumerate(_expanded_replacement_data_metadata):
+            if meta in _user_map.keys():
+                replacement_data_flattened[i] += ' (' + str(_user_map[meta].config.get(append_auth_user_mode, meta)) + ')'
+            else:
+                replacement_data_flattened[i] = f'{replacement_data_flattened[i]} ({meta})'
+    else:
+        replacement_data_flattened = utils.flatten_list(replacement_data_formatted)[0]
+    return {
+        'replacement_data': replacement_data_flattened,
+        'scripts': return_scripts
+    }
+
+def _parse_global_magic_formatter_config(gmf_match):
+    """Reads the history: and auth_user: options from the prefix of a global magic formatter.
+        Returns a tuple of (substitution_aggregation_mode, append_auth_user_mode).
+    """
+    substitution_aggregation_mode = 'latest'
+    append_auth_user_mode = None
+    gmf_prefix = re.findall('(?<=\$\{).*?(?=\})', gmf_match)
+    if len(gmf_prefix):
+        gmf_config = gmf_prefix[0].split()
+        for gmf_config_element in gmf_config:
+            if gmf_config_element.startswith('history'):
+                try:
+                    if gmf_config_element.split(':')[1] in GLOBAL_MAGIC_FORMATTER_HISTORY_MODES:
+                        substitution_aggregation_mode = gmf_config_element.split(':')[1]
+                except:
+                    # just ignore
+                    pass
+            elif gmf_config_element.startswith('auth_user'):
+                try:
+                    if gmf_config_element.split(':')[1] in GLOBAL_MAGIC_FORMATTER_AUTH_USER_MODES:
+                        append_auth_user_mode = gmf_config_element.split(':')[1]
+                except:
+                    # just ignore
+                    pass
+    return substitution_aggregation_mode, append_auth_user_mode
+
+class TextTemplate:
+    """A text with column references, tokenised once into literal and placeholder nodes
+        so that it can be rendered for many students in a single pass each.
         
+        Nodes are tuples of (kind, value) where kind is one of
+            text: value is the literal text
+            global_magic_formatter: value is a dict of the match and its parsed config
+            general_field: value is a key of GENERAL_FIELDS
+            column: value is a tuple of (column reference, original text)
+            summary: value is the original text
         
-        if append_auth_user_mode is not None:
-            # see what type of metadata is being requested
-            from sres.users import User
-            _unique_usernames = list(set(replacement_data_metadata))
-            _user_map = {}
-            for _username in _unique_usernames:
-                _user_map[_username] = User()
-                if not _user_map[_username].find_user(username=_username, add_if_not_exists=False):
-                    del(_user_map[_username])
-            # append the auth_user metadata
-            replacement_data_flattened, _topology = utils.flatten_list(replacement_data_formatted)
-            _expanded_replacement_data_metadata = []
-            for i, _e in enumerate(_topology):
-                _expanded_replacement_data_metadata.extend([replacement_data_metadata[i]] * _e)
-            for i, meta in enumerate(_expanded_replacement_data_metadata):
-                if meta in _user_map.keys():
-                    replacement_data_flattened[i] += ' (' + str(_user_map[meta].config.get(append_auth_user_mode, meta)) + ')'
-                else:
-                    replacement_data_flattened[i] = f'{replacement_data_flattened[i]} ({meta})'
-        else:
-            replacement_data_flattened = utils.flatten_list(replacement_data_formatted)[0]
-        return {
-            'replacement_data': replacement_data_flattened,
-            'scripts': return_scripts
-        }
-    
-    ### Find global magic formatters
-    if re.search(utils.GLOBAL_MAGIC_FORMATTER_REFERENCE_PATTERN, return_text) is not None:
-        for mf in [m for m in MAGIC_FORMATTERS_LIST if m.get('enabled_for_global_magic')]:
-            mf_pattern = '\$\{\s*' + mf['name'] + '\s*.*?\}.*?\{\s*' + mf['name'] + '\s*\}\$'
-            gmf_matches = re.findall(mf_pattern, return_text)
-            if gmf_matches:
-                for gmf_match in gmf_matches:
-                    substitution_aggregation_mode = 'latest'
-                    append_auth_user_mode = None
-                    # parse any config
-                    gmf_prefix = re.findall('(?<=\$\{).*?(?=\})', gmf_match)
-                    if len(gmf_prefix):
-                        gmf_config = gmf_prefix[0].split()
-                        for gmf_config_element in gmf_config:
-                            if gmf_config_element.startswith('history'):
-                                try:
-                                    if gmf_config_element.split(':')[1] in ['all', 'earliest', 'user_latest', 'user_earliest', 'given_latest', 'given_earliest', 'given_user_latest', 'given_user_earliest', 'given_all']:
-                                        substitution_aggregation_mode = gmf_config_element.split(':')[1]
-                                except:
-                                    # just ignore
-                                    pass
-                            elif gmf_config_element.startswith('auth_user'):
-                                try:
-                                    if gmf_config_element.split(':')[1] in ['username', 'full_name', 'given_names', 'surname', 'email']:
-                                        append_auth_user_mode = gmf_config_element.split(':')[1]
-                                except:
-                                    # just ignore
-                                    pass
-                    # read the column references internal to this global magic formatter
-                    column_references = _find_column_references(enclosing_char, gmf_match)
-                    all_replacement_data = []
-                    for column_reference in column_references:
-                        column_loaded = False
-                        column_reference = utils.clean_delimiter_from_column_references(column_reference)
-                        if preloaded_columns and column_reference in preloaded_columns.keys():
-                            column = preloaded_columns[column_reference]
-                            column_loaded = True
-                        else:
-                            column = Column()
-                            if column.load(column_reference=column_reference, default_table_uuid=default_table_uuid):
-                                column_loaded = True
-                                preloaded_columns[column_reference] = column
-                        if column_loaded:
-                            allow_html = column.config['custom_options']['allow_html']
-                            # get data
-                            student_data = _load_student_data_from_preload(identifier, column, preloaded_student_data_instances)
-                            if student_data._id:
-                                if column.is_system_column:
-                                    column_config_reference = next(col for col in SYSTEM_COLUMNS if col['insert_value'].upper() == column_reference.upper())['name']
-                                    all_replacement_data.extend([student_data.config[column_config_reference]])
-                                else:
-                                    _replacement_data = _get_replacement_data(column, student_data, allow_html, do_not_encode, substitution_aggregation_mode, blank_replacement, append_auth_user_mode)
-                                    all_replacement_data.extend(_replacement_data['replacement_data'])
-                                    return_scripts += _replacement_data['scripts']
-                    # transform and present loaded data
-                    replacement_text = None
-                    if mf['name'] in ['join_space', 'join_bullets', 'join_paragraphs']:
-                        # remove empty elements
-                        all_replacement_data = [ x for x in all_replacement_data if x != '' ]
-                        # format
-                        if mf['name'] == 'join_space':
-                            replacement_text = ' '.join(all_replacement_data)
-                        elif mf['name'] == 'join_bullets':
-                            replacement_text = '<ul><li>' + '</li><li>'.join(all_replacement_data) + '</li></ul>'
-                        elif mf['name'] == 'join_paragraphs':
-                            replacement_text = '<p>' + '</p><p>'.join(all_replacement_data) + '</p>'
-                        # do replacement
-                        if replacement_text is not None:
-                            return_text = return_text.replace(gmf_match, replacement_text)
+        Get instances from compile_text_template rather than directly, so they are shared.
+    """
     
-    if only_process_global_magic_formatters is False:
-        ### Find general fields
-        if re.search('\$(' + '|'.join(GENERAL_FIELDS.keys()) + ')\$', return_text) is not None:
-            for key, field in GENERAL_FIELDS.items():
-                if '${}$'.format(key) in return_text:
-                    return_text = return_text.replace('${}$'.format(key), datetime.now().strftime(field['format']))
+    def __init__(self, input, default_table_uuid='', enclosing_char='$', only_process_global_magic_formatters=False):
+        self.default_table_uuid = default_table_uuid
+        self.enclosing_char = enclosing_char
+        self.nodes = []
+        # Columns referenced by this template, keyed by column reference; values are tuples of (Column|None, loaded datetime)
+        self._columns = {}
+        # restore any encoded enclosing chars
+        text = input.replace(enclosing_char, '$')
+        # global magic formatters come first, and claim the column references inside them
+        spans = []
+        if re.search(utils.GLOBAL_MAGIC_FORMATTER_REFERENCE_PATTERN, text) is not None:
+            for mf in [m for m in MAGIC_FORMATTERS_LIST if m.get('enabled_for_global_magic')]:
+                mf_pattern = '\$\{\s*' + mf['name'] + '\s*.*?\}.*?\{\s*' + mf['name'] + '\s*\}\$'
+                for gmf_match in re.finditer(mf_pattern, text):
+                    if any(gmf_match.start() < end and start < gmf_match.end() for start, end, _node in spans):
+                        continue
+                    substitution_aggregation_mode, append_auth_user_mode = _parse_global_magic_formatter_config(gmf_match.group(0))
+                    spans.append((gmf_match.start(), gmf_match.end(), ('global_magic_formatter', {
+                        'name': mf['name'],
+                        'match': gmf_match.group(0),
+                        'substitution_aggregation_mode': substitution_aggregation_mode,
+                        'append_auth_user_mode': append_auth_user_mode,
+                        'column_references': [
+                            utils.clean_delimiter_from_column_references(r)
+                            for r in _find_column_references(enclosing_char, gmf_match.group(0))
+                        ]
+                    })))
+        position = 0
+        for start, end, node in sorted(spans, key=lambda s: s[0]):
+            self._tokenise(text[position:start], only_process_global_magic_formatters)
+            self.nodes.append(node)
+            position = end
+        self._tokenise(text[position:], only_process_global_magic_formatters)
     
-    ### Find standard column references
-    # find column references
-    column_references = _find_column_references(enclosing_char, return_text)
-    # set up helper objects
-    allow_html = 'false'
+    def _append_text(self, text):
+        if not text:
+            return
+        if self.nodes and self.nodes[-1][0] == 'text':
+            self.nodes[-1] = ('text', self.nodes[-1][1] + text)
+        else:
+            self.nodes.append(('text', text))
     
-    if only_process_global_magic_formatters:
-        column_references = []
+    def _tokenise(self, text, only_process_global_magic_formatters):
+        """Splits text outside of global magic formatters into general field, column and summary nodes."""
+        if only_process_global_magic_formatters:
+            self._append_text(text)
+            return
+        # general fields come before column references
+        position = 0
+        for general_field_match in re.finditer('\$(' + '|'.join(GENERAL_FIELDS.keys()) + ')\$', text):
+            self._tokenise_references(text[position:general_field_match.start()])
+            self.nodes.append(('general_field', general_field_match.group(1)))
+            position = general_field_match.end()
+        self._tokenise_references(text[position:])
     
-    # perform replacement
-    for column_reference in column_references:
-        column_loaded = False
-        column_reference = utils.clean_delimiter_from_column_references(column_reference)
-        if preloaded_columns and column_reference in preloaded_columns.keys():
-            column = preloaded_columns[column_reference]
-            column_loaded = True
+    def _tokenise_references(self, text):
+        if self.enclosing_char:
+            pattern = "(?:\$)[A-Z0-9a-z_\.]+(?:\$)"
         else:
+            pattern = "(?:\$?)[A-Z0-9a-z_\.]+(?:\$?)"
+        position = 0
+        for reference_match in re.finditer(pattern, text):
+            reference = reference_match.group(0)
+            if reference.startswith('$SMY_'):
+                if re.fullmatch(utils.DELIMITED_SUMMARY_REFERENCE_PATTERN, reference):
+                    self._append_text(text[position:reference_match.start()])
+                    self.nodes.append(('summary', reference))
+                    position = reference_match.end()
+                continue
+            self._append_text(text[position:reference_match.start()])
+            self.nodes.append(('column', (utils.clean_delimiter_from_column_references(reference), reference)))
+            position = reference_match.end()
+        self._append_text(text[position:])
+    
+    def _get_column(self, column_reference, preloaded_columns):
+        """Returns a loaded Column for column_reference, or None if it cannot be loaded.
+            Columns supplied by the caller in preloaded_columns take precedence, and the Column
+            used is added to preloaded_columns.
+        """
+        if column_reference in preloaded_columns.keys():
+            return preloaded_columns[column_reference]
+        cached = self._columns.get(column_reference)
+        if cached is None or (datetime.now() - cached[1]).total_seconds() >= TEXT_TEMPLATE_COLUMN_TTL_SECONDS:
             column = Column()
-            if column.load(column_reference=column_reference, default_table_uuid=default_table_uuid):
-                column_loaded = True
-                preloaded_columns[column_reference] = column
-        if column_loaded:
+            if not column.load(column_reference=column_reference, default_table_uuid=self.default_table_uuid):
+                column = None
+            cached = (column, datetime.now())
+            self._columns[column_reference] = cached
+        if cached[0] is not None:
+            preloaded_columns[column_reference] = cached[0]
+        return cached[0]
+    
+    def render(self, identifier, do_not_encode=False, preloaded_student_data=None, preloaded_columns=None, blank_replacement='', preloaded_student_data_instances=None):
+        """Substitutes the data of the specified student into this template.
+            See substitute_text_variables for arguments and return value.
+        """
+        if preloaded_student_data_instances is None:
+            preloaded_student_data_instances = {}
+        if len(preloaded_student_data_instances) == 0 and preloaded_student_data is not None:
+            preloaded_student_data_instances[ preloaded_student_data.table.config['uuid'] ] = preloaded_student_data
+        if preloaded_columns is None:
+            preloaded_columns = {}
+        identity_anonymiser_active = is_identity_anonymiser_active()
+        # scripts are returned in the order of global magic formatters, columns, then summaries
+        scripts = {
+            'global_magic_formatter': [],
+            'column': [],
+            'summary': []
+        }
+        # each distinct placeholder is only rendered once
+        rendered = {}
+        parts = []
+        for kind, value in self.nodes:
+            if kind == 'text':
+                parts.append(value.replace('$', self.enclosing_char) if self.enclosing_char != '$' else value)
+                continue
+            if kind == 'general_field':
+                parts.append(datetime.now().strftime(GENERAL_FIELDS[value]['format']))
+                continue
+            key = (kind, value['match'] if kind == 'global_magic_formatter' else value)
+            if key not in rendered.keys():
+                if kind == 'global_magic_formatter':
+                    rendered[key] = self._render_global_magic_formatter(value, identifier, do_not_encode, blank_replacement, preloaded_columns, preloaded_student_data_instances)
+                elif kind == 'column':
+                    rendered[key] = self._render_column(value[0], identifier, do_not_encode, blank_replacement, preloaded_columns, preloaded_student_data_instances, identity_anonymiser_active)
+                elif kind == 'summary':
+                    rendered[key] = self._render_summary(value, identifier, preloaded_columns, preloaded_student_data_instances)
+                scripts[kind].append(rendered[key][1])
+            replacement_text = rendered[key][0]
+            if replacement_text is None:
+                # leave as is
+                parts.append(value['match'] if kind == 'global_magic_formatter' else value[1] if kind == 'column' else value)
+            else:
+                parts.append(replacement_text)
+        return {
+            'new_text': ''.join(parts),
+            'scripts': ''.join(scripts['global_magic_formatter'] + scripts['column'] + scripts['summary'])
+        }
+    
+    def _render_global_magic_formatter(self, gmf, identifier, do_not_encode, blank_replacement, preloaded_columns, preloaded_student_data_instances):
+        """Returns a tuple of (replacement text or None, scripts) for a global magic formatter node."""
+        return_scripts = ''
+        all_replacement_data = []
+        for column_reference in gmf['column_references']:
+            column = self._get_column(column_reference, preloaded_columns)
+            if column is None:
+                continue
             allow_html = column.config['custom_options']['allow_html']
-            replacement_text = ''
             # get data
             student_data = _load_student_data_from_preload(identifier, column, preloaded_student_data_instances)
             if student_data._id:
                 if column.is_system_column:
                     column_config_reference = next(col for col in SYSTEM_COLUMNS if col['insert_value'].upper() == column_reference.upper())['name']
-                    replacement_text = student_data.config[column_config_reference]
-                    if identity_anonymiser_active:
-                        replacement_text = anonymise(column_config_reference, replacement_text)
+                    all_replacement_data.extend([student_data.config[column_config_reference]])
                 else:
-                    _replacement_data = _get_replacement_data(column, student_data, allow_html, do_not_encode, blank_replacement=blank_replacement)
-                    replacement_data = _replacement_data['replacement_data']
+                    _replacement_data = _get_replacement_data(column, student_data, allow_html, do_not_encode, gmf['substitution_aggregation_mode'], blank_replacement, gmf['append_auth_user_mode'])
+                    all_replacement_data.extend(_replacement_data['replacement_data'])
                     return_scripts += _replacement_data['scripts']
-                    # transform and present loaded data
-                    if column.magic_formatter == 'display' or column.magic_formatter == 'description':
-                        replacement_text = ' '.join(replacement_data)
-                    elif column.magic_formatter == 'image' and column.config['type'] == 'image':
-                        replacement_text = ''.join(replacement_data)
-                    elif column.magic_formatter == 'image' and column.config['type'] == 'imgurl':
-                        replacement_text = ''.join(replacement_data)
-                    elif column.magic_formatter == 'audio_player' and column.config['type'] == 'multiEntry':
-                        replacement_text = '<br>'.join(replacement_data)
-                    elif column.magic_formatter == 'file_download_links' and column.config['type'] == 'file':
-                        replacement_text = '<br>'.join(replacement_data)
-                    elif column.magic_formatter == 'file_download_links_bullets' and column.config['type'] == 'file':
-                        replacement_text = '<ul><li>' + '</li><li>'.join(replacement_data) + '</li></ul>'
-                    elif column.magic_formatter in ['join_space', 'join_bullets', 'join_paragraphs']:
-                        # remove empty elements
-                        replacement_data = [ x for x in replacement_data if x != '' ]
-                        # format
-                        if column.magic_formatter == 'join_space':
-                            replacement_text = ' '.join(replacement_data)
-                        elif column.magic_formatter == 'join_bullets':
-                            replacement_text = '<ul><li>' + '</li><li>'.join(replacement_data) + '</li></ul>'
-                        elif column.magic_formatter == 'join_paragraphs':
-                            replacement_text = '<p>' + '</p><p>'.join(replacement_data) + '</p>'
-                    elif column.magic_formatter and str(column.magic_formatter).startswith('round'):
-                        round_to = column.magic_formatter.replace('round', '')
-                        if utils.is_number(round_to) and utils.is_number(replacement_data[0]):
-                            replacement_text = str(utils.round_number(float(replacement_data[0]), round_to))
-                        else:
-                            replacement_text = replacement_data[0]
-                    else:
-                        replacement_text = replacement_data[0]
-                # do replacement
-                column_reference_to_find = '${}$'.format(column_reference)
-                return_text = return_text.replace('$', enclosing_char) # restore any unreplaced enclosing chars
-                if replacement_text is not None:
-                    # any final cleaning
-                    if column.config['custom_options'].get('newline_character_conversion', 'disabled') in [' ', '<br>']:
-                        newline_character = column.config['custom_options']['newline_character_conversion']
-                        if newline_character == '<br>':
-                            newline_character = Markup(newline_character)
-                        replacement_text = utils.replace_newline_characters(replacement_text, newline_character)
-                    if column.config['custom_options'].get('mojibake_conversion', 'enabled') == 'enabled':
-                        replacement_text = utils.replace_mojibake(replacement_text)
-                        replacement_text = utils.replace_quote_html_entities(replacement_text)
-                    # perform the replacement
-                    return_text = return_text.replace(column_reference_to_find, replacement_text)
-            else:
-                print('Could not find student', identifier)
-                # default to replacing in nothing
-                return_text = return_text.replace('${}$'.format(column_reference), '')
-        else:
-            logging.error('error loading column [{}]'.format(column_reference))
+        # transform and present loaded data
+        replacement_text = None
+        if gmf['name'] in ['join_space', 'join_bullets', 'join_paragraphs']:
+            # remove empty elements
+            all_replacement_data = [ x for x in all_replacement_data if x != '' ]
+            # format
+            if gmf['name'] == 'join_space':
+                replacement_text = ' '.join(all_replacement_data)
+            elif gmf['name'] == 'join_bullets':
+                replacement_text = '<ul><li>' + '</li><li>'.join(all_replacement_data) + '</li></ul>'
+            elif gmf['name'] == 'join_paragraphs':
+                replacement_text = '<p>' + '</p><p>'.join(all_replacement_data) + '</p>'
+        return replacement_text, return_scripts
     
-    if only_process_global_magic_formatters is False:
-        # find summary references
-        if '$SMY_' in return_text:
-            summary_references = _find_summary_references(return_text)
-            for summary_reference in summary_references:
-                summary = Summary()
-                summary_reference = summary_reference.replace('$', '').replace('SMY_', '')
-                if summary.load(summary_reference):
-                    # is grouping active?
-                    grouping_values = None
-                    if summary.is_grouping_active():
-                        # get the grouping column
-                        grouping_column_reference = summary.get_grouping_column_reference()
-                        column_loaded = False
-                        if preloaded_columns and grouping_column_reference in preloaded_columns.keys():
-                            column = preloaded_columns[grouping_column_reference]
-                            column_loaded = True
-                        else:
-                            column = Column()
-                            if column.load(column_reference=grouping_column_reference, default_table_uuid=default_table_uuid):
-                                column_loaded = True
-                                preloaded_columns[grouping_column_reference] = column
-                        if column_loaded:
-                            student_data = _load_student_data_from_preload(identifier, column, preloaded_student_data_instances)
-                            if student_data._id:
-                                _data = student_data.get_data(column.config['uuid'])
-                                if column.subfield is None:
-                                    grouping_values = [ _data['data'] ]
-                                else:
-                                    try:
-                                        _data = json.loads(_data['data'])
-                                        grouping_values = [ _data[column.subfield] ]
-                                    except:
-                                        logging.error('Could not get grouping value')
-                        else:
-                            logging.error('Could not load column to get grouping value')
-                    # prepare for the representation
-                    presentation_mode = summary.config['representation_config']['presentation']['mode']
-                    presentation_mode_extra_config = json.dumps(summary.config['representation_config']['presentation'].get('extra_config', {}))
-                    calculation_mode = summary.config['representation_config']['calculation']['mode']
-                    calculation_mode_extra_config = json.dumps(summary.config['representation_config']['calculation'].get('extra_config', {}))
-                    grouping_mode = summary.config['representation_config']['grouping']['mode']
-                    grouping_comparison_mode = summary.config['representation_config']['grouping']['comparison_mode']
-                    grouping_column_reference = summary.config['representation_config']['grouping']['column_reference']
-                    if type(summary.config['column_reference']) is str:
-                        summary_column_reference_encoded = summary.config['column_reference']
-                    elif type(summary.config['column_reference']) is list:
-                        summary_column_reference_encoded = parse.quote(','.join(summary.config['column_reference']))
-                    if presentation_mode.startswith('chart_'):
-                        representation_class = 'sres-summary-representation-chart'
-                        representation_styles = 'min-width:25vw; min-height:25vh;'
-                        representation_element = 'div'
-                    elif presentation_mode == 'wordcloud':
-                        representation_class = 'sres-summary-representation-wordcloud'
-                        representation_styles = 'width:100%; height:40vh;'
-                        representation_element = 'div'
-                    else:
-                        representation_class = ''
-                        representation_styles = ''
-                        representation_element = 'span'
-                    # add a span for the representation
-                    chart_id = 'representation_' + utils.create_uuid()
-                    summary_card_html = f"""<{representation_element} id="{chart_id}" class="{representation_class}" style="{representation_styles}"
-                        data-sres-presentation-mode="{presentation_mode}"
-                        data-sres-calculation-mode="{calculation_mode}"
-                        data-sres-grouping-mode="{grouping_mode}"
-                        data-sres-grouping-comparison-mode="{grouping_comparison_mode}"
-                        data-sres-grouping-column-reference="{grouping_column_reference}"
-                        data-sres-column-reference-encoded="{summary_column_reference_encoded}"
-                        data-sres-summary-uuid="{summary.config['uuid']}">
-                    """
-                    if grouping_values is not None:
-                        summary_card_html += """<select class="sres-summary-grouping-values"></select>"""
-                    summary_card_html += """<span class="fa fa-circle-notch spinning" aria-label="Loading..."></span></{representation_element}>"""
-                    return_text = return_text.replace( f"$SMY_{summary.config['uuid']}$", summary_card_html )
-                    # add a script to load the representation upon DOM ready
-                    return_scripts += f"""
-                        <script>
-                            $(document).ready(function(){{
-                                $('#{chart_id}').attr('data-sres-calculation-mode-extra-config', JSON.stringify({calculation_mode_extra_config}));
-                                $('#{chart_id}').attr('data-sres-presentation-mode-extra-config', JSON.stringify({presentation_mode_extra_config}));
-                    """
-                    if grouping_values is not None:
-                        for grouping_value in grouping_values:
-                            return_scripts += f"""$('#{chart_id}').find('.sres-summary-grouping-values').append('<option value="{grouping_value}">{grouping_value}</option>');"""
-                    return_scripts += f"""
-                                updateSummaryRepresentation('{chart_id}', false, true);
-                            }});
-                        </script>
-                    """
+    def _render_column(self, column_reference, identifier, do_not_encode, blank_replacement, preloaded_columns, preloaded_student_data_instances, identity_anonymiser_active):
+        """Returns a tuple of (replacement text or None, scripts) for a column node."""
+        column = self._get_column(column_reference, preloaded_columns)
+        if column is None:
+            logging.error('error loading column [{}]'.format(column_reference))
+            return None, ''
+        return_scripts = ''
+        allow_html = column.config['custom_options']['allow_html']
+        replacement_text = ''
+        # get data
+        student_data = _load_student_data_from_preload(identifier, column, preloaded_student_data_instances)
+        if not student_data._id:
+            print('Could not find student', identifier)
+            # default to replacing in nothing
+            return '', ''
+        if column.is_system_column:
+            column_config_reference = next(col for col in SYSTEM_COLUMNS if col['insert_value'].upper() == column_reference.upper())['name']
+            replacement_text = student_data.config[column_config_reference]
+            if identity_anonymiser_active:
+                replacement_text = anonymise(column_config_reference, replacement_text)
+        else:
+            _replacement_data = _get_replacement_data(column, student_data, allow_html, do_not_encode, blank_replacement=blank_replacement)
+            replacement_data = _replacement_data['replacement_data']
+            return_scripts += _replacement_data['scripts']
+            # transform and present loaded data
+            if column.magic_formatter == 'display' or column.magic_formatter == 'description':
+                replacement_text = ' '.join(replacement_data)
+            elif column.magic_formatter == 'image' and column.config['type'] == 'image':
+                replacement_text = ''.join(replacement_data)
+            elif column.magic_formatter == 'image' and column.config['type'] == 'imgurl':
+                replacement_text = ''.join(replacement_data)
+            elif column.magic_formatter == 'audio_player' and column.config['type'] == 'multiEntry':
+                replacement_text = '<br>'.join(replacement_data)
+            elif column.magic_formatter == 'file_download_links' and column.config['type'] == 'file':
+                replacement_text = '<br>'.join(replacement_data)
+            elif column.magic_formatter == 'file_download_links_bullets' and column.config['type'] == 'file':
+                replacement_text = '<ul><li>' + '</li><li>'.join(replacement_data) + '</li></ul>'
+            elif column.magic_formatter in ['join_space', 'join_bullets', 'join_paragraphs']:
+                # remove empty elements
+                replacement_data = [ x for x in replacement_data if x != '' ]
+                # format
+                if column.magic_formatter == 'join_space':
+                    replacement_text = ' '.join(replacement_data)
+                elif column.magic_formatter == 'join_bullets':
+                    replacement_text = '<ul><li>' + '</li><li>'.join(replacement_data) + '</li></ul>'
+                elif column.magic_formatter == 'join_paragraphs':
+                    replacement_text = '<p>' + '</p><p>'.join(replacement_data) + '</p>'
+            elif column.magic_formatter and str(column.magic_formatter).startswith('round'):
+                round_to = column.magic_formatter.replace('round', '')
+                if utils.is_number(round_to) and utils.is_number(replacement_data[0]):
+                    replacement_text = str(utils.round_number(float(replacement_data[0]), round_to))
                 else:
-                    logging.debug('could not load summary!')
+                    replacement_text = replacement_data[0]
+            else:
+                replacement_text = replacement_data[0]
+        if replacement_text is not None:
+            # any final cleaning
+            if column.config['custom_options'].get('newline_character_conversion', 'disabled') in [' ', '<br>']:
+                newline_character = column.config['custom_options']['newline_character_conversion']
+                if newline_character == '<br>':
+                    newline_character = Markup(newline_character)
+                replacement_text = utils.replace_newline_characters(replacement_text, newline_character)
+            if column.config['custom_options'].get('mojibake_conversion', 'enabled') == 'enabled':
+                replacement_text = utils.replace_mojibake(replacement_text)
+                replacement_text = utils.replace_quote_html_entities(replacement_text)
+        return replacement_text, return_scripts
     
-    # return
-    return {
-        'new_text': return_text,
-        'scripts': return_scripts
-    }
+    def _render_summary(self, summary_reference, identifier, preloaded_columns, preloaded_student_data_instances):
+        """Returns a tuple of (replacement text or None, scripts) for a summary node."""
+        return_scripts = ''
+        summary = Summary()
+        if not summary.load(summary_reference.replace('$', '').replace('SMY_', '')):
+            logging.debug('could not load summary!')
+            return None, ''
+        # is grouping active?
+        grouping_values = None
+        if summary.is_grouping_active():
+            # get the grouping column
+            grouping_column_reference = summary.get_grouping_column_reference()
+            column = self._get_column(grouping_column_reference, preloaded_columns)
+            if column is not None:
+                student_data = _load_student_data_from_preload(identifier, column, preloaded_student_data_instances)
+                if student_data._id:
+                    _data = student_data.get_data(column.config['uuid'])
+                    if column.subfield is None:
+                        grouping_values = [ _data['data'] ]
+                    else:
+                        try:
+                            _data = json.loads(_data['data'])
+                            grouping_values = [ _data[column.subfield] ]
+                        except:
+                            logging.error('Could not get grouping value')
+            else:
+                logging.error('Could not load column to get grouping value')
+        # prepare for the representation
+        presentation_mode = summary.config['representation_config']['presentation']['mode']
+        presentation_mode_extra_config = json.dumps(summary.config['representation_config']['presentation'].get('extra_config', {}))
+        calculation_mode = summary.config['representation_config']['calculation']['mode']
+        calculation_mode_extra_config = json.dumps(summary.config['representation_config']['calculation'].get('extra_config', {}))
+        grouping_mode = summary.config['representation_config']['grouping']['mode']
+        grouping_comparison_mode = summary.config['representation_config']['grouping']['comparison_mode']
+        grouping_column_reference = summary.config['representation_config']['grouping']['column_reference']
+        if type(summary.config['column_reference']) is str:
+            summary_column_reference_encoded = summary.config['column_reference']
+        elif type(summary.config['column_reference']) is list:
+            summary_column_reference_encoded = parse.quote(','.join(summary.config['column_reference']))
+        if presentation_mode.startswith('chart_'):
+            representation_class = 'sres-summary-representation-chart'
+            representation_styles = 'min-width:25vw; min-height:25vh;'
+            representation_element = 'div'
+        elif presentation_mode == 'wordcloud':
+            representation_class = 'sres-summary-representation-wordcloud'
+            representation_styles = 'width:100%; height:40vh;'
+            representation_element = 'div'
+        else:
+            representation_class = ''
+            representation_styles = ''
+            representation_element = 'span'
+        # add a span for the representation
+        chart_id = 'representation_' + utils.create_uuid()
+        summary_card_html = f"""<{representation_element} id="{chart_id}" class="{representation_class}" style="{representation_styles}"
+            data-sres-presentation-mode="{presentation_mode}"
+            data-sres-calculation-mode="{calculation_mode}"
+            data-sres-grouping-mode="{grouping_mode}"
+            data-sres-grouping-comparison-mode="{grouping_comparison_mode}"
+            data-sres-grouping-column-reference="{grouping_column_reference}"
+            data-sres-column-reference-encoded="{summary_column_reference_encoded}"
+            data-sres-summary-uuid="{summary.config['uuid']}">
+        """
+        if grouping_values is not None:
+            summary_card_html += """<select class="sres-summary-grouping-values"></select>"""
+        summary_card_html += """<span class="fa fa-circle-notch spinning" aria-label="Loading..."></span></{representation_element}>"""
+        # only a reference to the summary itself is replaced
+        replacement_text = summary_card_html if summary_reference == f"$SMY_{summary.config['uuid']}$" else None
+        # add a script to load the representation upon DOM ready
+        return_scripts += f"""
+            <script>
+                $(document).ready(function(){{
+                    $('#{chart_id}').attr('data-sres-calculation-mode-extra-config', JSON.stringify({calculation_mode_extra_config}));
+                    $('#{chart_id}').attr('data-sres-presentation-mode-extra-config', JSON.stringify({presentation_mode_extra_config}));
+        """
+        if grouping_values is not None:
+            for grouping_value in grouping_values:
+                return_scripts += f"""$('#{chart_id}').find('.sres-summary-grouping-values').append('<option value="{grouping_value}">{grouping_value}</option>');"""
+        return_scripts += f"""
+                    updateSummaryRepresentation('{chart_id}', false, true);
+                }});
+            </script>
+        """
+        return replacement_text, return_scripts
+
+def compile_text_template(input, default_table_uuid='', enclosing_char='$', only_process_global_magic_formatters=False):
+    """Returns a (shared) TextTemplate for input, compiling it only if it has not been compiled recently.
+        Templates are cached by a hash of their content and compilation arguments.
+    """
+    cache_key = hashlib.sha1(json.dumps([input, default_table_uuid, enclosing_char, only_process_global_magic_formatters]).encode()).hexdigest()
+    with _TEXT_TEMPLATE_CACHE_LOCK:
+        template = _TEXT_TEMPLATE_CACHE.get(cache_key)
+        if template is not None:
+            _TEXT_TEMPLATE_CACHE.move_to_end(cache_key)
+            return template
+    template = TextTemplate(input, default_table_uuid, enclosing_char, only_process_global_magic_formatters)
+    with _TEXT_TEMPLATE_CACHE_LOCK:
+        _TEXT_TEMPLATE_CACHE[cache_key] = template
+        while len(_TEXT_TEMPLATE_CACHE) > TEXT_TEMPLATE_CACHE_SIZE:
+            _TEXT_TEMPLATE_CACHE.popitem(last=False)
+    return template
+
+def invalidate_compiled_templates():
+    """Makes compiled text templates reload the Columns they reference, e.g. after a column is updated."""
+    with _TEXT_TEMPLATE_CACHE_LOCK:
+        for template in _TEXT_TEMPLATE_CACHE.values():
+            template._columns = {}
+
+def substitute_text_variables(input, identifier, default_table_uuid='', enclosing_char='$', do_not_encode=False, preloaded_student_data=None, preloaded_columns=None, blank_replacement='', preloaded_student_data_instances=None, only_process_global_magic_formatters=False):
+    """Replaces column references ('variables' in the supplied text) with their actual values.
+        The text is compiled once by compile_text_template and the compiled template reused.
+        
+        Args:
+            input (str): The text containing column references to be replaced, amongst other text.
+            identifier (str)
+            default_table_uuid (str): uuid
+            enclosing_char (str): The character prefix and suffix for column references.
+                If an empty string, then most words will look like a column reference so only use this
+                in certain circumstances.
+            do_not_encode (bool): If True, will not escape or get_text() on the returned text.
+            preloaded_student_data (StudentData): A loaded instance of StudentData, used for faster access to data.
+                A student's records must have been loaded already.
+            preloaded_columns (dict): dict of Column instances, keyed by column reference.
+            blank_replacement (any): Value to use if data cannot be found.
+            preloaded_student_data_instances (None or dict): Keyed by table_uuid, a dict of preloaded StudentData instances.
+                A student's record must have been loaded already in each of these instances.
+            only_process_global_magic_formatters (bool): Whether to only process the global magic formatters.
+        
+        Returns:
+            dict {
+                new_text (str): Substituted text
+                scripts (str): Any javascript needed for rendering
+            }
+    """
+
+    template = compile_text_template(input, default_table_uuid, enclosing_char, only_process_global_magic_formatters)
+    return template.render(
+        identifier,
+        do_not_encode=do_not_encode,
+        preloaded_student_data=preloaded_student_data,
+        preloaded_columns=preloaded_columns,
+        blank_replacement=blank_replacement,
+        preloaded_student_data_instances=preloaded_student_data_instances
+    )
+
 
 def _escape_substituted_text(input, do_not_encode, allow_html):
     if isinstance(input, list):
@@ -891,6 +1025,104 @@ def _is_username_allowed_access(auth_user_challenge, auth_users):
     else:
         return False
         
+def get_search_relevance(record, term):
+    """
+        Scores how well record (dict, db.data document) matches term (str): 2 for each word that
+        is a whole name or identifier token, 1 for each word that only starts one.
+    """
+    tokens = record.get(SEARCH_TOKENS_FIELD) or get_search_tokens(record)
+    score = 0
+    for word in _split_search_words(term):
+        if word in tokens:
+            score += 2
+        elif any(token.startswith(word) for token in tokens):
+            score += 1
+    return score
+
+def _split_search_words(s):
+    return [ w for w in re.split(r'[\W_]+', str(s).lower()) if w ]
+
+def get_search_tokens(record):
+    """
+        Returns a sorted list of lowercased tokens from the name and identifier fields of record (dict).
+        Values are split on anything not alphanumeric, so that jane.citizen@example.edu can be
+        found by searching for jane, citizen, example etc.
+    """
+    tokens = set()
+    for field in NAME_FIELDS + IDENTIFIER_FIELDS:
+        if record.get(field):
+            tokens.update(_split_search_words(record[field]))
+    return sorted(tokens)
+
+def get_search_tokens_filter(term, exact=False):
+    """
+        Returns a db.data filter (dict) for records with a search token starting with (or, if exact,
+        equal to) each word in term (str), or None if term has no words.
+    """
+    words = _split_search_words(term)
+    if not words:
+        return None
+    if exact:
+        return {SEARCH_TOKENS_FIELD: {'$all': words}}
+    else:
+        return {SEARCH_TOKENS_FIELD: {'$all': [ re.compile('^' + re.escape(w)) for w in words ]}}
+
+def find_by_search_tokens(db_filter, term, projection=None, limit=SEARCH_RESULTS_LIMIT):
+    """
+        Finds records in db.data that match db_filter (dict) and whose names or identifiers start
+        with the words in term (str). Records where all the words match exactly come first.
+        
+        Returns a list of up to limit (int) db.data documents.
+    """
+    results = []
+    seen_oids = set()
+    for exact in [True, False]:
+        tokens_filter = get_search_tokens_filter(term, exact=exact)
+        if tokens_filter is None or len(results) >= limit:
+            break
+        query = {'$and': [db_filter, tokens_filter]}
+        if seen_oids:
+            query['$and'].append({'_id': {'$nin': list(seen_oids)}})
+        for result in _get_db().data.find(query, projection).limit(limit - len(results)):
+            seen_oids.add(result['_id'])
+            results.append(result)
+    return results
+
+_SEARCH_TOKENS_ENSURED = set()
+
+def ensure_search_tokens(table_uuids=None):
+    """
+        Adds search tokens to records in db.data that predate them. Only checks each table
+        (or, if table_uuids is None, the whole collection) once per process.
+        
+        table_uuids (list of str|None)
+        
+        Returns the number of records updated.
+    """
+    keys = [None] if table_uuids is None else [ t for t in table_uuids if t not in _SEARCH_TOKENS_ENSURED ]
+    if not keys or None in _SEARCH_TOKENS_ENSURED:
+        return 0
+    db = _get_db()
+    query = {SEARCH_TOKENS_FIELD: {'$exists': False}}
+    if table_uuids is not None:
+        query['table_uuid'] = {'$in': keys}
+    count = 0
+    operations = []
+    for record in db.data.find(query, NAME_FIELDS + IDENTIFIER_FIELDS):
+        operations.append(UpdateOne(
+            {'_id': record['_id']},
+            {'$set': {SEARCH_TOKENS_FIELD: get_search_tokens(record)}}
+        ))
+        if len(operations) >= 1000:
+            db.data.bulk_write(operations, ordered=False)
+            count += len(operations)
+            operations = []
+    if operations:
+        db.data.bulk_write(operations, ordered=False)
+        count += len(operations)
+    _SEARCH_TOKENS_ENSURED.update(keys)
+    return count
+
 def search_students(term, table_uuid=None, column_uuid=None, preloaded_column=None, preloaded_student_data=None):
     from sres.tables import Table
     ret = {
@@ -935,10 +1167,20 @@ def search_students(term, table_uuid=None, column_uuid=None, preloaded_column=No
     if re.match('^[A-Za-z]{4}[0-9]{4}$', term):
         term_filters.append({'email': {'$regex': '^{}@uni.sydney.edu.au$'.format(term), '$options': 'i'}})
     # iterate through fields
-    for field in NAME_FIELDS + IDENTIFIER_FIELDS + additional_identifier_columns:
-        if allow_searching:
-            term_filters.append({field: {'$regex': '{}'.format(term), '$options': 'i'}})
+    if allow_searching:
+        # names and identifiers are searched by prefix through their search tokens
+        ensure_search_tokens([table.config['uuid']])
+        tokens_filter = get_search_tokens_filter(term)
+        if tokens_filter is not None:
+            term_filters.append(tokens_filter)
+            regex_fields = additional_identifier_columns
         else:
+            # no words to search for
+            regex_fields = NAME_FIELDS + IDENTIFIER_FIELDS + additional_identifier_columns
+        for field in regex_fields:
+            term_filters.append({field: {'$regex': '{}'.format(term), '$options': 'i'}})
+    else:
+        for field in NAME_FIELDS + IDENTIFIER_FIELDS + additional_identifier_columns:
             term_filters.append({field: {'$regex': '^{}$'.format(term), '$options': 'i'}})
     filters.append({'$or': term_filters})
     # students searching other students as part of peer data entry
@@ -948,7 +1190,7 @@ def search_students(term, table_uuid=None, column_uuid=None, preloaded_column=No
     if preloaded_column is not None and column.is_only_show_condition_enabled():
         filters.extend(column.get_db_filter_restrictors_for_only_show())
     # search db.data
-    results = db.data.find({'$and': filters})
+    results = db.data.find({'$and': filters}).limit(SEARCH_RESULTS_LIMIT)
     results = list(results)
     # prepare for return
     identity_anonymiser_active = is_identity_anonymiser_active()
@@ -970,9 +1212,11 @@ def search_students(term, table_uuid=None, column_uuid=None, preloaded_column=No
             _result['display_sid'] = result['sid']
             _result['fullname'] = '{} {}'.format(result.get('preferred_name', ''), result.get('surname', '')) if not anonymise_names else 'Anonymous'
             _result['fullgivenname'] = '{} {}'.format(result.get('given_names', ''), result.get('surname', '')) if not anonymise_names else 'Anonymous'
+        _result['_relevance'] = get_search_relevance(result, term)
         ret['search_results'].append(_result)
-    # sort
+    # sort, most relevant first
     ret['search_results'] = natsorted(ret['search_results'], key=lambda i: i['fullname'], alg=ns.IGNORECASE)
+    ret['search_results'] = sorted(ret['search_results'], key=lambda i: i.pop('_relevance'), reverse=True)
     # return
     return ret
 
@@ -1052,147 +1296,189 @@ def get_random_identifier_for_table(table_uuid, identifier_type='sid'):
 
 def run_aggregation_bulk(source_column_uuids, target_identifiers, override_username=None):
     """
-        Triggers the calculation of aggregators that aggregate the input columns.
+        Triggers the calculation of aggregators that aggregate the input columns, and of
+        the aggregators downstream of those, each once.
         
         source_column_uuids (list of string uuids)
         target_identifiers (list of string identifiers)
         override_username (string)
+        
+        Returns a dict keyed by the uuids of the aggregators that directly aggregate the input columns.
     """
-    t0 = datetime.now()
-    from sres.aggregatorcolumns import find_aggregators_of_columns, AggregatorColumn
+    from sres.aggregatorcolumns import find_aggregators_of_columns
+    from sres.aggregation_graph import run_aggregations
     aggregator_column_uuids = find_aggregators_of_columns(source_column_uuids)
-    #print('time for find_aggregators_of_columns', (datetime.now() - t0).total_seconds())
     ret = {}
     for aggregator_column_uuid in aggregator_column_uuids:
-        t0 = datetime.now()
         ret[aggregator_column_uuid] = {
             'successfully_aggregated': 0,
             'unsuccessfully_aggregated': 0
         }
-        aggregator_column = AggregatorColumn()
-        columns_already_traversed = []
-        if aggregator_column.load(aggregator_column_uuid):
-            if aggregator_column.config['aggregation_options']['recalculate_trigger'] != 'manual':
-                aggregation_results = aggregator_column.calculate_aggregation(
-                    identifiers=target_identifiers,
-                    auth_user_override=override_username,
-                    columns_already_traversed=columns_already_traversed
-                )
-                print('time for calculate_aggregation', (datetime.now() - t0).total_seconds())
-                for identifier, aggregation_result in aggregation_results.items():
-                    if aggregation_result['success']:
-                        ret[aggregator_column_uuid]['successfully_aggregated'] += 1
-                    else:
-                        ret[aggregator_column_uuid]['unsuccessfully_aggregated'] += 1
-                # log
-                logging.info("Completed bulk aggregation [{}] [{}] [{}]".format(
-                    aggregator_column_uuid,
-                    ret[aggregator_column_uuid]['successfully_aggregated'],
-                    ret[aggregator_column_uuid]['unsuccessfully_aggregated']
-                ))
-                print("Completed aggregation", aggregator_column_uuid, ret[aggregator_column_uuid]['successfully_aggregated'], ret[aggregator_column_uuid]['unsuccessfully_aggregated'])
+    all_aggregation_results = run_aggregations(
+        { aggregator_column_uuid: target_identifiers for aggregator_column_uuid in aggregator_column_uuids },
+        auth_user_override=override_username
+    )
+    for aggregator_column_uuid in aggregator_column_uuids:
+        for identifier, aggregation_result in all_aggregation_results.get(aggregator_column_uuid, {}).items():
+            if aggregation_result['success']:
+                ret[aggregator_column_uuid]['successfully_aggregated'] += 1
+            else:
+                ret[aggregator_column_uuid]['unsuccessfully_aggregated'] += 1
+        # log
+        logging.info("Completed bulk aggregation [{}] [{}] [{}]".format(
+            aggregator_column_uuid,
+            ret[aggregator_column_uuid]['successfully_aggregated'],
+            ret[aggregator_column_uuid]['unsuccessfully_aggregated']
+        ))
     return ret
 
-def _run_aggregation_single(identifier, column_uuid, columns_already_traversed=[], auth_user_override='', preloaded_columns=None):
-    """
-        Runs aggregation
-        
-        column_uuid (string) The aggregator column that needs to be recalculated
-        columns_already_traversed (list of string column_uuids)
-        auth_user_override (string??)
-        preloaded_columns
-        
-        Returns boolean of success
-    """
-    from sres.aggregatorcolumns import AggregatorColumn
-    if preloaded_columns is None:
-        preloaded_columns = {}
-    #logging.debug('in _run_aggregation_single ' + column_uuid + ' ' + identifier)
-    if column_uuid in preloaded_columns.keys():
-        aggregator_column = preloaded_columns[column_uuid]
-    else:
-        aggregator_column = AggregatorColumn()
-        aggregator_column.load(column_uuid)
-        preloaded_columns[column_uuid] = aggregator_column
-    if aggregator_column.column_loaded:
-        #logging.debug('calling calculate_aggregation [{}] [{}] [{}]'.format(aggregator_column.config['uuid'], aggregator_column.config['name'], str(columns_already_traversed)))
-        identifiers=[identifier]
-        # does this aggregator need to also be run for other identifiers?
-        if aggregator_column.config['aggregation_options']['method'] == 'self_peer_review':
-            # get the identifiers
-            student_data = StudentData(aggregator_column.table)
-            if student_data.find_student(identifier):
-                identifiers.extend( student_data.get_identifiers_for_students_in_same_group(
-                    aggregator_column.config['aggregation_options']['aggregator_type_self_peer_review_grouping_column']
-                ) )
-                identifiers = list(set(identifiers))
-        # run aggregation
-        result = aggregator_column.calculate_aggregation(
-            identifiers=identifiers,
-            columns_already_traversed=columns_already_traversed[:],
-            auth_user_override=auth_user_override,
-            preloaded_columns=preloaded_columns
-        )
-        return result[identifier]['success']
-    return False
-
-def _aggregation_consumer(args):
-    _run_aggregation_single(
-        identifier=args['identifier'],
-        column_uuid=args['column_uuid'],
-        columns_already_traversed=args['columns_already_traversed'],
-        auth_user_override=args['auth_user_override']
-    )
-def _remove_task_id(future):
-    cookie = DbCookie(future.sres_auth_user_override)
-    cookie.delete(future.sres_task_id)
-def _iterate_aggregated_by(identifier, aggregated_by, columns_already_traversed, auth_user_override, threaded_aggregation=False, task_id=None, preloaded_columns=None):
+def _iterate_aggregated_by(identifier, aggregated_by, columns_already_traversed, auth_user_override, threaded_aggregation=False, source_column_uuid=None, preloaded_columns=None):
     """Helper method to iterate through a column's aggregated_by (i.e. run aggregations of aggregator
-        columns that use the triggering column as a source). This method gives the option of running
-        these aggregations in sequential processes within a parallel thread.
+        columns that use the triggering column as a source). This method gives the option of queueing
+        these aggregations for the background workers of sres.aggregation_queue. Otherwise they, and
+        the aggregators downstream of them, are run in dependency order by run_aggregations.
+        
+        source_column_uuid (str|None) The column that changed; lets still_waiting_for_aggregation
+            find the queued aggregations.
     """
     if preloaded_columns is None:
         preloaded_columns = {}
     if threaded_aggregation:
-        # log that we are starting
-        if task_id:
-            cookie = DbCookie(auth_user_override)
-            cookie.set(
-                key=task_id,
-                value="running"
+        from sres.aggregation_queue import enqueue_aggregations
+        try:
+            enqueue_aggregations(
+                aggregated_by,
+                [identifier],
+                auth_user_override,
+                source_column_uuid=source_column_uuid
             )
+        except Exception as e:
+            logging.exception(e)
+            print(e)
+    else:
+        from sres.aggregation_graph import run_aggregations
         try:
-            with concurrent.futures.ProcessPoolExecutor() as executor:
-                for aggregator_column_uuid in aggregated_by:
-                    if len(aggregator_column_uuid.strip()) == 0:
-                        continue
-                    future = executor.submit(_aggregation_consumer, {
-                        'identifier': identifier,
-                        'column_uuid': aggregator_column_uuid, 
-                        'columns_already_traversed': columns_already_traversed, 
-                        'auth_user_override': auth_user_override
-                    })
-                    future.sres_auth_user_override = auth_user_override
-                    future.sres_task_id = task_id
-                    future.add_done_callback(_remove_task_id)
+            run_aggregations(
+                { aggregator_column_uuid: [identifier] for aggregator_column_uuid in aggregated_by if aggregator_column_uuid.strip() },
+                auth_user_override=auth_user_override,
+                preloaded_columns=preloaded_columns
+            )
         except Exception as e:
             logging.exception(e)
             print(e)
+
+_BULK_IDENTIFIER_CHUNK_SIZE = 5000
+
+def _identifier_types_for(identifier, table, additional_identifier_columns=None):
+    """Expands a single str identifier into an ordered dict of identifier_type: identifier
+        to try in turn when finding a student in table.
+        
+        additional_identifier_columns (list of str|None) Column uuids; looked up from table if None.
+    """
+    id_dict = {}
+    # special usyd codes; TODO must be refactored elsewhere
+    if re.match('^[A-Z0-9a-z]{2}[0-9]{9}[A-Za-z0-9]{4}$', identifier):
+        id_dict['sid'] = identifier[2:11]
+    elif re.match('^[A-Za-z]{4}[0-9]{4}$', identifier):
+        id_dict['email'] = '{}@uni.sydney.edu.au'.format(identifier)
+        id_dict['username'] = identifier
     else:
-        for aggregator_column_uuid in aggregated_by:
-            if len(aggregator_column_uuid.strip()) == 0:
-                continue
-            try:
-                _run_aggregation_single(
-                    identifier=identifier,
-                    column_uuid=aggregator_column_uuid, 
-                    columns_already_traversed=columns_already_traversed, 
-                    auth_user_override=auth_user_override,
-                    preloaded_columns=preloaded_columns
-                )
-            except Exception as e:
-                logging.exception(e)
-                print(e)
+        # find additional id columns
+        if additional_identifier_columns is None:
+            additional_identifier_columns = [col['uuid'] for col in table.get_additional_identifier_columns()]
+        for f in IDENTIFIER_FIELDS + additional_identifier_columns:
+            id_dict[f] = identifier
+    return id_dict
+
+def find_students_bulk(table, identifiers, projection=None):
+    """
+        Resolves many identifiers to students in table using one $in query per
+        identifier type, following the same precedence as StudentData.find_student
+        does for a single str identifier.
+        
+        table (Table, loaded)
+        identifiers (list of str)
+        projection (list of str|None) If provided, only these fields (plus identifier fields)
+            are fetched. The returned instances then hold partial data, but can still be save()d
+            because only changed fields are written.
+        
+        Returns a dict keyed by input identifier, with loaded StudentData instances as values.
+            Identifiers that resolve to the same student share one instance. Identifiers that
+            could not be resolved to exactly one student are omitted.
+    """
+    ret = {}
+    students_by_oid = {}
+    if table._id is None:
+        return ret
+    db = _get_db()
+    additional_identifier_columns = [col['uuid'] for col in table.get_additional_identifier_columns()]
+    # work out what to look for
+    id_dicts = {}
+    values_by_type = {}
+    for identifier in identifiers:
+        if identifier is None:
+            continue
+        _identifier = str(identifier)
+        if _identifier in id_dicts.keys():
+            continue
+        id_dicts[_identifier] = _identifier_types_for(_identifier, table, additional_identifier_columns)
+        for identifier_type, value in id_dicts[_identifier].items():
+            values_by_type.setdefault(identifier_type, set()).add(value)
+        # for the fallback primary identifier match
+        values_by_type.setdefault('sid', set()).add(_identifier)
+    if projection is not None:
+        projection = list(dict.fromkeys(NON_DATA_FIELDS + additional_identifier_columns + ['table', 'table_uuid'] + list(projection)))
+    # query each identifier type, indexing candidates by case-folded value
+    documents = {}
+    matches_by_type = {}
+    for identifier_type, values in values_by_type.items():
+        values = list(values)
+        matches_by_type[identifier_type] = {}
+        for i in range(0, len(values), _BULK_IDENTIFIER_CHUNK_SIZE):
+            results = db.data.find(
+                {
+                    'table_uuid': table.config['uuid'],
+                    identifier_type: {'$in': values[i:i + _BULK_IDENTIFIER_CHUNK_SIZE]}
+                },
+                projection,
+                collation=Collation(**CASE_INSENSITIVE_COLLATION)
+            )
+            for result in results:
+                documents[result['_id']] = result
+                if result.get(identifier_type) is None:
+                    continue
+                _matches = matches_by_type[identifier_type].setdefault(str(result[identifier_type]).casefold(), [])
+                if result['_id'] not in _matches:
+                    _matches.append(result['_id'])
+    # resolve each identifier in order of precedence
+    for identifier in identifiers:
+        if identifier is None:
+            continue
+        _identifier = str(identifier)
+        found_oid = None
+        for identifier_type, value in id_dicts[_identifier].items():
+            _matches = matches_by_type.get(identifier_type, {}).get(value.casefold(), [])
+            if len(_matches) == 1:
+                found_oid = _matches[0]
+                break
+        if found_oid is None:
+            # try force a primary identifier match i.e. to SID
+            _matches = matches_by_type.get('sid', {}).get(_identifier.casefold(), [])
+            if len(_matches) == 1:
+                found_oid = _matches[0]
+        if found_oid is not None:
+            if found_oid not in students_by_oid.keys():
+                student_data = StudentData(table)
+                student_data.load(documents[found_oid])
+                students_by_oid[found_oid] = student_data
+            ret[identifier] = students_by_oid[found_oid]
+    return ret
+
+def _identifier_equals(stored_value, identifier):
+    """Case-insensitive comparison that mirrors CASE_INSENSITIVE_COLLATION for identifiers."""
+    if stored_value is None:
+        return False
+    return str(stored_value).casefold() == str(identifier).casefold()
 
 def _modify_multientry_subfield(complete_data, subfield_n, subfield_data):
     """Modifies the data of a specific subfield.
@@ -1286,6 +1572,12 @@ class StudentData:
         self.config = deepcopy(STUDENT_DATA_DEFAULT_CONFIG)
         self.data = {}
         self._id = None
+        # what is in the db, for working out what has changed
+        self._saved_config = {}
+        self._saved_data = {}
+        self._version = None
+        # if a list, set_data(commit_immediately=False) collects change history here for save_many
+        self.change_history_buffer = None
     
     def find_student(self, identifiers, find_like=False, match_all=False):
         """
@@ -1316,17 +1608,7 @@ class StudentData:
                     id_dict[k] = str(v)
         else:
             identifiers = str(identifiers)
-            # special usyd codes; TODO must be refactored elsewhere
-            if re.match('^[A-Z0-9a-z]{2}[0-9]{9}[A-Za-z0-9]{4}$', identifiers):
-                id_dict['sid'] = identifiers[2:11]
-            elif re.match('^[A-Za-z]{4}[0-9]{4}$', identifiers):
-                id_dict['email'] = '{}@uni.sydney.edu.au'.format(identifiers)
-                id_dict['username'] = identifiers
-            else:
-                # find additional id columns
-                additional_identifier_columns = [col['uuid'] for col in self.table.get_additional_identifier_columns()]
-                for f in IDENTIFIER_FIELDS + additional_identifier_columns:
-                    id_dict[f] = str(identifiers)
+            id_dict = _identifier_types_for(identifiers, self.table)
         # search based on provided identifier(s)
         if id_dict and match_all:
             filter = {
@@ -1334,23 +1616,37 @@ class StudentData:
                 'table_uuid': self.table.config['uuid']
             }
             for k, v in id_dict.items():
-                regex = ('{}' if find_like else '^{}$').format(re.escape(v))
-                filter[k] = {'$regex': regex, '$options': 'i'}
-            results = self.db.data.find(filter)
-            results = list(results)
-        elif id_dict:
+                if find_like:
+                    filter[k] = {'$regex': re.escape(v), '$options': 'i'}
+                else:
+                    filter[k] = v
+            results = self._find_identifier_matches(filter, find_like)
+        elif id_dict and find_like:
             # loop through identifier types
             for identifier_type, identifier in id_dict.items():
                 filter = {
                     #'table': self.table._id,
                     'table_uuid': self.table.config['uuid'],
                     identifier_type: {
-                        '$regex': ('{}' if find_like else '^{}$').format(re.escape(identifier)),
-                        '$options': '-i'
+                        '$regex': re.escape(identifier),
+                        '$options': 'i'
                     }
                 }
-                results = self.db.data.find(filter)
-                results = list(results)
+                results = self._find_identifier_matches(filter, find_like)
+                if len(results) == 1:
+                    break
+        elif id_dict:
+            # exact matches for all identifier types in one indexed query, then
+            # take the first identifier type (in order) that matches exactly one student
+            filter = {
+                #'table': self.table._id,
+                'table_uuid': self.table.config['uuid'],
+                '$or': [ {k: v} for k, v in id_dict.items() ]
+            }
+            candidates = self._find_identifier_matches(filter, find_like)
+            results = []
+            for identifier_type, identifier in id_dict.items():
+                results = [ c for c in candidates if _identifier_equals(c.get(identifier_type), identifier) ]
                 if len(results) == 1:
                     break
         else:
@@ -1385,6 +1681,14 @@ class StudentData:
         else:
             return False
     
+    def _find_identifier_matches(self, filter, find_like=False):
+        """Runs filter against db.data. Exact matches are case-insensitive via collation
+            so that they can use the (table_uuid, identifier) indexes."""
+        if find_like:
+            return list(self.db.data.find(filter))
+        else:
+            return list(self.db.data.find(filter, collation=Collation(**CASE_INSENSITIVE_COLLATION)))
+    
     def load_from_oid(self, oid):
         if isinstance(oid, str):
             oid = ObjectId(oid)
@@ -1414,21 +1718,74 @@ class StudentData:
                 pass
         # load up data fields
         for key, value in db_result.items():
-            if key not in NON_DATA_FIELDS:
+            if key not in NON_DATA_FIELDS and key != SEARCH_TOKENS_FIELD and key != VERSION_FIELD:
                 self.data[key] = value
+        self._version = db_result.get(VERSION_FIELD)
+        self._mark_saved()
         return True
     
+    def _mark_saved(self):
+        """Records the current config and data as being what is in the db."""
+        self._saved_config = deepcopy(self.config)
+        self._saved_data = dict(self.data)
+    
+    def get_changed_fields(self):
+        """
+            Works out which fields have been changed since the student was loaded or saved.
+            
+            Returns a dict of field: new value.
+        """
+        changed = {}
+        for field in NON_DATA_FIELDS:
+            value = self.config.get(field)
+            if value is not None and value != self._saved_config.get(field):
+                changed[field] = value
+        for key, value in self.data.items():
+            if key not in self._saved_data or self._saved_data[key] != value:
+                changed[key] = value
+        return changed
+    
+    def _get_data_changes(self):
+        """
+            Lists the data values changed since the student was loaded or saved, for record_data_changes.
+            Only active students count towards column stats.
+            
+            Returns a list of tuples of (table_uuid, column_uuid, old value, new value).
+        """
+        if self.config.get('status') != 'active':
+            return []
+        return [
+            (self.table.config['uuid'], key, self._saved_data.get(key), self.data.get(key))
+            for key in set(self.data.keys()) | set(self._saved_data.keys())
+            if self._saved_data.get(key) != self.data.get(key)
+        ]
+    
+    def get_removed_fields(self):
+        """Returns a list of the data fields that have been removed since the student was loaded or saved."""
+        return [ key for key in self._saved_data.keys() if key not in self.data ]
+    
+    def _get_changes_update(self):
+        """Returns the update document for the changes since the student was loaded or saved, or None if unchanged."""
+        changed = self.get_changed_fields()
+        removed = self.get_removed_fields()
+        if not changed and not removed:
+            return None
+        if any(field in NON_DATA_FIELDS for field in changed.keys()):
+            changed[SEARCH_TOKENS_FIELD] = get_search_tokens(self.config)
+        update = {'$inc': {VERSION_FIELD: 1}}
+        if changed:
+            update['$set'] = changed
+        if removed:
+            update['$unset'] = { key: '' for key in removed }
+        return update
+    
     def reload(self):
         if self._id:
             return self.load_from_oid(self._id)
         return False
     
-    def save(self):
-        # if table identifiers are null... fail
-        if not self.table._id or not self.table.config['uuid']:
-            print('table not identified', self.table._id, self.table.config['uuid'])
-            return False
-        # set up record
+    def _get_record(self):
+        """Returns the complete db.data document for this student."""
         record = {
             'table': self.table._id,
             'table_uuid': self.table.config['uuid'] # make sure the table_uuid is saved
@@ -1440,18 +1797,154 @@ class StudentData:
         # add the data
         for key, value in self.data.items():
             record[key] = value
-        # save
-        result = self.db.data.update_one(
-            {
-                #'table': self.table._id,
+        record[SEARCH_TOKENS_FIELD] = get_search_tokens(record)
+        return record
+    
+    def save(self, check_version=False):
+        """
+            Saves the student. If the student was loaded from the db, only the fields that have
+            changed since are written. Otherwise the whole record is upserted.
+            
+            check_version (boolean) If True, only saves if nobody else has saved this student
+                through StudentData since it was loaded.
+            
+            Returns True if saved.
+        """
+        # if table identifiers are null... fail
+        if not self.table._id or not self.table.config['uuid']:
+            print('table not identified', self.table._id, self.table.config['uuid'])
+            return False
+        data_changes = self._get_data_changes()
+        if self._id is None:
+            # save everything
+            result = self.db.data.update_one(
+                {
+                    #'table': self.table._id,
+                    'table_uuid': self.table.config['uuid'],
+                    'sid': self.config['sid']
+                },
+                {
+                    '$set': self._get_record(),
+                    '$inc': {VERSION_FIELD: 1}
+                },
+                upsert=True
+            )
+            if result.upserted_id is not None:
+                self._id = result.upserted_id
+                self._version = 1
+            else:
+                self._version = None
+                # the previous values are unknown
+                data_changes = []
+        else:
+            # save changes only
+            update = self._get_changes_update()
+            if update is None:
+                return True
+            filter = {
                 'table_uuid': self.table.config['uuid'],
-                'sid': self.config['sid']
-            },
-            {'$set': record},
-            upsert=True
-        )
+                '_id': self._id
+            }
+            if check_version:
+                filter[VERSION_FIELD] = self._version if self._version is not None else {'$exists': False}
+            result = self.db.data.update_one(filter, update)
+            if result.matched_count == 0:
+                if check_version:
+                    logging.warning('StudentData.save version conflict [{}] [{}] [{}]'.format(self.table.config['uuid'], self.config['sid'], self._version))
+                else:
+                    logging.error('StudentData.save could not find student [{}] [{}]'.format(self.table.config['uuid'], self.config['sid']))
+                return False
+            self._version = (self._version or 0) + 1
+        if result.acknowledged:
+            self._mark_saved()
+            record_data_changes(data_changes)
         return result.acknowledged
     
+    @staticmethod
+    def save_many(student_datas):
+        """
+            Saves many students with one bulk write, then saves their buffered change history
+            with one insert.
+            
+            Students that have been loaded from the db only have their changed fields $set.
+            Students that have not been loaded are upserted in full, as for save().
+            
+            student_datas (list of StudentData)
+            
+            Returns a list of booleans, whether each of student_datas was saved.
+        """
+        # the same instance may be passed more than once, e.g. from aliased identifiers
+        unique_student_datas = list({ id(student_data): student_data for student_data in student_datas }.values())
+        if len(unique_student_datas) < len(student_datas):
+            saved = dict(zip([ id(student_data) for student_data in unique_student_datas ], StudentData.save_many(unique_student_datas)))
+            return [ saved[id(student_data)] for student_data in student_datas ]
+        results = [False] * len(student_datas)
+        data_changes = [ student_data._get_data_changes() for student_data in student_datas ]
+        operations = []
+        operation_indexes = []
+        for n, student_data in enumerate(student_datas):
+            if not student_data.table._id or not student_data.table.config['uuid']:
+                logging.error('save_many table not identified [{}]'.format(student_data.config['sid']))
+                continue
+            if student_data._id is None:
+                operations.append(UpdateOne(
+                    {
+                        'table_uuid': student_data.table.config['uuid'],
+                        'sid': student_data.config['sid']
+                    },
+                    {
+                        '$set': student_data._get_record(),
+                        '$inc': {VERSION_FIELD: 1}
+                    },
+                    upsert=True
+                ))
+            else:
+                update = student_data._get_changes_update()
+                if update is None:
+                    results[n] = True
+                    continue
+                operations.append(UpdateOne(
+                    {
+                        'table_uuid': student_data.table.config['uuid'],
+                        '_id': student_data._id
+                    },
+                    update
+                ))
+            operation_indexes.append(n)
+        if operations:
+            failed_operations = set()
+            try:
+                result = _get_db().data.bulk_write(operations, ordered=False)
+                upserted_ids = result.upserted_ids
+            except BulkWriteError as e:
+                logging.error('save_many bulk write errors [{}]'.format(str(e.details.get('writeErrors'))))
+                failed_operations = set([ error['index'] for error in e.details.get('writeErrors', []) ])
+                upserted_ids = { upserted['index']: upserted['_id'] for upserted in e.details.get('upserted', []) }
+            for operation_index, n in enumerate(operation_indexes):
+                if operation_index not in failed_operations:
+                    results[n] = True
+                    if operation_index in upserted_ids.keys():
+                        student_datas[n]._id = upserted_ids[operation_index]
+                        student_datas[n]._version = 1
+                    elif student_datas[n]._id is not None:
+                        student_datas[n]._version = (student_datas[n]._version or 0) + 1
+                    else:
+                        # matched an existing student, so the previous values are unknown
+                        data_changes[n] = []
+        # save change history of the students that were saved
+        change_history_records = {}
+        for n, student_data in enumerate(student_datas):
+            if results[n]:
+                student_data._mark_saved()
+                for record in student_data.change_history_buffer or []:
+                    change_history_records.setdefault(record['auth_user'], []).append(record)
+            if student_data.change_history_buffer is not None:
+                student_data.change_history_buffer = []
+        for auth_user, records in change_history_records.items():
+            change_history.save_change_history_bulk(records, auth_user)
+        record_data_changes([ c for n, changes in enumerate(data_changes) if results[n] for c in changes ])
+        return results
+    
     def add_single_student_from_scratch(self, username):
         ret = {
             'success': False,
@@ -1792,7 +2285,7 @@ class StudentData:
             preloaded_column (Column) A pre-loaded instance of Column to save processing.
             only_save_history_if_delta (boolean)
             skip_auth_checks (boolean) If True, assumes authorised.
-            threaded_aggregation (boolean) Whether to use threaded and multiprocessing aggregation.
+            threaded_aggregation (boolean) Whether to queue downstream aggregations for the background workers.
             preloaded_columns (dict of loaded Column instances keyed by column_uuid)
             report_index (int) For multiple reports mode
             authorised_as_student
@@ -1894,18 +2387,31 @@ class StudentData:
                     self.data[column_uuid] = data
                 # commit if necessary
                 if commit_immediately:
+                    previous_saved_data = self._saved_data.get(column_uuid)
+                    _set = {
+                        column_uuid: data
+                    }
+                    if column.is_system_column:
+                        _set[SEARCH_TOKENS_FIELD] = get_search_tokens(self.config)
                     result = self.db.data.update_one(
                         {
                             'table_uuid': self.table.config['uuid'],
                             '_id': self._id
                         },
                         {
-                            '$set': {
-                                column_uuid: data
-                            }
+                            '$set': _set,
+                            '$inc': {VERSION_FIELD: 1}
                         }
                     )
                     ret['success'] = result.acknowledged
+                    if result.acknowledged:
+                        if column.is_system_column:
+                            self._saved_config[column_uuid] = data
+                        else:
+                            self._saved_data[column_uuid] = data
+                            if self.config.get('status') == 'active':
+                                record_data_changes([(self.table.config['uuid'], column_uuid, previous_saved_data, data)])
+                        self._version = (self._version or 0) + 1
                 else:
                     # return
                     ret['success'] = True
@@ -1935,7 +2441,13 @@ class StudentData:
                             _record['report_number'] = _report_data['report_number']
                         ret['multiple_reports_meta']['index'] = _report_data['report_index']
                     # save to db
-                    self.save_change_history([_record], auth_user)
+                    if self.change_history_buffer is not None and not commit_immediately and not column.has_multiple_report_mode_enabled():
+                        # saved later by save_many
+                        _record['identifier'] = self.config['sid']
+                        _record['auth_user'] = auth_user
+                        self.change_history_buffer.append(_record)
+                    else:
+                        self.save_change_history([_record], auth_user)
                     # get meta on multiple reports
                     if column.has_multiple_report_mode_enabled():
                         _report_data = self.get_data_for_entry(column, report_index=report_index)
@@ -1953,7 +2465,7 @@ class StudentData:
                         columns_already_traversed,
                         auth_user,
                         threaded_aggregation,
-                        task_id=None if not threaded_aggregation else self._get_parallel_aggregation_task_id(column),
+                        source_column_uuid=column.config['uuid'],
                         preloaded_columns=preloaded_columns
                     )
                     ret['is_aggregated_by_others'] = True
@@ -2244,7 +2756,7 @@ class StudentData:
             original_column (Column, loaded) The column instance that contains the data to be shared around
             other_column_uuid (string) The column determining who to also share the data with
             notify_by_email (boolean) Whether to trigger send_notify_email
-            threaded_aggregation (boolean) Whether to calculate aggregations using parallelism
+            threaded_aggregation (boolean) Whether to queue aggregations for the background workers
             sdak (string|None)
             sda_mode (string)
             data_override (any, string, None) Data to use instead of existing data
@@ -2261,7 +2773,6 @@ class StudentData:
         }
         column = original_column
         other_column_uuid = utils.clean_uuid(other_column_uuid)
-        student_data = StudentData(self.table)
         if other_column_uuid:
             if other_column_uuid not in self.data.keys():
                 ret['messages'].append(("Could not find other students to apply data for.", "warning", 400))
@@ -2274,10 +2785,11 @@ class StudentData:
                     })
                     results = list(results)
                     _data = data_override if data_override is not None else self.data[column.config['uuid']]
+                    found_students = find_students_bulk(self.table, [ result['sid'] for result in results ])
                     for result in results:
-                        student_data._reset()
+                        student_data = found_students.get(result['sid'])
                         other_target_result = {}
-                        if student_data.find_student(result['sid']):
+                        if student_data is not None:
                             set_data_result = student_data.set_data(
                                 column_uuid=column.config['uuid'], 
                                 data=_data, 
@@ -2420,19 +2932,10 @@ class StudentData:
         current_groups = utils.force_interpret_str_to_list(self.data.get(grouping_column, ''))
         return any(str(current_group) in groups_to_check for current_group in current_groups)
     
-    def _get_parallel_aggregation_task_id(self, column):
-        return 'sres.column.aggregator.aggregation.parallel.t{}.c{}.i{}'.format(
-            column.table.config['uuid'],
-            column.config['uuid'],
-            self.config['sid']
-        )
-    
     def still_waiting_for_aggregation(self, column):
-        task_id = self._get_parallel_aggregation_task_id(column)
-        cookie = DbCookie()
-        if cookie.get(task_id):
-            return True
-        return False
+        """Whether aggregations triggered by a change to column are still queued or running for this student."""
+        from sres.aggregation_queue import is_aggregation_pending
+        return is_aggregation_pending(self.config['sid'], source_column_uuid=column.config['uuid'])
     
     def merge_with(self, other_student_data, mapping):
         available_columns = self.table.get_available_columns()
@@ -18,6 +18,7 @@ import json
 import random
 
 from sres.columns import Column
+from sres.column_stats import get_column_stats, get_value_counts
 from sres.db import _get_db
 from sres import utils
 from sres.auth import is_user_administrator
@@ -266,6 +267,33 @@ def table_uuids_from_summary_uuids(summary_uuids, existing_table_uuids_list=None
     # return
     return table_uuids
 
+def _get_data_series_from_column_stats(column):
+    """
+        Rebuilds the values of a column from its stats, instead of exporting the column's data.
+        
+        column (Column) Loaded Column instance
+        
+        Returns a pandas Series of the values of the active students (empty if there are none),
+        or None if the stats cannot stand in for the data.
+    """
+    if column.is_system_column or column.subfield is not None or column.magic_formatter is not None:
+        return None
+    if column.config['type'] in ['multiEntry', 'signinoutmemory'] or column.config.get('multientry_data_format') == True:
+        return None
+    stats = get_column_stats(column.table.config['uuid'], [column.config['uuid']]).get(column.config['uuid'])
+    if stats is None:
+        return None
+    value_counts = get_value_counts(stats, count_missing_as_empty=False)
+    if value_counts is None:
+        return None
+    if not value_counts:
+        return pandas.Series()
+    values = []
+    for value, count in value_counts.items():
+        values.extend([value] * count)
+    values.extend([numpy.nan] * stats.get('missing_count', 0))
+    return pandas.Series(values)
+
 class Representation:
     
     default_config = {
@@ -363,18 +391,27 @@ class Representation:
             data_series_ungrouped = None
         for column_reference in column_references:
             # continue
-            only_column_uuids = [ column_instances[column_reference].config['uuid'] ]
-            if using_grouping:
-                only_column_uuids.append(grouping_column.config['uuid'])
-            _source_data = column_instances[column_reference].table.export_data_to_df(
-                only_column_uuids=only_column_uuids,
-                do_not_rename_headers=True,
-                return_just_df=True
-            )
-            _df = pandas.DataFrame.from_dict(_source_data['data'])
-            # check there actually is data
-            if column_reference not in _df.columns:
-                # next column_reference please...
+            # without grouping, the values can be rebuilt from the column stats
+            _new_data_series = None
+            if not using_grouping:
+                _new_data_series = _get_data_series_from_column_stats(column_instances[column_reference])
+            if _new_data_series is None:
+                only_column_uuids = [ column_instances[column_reference].config['uuid'] ]
+                if using_grouping:
+                    only_column_uuids.append(grouping_column.config['uuid'])
+                _source_data = column_instances[column_reference].table.export_data_to_df(
+                    only_column_uuids=only_column_uuids,
+                    do_not_rename_headers=True,
+                    return_just_df=True
+                )
+                _df = pandas.DataFrame.from_dict(_source_data['data'])
+                # check there actually is data
+                if column_reference not in _df.columns:
+                    # next column_reference please...
+                    continue
+                _new_data_series = _df[column_reference]
+            elif _new_data_series.empty:
+                # no data; next column_reference please...
                 continue
             if using_grouping:
                 #_df = _df[_df[grouping_column_reference].isin(grouping_values)] # old way, not flexible
@@ -383,8 +420,8 @@ class Representation:
                 _df['__SRES_GROUPING_COLUMN__'] = _df[grouping_column_reference].map(utils.force_interpret_str_to_list)
                 _df['__SRES_GROUPING_MATCH__'] = _df['__SRES_GROUPING_COLUMN__'].apply(lambda x: any(y in x for y in grouping_values))
                 _df = _df[_df['__SRES_GROUPING_MATCH__']]
+                _new_data_series = _df[column_reference]
             # interpret multi-select data if relevant
-            _new_data_series = _df[column_reference]
             if column_instances[column_reference].is_multiple_selection_allowed():
                 _temp_data, _topology = utils.flatten_list( _new_data_series.to_list() )
                 _new_data_series = pandas.Series(_temp_data)
@@ -1,6 +1,8 @@
 from flask import g, session, current_app, escape, flash
 from flask_babel import gettext
 from bson.objectid import ObjectId
+from bson.son import SON
+from bson import BSON
 from copy import deepcopy, copy
 from natsort import natsorted, ns
 import json
@@ -11,16 +13,20 @@ import mimetypes
 import os
 import re
 from hashlib import sha512
+import itertools
+import collections
 import logging
 
-from sres.db import _get_db, DbCookie
+from sres.db import _get_db, DbCookie, NATURAL_SORT_COLLATION
+from sres.config_cache import get_cached_config, invalidate_cached_config
 from sres.auth import is_user_administrator, get_auth_user, get_auth_user_oid
 from sres import utils
 from sres.users import User, oids_to_usernames, usernames_to_oids
 from sres.columns import SYSTEM_COLUMNS, Column, column_uuid_to_oid, get_friendly_column_name, MAGIC_FORMATTERS_LIST, _is_student_direct_access_allowed
 from sres.files import get_file_access_url, GridFile
-from sres.studentdata import StudentData, NAME_FIELDS, IDENTIFIER_FIELDS, NON_DATA_FIELDS, run_aggregation_bulk, substitute_text_variables, _preload_columns
+from sres.studentdata import StudentData, SAVE_MANY_BATCH_SIZE, NAME_FIELDS, IDENTIFIER_FIELDS, NON_DATA_FIELDS, run_aggregation_bulk, substitute_text_variables, _preload_columns, find_students_bulk, ensure_search_tokens, get_search_tokens_filter, SEARCH_TOKENS_FIELD, _split_search_words
 from sres.anonymiser import anonymise, is_identity_anonymiser_active
+from sres.column_stats import invalidate_column_stats
 
 USER_ROLES = [
 	{
@@ -337,48 +343,47 @@ def rereference_columns_suggestions(target_table_uuid, existing_columns):
         ret['success'] = True
     return ret
 
-def _file_import_read_file_to_df(table_uuid, filename, skiprows=None, nrows=None, make_pickle=False, use_pickle=False):
+# Rows parsed from an import file are cached in db.import_chunks, in documents of at most
+# this many rows (or this many encoded bytes of rows), so each import step only loads its own rows
+FILE_IMPORT_CHUNK_ROWS = 500
+FILE_IMPORT_CHUNK_BYTES = 4 * 1024 * 1024
+# How much of a delimited file is used to detect its encoding
+FILE_IMPORT_ENCODING_SAMPLE_BYTES = 1024 * 1024
+
+def _file_import_cache_key(table_uuid, filename):
+    return utils.encrypt_to_hex(filename + table_uuid)
+
+def _file_import_row_to_dict(headers, values):
+    """Makes a row of values into a dict keyed by headers, in the same way as csv.DictReader."""
+    row = dict(zip(headers, values))
+    if len(values) > len(headers):
+        row[None] = values[len(headers):]
+    elif len(values) < len(headers):
+        for header in headers[len(values):]:
+            row[header] = None
+    return row
+
+def _file_import_iterate_rows(filename):
     """
-        Generic input spreadsheet reader.
+        Parses an uploaded spreadsheet from GridFS.
         
-        table_uuid (string) Associated uuid of table that data will be placed into.
-            Used to form part of the pickled data filename.
         filename (string) The source filename; this is typically already a UUID.
-        skiprows (int) Row of the input file to start on, 0-indexed.
-        nrows (int) Rows to read.
-        make_pickle (bool) Whether to save the parsed spreadsheet as a pickle.
-        use_pickle (bool) Whether to use a saved pickle instead of re-parsing the spreadsheet.
         
-        Returns 'df' which is actually a list of dicts. Naming is a hangover from when pandas was 
-        used for this method.
+        Returns a tuple of the headers (list) and an iterator of rows, each a list of values.
     """
-    import pickle
-    pickle_fn = utils.encrypt_to_hex(filename + table_uuid)
-    
-    if use_pickle:
-        
-        logging.debug("Loading pickle for [{}]".format(filename))
-        gf = GridFile('temp')
-        if gf.find_and_load(pickle_fn):
-            df = pickle.loads(gf.get_file().read())
-            
-    else:
-    
-        from chardet.universaldetector import UniversalDetector
-        # get gridfs
-        gf = GridFile('temp')
-        gf.find_and_load(filename)
-        # guess mimetype from filename
-        mime_type = utils.guess_mime_type(filename)
-        ext = filename.split('.')[-1].lower()
-        # read
-        if ext != 'csv' and (mime_type == 'application/vnd.ms-excel' or mime_type == 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet' or ext == 'xlsx' or ext == 'xls'):
-            logging.debug('read excel')
-            import xlrd
-            wb = xlrd.open_workbook(file_contents=gf.get_file().read())
-            sheet = wb.sheet_by_index(0)
-            file_data = []
-            headers = [cell.value for cell in sheet.row(0)]
+    gf = GridFile('temp')
+    gf.find_and_load(filename)
+    # guess mimetype from filename
+    mime_type = utils.guess_mime_type(filename)
+    ext = filename.split('.')[-1].lower()
+    # read
+    if ext != 'csv' and (mime_type == 'application/vnd.ms-excel' or mime_type == 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet' or ext == 'xlsx' or ext == 'xls'):
+        logging.debug('read excel')
+        import xlrd
+        wb = xlrd.open_workbook(file_contents=gf.get_file().read())
+        sheet = wb.sheet_by_index(0)
+        headers = [cell.value for cell in sheet.row(0)]
+        def _iterate_sheet():
             for row in range(1, sheet.nrows):
                 row_data = []
                 for cell in sheet.row(row):
@@ -392,71 +397,157 @@ def _file_import_read_file_to_df(table_uuid, filename, skiprows=None, nrows=None
                         if c.endswith('.0'):
                             c = c[:-2]
                         row_data.append(c)
-                value_dict = dict(zip(headers, row_data))
                 if len(''.join(row_data)) == 0:
                     continue
-                file_data.append(value_dict)
-            df = file_data
-        else:
-            logging.debug('read dsv')
-            import csv
-            # try detect encoding, and read file lines into temp var
-            detector = UniversalDetector()
-            file_lines = []
-            _first_line = ''
+                yield row_data
+        return headers, _iterate_sheet()
+    else:
+        logging.debug('read dsv')
+        import csv
+        from chardet.universaldetector import UniversalDetector
+        # try detect encoding from the start of the file
+        detector = UniversalDetector()
+        sample_bytes = 0
+        try:
+            s = gf.open_stream()
             try:
-                s = gf.open_stream()
                 line = s.readline()
-                _first_line = deepcopy(line)
-                while line:
-                    if not detector.done:
-                        detector.feed(line)
-                    file_lines.append(line)
+                while line and not detector.done and sample_bytes < FILE_IMPORT_ENCODING_SAMPLE_BYTES:
+                    detector.feed(line)
+                    sample_bytes += len(line)
                     line = s.readline()
-            except Exception as e:
-                logging.exception(e)
-                raise
-            detector.close()
-            encoding = detector.result['encoding']
-            logging.debug('encoding ' + str(encoding))
-            # read
-            file_data = []
+            finally:
+                s.close()
+        except Exception as e:
+            logging.exception(e)
+            raise
+        detector.close()
+        encoding = detector.result['encoding'] or 'utf-8'
+        logging.debug('encoding ' + str(encoding))
+        # decode lines as they are streamed
+        s = gf.open_stream()
+        try:
+            decoded_file_lines = (line.decode(encoding) for line in iter(s.readline, b''))
+            # sniff dialect
+            logging.debug('sniffing dialect')
+            first_lines = list(itertools.islice(decoded_file_lines, 5))
+            try:
+                dialect = csv.Sniffer().sniff('\r'.join(first_lines))
+            except csv.Error:
+                # try just with the first line
+                dialect = csv.Sniffer().sniff(first_lines[0] if first_lines else '')
+            reader = csv.reader(itertools.chain(first_lines, decoded_file_lines), dialect=dialect)
+            headers = next(reader, [])
+        except:
+            s.close()
+            raise
+        def _iterate_reader():
             try:
-                logging.debug('opening dsv')
-                # decode 
-                decoded_file_lines = []
-                for line in file_lines:
-                    decoded_file_lines.append(line.decode(encoding))
-                # sniff dialect
-                logging.debug('sniffing dialect')
-                try:
-                    dialect = csv.Sniffer().sniff('\r'.join(decoded_file_lines[:5]))
-                except csv.Error:
-                    # try just with the first line
-                    dialect = csv.Sniffer().sniff(_first_line.decode(encoding))
-                #logging.debug('dialect ' + str(dialect.doublequote) + ' ' + str(dialect.escapechar) + ' ' + str(dialect.quoting))
-                # read
-                reader = csv.DictReader(decoded_file_lines, dialect=dialect)
-                logging.debug('iterating file')
                 for row in reader:
-                    file_data.append(row)
-            except Exception as e:
-                logging.exception(e)
-                raise
-            logging.debug('making df')
-            df = file_data
+                    # skip blank lines, like csv.DictReader
+                    if row != []:
+                        yield row
+            finally:
+                s.close()
+        return headers, _iterate_reader()
+
+def _file_import_write_cache(cache_key, headers, rows):
+    """
+        Saves rows to db.import_chunks as they pass through.
+        
+        cache_key (string) From _file_import_cache_key.
+        headers (list)
+        rows (iterator of lists) Rows of values, which are yielded back unchanged.
+    """
+    db = _get_db()
+    db.import_chunks.delete_many({'cache_key': cache_key})
+    created = datetime.now()
+    chunk_rows = []
+    chunk_bytes = 0
+    row_start = 0
     
-    if make_pickle:
-        logging.debug("Making pickle for [{}]".format(filename))
-        gf = GridFile('temp')
-        if not gf.save_file(file=pickle.dumps(df), filename=pickle_fn, content_type='text/plain'):
-            logging.error("Failed making pickle in _file_import_read_file_to_df [{}]".format(filename))
+    def _save_chunk():
+        db.import_chunks.insert_one({
+            'cache_key': cache_key,
+            'row_start': row_start,
+            'row_end': row_start + len(chunk_rows),
+            'headers': headers,
+            'rows': chunk_rows,
+            'created': created
+        })
+    
+    for values in rows:
+        row_bytes = len(BSON.encode({'row': values}))
+        # save what is pending first if this row would take the chunk past either limit
+        if chunk_rows and (len(chunk_rows) >= FILE_IMPORT_CHUNK_ROWS or chunk_bytes + row_bytes > FILE_IMPORT_CHUNK_BYTES):
+            _save_chunk()
+            row_start += len(chunk_rows)
+            chunk_rows = []
+            chunk_bytes = 0
+        chunk_rows.append(values)
+        chunk_bytes += row_bytes
+        yield values
+    if chunk_rows:
+        _save_chunk()
+
+def _file_import_read_cache(cache_key, skiprows=None, nrows=None):
+    """Loads the rows cached by _file_import_write_cache, only reading the chunks that are needed."""
+    db = _get_db()
+    filter = {'cache_key': cache_key}
+    if skiprows is not None and nrows is not None:
+        filter['row_start'] = {'$lt': skiprows + nrows}
+        filter['row_end'] = {'$gt': skiprows}
+    df = []
+    for chunk in db.import_chunks.find(filter).sort('row_start', 1):
+        for row_number, values in enumerate(chunk['rows'], start=chunk['row_start']):
+            if skiprows is None or nrows is None or skiprows <= row_number < skiprows + nrows:
+                df.append(_file_import_row_to_dict(chunk['headers'], values))
+    return df
+
+def _file_import_cached_row_count(table_uuid, filename):
+    """Returns the number of rows cached for an import file."""
+    db = _get_db()
+    last_chunk = db.import_chunks.find_one(
+        {'cache_key': _file_import_cache_key(table_uuid, filename)},
+        ['row_end'],
+        sort=[('row_start', -1)]
+    )
+    return last_chunk['row_end'] if last_chunk else 0
+
+def _file_import_read_file_to_df(table_uuid, filename, skiprows=None, nrows=None, make_cache=False, use_cache=False):
+    """
+        Generic input spreadsheet reader.
+        
+        table_uuid (string) Associated uuid of table that data will be placed into.
+            Used to form part of the cache key.
+        filename (string) The source filename; this is typically already a UUID.
+        skiprows (int) Row of the input file to start on, 0-indexed.
+        nrows (int) Rows to read.
+        make_cache (bool) Whether to save the parsed spreadsheet in chunks to db.import_chunks.
+        use_cache (bool) Whether to use the saved chunks instead of re-parsing the spreadsheet.
+        
+        Returns 'df' which is actually a list of dicts. Naming is a hangover from when pandas was 
+        used for this method.
+    """
+    cache_key = _file_import_cache_key(table_uuid, filename)
+    
+    if use_cache:
+        logging.debug("Loading cached chunks for [{}]".format(filename))
+        return _file_import_read_cache(cache_key, skiprows, nrows)
+    
+    headers, rows = _file_import_iterate_rows(filename)
+    if make_cache:
+        logging.debug("Caching chunks for [{}]".format(filename))
+        rows = _file_import_write_cache(cache_key, headers, rows)
     
     logging.debug('returning')
     if skiprows is not None and nrows is not None:
-        return df[skiprows:skiprows+nrows]
-    else:
+        df = [ _file_import_row_to_dict(headers, values) for values in itertools.islice(rows, skiprows, skiprows + nrows) ]
+        # finish reading the file so that it is all cached
+        collections.deque(rows, maxlen=0)
         return df
+    else:
+        return [ _file_import_row_to_dict(headers, values) for values in rows ]
 
 class Table:
     
@@ -487,7 +578,10 @@ class Table:
         self._id = None
     
     def load(self, table_uuid=None, table_oid=None, preloaded_db_result=None):
-        if preloaded_db_result is None:
+        if preloaded_db_result is None and table_oid is None and table_uuid:
+            result = get_cached_config('tables', table_uuid)
+            result = [result] if result is not None else []
+        elif preloaded_db_result is None:
             db = _get_db()
             filter = {}
             if table_uuid is not None:
@@ -511,7 +605,8 @@ class Table:
     
     def update(self, override_username=None):
         if self.is_user_authorised(username=override_username):
-            result = self.db.tables.update_one({'uuid': self.config['uuid']}, {'$set': self.config})
+            result = self.db.tables.update_one({'uuid': self.config['uuid']}, {'$set': self.config, '$inc': {'_config_version': 1}})
+            invalidate_cached_config('tables', [self.config['uuid']])
             return result.acknowledged
         return False
     
@@ -1008,6 +1103,13 @@ class Table:
         results = self.db.columns.find({'table_uuid': self.config['uuid'], 'custom_options.additional_identifier': 'true'})
         return list(results)
     
+    def find_students_bulk(self, identifiers):
+        """
+            Finds many students in this table at once.
+            Returns a dict keyed by identifier, with loaded StudentData instances as values.
+        """
+        return find_students_bulk(self, identifiers)
+    
     def get_select_array(self, show_collapsed_multientry_option=False, data_type=None, only_column_uuids=None, hide_multientry_subfields=False, sda_only=False, get_text_only=False):
         """
             Returns an array of dicts, specifically for display in column selection UI.
@@ -1185,15 +1287,27 @@ class Table:
         # make all inactive
         if remove_not_present:
             self.db.data.update_many({'table_uuid': self.config['uuid']}, {'$set': {'status': 'inactive'}})
-        # iterate through input
-        student = StudentData(self)
+        # iterate through input, saving students in batches
         fields = NAME_FIELDS + IDENTIFIER_FIELDS
         fields.remove('sid')
+        students_to_save = []
+        sids_to_save = set()
+        def _save_students():
+            save_results = StudentData.save_many([ student for sid, student in students_to_save ])
+            for (sid, student), save_result in zip(students_to_save, save_results):
+                ret['save_results'][student.config['sid']] = save_result
+                if not save_result:
+                    ret['messages'].append(('Unexpected error saving details for student {}.'.format(sid), 'warning'))
+            students_to_save.clear()
+            sids_to_save.clear()
         for index, row in enumerate(df):
-            student._reset()
+            student = StudentData(self)
             _student_found = False
             try:
                 if row[mapping['sid']['field']] is not None and row[mapping['sid']['field']] != '':
+                    if str(row[mapping['sid']['field']]).casefold() in sids_to_save:
+                        # student appears again, so save what is pending first
+                        _save_students()
                     _student_found = student.find_student(identifiers={ 'sid': row[mapping['sid']['field']] })
                     if overwrite_details:
                         if _student_found:
@@ -1217,16 +1331,19 @@ class Table:
                         # don't overwrite details
                         pass
                     student.config['status'] = 'active'
-                    save_result = student.save()
-                    ret['save_results'][student.config['sid']] = save_result
-                    if not save_result:
-                        ret['messages'].append(('Unexpected error saving details for student {}.'.format(row[mapping['sid']['field']]), 'warning'))
+                    students_to_save.append((row[mapping['sid']['field']], student))
+                    sids_to_save.add(str(row[mapping['sid']['field']]).casefold())
+                    if len(students_to_save) >= SAVE_MANY_BATCH_SIZE:
+                        _save_students()
                 else:
                     ret['messages'].append(('A student did not have a student identifier so could not be added. Data: {}'.format(str(row)), 'warning'))
             except Exception as e:
                 ret['messages'].append(('Unexpected error saving details for student {}.'.format(row[mapping['sid']['field']]), 'warning'))
                 logging.error('_update_enrollments could not add student [{}] [{}]'.format(self.config['uuid'], str(row)))
                 logging.exception(e)
+        _save_students()
+        # statuses were changed in bulk above, so the incremental stats no longer hold
+        invalidate_column_stats(self.config['uuid'])
         # get now active
         ret['now_active'] = len(self.get_all_students_oids())
         return ret
@@ -1250,7 +1367,7 @@ class Table:
       
     def preprocess_file_import(self, new_filename):
         # read file to df
-        df = _file_import_read_file_to_df(self.config['uuid'], new_filename, nrows=10, make_pickle=True)
+        df = _file_import_read_file_to_df(self.config['uuid'], new_filename, skiprows=0, nrows=10, make_cache=True)
         # see if any column headers in dbcookie
         db_cookie = DbCookie()
         remembered_mappings = {}
@@ -1270,7 +1387,7 @@ class Table:
         _headers = list(df[0].keys())
         #_data_head = df.head().to_json()
         _data_head = json.dumps({k: [r[k] for r in df[:5]] for k in df[0]}, default=str)
-        _row_count = len(df)
+        _row_count = _file_import_cached_row_count(self.config['uuid'], new_filename)
         return {
             'headers': _headers,
             'data_head': _data_head,
@@ -1300,12 +1417,11 @@ class Table:
             filename=filename,
             skiprows=row_start,
             nrows=rows_to_process,
-            use_pickle=True
+            use_cache=True
         )
         
         ret = {}
         table = self
-        student_data = StudentData(table)
         db_cookie = DbCookie()
         records_saved = 0
         records_error = 0
@@ -1343,14 +1459,26 @@ class Table:
         identifier_header = list(df[0].keys())[identifier_header_index]
         auth_user_override = get_auth_user()
         t0 = datetime.now()
+        found_students = self.find_students_bulk([ str(row[identifier_header]).strip() for row in df ])
+        # rows are saved in batches; rows for the same student share one StudentData instance
+        rows_to_save = []
+        save_results = []
+        def _save_rows():
+            save_results.extend(zip(
+                [ identifier for identifier, student_data in rows_to_save ],
+                StudentData.save_many([ student_data for identifier, student_data in rows_to_save ])
+            ))
+            rows_to_save.clear()
         for index, row in enumerate(df):
-            student_data._reset()
             identifier = str(row[identifier_header]).strip()
             ret[identifier] = {
                 'success': False,
                 'messages': []
             }
-            if student_data.find_student(identifier):
+            student_data = found_students.get(identifier)
+            if student_data is not None:
+                if student_data.change_history_buffer is None:
+                    student_data.change_history_buffer = []
                 for i, column_to_import in columns_to_import.items():
                     if row.get(column_to_import['header']):
                         data = row[column_to_import['header']]
@@ -1366,17 +1494,22 @@ class Table:
                         skip_auth_checks=True,
                         auth_user_override=auth_user_override
                     )
-                # then save
-                if student_data.save():
-                    ret[identifier]['success'] = True
-                    records_saved += 1
-                else:
-                    ret[identifier]['messages'].append(("Unexpected error saving data for identifier {}.".format(identifier), "warning"))
-                    records_error += 1
+                # then save, in batches
+                rows_to_save.append((identifier, student_data))
+                if len(rows_to_save) >= SAVE_MANY_BATCH_SIZE:
+                    _save_rows()
             else:
                 ret[identifier]['messages'].append(("Could not find student with identifier {}.".format(identifier), "warning"))
                 records_error += 1
-        logging.debug('finished student_data.save')
+        _save_rows()
+        for identifier, save_result in save_results:
+            if save_result:
+                ret[identifier]['success'] = True
+                records_saved += 1
+            else:
+                ret[identifier]['messages'].append(("Unexpected error saving data for identifier {}.".format(identifier), "warning"))
+                records_error += 1
+        logging.debug('finished StudentData.save_many')
         
         t0 = datetime.now()
         # then calculate aggregations all together now
@@ -1816,6 +1949,31 @@ class Table:
     def list_make_doc_templates(self):
         return self.config['printout_templates']
 
+# Most rows matched by a global search of a table view
+TABLE_SEARCH_RESULTS_LIMIT = 1000
+# Field the pipeline in TableView.load_data ranks global search matches by
+_SEARCH_RELEVANCE_FIELD = '_search_relevance'
+
+# Counts of all the records in each table, keyed by table_uuid; see _get_table_records_total
+_TABLE_RECORDS_TOTALS = {}
+_TABLE_RECORDS_TOTALS_TTL = timedelta(seconds=60)
+
+def _get_table_records_total(table_uuid):
+    """
+        Returns the number of records (int) in db.data for the specified table, regardless of status.
+        Counts are cached briefly since they are only needed for display.
+    """
+    cached = _TABLE_RECORDS_TOTALS.get(table_uuid)
+    if cached is not None and datetime.now() - cached['timestamp'] < _TABLE_RECORDS_TOTALS_TTL:
+        return cached['count']
+    db = _get_db()
+    count = db.data.count_documents({'table_uuid': table_uuid})
+    _TABLE_RECORDS_TOTALS[table_uuid] = {
+        'count': count,
+        'timestamp': datetime.now()
+    }
+    return count
+
 class TableView:
     
     config = {}
@@ -2080,15 +2238,23 @@ class TableView:
             filters.append({
                 'status': 'active'
             })
+        search_words = []
         if global_search != '':
-            global_filters = []
-            for allowed_column_name in allowed_column_names:
-                global_filters.append({
-                    str(allowed_column_name): {'$regex': '{}'.format(global_search), '$options': 'i'}
+            # names and identifiers are searched by prefix through their indexed search tokens
+            ensure_search_tokens([self.table.config['uuid']])
+            tokens_filter = get_search_tokens_filter(global_search)
+            if tokens_filter is not None and self.db.data.find_one({'$and': filters + [tokens_filter]}, ['_id']) is not None:
+                filters.append(tokens_filter)
+                search_words = _split_search_words(global_search)
+            else:
+                # no name or identifier matches, so fall back to scanning the columns shown;
+                # the number of matches is bounded below
+                filters.append({
+                    '$or': [
+                        { str(allowed_column_name): {'$regex': '{}'.format(global_search), '$options': 'i'} }
+                        for allowed_column_name in allowed_column_names
+                    ]
                 })
-            filters.append({
-                '$or': global_filters
-            })
         for search_column in search_columns:
             filters.append({
                 search_column['column']: {'$regex': '{}'.format(search_column['value']), '$options': 'i'}
@@ -2106,30 +2272,57 @@ class TableView:
             })
         filter = {'$and': filters}
         
-        # run the query
-        results = list(self.db.data.find(filter))
-        all_results = self.db.data.find({'table_uuid': self.table.config['uuid']})
-        all_results = list(all_results)
-        
-        # sort if needed
-        if len(ordering_directives) > 0:
-            for ordering_directive in ordering_directives:
-                results = natsorted(results, key=lambda i: i[ordering_directive['column']] if ordering_directive['column'] in i.keys() else '', reverse=ordering_directive['reverse'], alg=ns.IGNORECASE)
+        # sort in the db, naturally and case-insensitively. Later ordering directives take
+        # precedence over earlier ones, and _id keeps the order of ties stable between pages.
+        sort = SON()
+        if search_words:
+            # rank rows by how many search words are whole name or identifier tokens
+            sort[_SEARCH_RELEVANCE_FIELD] = -1
+        for ordering_directive in reversed(ordering_directives):
+            if ordering_directive['column'] not in sort.keys():
+                sort[ordering_directive['column']] = ordering_directive['direction']
+        sort['_id'] = 1
+        pipeline = [
+            {'$match': filter}
+        ]
+        if search_words:
+            pipeline.append({'$addFields': {
+                _SEARCH_RELEVANCE_FIELD: {'$size': {'$setIntersection': [{'$ifNull': ['$' + SEARCH_TOKENS_FIELD, []]}, search_words]}}
+            }})
+        pipeline.append({'$sort': sort})
+        if global_search != '':
+            pipeline.append({'$limit': TABLE_SEARCH_RESULTS_LIMIT})
         
         # if just getting identifiers, return early
         if get_identifiers_only:
+            pipeline.append({'$project': {'sid': 1}})
+            results = self.db.data.aggregate(pipeline, allowDiskUse=True, collation=NATURAL_SORT_COLLATION)
             ret = [ r['sid'] for r in results ]
             return ret
         
         # paginate
+        if query_start > 0:
+            pipeline.append({'$skip': query_start})
         if query_length != -1:
-            results = results[query_start:query_start + query_length]
+            pipeline.append({'$limit': query_length})
+        
+        # only fetch the columns being shown
+        projection = {'sid': 1, 'email': 1, 'status': 1}
+        for select_column in select_columns.keys():
+            projection[select_column] = 1
+        pipeline.append({'$project': projection})
+        
+        # run the query
+        results = list(self.db.data.aggregate(pipeline, allowDiskUse=True, collation=NATURAL_SORT_COLLATION))
         
         # format the output
         ret = {}
         ret['draw'] = dt_input['draw']
-        ret['recordsTotal'] = len(all_results)
-        ret['recordsFiltered'] = self.db.data.find(filter).count()
+        ret['recordsTotal'] = _get_table_records_total(self.table.config['uuid'])
+        if global_search != '':
+            ret['recordsFiltered'] = self.db.data.count_documents(filter, limit=TABLE_SEARCH_RESULTS_LIMIT)
+        else:
+            ret['recordsFiltered'] = self.db.data.count_documents(filter)
         # format the row data
         results_all_keys = set().union(*(d.keys() for d in results))
         ret['data'] = []
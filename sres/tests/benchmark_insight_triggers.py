@@ -0,0 +1,101 @@
+"""
+    Times the evaluation of each insight trigger type over a synthetic cohort.
+
+    Run with python -m sres.tests.benchmark_insight_triggers [student_count] [column_count]
+"""
+import random
+import sys
+import time
+
+import pandas
+
+from sres.insights import get_triggered_identifiers
+
+_TRIGGER_CONFIGS = [
+    ('quartiles', {
+        'trigger_type': 'quartiles',
+        'trigger_config_quartiles_range': '1',
+        'trigger_config_quartiles_combiner': 'any'
+    }),
+    ('matching eq', {
+        'trigger_type': 'matching',
+        'trigger_config_matching_method': 'eq',
+        'trigger_config_matching_value': '5',
+        'trigger_config_matching_count': '2',
+        'trigger_config_matching_count_comparator': 'gt'
+    }),
+    ('matching like', {
+        'trigger_type': 'matching',
+        'trigger_config_matching_method': 'like',
+        'trigger_config_matching_value': 'abs',
+        'trigger_config_matching_count': '0',
+        'trigger_config_matching_count_comparator': 'gt'
+    }),
+    ('matching lt', {
+        'trigger_type': 'matching',
+        'trigger_config_matching_method': 'lt',
+        'trigger_config_matching_value': '3',
+        'trigger_config_matching_count': '2',
+        'trigger_config_matching_count_comparator': 'gt'
+    }),
+    ('matching isnull', {
+        'trigger_type': 'matching',
+        'trigger_config_matching_method': 'isnull',
+        'trigger_config_matching_value': '',
+        'trigger_config_matching_count': '3',
+        'trigger_config_matching_count_comparator': 'gt'
+    }),
+    ('matching regex', {
+        'trigger_type': 'matching',
+        'trigger_config_matching_method': 'regex',
+        'trigger_config_matching_value': '^ab[a-z]+',
+        'trigger_config_matching_count': '0',
+        'trigger_config_matching_count_comparator': 'gt'
+    }),
+    ('trending', {
+        'trigger_type': 'trending',
+        'trigger_config_trending_data_conversion': 'blankzero',
+        'trigger_config_trending_direction': 'down'
+    }),
+    ('distance_from_average', {
+        'trigger_type': 'distance_from_average',
+        'trigger_config_distance_value': '-2',
+        'trigger_config_distance_direction': 'lt',
+        'trigger_config_distance_combiner': 'any'
+    })
+]
+
+def _random_value():
+    r = random.random()
+    if r < 0.1:
+        return None
+    elif r < 0.15:
+        return 'absent'
+    else:
+        return str(random.randint(0, 10))
+
+def make_data(student_count, column_count):
+    """Builds a DataFrame shaped like the one run_insight builds from db.data."""
+    column_references = ['COL_{}'.format(n) for n in range(column_count)]
+    data = {}
+    for n in range(student_count):
+        row = {'identifier': str(100000000 + n)}
+        for column_reference in column_references:
+            row[column_reference] = _random_value()
+        data[row['identifier']] = row
+    return pandas.DataFrame.from_dict(data, orient='index'), column_references
+
+def run(student_count=10000, column_count=20, repeats=3):
+    random.seed(0)
+    df_data, column_references = make_data(student_count, column_count)
+    print('{} students x {} columns, best of {}'.format(student_count, column_count, repeats))
+    for name, trigger_config in _TRIGGER_CONFIGS:
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            identifiers = get_triggered_identifiers(df_data.copy(), column_references, trigger_config)
+            timings.append(time.perf_counter() - start)
+        print('{:<24}{:>10.1f} ms{:>10} triggered'.format(name, min(timings) * 1000, len(identifiers)))
+
+if __name__ == '__main__':
+    run(*[int(arg) for arg in sys.argv[1:3]])